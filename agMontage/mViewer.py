@@ -3,9 +3,12 @@
 #---------------------------------------------------------------------------------
 
 
-from threading import Thread
+from threading import Thread, Lock, RLock, Event, Condition, Semaphore, Timer, current_thread
+from multiprocessing.pool import ThreadPool
+from concurrent.futures import ThreadPoolExecutor
 
 import tornado.ioloop
+import tornado.gen
 import tornado.web
 import tornado.websocket
 import tornado.template
@@ -24,6 +27,28 @@ import hashlib
 import shlex
 import math
 import json
+import struct
+import collections
+import time
+import mimetypes
+
+# NumPy is optional; without it all the image processing
+# is left to the Montage executables.
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# So is PIL (Pillow); without it views are always sent as
+# mViewer's own PNG.
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+mimetypes.add_type("image/webp", ".webp")
 
 
 from pkg_resources import resource_filename
@@ -32,6 +57,24 @@ from pkg_resources import resource_filename
 # This file contains the main mViewer object and a few support objects:
 # 
 #    mvStruct       --  Parser for Montage executable module return structures
+#    mvMontageRunner -- Runs the Montage executables (bounded, timed)
+#    mvWCS          --  Minimal (TAN/SIN, equatorial) pixel to sky conversion
+#    mvImageInfo    --  Image metadata (size, WCS, units) cached per file
+#    mvFITS         --  Minimal FITS reader for in-process (memory-mapped)
+#                        cutouts and pick statistics
+#    mvPyramid      --  Power-of-two downsampled copies of a FITS image
+#    mvIntegral     --  Summed-area tables (fast region sums) for a FITS image
+#    mvMinMax       --  Block minimum/maximum tree (fast region extremes)
+#    mvSkyGrid      --  Equal-sized cells on the sky (cube faces)
+#    mvTable        --  Columnar binary (NumPy) copy of an IPAC table
+#    mvCatalogIndex --  Sky-cell index of a catalog table (rows in view)
+#    mvFootprintIndex -- Sky-cell index of image footprints (frames in view)
+#    mvMosaic       --  Virtual mosaic of the images in a metadata table
+#    mvSketch       --  Histogram of pixel values (quantiles, sigma)
+#    mvStretch      --  Pixel value distribution for resolving and
+#                        applying stretches in-process
+#    mvFileCache    --  LRU cache of rendered images (whole views 
+#                        and tiles)
 #    mvViewOverlay  --  Data structure for image overlays info
 #                        (grids, catalogs, etc.)
 #    mvViewFile     --  Data structure for FITS file display info
@@ -39,8 +82,14 @@ from pkg_resources import resource_filename
 #                       of the previous two objects)
 #    mvMainHandler  --  Event handler for Tornado web service toolkit 
 #                        (main index.html request)
+#    mvCommandQueue --  Queue of browser commands (per connection), run
+#                        in order with superseded views skipped
 #    mvWSHandler    --  Event handler for Tornado web service toolkit 
 #                        (support file requestss; e.g., JS files)
+#    mvTileHandler  --  Event handler for Tornado web service toolkit 
+#                        (tile image requests)
+#    mvColorTableHandler -- Event handler for Tornado web service toolkit
+#                        (color table requests, for browser-side stretching)
 #    mvThread       --  Extra thread for browser communications
 #    mViewer        --  Main object
 
@@ -86,7 +135,9 @@ from pkg_resources import resource_filename
 # All requests for changes to the view end up in the mViewer code, which
 # uses various Montage modules on the back end (mExamine, mSubimage,
 # mShrink, mViewer) to do the data management.  Currently, this is 
-# handled through subprocess.Popen() infrastructure, though the Montage
+# handled through subprocess.Popen() infrastructure (all of it going
+# through mvMontageRunner, which limits how many run at once, times
+# them and kills any that hang), though the Montage
 # Project is currently working on the Montage modules directly 
 # callable in Python.  Montage modules return a structure text response
 # and the final code here, mvStruct, is used to parse this and turn it
@@ -112,13 +163,15 @@ from pkg_resources import resource_filename
 #     mViewer +            +-> tornado.Application +-> mvMainHandler   <=>  [            ]
 #             |                                    |                        [  mViewer   ]
 #             |                                    +-> mvWSHandler     <=>  [ Javascript ]
+#             |                                    |                        [            ]
+#             |                                    +-> mvTileHandler   <=>  [            ]
 #             |                                                              ------------
 #             |
 #             |
 #             |
 #             |                            (Montage Applications)       
 #             |                              ------------------     
-#             +-> subprocess.Popen()  <=>   [                  ]
+#             +-> mvMontageRunner     <=>   [                  ]
 #             |                             [     mExamine     ]
 #             |                             [     mSubimage    ]
 #             |                             [     mShrink      ]
@@ -151,6 +204,11 @@ from pkg_resources import resource_filename
 #                      us connect messages generated in our Javascript code with our 
 #                      back-end Python processing.
 #
+#                      to_browser() can be called from any thread, so messages going
+#                      back to the browser are queued by mvWSHandler.send() and written 
+#                      from the web server thread, several to a frame (one per line), 
+#                      which the WebClient receive() splits up again.
+#
 #---------------------------------------------------------------------------------                                                                                 
                                                                                   
 #---------------------------------------------------------------------------------
@@ -249,2842 +307,8029 @@ class mvStruct(object):
 
 
 #---------------------------------------------------------------------------------
-# MVVIEWOVERLAY   Data holder class for overlay information.
+# MVMONTAGERUNNER  Runs the Montage programs.
+#
+# Every Montage command (mExamine, mSubimage, mShrink, mViewer, mGetHdr)
+# goes through here.  At most "workers" of them run at once (so a color
+# render, a prefetch and a screenful of tiles don't start dozens of 
+# processes together), output is collected with communicate() (so a
+# program writing a lot to stderr can't deadlock us), each is killed if
+# it runs longer than "timeout" seconds, and the time each program takes
+# is totalled up (see stats()).  The programs are looked for in "bin_dir"
+# if that is set, otherwise on the PATH (which is also how stand-in 
+# versions can be used for testing).
+#
+# The Montage programs are one-shot executables, so a process can't be
+# kept around and reused; limiting how many run together is what keeps
+# the load bounded.
 
-# These three classes here are pure data holders to provide 
-# structure for an mViewer display.   The main one (mvView) 
-# describes the whole display and contains an arbitrary number 
-# of mvViewOverlay objects for the overlays on the main image.
-# It also contains four mViewer.mvViewFile objects for the gray or 
-# red, green, blue file info.
+class mvMontageRunner(object):
 
-# We also need information on image/canvas sizes and cutout
-# offsets in order to map zoom regions and picks to original
-# image coordinates and to shrink/expand the displayed region
-# to fit the window.
+    def __init__(self, workers=8, timeout=300., bin_dir=""):
 
-class mvViewOverlay:
-    type         =  ""
-    visible      = True
-    coord_sys    =  ""
-    color        =  ""
-    data_file    =  ""
-    data_col     =  ""
-    data_ref     =  ""
-    data_type    =  ""
-    sym_size     =  ""
-    sym_type     =  ""
-    sym_sides    =  ""
-    sym_rotation =  ""
-    lon          =  ""
-    lat          =  ""
-    text         =  ""
- 
-        
-  # Standard object "string" representation
+        self.debug   = False
 
-    def __str__(self):
+        self.workers = workers
+        self.timeout = timeout
+        self.bin_dir = bin_dir
 
-        thisObj = dir(self)
+        self.slots   = Semaphore(workers)
+        self.lock    = Lock()
+        self.timing  = {}
 
-        string = ""
 
-        for item in thisObj:
+  # Run a command (a string, as it would be typed at the shell).
+  # "started" and "finished" are called with the process as it 
+  # starts and ends (for callers that want to be able to kill it)
+  # and "nice" lowers its priority.  Returns stdout and stderr.
 
-            val = getattr(self, item)
+    def run(self, command, timeout=None, started=None, finished=None, nice=0):
 
-            if item[0:2] == "__": 
-                continue
+        args = shlex.split(command)
 
-            if val == "": 
-                continue
+        program = args[0]
 
-            substr = "%40s" % (item)
+        if self.bin_dir:
+            args[0] = os.path.join(self.bin_dir, program)
 
-            if isinstance(val, str):
-                string += substr + ": '" + str(val) + "'\n"
-            else:
-                string += substr + ": " + str(val) + "\n"
+        if timeout is None:
+            timeout = self.timeout
 
-        return string
+        preexec = None
 
+        if nice and hasattr(os, 'nice'):
+            preexec = lambda: os.nice(nice)
 
-  # Standard object "representation" string
+        timed_out = []
 
-    def __repr__(self):
+        with self.slots:
 
-        thisObj = dir(self)
+            start = time.time()
 
-        string = "{"
+            p = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True, preexec_fn=preexec)
 
-        count = 0
+            if started is not None:
+                started(p)
 
-        for item in thisObj:
+            timer = None
 
-            val = getattr(self, item)
+            if timeout:
+                timer = Timer(timeout, self.kill, [p, timed_out])
+                timer.daemon = True
+                timer.start()
 
-            if item[0:2] == "__": 
-                continue
+            try:
+                stdout, stderr = p.communicate()
 
-            if val == "": 
-                continue
+            finally:
+                if timer is not None:
+                    timer.cancel()
+                    timer.join()
 
-            objType = val.__class__.__name__
+                if finished is not None:
+                    finished(p)
 
-            if count > 0:
-                string += ", "
+            elapsed = time.time() - start
 
+        with self.lock:
 
-            if objType == "bool":
+            count, total, longest = self.timing.get(program, (0, 0., 0.))
 
-                if val == True:
-                    string += '"' + item + '": true'
-                elif val == False:
-                    string += '"' + item + '": false'
+            self.timing[program] = (count + 1, total + elapsed, max(longest, elapsed))
 
-            else:
+        if self.debug:
+            print "DEBUG> " + program + ": " + str(round(elapsed, 3)) + " sec"
 
-                if isinstance(val, str):
-                    try:
-                        float(val)
-                        string += '"' + item + '": ' + str(val)
-                    except:
-                        string += '"' + item + '": "' + str(val) + '"'
-                else:
-                    string += '"' + item + '": ' + repr(val)
+        if timed_out:
+            raise Exception(program + " timed out after " + str(timeout) + " seconds.")
 
-            count += 1
+        return stdout, stderr
 
-        string += "}"
 
-        return string
+  # Run a command that reports back with a return structure: an
+  # exception if it writes anything to stderr, else the structure
 
-#---------------------------------------------------------------------------------
+    def call(self, command, timeout=None):
 
+        stdout, stderr = self.run(command, timeout)
 
-#---------------------------------------------------------------------------------
-# MVVIEWFILE  Data holder class for image file information.
+        if stderr:
+            raise Exception(stderr)
 
-class mvViewFile:
-    fits_file    = ""
-    color_table  = ""
-    stretch_min  = ""
-    stretch_max  = ""
-    stretch_mode = ""
-    min          = ""
-    max          = ""
-    data_min     = ""
-    data_max     = ""
-    min_sigma    = ""
-    max_sigma    = ""
-    min_percent  = ""
-    max_percent  = ""
-    # bunit        = ""
+        return mvStruct(shlex.split(command)[0], stdout.strip())
 
 
-  # Standard object "string" representation
+  # Timer callback for commands that take too long
 
-    def __str__(self):
+    def kill(self, p, timed_out):
 
-        thisObj = dir(self)
+        timed_out.append(True)
 
-        string = ""
+        try:
+            p.kill()
+        except OSError:
+            pass
 
-        for item in thisObj:
 
-            val = getattr(self, item)
+  # Count, total and longest time (in seconds) for each program
 
-            if item[0:2] == "__": 
-                continue
+    def stats(self):
 
-            if val == "": 
-                continue
+        with self.lock:
+            return dict((program, {"count": count, "total": round(total, 3), "longest": round(longest, 3)}) 
+                        for program, (count, total, longest) in self.timing.items())
 
-            substr = "%40s" % (item)
+#---------------------------------------------------------------------------------
 
-            string += substr + ": '" + str(val) + "'\n"
 
-        return string
+#---------------------------------------------------------------------------------
+# MVWCS  Minimal world coordinate system.
+#
+# Just enough of a WCS to give sky coordinates for pick statistics 
+# in-process, and to line images up in mosaic mode: the gnomonic (TAN)
+# and orthographic (SIN) projections, in equatorial coordinates, with 
+# the scale and rotation given either as CDELT/CROTA2, CDELT/PC or a 
+# CD matrix.  Anything else raises an
+# exception (and the caller goes back to mExamine, which uses the 
+# full Montage WCS library).
 
+class mvWCS(object):
 
-  # Standard object "representation" string
+    def __init__(self, wcs):
 
-    def __repr__(self):
+        ctype1 = str(wcs.get('CTYPE1', ""))
+        ctype2 = str(wcs.get('CTYPE2', ""))
 
-        thisObj = dir(self)
+        if ctype1[0:4] != 'RA--' or ctype2[0:4] != 'DEC-':
+            raise Exception("Unsupported coordinate system (" + ctype1 + ").")
 
-        string = "{"
+        self.proj = ctype1[5:8]
 
-        count = 0
+        if self.proj not in ['TAN', 'SIN'] or ctype2[5:8] != self.proj:
+            raise Exception("Unsupported projection (" + ctype1 + ").")
 
-        for item in thisObj:
+        if 'PV2_1' in wcs or 'PV2_2' in wcs:
+            raise Exception("Projection parameters not supported.")
 
-            val = getattr(self, item)
+        self.equinox = float(wcs.get('EQUINOX', wcs.get('EPOCH', 2000.)))
 
-            if item[0:2] == "__": 
-                continue
+        radesys = str(wcs.get('RADESYS', ""))
 
-            if val == "": 
-                continue
+        if radesys == 'FK4' or (radesys == "" and self.equinox < 1984.):
+            raise Exception("B1950 coordinates not supported.")
 
-            if count > 0:
-                string += ", "
+        self.csys = "EQUJ"
 
-            if isinstance(val, str):
-                try:
-                    float(val)
-                    string += '"' + item + '": ' + str(val)
-                except:
-                    string += '"' + item + '": "' + str(val) + '"'
-            else:
-                string += '"' + item + '": ' + repr(val)
+        self.crval1 = float(wcs['CRVAL1'])
+        self.crval2 = float(wcs['CRVAL2'])
+        self.crpix1 = float(wcs['CRPIX1'])
+        self.crpix2 = float(wcs['CRPIX2'])
 
-            count += 1
+        if 'CD1_1' in wcs:
 
-        string += "}"
+            cd11 = float(wcs.get('CD1_1', 0.))
+            cd12 = float(wcs.get('CD1_2', 0.))
+            cd21 = float(wcs.get('CD2_1', 0.))
+            cd22 = float(wcs.get('CD2_2', 1.))
 
-        return string
+            rot = math.atan2(-cd12, cd22)
 
-#---------------------------------------------------------------------------------
+            self.cdelt2 = math.hypot(cd12, cd22)
 
+            if abs(math.cos(rot)) > 0.5:
+                self.cdelt1 = cd11 / math.cos(rot)
+            else:
+                self.cdelt1 = cd21 / math.sin(rot)
 
-#---------------------------------------------------------------------------------
-# MVVIEW  Data holder class for the whole view.
-#
-# These are the quantities that we use to populate the update structure every 
-# time the image on the screen changes in any way.
+            self.crota2 = math.degrees(rot)
 
-class mvView:
+        else:
 
-  # Default values (to be overridden by actual image information)
+            cdelt1 = float(wcs['CDELT1'])
+            cdelt2 = float(wcs['CDELT2'])
 
-    image_file      = "viewer.png"
-    image_type      = "png"
-    disp_width      = "1000"
-    disp_height     = "1000"
-    image_width     = "1000"
-    image_height    = "1000"
+            if 'PC1_1' in wcs:
 
-    display_mode    = ""
+                pc11 = float(wcs.get('PC1_1', 1.))
+                pc12 = float(wcs.get('PC1_2', 0.))
+                pc21 = float(wcs.get('PC2_1', 0.))
+                pc22 = float(wcs.get('PC2_2', 1.))
 
-    cutout_x_offset = ""
-    cutout_y_offset = ""
-    canvas_height   = 1000
-    canvas_width    = 1000
-    xmin            = ""
-    ymin            = ""
-    xmax            = ""
-    ymax            = ""
-    factor          = ""
+                cd11, cd12, cd21, cd22 = cdelt1 * pc11, cdelt1 * pc12, cdelt2 * pc21, cdelt2 * pc22
 
-    currentPickX = 0
-    currentPickY = 0
+                self.crota2 = math.degrees(math.atan2(-cd12, cd22))
 
-    current_color           = "black"
+            else:
 
-    current_symbol_type     = "circle"
-    current_symbol_size     =  1.0
-    current_symbol_sides    =  ""
-    current_symbol_rotation =  ""
+                self.crota2 = float(wcs.get('CROTA2', 0.))
 
-    current_coord_sys       = "Equ J2000"
+                rot = math.radians(self.crota2)
 
-    gray_file  = mvViewFile()
-    red_file   = mvViewFile()
-    green_file = mvViewFile()
-    blue_file  = mvViewFile()
+                cd11 =  cdelt1 * math.cos(rot)
+                cd12 = -cdelt2 * math.sin(rot)
+                cd21 =  cdelt1 * math.sin(rot)
+                cd22 =  cdelt2 * math.cos(rot)
 
-    bunit = "DN"
+            self.cdelt1 = cdelt1
+            self.cdelt2 = cdelt2
 
-    overlay = []
+        self.cd = (cd11, cd12, cd21, cd22)
 
+        self.lonpole = math.radians(float(wcs.get('LONPOLE', 180.)))
 
-  # Standard object "string" representation
 
-    def __str__(self):
+  # Sky coordinates (RA, Dec in degrees) of (1-based) pixel 
+  # coordinates.  Works on scalars or NumPy arrays.
 
-        thisObj = dir(self)
+    def pix2sky(self, x, y):
 
-        string = "\n"
+        cd11, cd12, cd21, cd22 = self.cd
 
-        count = 0
+        dx = x - self.crpix1
+        dy = y - self.crpix2
 
-        for item in thisObj:
+        xi  = numpy.radians(cd11 * dx + cd12 * dy)
+        eta = numpy.radians(cd21 * dx + cd22 * dy)
 
-            val = getattr(self, item)
+        r   = numpy.hypot(xi, eta)
+        phi = numpy.arctan2(xi, -eta)
 
-            if item[0:2] == "__": 
-                continue
+        if self.proj == 'TAN':
+            theta = numpy.arctan2(1., r)
+        else:
+            theta = numpy.arccos(numpy.clip(r, 0., 1.))
 
-            if item == 'json_update':
-                continue
+        dec0 = math.radians(self.crval2)
 
-            if item == 'update_view':
-                continue
+        dphi = phi - self.lonpole
 
-            if val == "": 
-                continue
+        ra = math.radians(self.crval1) + numpy.arctan2(-numpy.cos(theta) * numpy.sin(dphi),
+                                                       numpy.sin(theta) * math.cos(dec0) - numpy.cos(theta) * math.sin(dec0) * numpy.cos(dphi))
 
-            substr = "%25s" % (item)
+        dec = numpy.arcsin(numpy.clip(numpy.sin(theta) * math.sin(dec0) + numpy.cos(theta) * math.cos(dec0) * numpy.cos(dphi), -1., 1.))
 
-            objType = val.__class__.__name__
+        return numpy.degrees(ra) % 360., numpy.degrees(dec)
 
-            if objType == 'str':
-                string += substr + ": '" + str(val) + "'\n"
 
-            elif objType == 'list':
+  # And back: (1-based) pixel coordinates of sky positions.  Points
+  # on the far side of the sky (for TAN) come out as NaN.
 
-                string += substr + ":\n"
+    def sky2pix(self, ra, dec):
 
-                count = 0
-                for ovly in val:
-                   label = "%38s %d:\n" % ("Overlay", count)
+        ra  = numpy.radians(numpy.asarray(ra,  dtype='f8'))
+        dec = numpy.radians(numpy.asarray(dec, dtype='f8'))
 
-                   string += label
-                   string += ovly.__str__() 
+        dec0 = math.radians(self.crval2)
+        dra  = ra - math.radians(self.crval1)
 
-                   count += 1
+        sin_theta = numpy.sin(dec) * math.sin(dec0) + numpy.cos(dec) * math.cos(dec0) * numpy.cos(dra)
 
-            elif objType == 'mvViewFile':
+        dphi = numpy.arctan2(-numpy.cos(dec) * numpy.sin(dra),
+                             numpy.sin(dec) * math.cos(dec0) - numpy.cos(dec) * math.sin(dec0) * numpy.cos(dra))
 
-                string += substr + ":\n"
+        phi = dphi + self.lonpole
 
-                string += val.__str__() 
+        cos_theta = numpy.sqrt(numpy.clip(1. - sin_theta**2, 0., 1.))
+
+        with numpy.errstate(invalid='ignore', divide='ignore'):
 
+            if self.proj == 'TAN':
+                r = numpy.where(sin_theta > 0., cos_theta / sin_theta, numpy.nan)
             else:
-                string += substr + ": " + str(val) + "\n"
+                r = numpy.where(sin_theta >= 0., cos_theta, numpy.nan)
 
-            count += 1
+        xi  = numpy.degrees( r * numpy.sin(phi))
+        eta = numpy.degrees(-r * numpy.cos(phi))
 
-        string += "\n"
+        cd11, cd12, cd21, cd22 = self.cd
 
-        return string
+        det = cd11 * cd22 - cd12 * cd21
 
+        x = self.crpix1 + ( cd22 * xi - cd12 * eta) / det
+        y = self.crpix2 + (-cd21 * xi + cd11 * eta) / det
 
-  # Standard object "representation" string
+        return x, y
 
-    def __repr__(self):
+#---------------------------------------------------------------------------------
 
-        thisObj = dir(self)
 
-        string = "{"
+#---------------------------------------------------------------------------------
+# MVIMAGEINFO  Image metadata: size, WCS and units.
+#
+# Every browser command needs the size of the image being displayed.
+# Rather than run mExamine each time, mViewer keeps one of these per file
+# (see mViewer.image_info()), refreshed only if the file changes.  Normally
+# it is an mvFITS object (reading the header directly); for files mvFITS
+# can't handle, it is filled in from a single mExamine call.
 
-        count = 0
+class mvImageInfo(object):
 
-        for item in thisObj:
+    wcs_keywords = ['CTYPE1', 'CTYPE2', 'CRVAL1', 'CRVAL2', 'CRPIX1', 'CRPIX2',
+                    'CDELT1', 'CDELT2', 'CROTA2', 'CD1_1',  'CD1_2',  'CD2_1',
+                    'CD2_2',  'PC1_1',  'PC1_2',  'PC2_1',  'PC2_2',  'PV2_1',
+                    'PV2_2',  'LONPOLE','LATPOLE','EQUINOX','EPOCH',  'RADESYS']
 
-            val = getattr(self, item)
+    def __init__(self, fits_file, naxis1, naxis2, bunit="", wcs=None):
 
+        self.fits_file = fits_file
+        self.naxis1    = int(naxis1)
+        self.naxis2    = int(naxis2)
+        self.bunit     = bunit
+        self.wcs       = wcs
 
-            if item[0:2] == "__": 
-                continue
+        if self.wcs is None:
+            self.wcs = {}
 
-            objType = val.__class__.__name__
 
-            if objType == "instancemethod":
-                continue
+  # Convert a view box (the same xmin/ymin/xmax/ymax values we would
+  # give mSubimage in pixel mode) to array index ranges clipped
+  # to the image
 
-            if objType == "builtin_function_or_method":
-                continue
+    def bounds(self, xmin, ymin, xmax, ymax):
 
-            if val == "": 
-                continue
+        xmin = int(float(xmin))
+        ymin = int(float(ymin))
+        xmax = int(float(xmax))
+        ymax = int(float(ymax))
 
-            if count > 0:
-                string += ", "
+        x0 = max(xmin - 1, 0)
+        y0 = max(ymin - 1, 0)
 
-            if isinstance(val, str):
-                try:
-                    float(val)
-                    string += '"' + item + '": ' + str(val)
-                except:
-                    string += '"' + item + '": "' + str(val) + '"'
-            else:
-                string += '"' + item + '": ' + repr(val)
+        x1 = min(x0 + xmax - xmin, self.naxis1)
+        y1 = min(y0 + ymax - ymin, self.naxis2)
 
-            count += 1
+        if x1 <= x0 or y1 <= y0:
+            raise Exception("Cutout region is off the image.")
 
-        string += "}"
+        return x0, y0, x1, y1
 
-        return string
+#---------------------------------------------------------------------------------
 
 
-  # Updates coming from Javascript will be in the form of a JSON string.  
-  # This method loads the view with the contents of such.
+#---------------------------------------------------------------------------------
+# MVFITS  Minimal FITS reader for doing cutouts in-process.
+#
+# mSubimage has to be forked for every zoom and pan and writes a complete
+# copy of the region to the workspace, which then has to be read back.
+# For the common case (a simple 2D image in the primary HDU) we can do
+# much better by memory-mapping the data and slicing out the region we
+# want as a NumPy view; nothing is read from disk until it is used.
+#
+# Anything this class does not understand (images in extensions,
+# compressed data, real cubes) raises an exception and the caller is
+# expected to fall back on the Montage executables.
 
-    def json_update(self, json_str):
+class mvFITS(mvImageInfo):
 
-        json_dict = json.loads(json_str)
+    block_size = 2880
 
-        self.update_view(json_dict, 0, None)
-        
+    dtypes = {   8: '>u1',
+                16: '>i2',
+                32: '>i4',
+                64: '>i8',
+               -32: '>f4',
+               -64: '>f8' }
 
-  # The above code turns the JSON string into a Python dictionary
-  # This routine recursively transfers the values in that dictionary
-  # to this mvView object.  We don't yet deal with the possibility
-  # of the JSON having different structure from the current object;
-  # that would complicate things considerably.  
-  #
-  # If needed in future iterations of the application, we will
-  # deal with updates (e.g. adding an overlay or switching between
-  # grayscale and color) via separate commands.
 
-    def update_view(self, parms, index, parents):
+  # Read and parse the primary header
 
-        if parents is None:
-           parents = []
- 
-        for key, val in parms.iteritems():
- 
-            newlist = list(parents)
- 
-            if len(newlist) > 0:
-                newlist.append(index)
- 
-            newlist.append(str(key))
- 
-            objType = val.__class__.__name__
- 
-            if objType == "float" or objType == "int" or objType == "str" or objType == "unicode" or objType == "bool":
- 
-                newlist.append(str(key))
- 
-                depth = len(newlist)
- 
-                depth = depth / 2
- 
-                element = self
- 
-                for i in range(0, depth-1):
- 
-                    name = newlist[2 * i]
-                    ind  = newlist[2 * i + 1]
- 
-                    element = getattr(element, name)
- 
-                    elementType = element.__class__.__name__
- 
-                    if elementType == "list":
-                        element = element[ind]
- 
-                if objType == "unicode":
-                    setattr(element, str(key), str(val))
-                else:
-                    setattr(element, str(key), val)
- 
-            elif objType == "list":
-                 count = 0
-                 for list_item in val:
-                   self.update_view(list_item, count, newlist)
-                   count = count + 1
- 
-            elif objType == "dict":
-                self.update_view(val, 0, newlist)
- 
-            else:
-                print "ERROR> Object in our dictionary?  Should not be possible."
+    def __init__(self, fits_file):
 
-#---------------------------------------------------------------------------------
+        self.fits_file = fits_file
+        self.cards     = []
+        self.header    = {}
 
+        nblock = 0
+        end    = False
 
-#---------------------------------------------------------------------------------
-# MVMAINHANDLER  Tornado support class for the index.html download.
+        fp = open(fits_file, 'rb')
 
-# This and the next object are used by Tornado as document type handlers 
-# for its web server functionality.  This one is for retrieving "index.html";
-# the next for processing commands sent from Javascript.  Our tornado instance
-# actually uses one more: a built-in method for simple file retrieval (which
-# we use to get a bunch of static files like Javascript libraries and banner
-# images to the browser.
+        try:
+            while not end:
 
-class mvMainHandler(tornado.web.RequestHandler):
+                block = fp.read(self.block_size)
 
-  # This object needs the workspace 
+                if len(block) < self.block_size:
+                    raise Exception("Truncated FITS header in " + fits_file)
 
-    def initialize(self, data):
+                nblock += 1
 
-        self.data      = data
-        self.workspace = self.data['workspace']
+                for i in range(0, self.block_size, 80):
 
+                    card    = block[i:i+80]
+                    keyword = card[0:8].strip()
 
-  # The initialization GET returns the index.html
-  # file we put in the workspace
+                    if keyword == 'END':
+                        end = True
+                        break
 
-    def get(self):
-    
-        loader = tornado.template.Loader(".")
+                    self.cards.append(card)
 
-        self.write(loader.load(self.workspace + "/index.html").generate())
+                    if card[8:10] == '= ':
+                        self.header[keyword] = self.parse_value(card[10:])
+        finally:
+            fp.close()
 
-#---------------------------------------------------------------------------------
+        self.data_offset = nblock * self.block_size
 
+        if self.header.get('SIMPLE') != True:
+            raise Exception(fits_file + " is not a simple FITS file.")
 
-#---------------------------------------------------------------------------------
-# MVWSHANDLER  Tornado support class for browser "processing" requests.
+        naxis = self.header.get('NAXIS', 0)
 
-class mvWSHandler(tornado.websocket.WebSocketHandler):
+        if naxis < 2:
+            raise Exception("No image in the primary HDU of " + fits_file)
 
-  # The methods of this tornado RequestHandler are
-  # predefined; we just fill in the functionality we
-  # need.  We make use of the intialization method
-  # to give the mViewer object a handle to this 
-  # webserver (which it needs for sending messages
-  # to the browser).
+        for i in range(3, naxis+1):
+            if self.header.get('NAXIS' + str(i), 1) != 1:
+                raise Exception(fits_file + " is a cube.")
 
-    def initialize(self, data):
+        self.bitpix = self.header.get('BITPIX')
 
-        self.debug = False
-        
-        self.data      = data;
-        self.viewer    = self.data['viewer']
-        self.view      = self.viewer.view
+        if self.bitpix not in self.dtypes:
+            raise Exception("Invalid BITPIX in " + fits_file)
 
-        self.viewer.webserver = self
+        self.naxis1 = self.header['NAXIS1']
+        self.naxis2 = self.header['NAXIS2']
 
+        self.bscale = float(self.header.get('BSCALE', 1.))
+        self.bzero  = float(self.header.get('BZERO',  0.))
+        self.blank  = self.header.get('BLANK')
 
-  # This is another "pre-defined" tornado method.
-  # If the browser sends a message that it is shutting
-  # down, we take the oppurtunity to delete the workspace
+        self.bunit  = self.header.get('BUNIT', "")
+        self.wcs    = {}
 
-    def open(self):
+        for keyword in self.wcs_keywords:
+            if keyword in self.header:
+                self.wcs[keyword] = self.header[keyword]
 
-        if self.debug:
-           print "mvWSHandler.open()"
 
-        self.write_message("mViewer python server connection accepted.")
-        self.write_message("")
+  # Header card values: strings (with '' as an escaped quote),
+  # logicals, integers and floats (possibly with a 'D' exponent)
 
+    def parse_value(self, text):
 
-  # This is where we process "commands" coming
-  # from the browser.  These are things like 
-  # resize, zoom and pick events.  All we do 
-  # in the webserver code is to pass them along
-  # to mViewer for processing.
+        text = text.strip()
 
-    def on_message(self, message):
+        if text[0:1] == "'":
 
-        if self.debug:
-           print "mvWSHandler.on_message('" + message + "')"
+            value = ""
 
-        self.viewer.from_browser(message);
+            i = 1
+            while i < len(text):
 
+                if text[i] == "'":
+                    if text[i+1:i+2] == "'":
+                        value += "'"
+                        i += 2
+                        continue
+                    break
 
-  # If the browser sends a message that it is shutting
-  # down, we take the oppurtunity to delete the workspace
+                value += text[i]
+                i += 1
 
-    def on_close(self):
+            return value.rstrip()
 
-        if self.debug:
-           print "mvWSHandler.open()"
+        text = text.split('/')[0].strip()
 
-        print '\nWeb connection closed by browser. Deleting workspace.'
+        if text == 'T':
+            return True
 
-        self.viewer.close()
+        if text == 'F':
+            return False
 
-        print 'Exiting.\n'
+        try:
+            return int(text)
+        except ValueError:
+            pass
 
-        os._exit(0)
+        try:
+            return float(text.replace('D', 'E'))
+        except ValueError:
+            return text
 
-#---------------------------------------------------------------------------------
 
+  # Build an 80-character header card
 
-#---------------------------------------------------------------------------------
-# MVTHREAD  Second thread, for running Tornado web server.
+    def make_card(self, keyword, value):
 
-# Since we want to have the web window containing mViewer open 
-# while still allowing interactive Python processing, we need 
-# to put the Tornado connection in a separate thread.
+        if isinstance(value, bool):
+            if value:
+                valstr = "%20s" % "T"
+            else:
+                valstr = "%20s" % "F"
 
-class mvThread(Thread):
- 
-    def __init__(self, port, workspace, viewer, view):
-        
-        Thread.__init__(self)
+        elif isinstance(value, (int, long)):
+            valstr = "%20d" % value
 
-        self.remote    = None
-        self.port      = port
-        self.workspace = workspace
-        self.view      = view
-        self.viewer    = viewer
+        elif isinstance(value, float):
+            valstr = "%20s" % repr(value).upper()
 
-        self.handler   = mvWSHandler
+        else:
+            valstr = "'%-8s'" % str(value).replace("'", "''")
 
-        self.debug = False
+        card = "%-8s= %s" % (keyword, valstr)
 
-        self.daemon = True    # If we make the thread a daemon, 
-                              # it closes when the process finishes.
- 
-    def run(self):
+        return card.ljust(80)[0:80]
 
-        if self.workspace is None:
-            print "Please set a workspace location first."
-            return
 
-        data = dict(view=self.view, viewer=self.viewer, port=self.port, workspace=self.workspace)
+  # Copy of the header cards with some values replaced.  Any axes
+  # beyond the second are dropped (they all have length one) and
+  # keywords not already in the header are added at the end.
+  # A value of None removes the keyword altogether.
 
-        application = tornado.web.Application([
-            (r'/ws',   mvWSHandler,                   dict(data=data)),
-            (r'/',     mvMainHandler,                 dict(data=data)),
-            (r"/(.*)", tornado.web.StaticFileHandler, {"path": self.workspace})
-        ])
+    def update_cards(self, values):
 
+        cards = []
+        found = {}
 
-      # Here we would populate the workspace and configure
-      # its specific index.html to use this specific port
+        for card in self.cards:
 
-        application.listen(self.port)
+            keyword = card[0:8].strip()
 
-        if self.debug:
-            print "DEBUG> mvThread: port = " + str(self.port)
+            if keyword[0:5] == 'NAXIS' and keyword[5:].isdigit() and int(keyword[5:]) > 2:
+                continue
 
-        if self.viewer.serverMode:
+            if keyword in values:
 
-            host = socket.getfqdn()
+                found[keyword] = True
 
-            print "Cut/paste the following into your browser: http://" + host + ":" + str(self.port)
+                if values[keyword] is None:
+                    continue
 
-        else:
+                card = self.make_card(keyword, values[keyword])
 
-            platform = sys.platform.lower()
+            cards.append(card)
 
-            browser = "firefox"
+        for keyword in values:
+            if keyword not in found and values[keyword] is not None:
+                cards.append(self.make_card(keyword, values[keyword]))
 
-            if platform == 'darwin':
-                browser = "safari"
-            elif platform.find("win") == 0: 
-                browser = "C:/Program\ Files\ (x86)/Mozilla\ Firefox/firefox.exe %s"
+        return cards
 
-            if self.debug:
-                print "DEBUG> mvThread: browser = [" + str(browser) + "]"
 
-            webbrowser.get(browser).open("localhost:" + str(self.port))
+  # Memory-mapped (read-only) image data, in the file's own
+  # big-endian type.  Note that NumPy arrays are indexed [y, x].
 
+    def data(self):
 
-        tornado.ioloop.IOLoop.instance().start()
+        return numpy.memmap(self.fits_file, dtype=self.dtypes[self.bitpix], mode='r',
+                            offset=self.data_offset, shape=(self.naxis2, self.naxis1))
 
-#---------------------------------------------------------------------------------
 
+  # The cutout itself is a zero-copy view of the memory-mapped data;
+  # the header is the original one with the size and reference pixel
+  # adjusted for the region.  If the caller is going to convert the
+  # data to some other type, the header can be given the new BITPIX
+  # (and loses any scaling keywords).
 
-#---------------------------------------------------------------------------------
-# MVIEWER  Main entry point.  We name the three "main" parts of the
-# system (this Python entry point, the Javascript main entry point,
-# and the back-end C image generation utility all "mViewer" to 
-# identify them as a set.
+    def cutout(self, xmin, ymin, xmax, ymax, bitpix=None):
 
-class mViewer():
+        x0, y0, x1, y1 = self.bounds(xmin, ymin, xmax, ymax)
 
-  # Initialization (mostly setting up the workspace)
+        values = { 'NAXIS' : 2,
+                   'NAXIS1': x1 - x0,
+                   'NAXIS2': y1 - y0 }
 
-    def __init__(self, *arg):
+        if bitpix is not None:
+            values['BITPIX'] = bitpix
+            values['BSCALE'] = None
+            values['BZERO']  = None
+            values['BLANK']  = None
 
-        self.debug = False
+        if 'CRPIX1' in self.header:
+            values['CRPIX1'] = float(self.header['CRPIX1']) - x0
 
-        self.serverMode = False
+        if 'CRPIX2' in self.header:
+            values['CRPIX2'] = float(self.header['CRPIX2']) - y0
 
-        nargs = len(arg)
+        return self.data()[y0:y1, x0:x1], self.update_cards(values)
 
-        if nargs == 0:
-            workspace = tempfile.mkdtemp(prefix="mvWork_", dir=".")
-        else:
-            workspace = arg[0]
 
-        workspace = workspace.replace("\\", "/")
+  # Physical (BSCALE/BZERO applied, blanks set to NaN) values
+  # for a block of raw data
 
-        try:
-            os.makedirs(workspace)
+    def physical(self, raw):
 
-        except OSError as exception:
+        data = numpy.array(raw, dtype='f8')
 
-            if exception.errno != errno.EEXIST:
-                raise
-                return
+        if self.blank is not None and self.bitpix > 0:
+            data[raw == self.blank] = numpy.nan
 
-        self.workspace = workspace
-        self.view      = mvView()
+        if self.bscale != 1. or self.bzero != 0.:
+            data = data * self.bscale + self.bzero
 
-        self.pick_callback = self.pick_location
+        return data
 
 
-  # Use the webserver connection to write commands
-  # to the Javascript in the browser.
+  # Statistics for a circular region (center and radius in pixels),
+  # as "mExamine -p" would give them and in the same form (an mvStruct
+  # with the same fields): the image geometry, the value at the center,
+  # the minimum and maximum (and where they are), and the average and
+  # RMS.  If there are indexes for the file (mvIntegral for the sums,
+  # mvMinMax for the extremes) they are used; otherwise the pixels in
+  # the box around the circle are read.
 
-    def to_browser(self, msg):
+    def region_stats(self, x, y, radius, integral=None, minmax=None):
 
-        if self.debug:
-            print "DEBUG> mViewer.to_browser('" + msg + "')"
+        wcs = mvWCS(self.wcs)
 
-        self.webserver.write_message(msg)
+        ix = int(math.floor(x + 0.5))
+        iy = int(math.floor(y + 0.5))
+        r  = int(radius)
 
+        if ix < 1 or iy < 1 or ix > self.naxis1 or iy > self.naxis2:
+            raise Exception("Location is off the image.")
 
-  # Shutdown (remove workspace and delete temporary files - subimages, etc.)
+        use_sums    = integral is not None and integral.ready()
+        use_extrema = minmax   is not None and minmax.ready()
 
-    def close(self):
+        if not use_sums or not use_extrema:
 
-        try:
-            files = os.listdir(self.workspace)
+            x0 = max(ix - r, 1)
+            y0 = max(iy - r, 1)
+            x1 = min(ix + r, self.naxis1)
+            y1 = min(iy + r, self.naxis2)
 
-            for file in files:
+            data = self.physical(self.data()[y0-1:y1, x0-1:x1])
 
-                if self.debug:
-                    print "Deleting " + self.workspace + "/" + file
+            xs = numpy.arange(x0, x1 + 1)
+            ys = numpy.arange(y0, y1 + 1)
 
-                os.remove(self.workspace + "/" + file)
-        except:
-            print "Workspace cleanup failed."
+            inside = ((xs[numpy.newaxis, :] - ix)**2 + (ys[:, numpy.newaxis] - iy)**2) <= r * r
+            valid  = inside & numpy.isfinite(data)
 
-        try:
-            os.rmdir(self.workspace)
-        except:
-            print "Workspace directory ('" + self.workspace + "') delete failed"
+            values = data[valid]
 
-        try:
-            self.command("close")
+            npixel = int(values.size)
+            nnull  = int(inside.sum()) - npixel
 
-            print "Browser connection closed."
+        if use_sums:
+            npixel, nnull, aveflux, rmsflux = integral.circle_stats(ix, iy, r)
 
-        except:
-            print "No active browser connection."
+        elif npixel > 0:
+            aveflux = float(values.mean())
+            rmsflux = float(values.std())
 
-        # Failure or incomplete execution of a close may result in 
-        # extraneous temporary files in the work directory, which
-        # must be removed manually.
+        else:
+            aveflux = 0.
+            rmsflux = 0.
 
+        if use_extrema:
+            extrema = minmax.circle_extrema(self, ix, iy, r)
 
-  # Utility function: set the display mode (grayscale / color)
+        elif npixel > 0:
+            jmin, imin = numpy.unravel_index(numpy.where(valid, data,  numpy.inf).argmin(), data.shape)
+            jmax, imax = numpy.unravel_index(numpy.where(valid, data, -numpy.inf).argmax(), data.shape)
 
-    def set_display_mode(self, mode):
+            extrema = (x0 + imin, y0 + jmin), (x0 + imax, y0 + jmax)
 
-        mode = str(mode)
+        else:
+            extrema = None
 
-        if len(mode) == 0:
-           mode = "grayscale"
+        def sigma(value):
+            if rmsflux > 0.:
+                return (value - aveflux) / rmsflux
+            return 0.
 
-        if mode[0] == 'g':
-            self.view.display_mode = "grayscale"
+        def flux(value):
+            if math.isnan(value):
+                return 0.
+            return float(value)
 
-        if mode[0] == 'G':
-            self.view.display_mode = "grayscale"
+        points = [('ref', ix, iy)]
 
-        if mode[0] == 'b':
-            self.view.display_mode = "grayscale"
+        if extrema is not None:
+            points.append(('min', ) + extrema[0])
+            points.append(('max', ) + extrema[1])
+        else:
+            points.append(('min', ix, iy))
+            points.append(('max', ix, iy))
 
-        if mode[0] == 'B':
-            self.view.display_mode = "grayscale"
+        retval = mvStruct("mExamine", '[struct stat="OK"]')
 
-        if mode[0] == 'r':
-            self.view.display_mode = "color"
+        retval.proj    = wcs.proj
+        retval.csys    = wcs.csys
+        retval.equinox = wcs.equinox
+        retval.naxis   = 2
+        retval.naxis1  = self.naxis1
+        retval.naxis2  = self.naxis2
+        retval.crval1  = wcs.crval1
+        retval.crval2  = wcs.crval2
+        retval.crpix1  = wcs.crpix1
+        retval.crpix2  = wcs.crpix2
+        retval.cdelt1  = wcs.cdelt1
+        retval.cdelt2  = wcs.cdelt2
+        retval.crota2  = wcs.crota2
 
-        if mode[0] == 'R':
-            self.view.display_mode = "color"
+        xc = (self.naxis1 + 1) / 2.
+        yc = (self.naxis2 + 1) / 2.
 
-        if mode[0] == 'c':
-            self.view.display_mode = "color"
+        rac, decc = wcs.pix2sky(xc, yc)
 
-        if mode[0] == 'C':
-            self.view.display_mode = "color"
+        retval.lonc = retval.rac  = float(rac)
+        retval.latc = retval.decc = float(decc)
 
-        if mode[0] == 'f':
-            self.view.display_mode = "color"
+        retval.ximgsize = abs(wcs.cdelt1) * self.naxis1
+        retval.yimgsize = abs(wcs.cdelt2) * self.naxis2
 
-        if mode[0] == 'F':
-            self.view.display_mode = "color"
+        ran, decn = wcs.pix2sky(xc, yc + 1.)
 
+        retval.rotequ = math.degrees(math.atan2(-(ran - rac) * math.cos(math.radians(decc)), decn - decc))
 
-  # Utility function: set the gray_file
+        corners = [(0.5, 0.5), (self.naxis1 + 0.5, 0.5), (self.naxis1 + 0.5, self.naxis2 + 0.5), (0.5, self.naxis2 + 0.5)]
 
-    def set_gray_file(self, gray_file):
+        for i in range(len(corners)):
+            ra, dec = wcs.pix2sky(corners[i][0], corners[i][1])
+            setattr(retval, 'ra'  + str(i+1), float(ra))
+            setattr(retval, 'dec' + str(i+1), float(dec))
 
-        self.view.gray_file.fits_file = gray_file
+        retval.radius  = abs(wcs.cdelt2) * r
+        retval.radpix  = r
+        retval.npixel  = npixel
+        retval.nnull   = nnull
+        retval.aveflux = aveflux
+        retval.rmsflux = rmsflux
 
-        if self.view.display_mode == "":
-            self.view.display_mode = "grayscale"
+        for name, px, py in points:
 
+            value = self.physical(self.data()[py-1:py, px-1:px])[0, 0]
 
-  # Utility function: set the blue_file
+            ra, dec = wcs.pix2sky(px, py)
 
-    def set_blue_file(self, blue_file):
+            setattr(retval, 'flux'  + name, flux(value))
+            setattr(retval, 'sigma' + name, flux(sigma(value)))
+            setattr(retval, 'x'     + name, int(px))
+            setattr(retval, 'y'     + name, int(py))
+            setattr(retval, 'ra'    + name, float(ra))
+            setattr(retval, 'dec'   + name, float(dec))
 
-        self.view.blue_file.fits_file = blue_file
+        return retval
 
-        if self.view.display_mode == "":
-            if self.view.red_file.fits_file != "" and self.view.green_file.fits_file != "":
-                self.view.display_mode = "color"
 
+  # Fused cutout and downsample.  Rather than cutting out the full
+  # resolution region and shrinking it afterwards, we go straight from
+  # the file to an (ny, nx) float32 image, reading the region a band of
+  # rows at a time.  The memory used is bounded by the output size (plus
+  # one band), not the cutout size.  With stream=True, the output bands
+  # are returned as a generator instead (for writing images too big to
+  # hold in memory; see write()).
+  #
+  # Output pixels are either the average of the (non-null) source
+  # pixels they cover ("average") or the single source pixel at
+  # their center ("sample", which touches far fewer pixels).  If
+  # nx/ny are larger than the region, pixels are replicated.
+  # The header has the reference pixel and scale adjusted.
 
-  # Utility function: set the green_file
+    def downsample(self, xmin, ymin, xmax, ymax, nx, ny, method="average", stream=False):
 
-    def set_green_file(self, green_file):
+        x0, y0, x1, y1 = self.bounds(xmin, ymin, xmax, ymax)
 
-        self.view.green_file.fits_file = green_file
+        bands = self.downsample_bands(x0, y0, x1, y1, nx, ny, method)
 
-        if self.view.display_mode == "":
-            if self.view.red_file.fits_file != "" and self.view.blue_file.fits_file != "":
-                self.view.display_mode = "color"
+        if stream:
+            return bands, self.downsample_cards(x0, y0, x1, y1, nx, ny)
 
+        return numpy.concatenate(list(bands)), self.downsample_cards(x0, y0, x1, y1, nx, ny)
 
-  # Utility function: set the red_file
 
-    def set_red_file(self, red_file):
+  # The header for downsample(), given the region as array index 
+  # ranges.  This is also the geometry (and WCS) of the display.
 
-        self.view.red_file.fits_file = red_file
+    def downsample_cards(self, x0, y0, x1, y1, nx, ny):
 
-        if self.view.display_mode == "":
-            if self.view.green_file.fits_file != "" and self.view.blue_file.fits_file != "":
-                self.view.display_mode = "color"
+        fx = float(x1 - x0) / nx
+        fy = float(y1 - y0) / ny
 
+        values = { 'NAXIS' : 2,
+                   'NAXIS1': nx,
+                   'NAXIS2': ny,
+                   'BITPIX': -32,
+                   'BSCALE': None,
+                   'BZERO' : None,
+                   'BLANK' : None }
 
-  # Utility function: set the current_color
+        if 'CRPIX1' in self.header:
+            values['CRPIX1'] = (float(self.header['CRPIX1']) - x0 - 0.5) / fx + 0.5
 
-    def set_current_color(self, current_color):
+        if 'CRPIX2' in self.header:
+            values['CRPIX2'] = (float(self.header['CRPIX2']) - y0 - 0.5) / fy + 0.5
 
-        self.view.current_color = current_color
+        for keyword, scale in [('CDELT1', fx), ('CD1_1', fx), ('CD2_1', fx),
+                               ('CDELT2', fy), ('CD1_2', fy), ('CD2_2', fy)]:
+            if keyword in self.header:
+                values[keyword] = float(self.header[keyword]) * scale
 
+        return self.update_cards(values)
 
-  # Utility function: set the currentSymbol
 
-    def set_current_symbol(self, *arg):
-    
-        nargs = len(arg)
+  # The band-by-band worker for downsample()
 
-        symbol_sides    = ""
-        symbol_rotation = ""
+    def downsample_bands(self, x0, y0, x1, y1, nx, ny, method):
 
-        symbol_size     = arg[0]
-        symbol_type     = arg[1]
+        width  = x1 - x0
+        height = y1 - y0
 
-        if nargs > 2:
-            symbol_sides = arg[2]
+        fy = float(height) / ny
 
-        if nargs > 3:
-            symbol_rotation = arg[3]
+        data = self.data()
 
-        self.view.current_symbol_size     = symbol_size
-        self.view.current_symbol_type     = symbol_type
-        self.view.current_symbol_sides    = symbol_sides
-        self.view.current_symbol_rotation = symbol_rotation
+        if method == "sample":
 
+            xc = x0 + (2 * numpy.arange(nx) + 1) * width  // (2 * nx)
+            yc = y0 + (2 * numpy.arange(ny) + 1) * height // (2 * ny)
 
-  # Utility function: set the coord_sys
+            band = max(1, 4194304 // nx)
 
-    def set_current_coord_sys(self, coord_sys):
+            for j in range(0, ny, band):
+                rows = yc[j:j+band]
+                yield self.physical(data[rows[:, None], xc[None, :]]).astype('f4')
 
-        self.view.current_coord_sys = coord_sys
+        else:
 
+            xstart = numpy.arange(nx) * width  // nx
+            ystart = numpy.arange(ny) * height // ny
 
-  # Utility function: set the color table (grayscale file)
+            band = max(1, int(4194304 / (width * max(fy, 1.))))
 
-    def set_color_table(self, color_table):
+            for j in range(0, ny, band):
 
-        self.view.gray_file.color_table = color_table
+                r0 = ystart[j]
 
+                if j + band < ny:
+                    r1 = ystart[j+band]
+                else:
+                    r1 = height
 
-  # Utility function: set the grayscale color stretch
+                r1 = max(r1, ystart[min(j+band, ny)-1] + 1)
 
-    def set_gray_stretch(self, stretch_min, stretch_max, stretch_mode):
+                block = self.physical(data[y0+r0:y0+r1, x0:x1])
+                valid = numpy.isfinite(block)
 
-        self.view.gray_file.stretch_min  = stretch_min
-        self.view.gray_file.stretch_max  = stretch_max
-        self.view.gray_file.stretch_mode = stretch_mode
+                block[~valid] = 0.
 
+                rows = ystart[j:j+band] - r0
 
-  # Utility function: set the blue color stretch
+                sums   = numpy.add.reduceat(numpy.add.reduceat(block, xstart, axis=1), rows, axis=0)
+                counts = numpy.add.reduceat(numpy.add.reduceat(valid.astype('f8'), xstart, axis=1), rows, axis=0)
 
-    def set_blue_stretch(self, stretch_min, stretch_max, stretch_mode):
+                with numpy.errstate(invalid='ignore', divide='ignore'):
+                    yield (sums / counts).astype('f4')
 
-        self.view.blue_file.stretch_min  = stretch_min
-        self.view.blue_file.stretch_max  = stretch_max
-        self.view.blue_file.stretch_mode = stretch_mode
 
+  # Write an image and header to a new FITS file.  The data is written
+  # a band of rows at a time so a memory-mapped view never has to be
+  # pulled into memory all at once.  The data can also be given as a
+  # sequence of row bands (as from downsample(..., stream=True)).
 
-  # Utility function: set the green color stretch
+    def write(self, out_file, data, cards):
 
-    def set_green_stretch(self, stretch_min, stretch_max, stretch_mode):
+        header = "".join(cards) + "END".ljust(80)
 
-        self.view.green_file.stretch_min  = stretch_min
-        self.view.green_file.stretch_max  = stretch_max
-        self.view.green_file.stretch_mode = stretch_mode
+        nfill  = -len(header) % self.block_size
 
+        dtype  = self.dtypes[self.bitpix]
 
-  # Utility function: set the red color stretch
+        for card in cards:
+            if card[0:8].strip() == 'BITPIX':
+                dtype = self.dtypes[self.parse_value(card[10:])]
 
-    def set_red_stretch(self, stretch_min, stretch_max, stretch_mode):
+        fp = open(out_file, 'wb')
 
-        self.view.red_file.stretch_min  = stretch_min
-        self.view.red_file.stretch_max  = stretch_max
-        self.view.red_file.stretch_mode = stretch_mode
+        try:
+            fp.write(header + " " * nfill)
 
+            if isinstance(data, numpy.ndarray):
+                band  = max(1, 4194304 // max(1, data.shape[1]))
+                bands = (data[row:row+band] for row in range(0, data.shape[0], band))
+            else:
+                bands = data
 
-  # Utility function: add a grid overlay
+            nbyte = 0
 
-    def add_grid(self, coord_sys):
+            for chunk in bands:
+                chunk = numpy.ascontiguousarray(chunk, dtype=dtype)
+                fp.write(chunk.tostring())
+                nbyte += chunk.nbytes
 
-        ovly = mvViewOverlay()
+            fp.write("\0" * (-nbyte % self.block_size))
+        finally:
+            fp.close()
 
-        ovly.type     = "grid"
-        ovly.visible  =  True
-        ovly.color    =  self.view.current_color
-        ovly.coord_sys =  coord_sys
+#---------------------------------------------------------------------------------
 
-        self.view.overlay.append(ovly)
 
-        return ovly
+#---------------------------------------------------------------------------------
+# MVPYRAMID  Multi-resolution (power-of-two) copies of a FITS image.
+#
+# Zoomed-out views of a big image need only a small fraction of its
+# pixels, but getting them from the full-resolution data means reading
+# all of them.  So, once per file, we build a pyramid of 2x2 block
+# averaged levels (level N is 2^N times coarser than the original) and
+# render each view from the coarsest level that still has at least as
+# much resolution as the canvas.  Rendering cost then depends on the
+# canvas size rather than the image size.
+#
+# Levels are built in a background thread, each from the one before
+# it, and are written under a temporary name and renamed when complete.
+# A partly-built pyramid is therefore still usable (we just pick from
+# the levels that exist) and an interrupted build picks up where it left
+# off.  The cache directory is keyed by the file's path, size and
+# modification time so a changed file gets a new pyramid.
 
+class mvPyramid(object):
 
-  # Utility function: add a catalog overlay
+    def __init__(self, fits_file, cache_dir, min_size=256):
 
-    def add_catalog(self, data_file, data_col, data_ref, data_type):
+        self.fits_file = fits_file
+        self.min_size  = min_size
+        self.thread    = None
+        self.error     = ""
 
-        ovly = mvViewOverlay()
+        fits = mvFITS(fits_file)
 
-        ovly.type         = "catalog"
-        ovly.visible      =  True
-        ovly.sym_size     =  self.view.current_symbol_size
-        ovly.sym_type     =  self.view.current_symbol_type
-        ovly.sym_sides    =  self.view.current_symbol_sides
-        ovly.sym_rotation =  self.view.current_symbol_rotation
-        ovly.coord_sys    =  self.view.current_coord_sys
-        ovly.data_file    =  data_file
-        ovly.data_col     =  data_col
-        ovly.data_ref     =  data_ref
-        ovly.data_type    =  data_type 
-        ovly.color        =  self.view.current_color
+        self.naxis1 = fits.naxis1
+        self.naxis2 = fits.naxis2
 
-        self.view.overlay.append(ovly)
+        self.directory = cache_dir + "/" + self.file_key()
 
-        return ovly
+        self.nlevel = 0
 
+        size = max(self.naxis1, self.naxis2)
 
-  # Utility function: add an imginfo overlay
+        while (size >> (self.nlevel + 1)) >= min_size:
+            self.nlevel += 1
 
-    def add_img_info(self, data_file):
 
-        ovly = mvViewOverlay()
+  # Cache key for the current state of the file
 
-        ovly.type      = "imginfo"
-        ovly.visible   = True
-        ovly.data_file = data_file
-        ovly.color     = self.view.current_color
-        ovly.coord_sys = self.view.current_coord_sys
+    def file_key(self):
 
-        self.view.overlay.append(ovly)
+        info = os.stat(self.fits_file)
 
-        return ovly
+        key = os.path.abspath(self.fits_file) + ":" + str(info.st_size) + ":" + str(info.st_mtime)
 
+        return hashlib.md5(key).hexdigest()
 
-  # Utility function: add a marker overlay
 
-    def add_marker(self, lon, lat):
+  # Has the file changed since the pyramid was set up?
 
-        ovly = mvViewOverlay()
+    def current(self):
 
-        ovly.type         = "mark"
-        ovly.visible      =  True
-        ovly.sym_size     =  self.view.current_symbol_size
-        ovly.sym_type     =  self.view.current_symbol_type
-        ovly.sym_sides    =  self.view.current_symbol_sides
-        ovly.sym_rotation =  self.view.current_symbol_rotation
-        ovly.lon          =  lon
-        ovly.lat          =  lat
-        ovly.coord_sys    =  self.view.current_coord_sys
-        ovly.color        =  self.view.current_color
+        return os.path.basename(self.directory) == self.file_key()
 
-        self.view.overlay.append(ovly)
 
-        return ovly
+  # File for a given level (level zero is the original image)
 
+    def level_file(self, level):
 
-  # Utility function: add a label overlay
+        if level == 0:
+            return self.fits_file
 
-    def add_label(self, lon, lat, text):
+        return self.directory + "/level" + str(level) + ".fits"
 
-        ovly = mvViewOverlay()
 
-        ovly.type      = "label"
-        ovly.visible   =  True
-        ovly.lon       =  lon
-        ovly.lat       =  lat
-        ovly.text      =  text
-        ovly.coord_sys =  self.view.current_coord_sys
-        ovly.color     =  self.view.current_color
+  # Levels that are ready to use
 
-        self.view.overlay.append(ovly)
+    def levels(self):
 
-        return ovly
+        levels = [0]
 
+        for level in range(1, self.nlevel+1):
+            if os.path.exists(self.level_file(level)):
+                levels.append(level)
 
-  # This utility function is used by load_JSON() below
-  # to convert any unicode to simple printable ASCII
+        return levels
 
-    def fix_unicode(self, input):
-        if isinstance(input, unicode):
-            return input.encode('ascii')
-        else:
-            return input
 
+  # The coarsest available level whose pixels are no bigger than
+  # the output pixels for a given shrink factor
 
-  # Load the view object with data described in a JSON file
+    def choose(self, factor):
 
-    def load_JSON(self, json_file):
+        best = 0
 
-        # Open the JSON file and parse the contents
+        for level in self.levels():
+            if 2**level <= factor:
+                best = level
 
-        try:
+        return best
 
-            fp = open(json_file, 'r')
 
-            json_data = json.load(fp)
+  # Convert a full-resolution region (array index ranges, as from 
+  # mvFITS.bounds()) to a box at a given level, in the same form as 
+  # the view box (xmin, ymin, xmax, ymax)
 
-        except:
-            print "JSON file open failed."
-            os._exit(0)
+    def level_box(self, level, x0, y0, x1, y1):
 
-            return
+        scale = 2**level
 
-        # Loop over the contents, loading them into the view object
-        # This is going to add to the existing view (replace in the
-        # case of image parmeters), so the user should zero the view
-        # out if they want a clean start.
+        lx0 = x0 // scale
+        ly0 = y0 // scale
+        lx1 = -(-x1 // scale)
+        ly1 = -(-y1 // scale)
 
-        # First check and see if we want modify the image parameters
+        return lx0 + 1, ly0 + 1, lx1 + 1, ly1 + 1
 
-        if "image" in json_data:
-            
-            image = json_data["image"]
 
-            if "type" in image:
+  # Build any missing levels
 
-                image_type = image["type"]
+    def build(self):
 
+        try:
+            os.makedirs(self.directory)
 
-                # Grayscale image parameters
+        except OSError as exception:
 
-                if image_type == "grayscale":
+            if exception.errno != errno.EEXIST:
+                raise
 
-                    if "gray" in image:
+        for level in range(1, self.nlevel+1):
 
-                        gray = image["gray"]
+            out_file = self.level_file(level)
 
-                        if "file" in gray:
-                            file_name = self.fix_unicode(gray["file"])
-                        else:
-                            print "Required grayscale filename missing."
+            if os.path.exists(out_file):
+                continue
 
-                        color_table = 0
-                        if "color_table" in gray:
-                            color_table = self.fix_unicode(gray["color_table"])
+            fits = mvFITS(self.level_file(level-1))
 
-                        min_value = "-2s"
-                        if "min" in gray:
-                            min_value = self.fix_unicode(gray["min"])
+            nx = fits.naxis1 // 2
+            ny = fits.naxis2 // 2
 
-                        max_value = "max"
-                        if "max" in gray:
-                            max_value = self.fix_unicode(gray["max"])
+            bands, cards = fits.downsample(1, 1, 2*nx + 1, 2*ny + 1, nx, ny, "average", stream=True)
 
-                        mode = "gaussian-log"
-                        if "mode" in gray:
-                            mode = self.fix_unicode(gray["mode"])
+            fits.write(out_file + ".part", bands, cards)
 
-                        self.set_gray_file(file_name)
-                        self.set_color_table(color_table)
-                        self.set_gray_stretch(min_value, max_value, mode)
+            os.rename(out_file + ".part", out_file)
 
-                    else:
-                        print "Grayscale image information missing."
-                        return
 
+    def run_build(self):
 
-                # Color image parameters
+        try:
+            self.build()
 
-                elif image_type == "color":
+        except Exception as e:
+            self.error = str(e)
 
-                    # BLUE
 
-                    if "blue" in image:
+  # Start a background build (if one isn't already running)
 
-                        blue = image["blue"]
+    def build_in_background(self):
 
-                        if "file" in blue:
-                            file_name = self.fix_unicode(blue["file"])
-                        else:
-                            print "Required blue filename missing."
+        if self.thread is not None and self.thread.is_alive():
+            return
 
-                        min_value = "-2s"
-                        if "min" in blue:
-                            min_value = self.fix_unicode(blue["min"])
+        if len(self.levels()) > self.nlevel:
+            return
 
-                        max_value = "max"
-                        if "max" in blue:
-                            max_value = self.fix_unicode(blue["max"])
+        self.thread = Thread(target=self.run_build)
+        self.thread.daemon = True
+        self.thread.start()
 
-                        mode = "gaussian-log"
-                        if "mode" in blue:
-                            mode = self.fix_unicode(blue["mode"])
+#---------------------------------------------------------------------------------
 
-                        self.set_blue_file(file_name)
-                        self.set_blue_stretch(min_value, max_value, mode)
 
-                    else:
-                        print "Blue image information missing."
-                        return
+#---------------------------------------------------------------------------------
+# MVINTEGRAL  Summed-area tables for a FITS image.
+#
+# The pick statistics add up every pixel in the aperture, so the cost
+# grows with its area.  Once per file we build "integral images" of the
+# pixel count (non-null pixels), sum and sum of squares: element [j, i]
+# of each is the total over all pixels below and left of (i, j).  The
+# total over any box is then four lookups, and over a circle two per
+# row.  The tables are float64, memory-mapped from a single file in the
+# same (per-file) cache directory as the pyramid, built in the 
+# background and written under a temporary name until they are done.
 
+class mvIntegral(object):
 
-                    # GREEN
+    def __init__(self, pyramid):
 
-                    if "green" in image:
+        self.pyramid   = pyramid
+        self.fits_file = pyramid.fits_file
+        self.directory = pyramid.directory
+        self.file_name = self.directory + "/integral.f8"
+        self.naxis1    = pyramid.naxis1
+        self.naxis2    = pyramid.naxis2
+        self.thread    = None
+        self.error     = ""
 
-                        green = image["green"]
+        self.tables = None
 
-                        if "file" in green:
-                            file_name = self.fix_unicode(green["file"])
-                        else:
-                            print "Required green filename missing."
 
-                        min_value = "-2s"
-                        if "min" in green:
-                            min_value = self.fix_unicode(green["min"])
+  # Has the file changed since the index was set up?
 
-                        max_value = "max"
-                        if "max" in green:
-                            max_value = self.fix_unicode(green["max"])
+    def current(self):
 
-                        mode = "gaussian-log"
-                        if "mode" in green:
-                            mode = self.fix_unicode(green["mode"])
+        return self.pyramid.current()
 
-                        self.set_green_file(file_name)
-                        self.set_green_stretch(min_value, max_value, mode)
 
-                    else:
-                        print "Green image information missing."
-                        return
+  # Is the index there to use?
 
+    def ready(self):
 
-                    # RED  
+        return os.path.exists(self.file_name)
 
-                    if "red" in image:
 
-                        red = image["red"]
+  # The (count, sum, sum of squares) tables
 
-                        if "file" in red:
-                            file_name = self.fix_unicode(red["file"])
-                        else:
-                            print "Required red filename missing."
+    def data(self):
 
-                        min_value = "-2s"
-                        if "min" in red:
-                            min_value = self.fix_unicode(red["min"])
+        if self.tables is None:
+            self.tables = numpy.memmap(self.file_name, dtype='f8', mode='r', 
+                                       shape=(3, self.naxis2 + 1, self.naxis1 + 1))
 
-                        max_value = "max"
-                        if "max" in red:
-                            max_value = self.fix_unicode(red["max"])
+        return self.tables
 
-                        mode = "gaussian-log"
-                        if "mode" in red:
-                            mode = self.fix_unicode(red["mode"])
 
-                        self.set_red_file(file_name)
-                        self.set_red_stretch(min_value, max_value, mode)
+  # Count, sum and sum of squares over a box of array 
+  # index ranges ([y0:y1, x0:x1] in NumPy terms)
 
-                    else:
-                        print "Red image information missing."
-                        return
+    def sums(self, x0, y0, x1, y1):
 
+        t = self.data()
 
-                else:
-                    print "Invalid image type: " + image_type
-                    return
+        return t[:, y1, x1] - t[:, y0, x1] - t[:, y1, x0] + t[:, y0, x0]
 
 
-        # Now loop over any overlay specifications, adding them
+  # Count, mean and RMS over a box (1-based, inclusive pixel ranges)
 
-        if "overlays" in json_data:
+    def box_stats(self, xmin, ymin, xmax, ymax):
 
-            overlays = json_data["overlays"]
+        x0 = max(int(xmin) - 1, 0)
+        y0 = max(int(ymin) - 1, 0)
+        x1 = min(int(xmax), self.naxis1)
+        y1 = min(int(ymax), self.naxis2)
 
-            noverlay = 0
+        return self.moments(self.sums(x0, y0, x1, y1))
 
-            for overlay in overlays:
 
-                noverlay = noverlay + 1
+  # Count, null count, mean and RMS over a circle (center and radius
+  # in pixels; the same pixels as mvFITS.region_stats() uses)
 
-                if "type" in overlay:
-                    overlay_type = self.fix_unicode(overlay["type"])
-                else:
-                    print "Invalid type for overlay " + noverlay
-                    return
+    def circle_stats(self, ix, iy, r):
 
+        t = self.data()
 
-                # Check for all the potential overlay parameters
-                # Some can have default values
+        totals = numpy.zeros(3)
+        area   = 0
 
-                file_name       = ""
-                column          = ""
-                ref_value       = ""
-                data_type       = "flux"
-                symbol_type     = "circle"
-                symbol_size     = 1.0
-                symbol_sides    = ""
-                symbol_rotation = ""
-                color           = "white"
-                coord_sys       = "Equatorial J2000"
-                lon             = ""
-                lat             = ""
-                text            = ""
+        for y in range(max(iy - r, 1), min(iy + r, self.naxis2) + 1):
 
-                if "file" in overlay:
-                    file_name = self.fix_unicode(overlay["file"])
+            half = int(math.floor(math.sqrt(r * r - (y - iy)**2)))
 
-                if "column" in overlay:
-                    column = self.fix_unicode(overlay["column"])
+            x0 = max(ix - half, 1) - 1
+            x1 = min(ix + half, self.naxis1)
 
-                if "ref_value" in overlay:
-                    ref_value = self.fix_unicode(overlay["ref_value"])
+            totals += t[:, y, x1] - t[:, y - 1, x1] - t[:, y, x0] + t[:, y - 1, x0]
+            area   += x1 - x0
 
-                if "data_type" in overlay:
-                    data_type = self.fix_unicode(overlay["data_type"])
+        npixel, mean, rms = self.moments(totals)
 
-                if "symbol_size" in overlay:
-                    symbol_size = self.fix_unicode(overlay["symbol_size"])
+        return npixel, area - npixel, mean, rms
 
-                if "symbol_type" in overlay:
-                    symbol_type = self.fix_unicode(overlay["symbol_type"])
 
-                if "symbol_sides" in overlay:
-                    symbol_sides = self.fix_unicode(overlay["symbol_sides"])
+    def moments(self, totals):
 
-                if "symbol_rotation" in overlay:
-                    symbol_rotation = self.fix_unicode(overlay["symbol_rotation"])
+        count, total, total2 = totals
 
-                if "color" in overlay:
-                    color = self.fix_unicode(overlay["color"])
+        if count <= 0:
+            return 0, 0., 0.
 
-                if "coord_sys" in overlay:
-                    coord_sys = self.fix_unicode(overlay["coord_sys"])
+        mean = total / count
 
-                if "lon" in overlay:
-                    lon = self.fix_unicode(overlay["lon"])
+        return int(round(count)), float(mean), float(math.sqrt(max(total2 / count - mean * mean, 0.)))
 
-                if "lat" in overlay:
-                    lat = self.fix_unicode(overlay["lat"])
 
-                if "text" in overlay:
-                    text = self.fix_unicode(overlay["text"])
+  # Build the tables, a band of rows at a time
 
+    def build(self):
 
-                # For each overlay type, check for required parameters
-                # then call the appropriate overlay "add" function
+        if self.ready():
+            return
 
-                # CATALOG
+        try:
+            os.makedirs(self.directory)
 
-                if overlay_type == "catalog":
+        except OSError as exception:
 
-                    if file_name == "":
-                        print "No catalog file name given."
-                        return
-                    
-                    self.set_current_coord_sys(coord_sys)
-                    self.set_current_color(color)
+            if exception.errno != errno.EEXIST:
+                raise
 
-                    if symbol_sides == "":
-                        self.set_current_symbol(symbol_size, symbol_type)
+        fits = mvFITS(self.fits_file)
 
-                    elif symbol_rotation == "":
-                        self.set_current_symbol(symbol_size, symbol_type, symbol_sides)
+        raw = fits.data()
 
-                    else:
-                        self.set_current_symbol(symbol_size, symbol_type, symbol_sides, symbol_rotation)
+        part = self.file_name + ".part"
 
-                    self.add_catalog(file_name, column, ref_value, data_type)
+        tables = numpy.memmap(part, dtype='f8', mode='w+', shape=(3, self.naxis2 + 1, self.naxis1 + 1))
 
+        tables[:, 0, :] = 0.
+        tables[:, :, 0] = 0.
 
-                # IMAGE OUTLINES
+        band = max(1, (4 * 1024 * 1024) // max(self.naxis1, 1))
 
-                elif overlay_type == "imginfo":
+        for y0 in range(0, self.naxis2, band):
 
-                    if file_name == "":
-                        print "No image metadata file name given."
-                        return
+            y1 = min(y0 + band, self.naxis2)
 
-                    self.set_current_coord_sys(coord_sys)
-                    self.set_current_color(color)
+            data  = fits.physical(raw[y0:y1])
+            valid = numpy.isfinite(data)
+            data  = numpy.where(valid, data, 0.)
 
-                    self.add_img_info(file_name)
+            for k, values in enumerate([valid.astype('f8'), data, data * data]):
 
+                sums = numpy.cumsum(numpy.cumsum(values, axis=1), axis=0)
 
-                # COORDINATE GRID
+                tables[k, y0+1:y1+1, 1:] = sums + tables[k, y0, 1:]
 
-                elif overlay_type == "grid":
+        tables.flush()
 
-                    self.set_current_color(color)
+        del tables
 
-                    self.add_grid(coord_sys)
+        os.rename(part, self.file_name)
 
 
-                # LABEL         
+    def run_build(self):
 
-                elif overlay_type == "label":
+        try:
+            self.build()
 
-                    if text == "":
-                        print "No label text given."
-                        return
+        except Exception as e:
+            self.error = str(e)
 
-                    if lon == "":
-                        print "No longitude given."
-                        return
 
-                    if lat == "":
-                        print "No latitude given."
-                        return
+  # Start a background build (if one isn't already running)
 
-                    self.set_current_coord_sys(coord_sys)
-                    self.set_current_color(color)
+    def build_in_background(self):
 
-                    self.add_label(lon, lat, text)
+        if self.thread is not None and self.thread.is_alive():
+            return
 
+        if self.ready():
+            return
 
-                # MARKER
+        self.thread = Thread(target=self.run_build)
+        self.thread.daemon = True
+        self.thread.start()
 
-                elif overlay_type == "marker":
+#---------------------------------------------------------------------------------
 
-                    if lon == "":
-                        print "No longitude given."
-                        return
 
-                    if lat == "":
-                        print "No latitude given."
-                        return
+#---------------------------------------------------------------------------------
+# MVMINMAX  Block minimum/maximum tree for a FITS image.
+#
+# The pick statistics also report where the smallest and largest values
+# in the aperture are, which otherwise means looking at every pixel in
+# it.  So once per file we record the minimum and maximum (and their
+# positions) for each block of block_size x block_size pixels, then for
+# each 2x2 group of blocks, and so on up to a single block covering the 
+# whole image.  A query works down from the top: blocks entirely inside
+# the aperture are answered from the tree, blocks entirely outside are 
+# skipped and only the smallest blocks on the edge of the aperture have
+# their pixels read.  Like mvIntegral, the tree lives in the file's 
+# pyramid cache directory and is built in the background.
 
-                    self.set_current_coord_sys(coord_sys)
-                    self.set_current_color(color)
+class mvMinMax(object):
 
-                    if symbol_sides == "":
-                        self.set_current_symbol(symbol_size, symbol_type)
+    block_size = 32
 
-                    elif symbol_rotation == "":
-                        self.set_current_symbol(symbol_size, symbol_type, symbol_sides)
+    def __init__(self, pyramid):
 
-                    else:
-                        self.set_current_symbol(symbol_size, symbol_type, symbol_sides, symbol_rotation)
+        self.pyramid   = pyramid
+        self.fits_file = pyramid.fits_file
+        self.directory = pyramid.directory
+        self.file_name = self.directory + "/minmax.npz"
+        self.naxis1    = pyramid.naxis1
+        self.naxis2    = pyramid.naxis2
+        self.thread    = None
+        self.error     = ""
 
-                    self.add_marker(lon, lat)
+        self.levels = None
 
 
-                else:
-                    print "Invalid overlay type: " + overlay_type
-                    return
+  # Has the file changed since the tree was set up?
 
+    def current(self):
 
+        return self.pyramid.current()
 
-  # Start a second thread to interact with the browser.
 
-    def init_browser_display(self):
+  # Is the tree there to use?
 
-        self.port = random.randint(10000,60000)
+    def ready(self):
 
-        template_file = resource_filename('agMontage', 'web/index.html')
-        index_file    = self.workspace + "/index.html"
+        return os.path.exists(self.file_name)
 
-        host          = socket.getfqdn()
-        port_string   = str(self.port)
 
-        host = "localhost"
+  # The levels of the tree: (min, argmin, max, argmax) arrays indexed 
+  # [block y, block x], with positions as offsets into the image array
+  # (y * naxis1 + x) and +/- infinity for blocks that are all nulls
 
-        if self.serverMode:
-           host = socket.getfqdn()
+    def load(self):
 
+        if self.levels is None:
 
-        with open(index_file,'w') as new_file:
-           with open(template_file) as old_file:
-              for line in old_file:
-                 new_file.write(line.replace("\\SERVER\\", host).replace("\\PORT\\", port_string))
+            npz = numpy.load(self.file_name)
 
+            self.levels = [(npz['min' + str(k)], npz['argmin' + str(k)], npz['max' + str(k)], npz['argmax' + str(k)])
+                           for k in range(int(npz['nlevel']))]
 
-      # Copy all required web files into work directory 
-      # (includes Javascript, css, icons, etc.)
-      #---------------------------------------------------------------------------
-      # JSON files (coordinate "pick" statistic information)
-      #---------------------------------------------------------------------------
+        return self.levels
 
-        in_file  = resource_filename('agMontage', 'web/pick.json')
-        out_file = self.workspace + '/pick.json'
-        shutil.copy(in_file, out_file)
 
-        in_file  = resource_filename('agMontage', 'web/pick0.json')
-        out_file = self.workspace + '/pick0.json'
-        shutil.copy(in_file, out_file)
+  # The positions (1-based x, y) of the minimum and maximum non-null
+  # values in a circle (center and radius in pixels; the same pixels 
+  # as mvFITS.region_stats() uses), or None if they are all null
 
-        in_file  = resource_filename('agMontage', 'web/pick1.json')
-        out_file = self.workspace + '/pick1.json'
-        shutil.copy(in_file, out_file)
+    def circle_extrema(self, fits, ix, iy, r):
 
-        in_file  = resource_filename('agMontage', 'web/pick2.json')
-        out_file = self.workspace + '/pick2.json'
-        shutil.copy(in_file, out_file)
+        levels = self.load()
 
-      #---------------------------------------------------------------------------
-      # CSS files
-      #---------------------------------------------------------------------------
+        raw = fits.data()
 
-        in_file  = resource_filename('agMontage', 'web/stylesheet01.css')
-        out_file = self.workspace + '/stylesheet01.css'
-        shutil.copy(in_file, out_file)
+        lo, lo_at = numpy.inf,  None
+        hi, hi_at = -numpy.inf, None
 
-        in_file  = resource_filename('agMontage', 'web/ColorStretch.css')
-        out_file = self.workspace + '/ColorStretch.css'
-        shutil.copy(in_file, out_file)
+        nodes = [(len(levels) - 1, 0, 0)]
 
-        in_file  = resource_filename('agMontage', 'web/LayerControl.css')
-        out_file = self.workspace + '/LayerControl.css'
-        shutil.copy(in_file, out_file)
+        while len(nodes) > 0:
 
-        in_file  = resource_filename('agMontage', 'web/RegionStats.css')
-        out_file = self.workspace + '/RegionStats.css'
-        shutil.copy(in_file, out_file)
+            level, bx, by = nodes.pop()
 
-        in_file  = resource_filename('agMontage', 'web/FITSHeaderViewer.css')
-        out_file = self.workspace + '/FITSHeaderViewer.css'
-        shutil.copy(in_file, out_file)
+            mins, argmins, maxs, argmaxs = levels[level]
 
-        in_file  = resource_filename('agMontage', 'web/InfoDisplay.css')
-        out_file = self.workspace + '/InfoDisplay.css'
-        shutil.copy(in_file, out_file)
+            if by >= mins.shape[0] or bx >= mins.shape[1]:
+                continue
 
-        in_file  = resource_filename('agMontage', 'web/ZoomControl.css')
-        out_file = self.workspace + '/ZoomControl.css'
-        shutil.copy(in_file, out_file)
+            size = self.block_size * 2**level
 
-        in_file  = resource_filename('agMontage', 'web/spectrum.css')
-        out_file = self.workspace + '/spectrum.css'
-        shutil.copy(in_file, out_file)
+            x0 = bx * size + 1
+            y0 = by * size + 1
+            x1 = min(x0 + size - 1, self.naxis1)
+            y1 = min(y0 + size - 1, self.naxis2)
 
-      #---------------------------------------------------------------------------
-      # Javascript files
-      #---------------------------------------------------------------------------
+            near = max(x0 - ix, 0, ix - x1)**2 + max(y0 - iy, 0, iy - y1)**2
+            far  = max(ix - x0, x1 - ix)**2    + max(iy - y0, y1 - iy)**2
 
-        in_file  = resource_filename('agMontage', 'web/WebClient.js')
-        out_file = self.workspace + '/WebClient.js'
-        shutil.copy(in_file, out_file)
+            if near > r * r:
+                continue
 
-        in_file  = resource_filename('agMontage', 'web/mViewer.js')
-        out_file = self.workspace + '/mViewer.js'
-        shutil.copy(in_file, out_file)
+            if far <= r * r:
 
-        in_file  = resource_filename('agMontage', 'web/iceGraphics.js')
-        out_file = self.workspace + '/iceGraphics.js'
-        shutil.copy(in_file, out_file)
+                if mins[by, bx] < lo:
+                    lo, lo_at = mins[by, bx], argmins[by, bx]
 
-        in_file  = resource_filename('agMontage', 'web/ColorStretch.js')
-        out_file = self.workspace + '/ColorStretch.js'
-        shutil.copy(in_file, out_file)
+                if maxs[by, bx] > hi:
+                    hi, hi_at = maxs[by, bx], argmaxs[by, bx]
 
-        in_file  = resource_filename('agMontage', 'web/LayerControl.js')
-        out_file = self.workspace + '/LayerControl.js'
-        shutil.copy(in_file, out_file)
+            elif level > 0:
 
-        in_file  = resource_filename('agMontage', 'web/RegionStats.js')
-        out_file = self.workspace + '/RegionStats.js'
-        shutil.copy(in_file, out_file)
+                for j in range(2):
+                    for i in range(2):
+                        nodes.append((level - 1, 2*bx + i, 2*by + j))
 
-        in_file  = resource_filename('agMontage', 'web/FITSHeaderViewer.js')
-        out_file = self.workspace + '/FITSHeaderViewer.js'
-        shutil.copy(in_file, out_file)
+            else:
 
-        in_file  = resource_filename('agMontage', 'web/InfoDisplay.js')
-        out_file = self.workspace + '/InfoDisplay.js'
-        shutil.copy(in_file, out_file)
+                data = fits.physical(raw[y0-1:y1, x0-1:x1])
 
-        in_file  = resource_filename('agMontage', 'web/ZoomControl.js')
-        out_file = self.workspace + '/ZoomControl.js'
-        shutil.copy(in_file, out_file)
+                xs = numpy.arange(x0, x1 + 1)
+                ys = numpy.arange(y0, y1 + 1)
 
-        in_file  = resource_filename('agMontage', 'web/spectrum.js')
-        out_file = self.workspace + '/spectrum.js'
-        shutil.copy(in_file, out_file)
+                inside = ((xs[numpy.newaxis, :] - ix)**2 + (ys[:, numpy.newaxis] - iy)**2) <= r * r
+                valid  = inside & numpy.isfinite(data)
 
-        in_file  = resource_filename('agMontage', 'web/viewerUtils.js')
-        out_file = self.workspace + '/viewerUtils.js'
-        shutil.copy(in_file, out_file)
+                if not valid.any():
+                    continue
 
-      #---------------------------------------------------------------------------
+                k = numpy.where(valid, data, numpy.inf).argmin()
+
+                if data.flat[k] < lo:
+                    lo, lo_at = data.flat[k], (y0 - 1 + k // data.shape[1]) * self.naxis1 + x0 - 1 + k % data.shape[1]
+
+                k = numpy.where(valid, data, -numpy.inf).argmax()
+
+                if data.flat[k] > hi:
+                    hi, hi_at = data.flat[k], (y0 - 1 + k // data.shape[1]) * self.naxis1 + x0 - 1 + k % data.shape[1]
+
+        if lo_at is None:
+            return None
+
+        return (int(lo_at % self.naxis1) + 1, int(lo_at // self.naxis1) + 1), (int(hi_at % self.naxis1) + 1, int(hi_at // self.naxis1) + 1)
+
+
+  # Build the tree: the bottom level a band of block rows at
+  # a time, then each level above from the one below it
+
+    def build(self):
+
+        if self.ready():
+            return
+
+        try:
+            os.makedirs(self.directory)
+
+        except OSError as exception:
+
+            if exception.errno != errno.EEXIST:
+                raise
+
+        fits = mvFITS(self.fits_file)
+
+        raw  = fits.data()
+        size = self.block_size
+
+        nbx = -(-self.naxis1 // size)
+        nby = -(-self.naxis2 // size)
+
+        mins    = numpy.empty((nby, nbx))
+        maxs    = numpy.empty((nby, nbx))
+        argmins = numpy.empty((nby, nbx), dtype='i8')
+        argmaxs = numpy.empty((nby, nbx), dtype='i8')
+
+        columns = numpy.arange(nbx)
+
+        for by in range(nby):
+
+            y0 = by * size
+            y1 = min(y0 + size, self.naxis2)
+
+            band = numpy.full((size, nbx * size), numpy.nan)
+
+            band[0:y1-y0, 0:self.naxis1] = fits.physical(raw[y0:y1])
+
+            blocks = band.reshape(size, nbx, size).transpose(1, 0, 2).reshape(nbx, size * size)
+            nulls  = numpy.isnan(blocks)
+
+            for values, args, fill, pick in [(mins, argmins,  numpy.inf, numpy.argmin), 
+                                             (maxs, argmaxs, -numpy.inf, numpy.argmax)]:
+
+                filled = numpy.where(nulls, fill, blocks)
+
+                k = pick(filled, axis=1)
+
+                values[by] = filled[columns, k]
+                args[by]   = (y0 + k // size) * self.naxis1 + columns * size + k % size
+
+        levels = [(mins, argmins, maxs, argmaxs)]
+
+        while mins.shape[0] > 1 or mins.shape[1] > 1:
+
+            mins, argmins = self.combine(mins, argmins,  numpy.inf, numpy.argmin)
+            maxs, argmaxs = self.combine(maxs, argmaxs, -numpy.inf, numpy.argmax)
+
+            levels.append((mins, argmins, maxs, argmaxs))
+
+        arrays = { 'nlevel': numpy.array(len(levels)) }
+
+        for k in range(len(levels)):
+            for name, array in zip(['min', 'argmin', 'max', 'argmax'], levels[k]):
+                arrays[name + str(k)] = array
+
+        part = self.file_name + ".part"
+
+        fp = open(part, 'wb')
+
+        try:
+            numpy.savez(fp, **arrays)
+        finally:
+            fp.close()
+
+        os.rename(part, self.file_name)
+
+
+  # One level up: the extreme (and its position) of each 2x2 group
+
+    def combine(self, values, args, fill, pick):
+
+        ny, nx = values.shape
+
+        padded_values = numpy.full((ny + ny % 2, nx + nx % 2), fill)
+        padded_args   = numpy.zeros((ny + ny % 2, nx + nx % 2), dtype='i8')
+
+        padded_values[0:ny, 0:nx] = values
+        padded_args  [0:ny, 0:nx] = args
+
+        quads = [(0, 0), (0, 1), (1, 0), (1, 1)]
+
+        values4 = numpy.array([padded_values[j::2, i::2] for j, i in quads])
+        args4   = numpy.array([padded_args  [j::2, i::2] for j, i in quads])
+
+        k = pick(values4, axis=0)
+
+        return numpy.choose(k, values4), numpy.choose(k, args4)
+
+
+    def run_build(self):
+
+        try:
+            self.build()
+
+        except Exception as e:
+            self.error = str(e)
+
+
+  # Start a background build (if one isn't already running)
+
+    def build_in_background(self):
+
+        if self.thread is not None and self.thread.is_alive():
+            return
+
+        if self.ready():
+            return
+
+        self.thread = Thread(target=self.run_build)
+        self.thread.daemon = True
+        self.thread.start()
+
+#---------------------------------------------------------------------------------
+
+
+#---------------------------------------------------------------------------------
+# MVSKYGRID  Cells on the sky.
+#
+# The sphere is split into cells by projecting it onto the six faces of
+# a cube and dividing each face into an nside x nside grid.  The cells 
+# are all about the same size (no pole problems) and which one a position
+# falls in is a few arithmetic operations, so lists of things on the sky
+# can be sorted by cell and searched a patch of sky at a time.  Positions
+# are handled as unit vectors.
+
+class mvSkyGrid(object):
+
+    def __init__(self, nside=64):
+
+        self.nside   = nside
+        self.ncell   = 6 * nside * nside
+        self.centers = None
+        self.radii   = None
+
+
+  # Unit vectors (N x 3) for RA, Dec (degrees)
+
+    def unit_vectors(self, ra, dec):
+
+        ra  = numpy.radians(numpy.asarray(ra,  dtype='f8'))
+        dec = numpy.radians(numpy.asarray(dec, dtype='f8'))
+
+        return numpy.column_stack((numpy.cos(dec) * numpy.cos(ra), numpy.cos(dec) * numpy.sin(ra), numpy.sin(dec)))
+
+
+  # Cell numbers for unit vectors.  The cube face is that of the 
+  # biggest component (0-2 for +x, +y, +z; 3-5 for -x, -y, -z) and 
+  # the position on it the other two components, in turn, over that.
+
+    def cells(self, xyz):
+
+        n = self.nside
+
+        xyz   = numpy.asarray(xyz, dtype='f8').reshape(-1, 3)
+        rows  = numpy.arange(len(xyz))
+        major = numpy.argmax(numpy.abs(xyz), axis=1)
+        top   = xyz[rows, major]
+
+        face = major + 3 * (top < 0.)
+
+        u = xyz[rows, (major + 1) % 3] / numpy.abs(top)
+        v = xyz[rows, (major + 2) % 3] / numpy.abs(top)
+
+        i = numpy.clip(((u + 1.) / 2. * n).astype(int), 0, n - 1)
+        j = numpy.clip(((v + 1.) / 2. * n).astype(int), 0, n - 1)
+
+        return (face * n + j) * n + i
+
+
+  # Unit vector for a point on a cube face
+
+    def face_point(self, face, u, v):
+
+        major = face % 3
+
+        xyz = numpy.zeros((len(face), 3))
+
+        rows = numpy.arange(len(face))
+
+        xyz[rows, major]           = numpy.where(face < 3, 1., -1.)
+        xyz[rows, (major + 1) % 3] = u
+        xyz[rows, (major + 2) % 3] = v
+
+        return xyz / numpy.sqrt((xyz**2).sum(axis=1))[:, None]
+
+
+  # Center of every cell and the angle (radians) from it to 
+  # its farthest corner
+
+    def geometry(self):
+
+        if self.centers is None:
+
+            n = self.nside
+
+            cell = numpy.arange(self.ncell)
+
+            face = cell // (n * n)
+            j    = (cell // n) % n
+            i    = cell % n
+
+            def face_coord(k):
+                return k * 2. / n - 1.
+
+            centers = self.face_point(face, face_coord(i + 0.5), face_coord(j + 0.5))
+
+            radii = numpy.zeros(self.ncell)
+
+            for di, dj in [(0, 0), (1, 0), (0, 1), (1, 1)]:
+
+                corner = self.face_point(face, face_coord(i + di), face_coord(j + dj))
+
+                radii = numpy.maximum(radii, numpy.arccos(numpy.clip((centers * corner).sum(axis=1), -1., 1.)))
+
+            self.centers = centers
+            self.radii   = radii
+
+        return self.centers, self.radii
+
+
+  # Cells that might have something within a given angle (radians) 
+  # of a position (unit vector)
+
+    def cone_cells(self, center, radius):
+
+        centers, radii = self.geometry()
+
+        angles = numpy.arccos(numpy.clip(numpy.dot(centers, center), -1., 1.))
+
+        return numpy.nonzero(angles <= radius + radii)[0]
+
+#---------------------------------------------------------------------------------
+
+
+#---------------------------------------------------------------------------------
+# MVTABLE  Columnar binary copy of an IPAC table.
+#
+# Catalog tables can have millions of rows, and parsing them as text is
+# slow.  So each numeric column we need (the positions, and whatever
+# column sets the symbol sizes) is parsed once and saved as a NumPy array
+# (float64, NaN for nulls), memory-mapped when used.  The arrays go in a
+# cache directory keyed by the table's path, size and modification time.
+#
+# The table is read a large block at a time.  IPAC tables are normally
+# fixed width, in which case a whole block is converted in one go;
+# blocks that aren't (or have nulls) are done a line at a time.  We
+# also keep where each row starts in the file, so the original lines
+# for a set of rows can be copied out without reading the rest.
+
+class mvTable(object):
+
+    block_size = 16 * 1024 * 1024
+
+    def __init__(self, table_file, cache_dir):
+
+        self.table_file = table_file
+        self.directory  = cache_dir + "/" + self.file_key()
+        self.lock       = Lock()
+        self.columns    = {}
+
+        self.read_header()
+
+
+  # Cache key for the current state of the file
+
+    def file_key(self):
+
+        info = os.stat(self.table_file)
+
+        key = os.path.abspath(self.table_file) + ":" + str(info.st_size) + ":" + str(info.st_mtime)
+
+        return hashlib.md5(key).hexdigest()
+
+
+    def current(self):
+
+        return os.path.basename(self.directory) == self.file_key()
+
+
+  # Column names and types (lower case) and where they are in the 
+  # line, from the "|" header lines, and the length of the header
+
+    def read_header(self):
+
+        self.names  = None
+        self.types  = None
+        self.bars   = None
+        self.header = 0
+
+        fp = open(self.table_file, 'rb')
+
+        try:
+            for line in fp:
+
+                if line.startswith("\\"):
+                    self.header += len(line)
+                    continue
+
+                if not line.startswith("|"):
+                    break
+
+                self.header += len(line)
+
+                bars   = [i for i, c in enumerate(line.rstrip("\r\n")) if c == "|"]
+                fields = [line[bars[k]+1:bars[k+1]].strip().lower() for k in range(len(bars) - 1)]
+
+                if self.names is None:
+                    self.names = fields
+                    self.bars  = bars
+
+                elif self.types is None:
+                    self.types = fields
+        finally:
+            fp.close()
+
+        if self.names is None:
+            raise Exception("No column header in " + self.table_file)
+
+
+    def column_file(self, name):
+
+        return self.directory + "/table_" + name + ".npy"
+
+
+    def has(self, name):
+
+        return os.path.exists(self.column_file(name))
+
+
+    def offset_file(self):
+
+        return self.directory + "/table_offsets.npy"
+
+
+  # The file offset of each row (memory-mapped)
+
+    def offsets(self):
+
+        if not os.path.exists(self.offset_file()):
+            self.build([])
+
+        return numpy.load(self.offset_file(), mmap_mode='r')
+
+
+  # The header lines and the original lines for a set of rows
+
+    def header_text(self):
+
+        fp = open(self.table_file, 'rb')
+
+        try:
+            return fp.read(self.header)
+        finally:
+            fp.close()
+
+
+    def lines(self, rows):
+
+        offsets = self.offsets()
+
+        lines = []
+
+        fp = open(self.table_file, 'rb')
+
+        try:
+            for row in rows:
+                fp.seek(offsets[row])
+                lines.append(fp.readline())
+        finally:
+            fp.close()
+
+        return lines
+
+
+  # One field (as a string) from a line of the table
+
+    def field(self, line, name):
+
+        k = self.names.index(name.lower())
+
+        return line[self.bars[k]+1:self.bars[k+1]].strip()
+
+
+  # A column (memory-mapped)
+
+    def column(self, name):
+
+        name = name.lower()
+
+        if name not in self.columns:
+
+            if not self.has(name):
+                self.build([name])
+
+            self.columns[name] = numpy.load(self.column_file(name), mmap_mode='r')
+
+        return self.columns[name]
+
+
+  # Parse any of the given columns we don't already have
+
+    def build(self, names):
+
+        with self.lock:
+
+            names = [name.lower() for name in names if not self.has(name.lower())]
+
+            if len(names) == 0 and os.path.exists(self.offset_file()):
+                return
+
+            for name in names:
+                if name not in self.names:
+                    raise Exception("No " + name + " column in " + self.table_file)
+
+            try:
+                os.makedirs(self.directory)
+
+            except OSError as exception:
+
+                if exception.errno != errno.EEXIST:
+                    raise
+
+            spans = [(self.bars[self.names.index(name)], self.bars[self.names.index(name) + 1]) for name in names]
+
+            parts   = [[] for name in names]
+            offsets = []
+
+            fp = open(self.table_file, 'rb')
+
+            try:
+                fp.seek(self.header)
+
+                start = self.header
+                rest  = ""
+
+                while True:
+
+                    block = fp.read(self.block_size)
+
+                    if block == "":
+                        lines  = [rest]
+                        starts = numpy.array([start])
+
+                    else:
+                        block = rest + block
+                        end   = block.rfind("\n")
+
+                        if end < 0:
+                            rest = block
+                            continue
+
+                        lines = block[:end].split("\n")
+                        rest  = block[end+1:]
+
+                        starts = start + numpy.cumsum([0] + [len(line) + 1 for line in lines[:-1]])
+                        start += end + 1
+
+                    keep = [k for k, line in enumerate(lines) if line.strip() != ""]
+
+                    lines = [lines[k] for k in keep]
+
+                    offsets.append(starts[keep])
+
+                    if len(lines) > 0:
+                        for part, values in zip(parts, self.parse_lines(lines, spans)):
+                            part.append(values)
+
+                    if block == "":
+                        break
+            finally:
+                fp.close()
+
+            for name, part in zip(names, parts):
+
+                if len(part) == 0:
+                    part = [numpy.zeros(0)]
+
+                numpy.save(self.column_file(name) + ".part", numpy.concatenate(part))
+                os.rename(self.column_file(name) + ".part.npy", self.column_file(name))
+
+            if not os.path.exists(self.offset_file()):
+
+                numpy.save(self.offset_file() + ".part", numpy.concatenate(offsets).astype('i8'))
+                os.rename(self.offset_file() + ".part.npy", self.offset_file())
+
+
+  # Values of some columns (character ranges) in a set of lines
+
+    def parse_lines(self, lines, spans):
+
+        width = len(lines[0])
+
+        if len(set([len(line) for line in lines])) == 1:
+
+            chars = numpy.frombuffer("".join(lines), dtype='S1').reshape(len(lines), width)
+
+            results = []
+
+            for start, end in spans:
+
+                field = numpy.ascontiguousarray(chars[:, start:end])
+
+                try:
+                    results.append(field.view('S' + str(field.shape[1])).ravel().astype('f8'))
+
+                except ValueError:
+                    results.append(self.parse_slow(lines, start, end))
+
+            return results
+
+        return [self.parse_slow(lines, start, end) for start, end in spans]
+
+
+    def parse_slow(self, lines, start, end):
+
+        values = numpy.empty(len(lines))
+
+        for i, line in enumerate(lines):
+
+            try:
+                values[i] = float(line[start:end])
+
+            except ValueError:
+                values[i] = numpy.nan
+
+        return values
+
+#---------------------------------------------------------------------------------
+
+
+#---------------------------------------------------------------------------------
+# MVCATALOGINDEX  Sky-cell index of a catalog (IPAC) table.
+#
+# mViewer reads and projects every row of a catalog table each time it
+# draws it, however little of the sky is in view.  So, once per table,
+# we put each row in an mvSkyGrid cell (from its position in the table's
+# mvTable copy) and keep the row numbers sorted by cell.  For a view we
+# then only look at the rows in the cells around it, check which are 
+# within a cone covering it and write just those (position and symbol 
+# size column) to a small table for mViewer.  The index arrays go with
+# the table's columns and are built in the background.
+#
+# Positions come from the "ra" and "dec" columns; tables without them
+# aren't indexed (and are drawn whole, as before).
+
+class mvCatalogIndex(object):
+
+    grid   = mvSkyGrid()
+    arrays = ['cells', 'order']
+
+    def __init__(self, table):
+
+        self.table     = table
+        self.directory = table.directory
+        self.columns   = ['ra', 'dec']
+        self.thread    = None
+        self.error     = ""
+
+        self.data = None
+
+        for name in self.columns:
+            if name not in table.names:
+                raise Exception("No " + name + " column in " + table.table_file)
+
+
+    def current(self):
+
+        return self.table.current()
+
+
+    def array_file(self, name):
+
+        return self.directory + "/catalog_" + name + ".npy"
+
+
+  # Is the index (and every column asked for) there to use?
+
+    def ready(self):
+
+        if not os.path.exists(self.array_file('order')):
+            return False
+
+        return len([name for name in self.columns if not self.table.has(name)]) == 0
+
+
+  # Ask for more columns to be ready (for symbol sizes)
+
+    def want(self, name):
+
+        if name != "" and name.lower() not in self.columns:
+            self.columns.append(name.lower())
+
+
+  # The index arrays: the cell numbers, in order, and 
+  # the rows they go with
+
+    def load(self):
+
+        if self.data is None:
+
+            data = {}
+
+            for name in self.arrays:
+                data[name] = numpy.load(self.array_file(name), mmap_mode='r')
+
+            self.data = data
+
+        return self.data
+
+
+  # Rows within a given radius of a position (all in degrees)
+
+    def cone(self, ra, dec, radius):
+
+        data = self.load()
+
+        center = self.grid.unit_vectors([ra], [dec])[0]
+
+        radius = math.radians(radius)
+
+        wanted = self.grid.cone_cells(center, radius)
+
+        starts = numpy.searchsorted(data['cells'], wanted, 'left')
+        ends   = numpy.searchsorted(data['cells'], wanted, 'right')
+
+        ranges = [(start, end) for start, end in zip(starts, ends) if end > start]
+
+        if len(ranges) == 0:
+            return numpy.zeros(0, dtype=int)
+
+        rows = numpy.sort(numpy.concatenate([data['order'][start:end] for start, end in ranges]))
+
+        xyz = self.grid.unit_vectors(self.table.column('ra')[rows], self.table.column('dec')[rows])
+
+        return rows[numpy.dot(xyz, center) >= math.cos(radius)]
+
+
+  # Write an IPAC table of the position (and, if given, one 
+  # other column) of the given rows
+
+    def write_subset(self, rows, out_file, data_col=""):
+
+        names = ['ra', 'dec']
+
+        if data_col != "":
+            names.append(data_col.lower())
+
+        columns = [self.table.column(name)[rows] for name in names]
+
+        width = 16
+
+        out = open(out_file + ".part", 'wb')
+
+        try:
+            out.write("\\ Rows of " + str(self.table.table_file) + " in view\n")
+            out.write("|" + "|".join([name.rjust(width) for name in names]) + "|\n")
+            out.write("|" + "|".join(["double".rjust(width) for name in names]) + "|\n")
+
+            for values in zip(*columns):
+
+                fields = []
+
+                for value in values:
+
+                    if numpy.isnan(value):
+                        fields.append("null".rjust(width))
+                    else:
+                        fields.append(("%.10g" % value).rjust(width))
+
+                out.write(" " + " ".join(fields) + " \n")
+        finally:
+            out.close()
+
+        os.rename(out_file + ".part", out_file)
+
+
+  # Make sure we have the columns, then index the positions
+
+    def build(self):
+
+        self.table.build(self.columns)
+
+        if os.path.exists(self.array_file('order')):
+            return
+
+        ra  = self.table.column('ra')
+        dec = self.table.column('dec')
+
+        cells = numpy.empty(len(ra), dtype='i4')
+
+        step = 1048576
+
+        with numpy.errstate(invalid='ignore'):
+            for start in range(0, len(ra), step):
+                cells[start:start+step] = self.grid.cells(self.grid.unit_vectors(ra[start:start+step], dec[start:start+step]))
+
+        valid = numpy.nonzero(numpy.isfinite(ra) & numpy.isfinite(dec))[0]
+
+        order = valid[numpy.argsort(cells[valid], kind='mergesort')]
+
+        numpy.save(self.array_file('cells') + ".part", cells[order])
+        os.rename(self.array_file('cells') + ".part.npy", self.array_file('cells'))
+
+        numpy.save(self.array_file('order') + ".part", order)
+        os.rename(self.array_file('order') + ".part.npy", self.array_file('order'))
+
+
+    def run_build(self):
+
+        try:
+            self.build()
+
+        except Exception as e:
+            self.error = str(e)
+
+
+  # Start a background build (if one isn't already running)
+
+    def build_in_background(self):
+
+        if self.thread is not None and self.thread.is_alive():
+            return
+
+        if self.ready() or self.error != "":
+            return
+
+        self.thread = Thread(target=self.run_build)
+        self.thread.daemon = True
+        self.thread.start()
+
+#---------------------------------------------------------------------------------
+
+
+#---------------------------------------------------------------------------------
+# MVFOOTPRINTINDEX  Sky-cell index of the image footprints in an image
+# metadata table.
+#
+# Image metadata tables (from mImgtbl -c) give the four corners of each
+# image (ra1, dec1 ... ra4, dec4) and a survey can have hundreds of
+# thousands of them.  Once per table we reduce each footprint to a
+# circle around it (the center and the angle to the farthest corner),
+# file it in the mvSkyGrid cell of the center and keep the rows sorted
+# by cell.  The images that might overlap a view are then those in the
+# cells around it whose circles reach the view's cone; the images
+# covering a point are checked exactly against their corners.
+#
+# Like mvCatalogIndex, the arrays go with the table's binary columns
+# (mvTable) and are built in the background.
+
+class mvFootprintIndex(object):
+
+    grid    = mvSkyGrid()
+    arrays  = ['cells', 'order', 'centers', 'radii']
+    columns = ['ra1', 'dec1', 'ra2', 'dec2', 'ra3', 'dec3', 'ra4', 'dec4']
+
+    def __init__(self, table):
+
+        self.table     = table
+        self.directory = table.directory
+        self.thread    = None
+        self.error     = ""
+
+        self.data = None
+
+        for name in self.columns:
+            if name not in table.names:
+                raise Exception("No " + name + " column in " + table.table_file)
+
+
+    def current(self):
+
+        return self.table.current()
+
+
+    def array_file(self, name):
+
+        return self.directory + "/footprint_" + name + ".npy"
+
+
+    def ready(self):
+
+        return os.path.exists(self.array_file('order'))
+
+
+  # The index arrays (all in row order but 'cells', which is in
+  # the sorted order given by 'order') and the largest footprint
+
+    def load(self):
+
+        if self.data is None:
+
+            data = {}
+
+            for name in self.arrays:
+                data[name] = numpy.load(self.array_file(name), mmap_mode='r')
+
+            if len(data['radii']) > 0:
+                data['max_radius'] = float(numpy.nanmax(data['radii']))
+            else:
+                data['max_radius'] = 0.
+
+            self.data = data
+
+        return self.data
+
+
+  # The corners of some rows as unit vectors (N x 4 x 3)
+
+    def corners(self, rows):
+
+        corners = numpy.empty((len(rows), 4, 3))
+
+        for k in range(4):
+            corners[:, k, :] = self.grid.unit_vectors(self.table.column('ra'  + str(k+1))[rows],
+                                                      self.table.column('dec' + str(k+1))[rows])
+
+        return corners
+
+
+  # Rows whose footprints might reach within a given radius of a
+  # position (all in degrees)
+
+    def cone(self, ra, dec, radius):
+
+        data = self.load()
+
+        center = self.grid.unit_vectors([ra], [dec])[0]
+
+        radius = math.radians(radius)
+
+        wanted = self.grid.cone_cells(center, radius + data['max_radius'])
+
+        starts = numpy.searchsorted(data['cells'], wanted, 'left')
+        ends   = numpy.searchsorted(data['cells'], wanted, 'right')
+
+        ranges = [(start, end) for start, end in zip(starts, ends) if end > start]
+
+        if len(ranges) == 0:
+            return numpy.zeros(0, dtype=int)
+
+        rows = numpy.sort(numpy.concatenate([data['order'][start:end] for start, end in ranges]))
+
+        angles = numpy.arccos(numpy.clip(numpy.dot(data['centers'][rows], center), -1., 1.))
+
+        return rows[angles <= radius + data['radii'][rows]]
+
+
+  # Rows whose footprints contain a position: the point has to be
+  # on the inside of all four edges (great circles) of the footprint,
+  # whichever way round the corners go
+
+    def covering(self, ra, dec):
+
+        rows = self.cone(ra, dec, 0.)
+
+        if len(rows) == 0:
+            return rows
+
+        point   = self.grid.unit_vectors([ra], [dec])[0]
+        corners = self.corners(rows)
+
+        sides = numpy.empty((len(rows), 4))
+
+        for k in range(4):
+            sides[:, k] = numpy.dot(numpy.cross(corners[:, k, :], corners[:, (k+1) % 4, :]), point)
+
+        inside = numpy.all(sides >= 0., axis=1) | numpy.all(sides <= 0., axis=1)
+
+        return rows[inside]
+
+
+  # Write an image metadata table of just the given rows (the
+  # original lines, so every column is still there)
+
+    def write_subset(self, rows, out_file):
+
+        out = open(out_file + ".part", 'wb')
+
+        try:
+            out.write(self.table.header_text())
+
+            for line in self.table.lines(rows):
+                out.write(line)
+        finally:
+            out.close()
+
+        os.rename(out_file + ".part", out_file)
+
+
+  # Get the corner columns, then index the footprints
+
+    def build(self):
+
+        self.table.build(self.columns)
+
+        if self.ready():
+            return
+
+        nrow = len(self.table.column('ra1'))
+
+        centers = numpy.zeros((nrow, 3))
+        radii   = numpy.zeros(nrow)
+
+        step = 262144
+
+        for start in range(0, nrow, step):
+
+            rows = numpy.arange(start, min(start + step, nrow))
+
+            corners = self.corners(rows)
+
+            center = corners.sum(axis=1)
+            center = center / numpy.sqrt((center**2).sum(axis=1))[:, None]
+
+            angles = numpy.arccos(numpy.clip((corners * center[:, None, :]).sum(axis=2), -1., 1.))
+
+            centers[rows] = center
+            radii[rows]   = angles.max(axis=1)
+
+        with numpy.errstate(invalid='ignore'):
+            cells = self.grid.cells(centers)
+
+        valid = numpy.nonzero(numpy.isfinite(radii))[0]
+
+        order = valid[numpy.argsort(cells[valid], kind='mergesort')]
+
+        for name, values in [('centers', centers), ('radii', radii), ('cells', cells[order]), ('order', order)]:
+
+            numpy.save(self.array_file(name) + ".part", values)
+            os.rename(self.array_file(name) + ".part.npy", self.array_file(name))
+
+
+    def run_build(self):
+
+        try:
+            self.build()
+
+        except Exception as e:
+            self.error = str(e)
+
+
+  # Start a background build (if one isn't already running)
+
+    def build_in_background(self):
+
+        if self.thread is not None and self.thread.is_alive():
+            return
+
+        if self.ready() or self.error != "":
+            return
+
+        self.thread = Thread(target=self.run_build)
+        self.thread.daemon = True
+        self.thread.start()
+
+#---------------------------------------------------------------------------------
+
+
+#---------------------------------------------------------------------------------
+# MVMOSAIC  A mosaic that is never made.
+#
+# In mosaic mode the image being viewed is a mosaic of the images in an
+# image metadata table (from mImgtbl -c) on the grid of a header template
+# (the same text file of header cards mAdd would use).  The mosaic has
+# no pixels of its own: for each display we find the images whose
+# footprints reach the view (see mvFootprintIndex), sample each of
+# them at the display pixels and average them where they overlap.  So
+# the cost goes with the number of images in view, not the size of the
+# survey.
+#
+# The sampling goes through both WCSs (see mvWCS), so the template and
+# the images all have to be TAN or SIN projections in equatorial
+# coordinates.  Otherwise this is just an image without data (the
+# header and geometry are all the rest of the viewer needs).
+
+class mvMosaic(mvFITS):
+
+    def __init__(self, table_file, header_file, cache_dir):
+
+        self.fits_file   = table_file
+        self.header_file = header_file
+        self.cards       = []
+        self.header      = {}
+
+        fp = open(header_file, 'r')
+
+        try:
+            for line in fp:
+
+                card    = line.rstrip("\r\n").ljust(80)[0:80]
+                keyword = card[0:8].strip()
+
+                if keyword == 'END':
+                    break
+
+                if keyword == "":
+                    continue
+
+                self.cards.append(card)
+
+                if card[8:10] == '= ':
+                    self.header[keyword] = self.parse_value(card[10:])
+        finally:
+            fp.close()
+
+        if 'NAXIS1' not in self.header or 'NAXIS2' not in self.header:
+            raise Exception("No image size in " + header_file)
+
+        self.naxis1 = int(self.header['NAXIS1'])
+        self.naxis2 = int(self.header['NAXIS2'])
+
+
+      # Templates needn't start like a FITS header, 
+      # but the images we make from it must
+
+        first = [self.make_card('SIMPLE', True),
+                 self.make_card('BITPIX', -32),
+                 self.make_card('NAXIS',  2),
+                 self.make_card('NAXIS1', self.naxis1),
+                 self.make_card('NAXIS2', self.naxis2)]
+
+        self.cards = first + [c for c in self.cards if c[0:8].strip() not in ['SIMPLE', 'BITPIX', 'NAXIS', 'NAXIS1', 'NAXIS2']]
+
+        self.bitpix = -32
+        self.bscale = 1.
+        self.bzero  = 0.
+        self.blank  = None
+
+        self.bunit  = self.header.get('BUNIT', "")
+        self.wcs    = {}
+
+        for keyword in self.wcs_keywords:
+            if keyword in self.header:
+                self.wcs[keyword] = self.header[keyword]
+
+        self.projection = mvWCS(self.wcs)
+
+        info = os.stat(header_file)
+
+        self.stamp = (info.st_size, info.st_mtime)
+
+        self.index = mvFootprintIndex(mvTable(table_file, cache_dir))
+
+        self.index.build_in_background()
+
+        self.frame_dir = os.path.dirname(os.path.abspath(table_file))
+
+
+  # Still good (neither the table nor the template changed)?
+
+    def current(self):
+
+        info = os.stat(self.header_file)
+
+        return self.index.current() and self.stamp == (info.st_size, info.st_mtime)
+
+
+    def data(self):
+
+        raise Exception("A virtual mosaic has no pixel data.")
+
+
+  # The images that might have pixels in a region (array index 
+  # ranges).  File names in the table are taken as relative to 
+  # the table's directory.  We have to wait for the index here.
+
+    def frames(self, x0, y0, x1, y1):
+
+        if not self.index.ready():
+
+            thread = self.index.thread
+
+            if thread is not None:
+                thread.join()
+
+            if not self.index.ready():
+                self.index.build()
+
+        xs = numpy.array([x0, x1, x0, x1, (x0 + x1) / 2.]) + 0.5
+        ys = numpy.array([y0, y0, y1, y1, (y0 + y1) / 2.]) + 0.5
+
+        ra, dec = self.projection.pix2sky(xs, ys)
+
+        xyz = self.index.grid.unit_vectors(ra, dec)
+
+        radius = numpy.degrees(numpy.arccos(numpy.clip(numpy.dot(xyz[0:4], xyz[4]), -1., 1.)).max())
+
+        table = self.index.table
+
+        frames = []
+
+        for line in table.lines(self.index.cone(ra[4], dec[4], radius)):
+
+            name = table.field(line, "fname")
+
+            if not os.path.isabs(name):
+                name = os.path.join(self.frame_dir, name)
+
+            frames.append(name)
+
+        return frames
+
+
+  # Sample one image (an mvFITS, maybe a pyramid level) at the centers
+  # of the display pixels for a region (array index ranges, shown
+  # nx x ny).  Returns the range of display rows and columns it
+  # covers and the values there (NaN where it has none), or None 
+  # if it misses altogether.
+
+    def sample_frame(self, fits, x0, y0, x1, y1, nx, ny):
+
+        wcs = mvWCS(fits.wcs)
+
+        fx = float(x1 - x0) / nx
+        fy = float(y1 - y0) / ny
+
+
+      # Where the image's edges fall on the display
+
+        ex = numpy.array([0., 0.5, 1., 1., 1., 0.5, 0., 0.]) * fits.naxis1 + 0.5
+        ey = numpy.array([0., 0., 0., 0.5, 1., 1., 1., 0.5]) * fits.naxis2 + 0.5
+
+        mx, my = self.projection.sky2pix(*wcs.pix2sky(ex, ey))
+
+        if not numpy.all(numpy.isfinite(mx) & numpy.isfinite(my)):
+            return None
+
+        i0 = max(0,  int(math.floor((mx.min() - 0.5 - x0) / fx)))
+        i1 = min(nx, int(math.ceil ((mx.max() - 0.5 - x0) / fx)))
+        j0 = max(0,  int(math.floor((my.min() - 0.5 - y0) / fy)))
+        j1 = min(ny, int(math.ceil ((my.max() - 0.5 - y0) / fy)))
+
+        if i1 <= i0 or j1 <= j0:
+            return None
+
+
+      # and the image pixel under each display pixel there
+
+        px = x0 + (numpy.arange(i0, i1) + 0.5) * fx + 0.5
+        py = y0 + (numpy.arange(j0, j1) + 0.5) * fy + 0.5
+
+        px, py = numpy.meshgrid(px, py)
+
+        sx, sy = wcs.sky2pix(*self.projection.pix2sky(px, py))
+
+        with numpy.errstate(invalid='ignore'):
+
+            ix = numpy.floor(sx - 0.5)
+            iy = numpy.floor(sy - 0.5)
+
+            inside = (ix >= 0) & (ix < fits.naxis1) & (iy >= 0) & (iy < fits.naxis2)
+
+        values = numpy.empty(px.shape, dtype='f4')
+
+        values[:] = numpy.nan
+
+        values[inside] = fits.physical(fits.data()[iy[inside].astype(int), ix[inside].astype(int)])
+
+        return j0, j1, i0, i1, values
+
+#---------------------------------------------------------------------------------
+
+
+#---------------------------------------------------------------------------------
+# MVSKETCH  Histogram of pixel values.
+#
+# A fixed set of bin edges (normally the quantiles of a sample of the
+# whole image, so every bin holds about the same share of the pixels
+# however skewed the distribution) and the count in each.  Quantiles,
+# the percentile of a value, the median and a robust sigma are read off
+# the cumulative counts.  Sketches with the same edges can be added 
+# together, so a sketch can be built up a block of data at a time or
+# for any part of the image and still be compared with the whole.
+
+class mvSketch(object):
+
+    def __init__(self, edges):
+
+        self.edges    = edges
+        self.counts   = numpy.zeros(len(edges) - 1)
+        self.count    = 0
+        self.data_min =  numpy.inf
+        self.data_max = -numpy.inf
+
+
+  # Add some (physical) data; nulls are ignored
+
+    def add(self, data):
+
+        values = numpy.asarray(data, dtype='f8').ravel()
+        values = values[numpy.isfinite(values)]
+
+        if len(values) == 0:
+            return
+
+        bins = numpy.clip(numpy.searchsorted(self.edges, values, 'right') - 1, 0, len(self.counts) - 1)
+
+        self.counts  += numpy.bincount(bins, minlength=len(self.counts))
+        self.count   += len(values)
+        self.data_min = min(self.data_min, float(values.min()))
+        self.data_max = max(self.data_max, float(values.max()))
+
+
+  # Add in another sketch (with the same edges)
+
+    def merge(self, other):
+
+        self.counts  += other.counts
+        self.count   += other.count
+        self.data_min = min(self.data_min, other.data_min)
+        self.data_max = max(self.data_max, other.data_max)
+
+
+  # Fraction of the values below each of the bin edges
+
+    def cumulative(self):
+
+        return numpy.concatenate(([0.], numpy.cumsum(self.counts))) / max(self.count, 1)
+
+
+  # Fraction of the values below each of the given values
+
+    def cdf(self, values):
+
+        return numpy.interp(values, self.edges, self.cumulative())
+
+
+  # Value at a given percentile
+
+    def value_at(self, percent):
+
+        if self.count == 0:
+            raise Exception("No valid pixels.")
+
+        value = float(numpy.interp(min(max(percent, 0.), 100.) / 100., self.cumulative(), self.edges))
+
+        return min(max(value, self.data_min), self.data_max)
+
+
+  # Percentile of a given value
+
+    def percent_at(self, value):
+
+        return 100. * float(self.cdf(value))
+
+
+    def median(self):
+
+        return self.value_at(50.)
+
+
+  # Sigma from the spread of the middle 68% (so a few very 
+  # bright pixels don't swamp it)
+
+    def sigma(self):
+
+        sigma = (self.value_at(84.1345) - self.value_at(15.8655)) / 2.
+
+        if sigma <= 0.:
+            sigma = max((self.data_max - self.data_min) / 2., 1.e-30)
+
+        return sigma
+
+#---------------------------------------------------------------------------------
+
+
+#---------------------------------------------------------------------------------
+# MVSTRETCH  Pixel value distribution for a FITS image.
+#
+# The stretch limits given to mViewer ("-1s", "max", "99.5%", ...) are
+# normally worked out by the mViewer executable from the pixels it is
+# rendering, i.e. from the current cutout, so they (and the look of the
+# image) change as we pan.  In tiled mode, where each tile is rendered 
+# on its own, every tile would come out differently.  Instead we take a
+# sample of the whole image once (plus its true minimum and maximum),
+# summarize it as an mvSketch and resolve the stretch limits against
+# that (or, for limits that should follow the view, against a sketch
+# of a sample of just the cutout with the same bins; see local()).  
+# In tiled mode we also apply the stretch ourselves; the result is a
+# byte image that only needs the color table applied.
+#
+# The stretch modes follow the mViewer ones: linear, log (three
+# decades), log-log, and histogram equalization to a gaussian
+# ("gaussian", and "gaussian-log" which adds a log stretch on top).
+
+class mvStretch(object):
+
+    max_sample  = 1048576
+    nbin        = 4096
+    local_size  = 512
+
+    def __init__(self, fits_file):
+
+        self.fits_file = fits_file
+        self.stamp     = self.file_stamp()
+
+        fits = mvFITS(fits_file)
+
+        step = int(math.ceil(math.sqrt(float(fits.naxis1) * fits.naxis2 / self.max_sample)))
+
+        sample = fits.physical(fits.data()[::step, ::step]).ravel()
+
+        sample = numpy.sort(sample[numpy.isfinite(sample)])
+
+        if len(sample) == 0:
+            raise Exception("No valid pixels in " + fits_file)
+
+        edges = numpy.unique(sample[numpy.linspace(0, len(sample) - 1, self.nbin + 1).astype(int)])
+
+        if len(edges) < 2:
+            edges = numpy.array([edges[0], edges[0] + 1.])
+
+
+      # The sample gives the shape of the distribution, but "min" and
+      # "max" have to be the image's own extremes (as mViewer finds 
+      # them), so unless the sample was every pixel we look for those
+      # in a pass over the data, and the outer bins are stretched to
+      # take them in
+
+        data_min = float(sample[0])
+        data_max = float(sample[-1])
+
+        if step > 1:
+
+            data_min, data_max = self.extremes(fits)
+
+            edges[0]  = min(edges[0],  data_min)
+            edges[-1] = max(edges[-1], data_max)
+
+        self.sketch = mvSketch(edges)
+
+        self.sketch.add(sample)
+
+        self.sketch.data_min = data_min
+        self.sketch.data_max = data_max
+
+        self.bunit = fits.header.get('BUNIT', "")
+
+        self.data_min = self.sketch.data_min
+        self.data_max = self.sketch.data_max
+
+        self.median = self.sketch.median()
+        self.sigma  = self.sketch.sigma()
+
+
+  # The smallest and largest (physical, non-null) values in the 
+  # image, read a block of rows at a time
+
+    def extremes(self, fits):
+
+        raw = fits.data()
+
+        rows = max(1, self.max_sample // fits.naxis1)
+
+        data_min =  numpy.inf
+        data_max = -numpy.inf
+
+        for y in range(0, fits.naxis2, rows):
+
+            block = fits.physical(raw[y:y+rows]).ravel()
+            block = block[numpy.isfinite(block)]
+
+            if len(block) > 0:
+                data_min = min(data_min, float(block.min()))
+                data_max = max(data_max, float(block.max()))
+
+        return data_min, data_max
+
+
+  # Size and modification time of the file, to tell if it has 
+  # changed since the sample was taken
+
+    def file_stamp(self):
+
+        info = os.stat(self.fits_file)
+
+        return (info.st_size, info.st_mtime)
+
+
+    def current(self):
+
+        return self.stamp == self.file_stamp()
+
+
+  # A sketch of just part of the image (a view box, as given to 
+  # mSubimage), from an evenly-spaced sample of its pixels
+
+    def local(self, xmin, ymin, xmax, ymax):
+
+        fits = mvFITS(self.fits_file)
+
+        x0, y0, x1, y1 = fits.bounds(xmin, ymin, xmax, ymax)
+
+        nx = min(x1 - x0, self.local_size)
+        ny = min(y1 - y0, self.local_size)
+
+        data, cards = fits.downsample(xmin, ymin, xmax, ymax, nx, ny, "sample")
+
+        sketch = mvSketch(self.sketch.edges)
+
+        sketch.add(data)
+
+        if sketch.count == 0:
+            return self.sketch
+
+        return sketch
+
+
+  # Turn a stretch limit as given to mViewer ("min", "max", 
+  # "99.5%", "-1s" or just a data value) into a data value,
+  # using the whole-image sketch unless given another
+
+    def resolve(self, spec, sketch=None):
+
+        if sketch is None:
+            sketch = self.sketch
+
+        spec = str(spec).strip()
+
+        if spec == "min":
+            return sketch.data_min
+
+        if spec == "max":
+            return sketch.data_max
+
+        if spec.endswith("%"):
+            return sketch.value_at(float(spec[:-1]))
+
+        if spec.endswith("s"):
+            return sketch.median() + float(spec[:-1]) * sketch.sigma()
+
+        return float(spec)
+
+
+  # Apply a stretch to (physical) data, giving a 0-255 byte 
+  # image.  Blank pixels come out as zero.
+
+    def apply(self, data, vmin, vmax, mode):
+
+        valid = numpy.isfinite(data)
+
+        if vmax <= vmin:
+            return numpy.zeros(data.shape, dtype='u1')
+
+        if mode == "gaussian" or mode == "gaussian-log":
+
+            lo, hi = self.sketch.cdf([vmin, vmax])
+
+            if hi > lo:
+                frac = (self.sketch.cdf(numpy.where(valid, data, vmin)) - lo) / (hi - lo)
+            else:
+                frac = (numpy.where(valid, data, vmin) - vmin) / (vmax - vmin)
+
+            frac = numpy.clip(frac, 0., 1.)
+
+            z   = numpy.linspace(-3., 3., 1201)
+            cdf = numpy.array([0.5 * (1. + math.erf(x / math.sqrt(2.))) for x in z])
+
+            value = (numpy.interp(frac, cdf, z) + 3.) / 6.
+
+            if mode == "gaussian-log":
+                value = numpy.log10(1. + 999. * value) / 3.
+
+        else:
+
+            with numpy.errstate(invalid='ignore'):
+                value = numpy.clip((data - vmin) / (vmax - vmin), 0., 1.)
+
+            if mode == "log":
+                value = numpy.log10(1. + 999. * value) / 3.
+
+            elif mode == "loglog":
+                value = numpy.log10(1. + 999. * numpy.log10(1. + 999. * value) / 3.) / 3.
+
+        value = numpy.where(valid, value, 0.)
+
+        return (value * 255. + 0.5).astype('u1')
+
+#---------------------------------------------------------------------------------
+
+
+#---------------------------------------------------------------------------------
+# MVFILECACHE  Least-recently-used cache of rendered images.
+#
+# Entries are files in a cache directory, named by a key that captures
+# everything that went into them (for a whole view, a hash of the files,
+# view box, canvas size, stretch, color table and overlays; for a tile,
+# the tile state, pyramid level and position), plus an optional value
+# kept in memory (e.g. the mViewer return structure).  Once the total
+# size of the files goes over the limit, the entries that have gone
+# longest without being used are deleted.  Hit and miss counts are kept
+# for tuning the size.
+
+class mvFileCache(object):
+
+    def __init__(self, directory, max_bytes, suffix=".png"):
+
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.suffix    = suffix
+        self.nbytes    = 0
+        self.hits      = 0
+        self.misses    = 0
+        self.entries   = collections.OrderedDict()
+        self.lock      = Lock()
+
+        try:
+            os.makedirs(directory)
+
+        except OSError as exception:
+
+            if exception.errno != errno.EEXIST:
+                raise
+
+
+    def file_name(self, key):
+
+        return self.directory + "/" + key + self.suffix
+
+
+  # Look up an entry, marking it as recently used.  Returns
+  # its value (True if it has none) or None if not cached.
+
+    def get(self, key):
+
+        with self.lock:
+
+            if key not in self.entries:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+
+            self.entries[key] = self.entries.pop(key)
+
+            value = self.entries[key][1]
+
+            if value is None:
+                value = True
+
+            return value
+
+
+  # Check for an entry without counting it as a use
+
+    def contains(self, key):
+
+        with self.lock:
+            return key in self.entries
+
+
+  # Same as get(), but returning the contents of the file
+
+    def read(self, key):
+
+        with self.lock:
+
+            if key not in self.entries:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+
+            self.entries[key] = self.entries.pop(key)
+
+            fp = open(self.file_name(key), 'rb')
+
+            try:
+                return fp.read()
+            finally:
+                fp.close()
+
+
+  # Add an entry, moving (or copying) the file into the cache
+
+    def put(self, key, file_name, value=None, copy=False):
+
+        with self.lock:
+
+            if key in self.entries:
+                self.nbytes -= self.entries.pop(key)[0]
+
+            if copy:
+                shutil.copyfile(file_name, self.file_name(key))
+            else:
+                os.rename(file_name, self.file_name(key))
+
+            size = os.path.getsize(self.file_name(key))
+
+            self.entries[key] = (size, value)
+            self.nbytes      += size
+
+            while self.nbytes > self.max_bytes and len(self.entries) > 1:
+
+                old_key, old_entry = self.entries.popitem(last=False)
+
+                self.nbytes -= old_entry[0]
+
+                try:
+                    os.remove(self.file_name(old_key))
+                except OSError:
+                    pass
+
+
+  # Drop everything (files included)
+
+    def clear(self):
+
+        with self.lock:
+
+            for key in self.entries:
+
+                try:
+                    os.remove(self.file_name(key))
+                except OSError:
+                    pass
+
+            self.entries.clear()
+
+            self.nbytes = 0
+
+
+  # Counts, for tuning
+
+    def stats(self):
+
+        with self.lock:
+            return { 'hits': self.hits, 'misses': self.misses, 'entries': len(self.entries), 'bytes': self.nbytes }
+
+#---------------------------------------------------------------------------------
+# MVVIEWOVERLAY   Data holder class for overlay information.
+
+# These three classes here are pure data holders to provide 
+# structure for an mViewer display.   The main one (mvView) 
+# describes the whole display and contains an arbitrary number 
+# of mvViewOverlay objects for the overlays on the main image.
+# It also contains four mViewer.mvViewFile objects for the gray or 
+# red, green, blue file info.
+
+# We also need information on image/canvas sizes and cutout
+# offsets in order to map zoom regions and picks to original
+# image coordinates and to shrink/expand the displayed region
+# to fit the window.
+
+class mvViewOverlay:
+    type         =  ""
+    visible      = True
+    coord_sys    =  ""
+    color        =  ""
+    data_file    =  ""
+    data_col     =  ""
+    data_ref     =  ""
+    data_type    =  ""
+    sym_size     =  ""
+    sym_type     =  ""
+    sym_sides    =  ""
+    sym_rotation =  ""
+    lon          =  ""
+    lat          =  ""
+    text         =  ""
+ 
+        
+  # Standard object "string" representation
+
+    def __str__(self):
+
+        thisObj = dir(self)
+
+        string = ""
+
+        for item in thisObj:
+
+            val = getattr(self, item)
+
+            if item[0:2] == "__": 
+                continue
+
+            if val == "": 
+                continue
+
+            substr = "%40s" % (item)
+
+            if isinstance(val, str):
+                string += substr + ": '" + str(val) + "'\n"
+            else:
+                string += substr + ": " + str(val) + "\n"
+
+        return string
+
+
+  # Standard object "representation" string
+
+    def __repr__(self):
+
+        thisObj = dir(self)
+
+        string = "{"
+
+        count = 0
+
+        for item in thisObj:
+
+            val = getattr(self, item)
+
+            if item[0:2] == "__": 
+                continue
+
+            if val == "": 
+                continue
+
+            objType = val.__class__.__name__
+
+            if count > 0:
+                string += ", "
+
+
+            if objType == "bool":
+
+                if val == True:
+                    string += '"' + item + '": true'
+                elif val == False:
+                    string += '"' + item + '": false'
+
+            else:
+
+                if isinstance(val, str):
+                    try:
+                        float(val)
+                        string += '"' + item + '": ' + str(val)
+                    except:
+                        string += '"' + item + '": "' + str(val) + '"'
+                else:
+                    string += '"' + item + '": ' + repr(val)
+
+            count += 1
+
+        string += "}"
+
+        return string
+
+#---------------------------------------------------------------------------------
+
+
+#---------------------------------------------------------------------------------
+# MVVIEWFILE  Data holder class for image file information.
+
+class mvViewFile:
+    fits_file    = ""
+    color_table  = ""
+    stretch_min  = ""
+    stretch_max  = ""
+    stretch_mode = ""
+    min          = ""
+    max          = ""
+    data_min     = ""
+    data_max     = ""
+    min_sigma    = ""
+    max_sigma    = ""
+    min_percent  = ""
+    max_percent  = ""
+    # bunit        = ""
+
+
+  # Standard object "string" representation
+
+    def __str__(self):
+
+        thisObj = dir(self)
+
+        string = ""
+
+        for item in thisObj:
+
+            val = getattr(self, item)
+
+            if item[0:2] == "__": 
+                continue
+
+            if val == "": 
+                continue
+
+            substr = "%40s" % (item)
+
+            string += substr + ": '" + str(val) + "'\n"
+
+        return string
+
+
+  # Standard object "representation" string
+
+    def __repr__(self):
+
+        thisObj = dir(self)
+
+        string = "{"
+
+        count = 0
+
+        for item in thisObj:
+
+            val = getattr(self, item)
+
+            if item[0:2] == "__": 
+                continue
+
+            if val == "": 
+                continue
+
+            if count > 0:
+                string += ", "
+
+            if isinstance(val, str):
+                try:
+                    float(val)
+                    string += '"' + item + '": ' + str(val)
+                except:
+                    string += '"' + item + '": "' + str(val) + '"'
+            else:
+                string += '"' + item + '": ' + repr(val)
+
+            count += 1
+
+        string += "}"
+
+        return string
+
+#---------------------------------------------------------------------------------
+
+
+#---------------------------------------------------------------------------------
+# MVVIEW  Data holder class for the whole view.
+#
+# These are the quantities that we use to populate the update structure every 
+# time the image on the screen changes in any way.
+
+class mvView:
+
+  # Default values (to be overridden by actual image information)
+
+    image_file      = "viewer.png"
+    image_type      = "png"
+    disp_width      = "1000"
+    disp_height     = "1000"
+    image_width     = "1000"
+    image_height    = "1000"
+
+    display_mode    = ""
+
+    mosaic_header   = ""
+    mosaic_frames   = ""
+
+    cutout_x_offset = ""
+    cutout_y_offset = ""
+    canvas_height   = 1000
+    canvas_width    = 1000
+    xmin            = ""
+    ymin            = ""
+    xmax            = ""
+    ymax            = ""
+    factor          = ""
+
+    tile_key        = ""
+    tile_level      = ""
+    tile_size       = ""
+
+    pixel_key       = ""
+
+    layer_keys      = ""
+
+    currentPickX = 0
+    currentPickY = 0
+
+    current_color           = "black"
+
+    current_symbol_type     = "circle"
+    current_symbol_size     =  1.0
+    current_symbol_sides    =  ""
+    current_symbol_rotation =  ""
+
+    current_coord_sys       = "Equ J2000"
+
+    gray_file  = mvViewFile()
+    red_file   = mvViewFile()
+    green_file = mvViewFile()
+    blue_file  = mvViewFile()
+
+    bunit = "DN"
+
+    overlay = []
+
+
+  # Standard object "string" representation
+
+    def __str__(self):
+
+        thisObj = dir(self)
+
+        string = "\n"
+
+        count = 0
+
+        for item in thisObj:
+
+            val = getattr(self, item)
+
+            if item[0:2] == "__": 
+                continue
+
+            if item == 'json_update':
+                continue
+
+            if item == 'update_view':
+                continue
+
+            if val == "": 
+                continue
+
+            substr = "%25s" % (item)
+
+            objType = val.__class__.__name__
+
+            if objType == 'str':
+                string += substr + ": '" + str(val) + "'\n"
+
+            elif objType == 'list':
+
+                string += substr + ":\n"
+
+                count = 0
+                for ovly in val:
+                   label = "%38s %d:\n" % ("Overlay", count)
+
+                   string += label
+                   string += ovly.__str__() 
+
+                   count += 1
+
+            elif objType == 'mvViewFile':
+
+                string += substr + ":\n"
+
+                string += val.__str__() 
+
+            else:
+                string += substr + ": " + str(val) + "\n"
+
+            count += 1
+
+        string += "\n"
+
+        return string
+
+
+  # Standard object "representation" string
+
+    def __repr__(self):
+
+        thisObj = dir(self)
+
+        string = "{"
+
+        count = 0
+
+        for item in thisObj:
+
+            val = getattr(self, item)
+
+
+            if item[0:2] == "__": 
+                continue
+
+            objType = val.__class__.__name__
+
+            if objType == "instancemethod":
+                continue
+
+            if objType == "builtin_function_or_method":
+                continue
+
+            if val == "": 
+                continue
+
+            if count > 0:
+                string += ", "
+
+            if isinstance(val, str):
+                try:
+                    float(val)
+                    string += '"' + item + '": ' + str(val)
+                except:
+                    string += '"' + item + '": "' + str(val) + '"'
+            else:
+                string += '"' + item + '": ' + repr(val)
+
+            count += 1
+
+        string += "}"
+
+        return string
+
+
+  # Updates coming from Javascript will be in the form of a JSON string.  
+  # This method loads the view with the contents of such.
+
+    def json_update(self, json_str):
+
+        json_dict = json.loads(json_str)
+
+        self.update_view(json_dict, 0, None)
+        
+
+  # The above code turns the JSON string into a Python dictionary
+  # This routine recursively transfers the values in that dictionary
+  # to this mvView object.  We don't yet deal with the possibility
+  # of the JSON having different structure from the current object;
+  # that would complicate things considerably.  
+  #
+  # If needed in future iterations of the application, we will
+  # deal with updates (e.g. adding an overlay or switching between
+  # grayscale and color) via separate commands.
+
+    def update_view(self, parms, index, parents):
+
+        if parents is None:
+           parents = []
+ 
+        for key, val in parms.iteritems():
+ 
+            newlist = list(parents)
+ 
+            if len(newlist) > 0:
+                newlist.append(index)
+ 
+            newlist.append(str(key))
+ 
+            objType = val.__class__.__name__
+ 
+            if objType == "float" or objType == "int" or objType == "str" or objType == "unicode" or objType == "bool":
+ 
+                newlist.append(str(key))
+ 
+                depth = len(newlist)
+ 
+                depth = depth / 2
+ 
+                element = self
+ 
+                for i in range(0, depth-1):
+ 
+                    name = newlist[2 * i]
+                    ind  = newlist[2 * i + 1]
+ 
+                    element = getattr(element, name)
+ 
+                    elementType = element.__class__.__name__
+ 
+                    if elementType == "list":
+                        element = element[ind]
+ 
+                if objType == "unicode":
+                    setattr(element, str(key), str(val))
+                else:
+                    setattr(element, str(key), val)
+ 
+            elif objType == "list":
+                 count = 0
+                 for list_item in val:
+                   self.update_view(list_item, count, newlist)
+                   count = count + 1
+ 
+            elif objType == "dict":
+                self.update_view(val, 0, newlist)
+ 
+            else:
+                print "ERROR> Object in our dictionary?  Should not be possible."
+
+#---------------------------------------------------------------------------------
+
+
+#---------------------------------------------------------------------------------
+# MVMAINHANDLER  Tornado support class for the index.html download.
+
+# This and the next object are used by Tornado as document type handlers 
+# for its web server functionality.  This one is for retrieving "index.html";
+# the next for processing commands sent from Javascript.  Our tornado instance
+# actually uses one more: a built-in method for simple file retrieval (which
+# we use to get a bunch of static files like Javascript libraries and banner
+# images to the browser.
+
+class mvMainHandler(tornado.web.RequestHandler):
+
+  # This object needs the workspace 
+
+    def initialize(self, data):
+
+        self.data      = data
+        self.workspace = self.data['workspace']
+
+
+  # The initialization GET returns the index.html
+  # file we put in the workspace
+
+    def get(self):
+    
+        loader = tornado.template.Loader(".")
+
+        self.write(loader.load(self.workspace + "/index.html").generate())
+
+#---------------------------------------------------------------------------------
+
+
+#---------------------------------------------------------------------------------
+# MVCOMMANDQUEUE  Browser commands waiting to be run.
+#
+# Clicking "zoom in" five times quickly sends five commands, each of
+# which used to be fully rendered in turn (with the web server stuck
+# the whole time).  Instead, commands go into this queue and are run
+# in order on the viewer's render thread pool (one batch at a time),
+# leaving the web server free.  There is one queue per viewer, which
+# every browser connection feeds, so commands for the same view never
+# run side by side (the cancel and defer flags they set are the 
+# viewer's).  Commands that change the view (zooms, pans, updates) 
+# are cheap to apply but expensive to display, so when more than one
+# is waiting all but the last are applied without making the image.
+# And if a new view change arrives while a display is being made, 
+# that display is abandoned (its Montage processes killed).  So
+# however fast the commands come in, the wait is at most one render.
+
+class mvCommandQueue(object):
+
+    view_commands = ['update',      'submitUpdateRequest', 'initialize',
+                     'zoom',        'zoomIn',      'zoomOut',    'zoomReset', 'center',
+                     'panUp',       'panDown',     'panLeft',    'panRight',
+                     'panUpLeft',   'panUpRight',  'panDownLeft','panDownRight']
+
+    def __init__(self, viewer):
+
+        self.viewer    = viewer
+        self.messages  = []
+        self.current   = None
+        self.running   = False
+        self.condition = Condition()
+
+
+    def is_view_command(self, message):
+
+        return message.split(" ", 1)[0] in self.view_commands
+
+
+  # Add a command (called from the web server)
+
+    def put(self, message):
+
+        with self.condition:
+
+            self.messages.append(message)
+
+            if self.is_view_command(message) and self.current is not None and self.is_view_command(self.current):
+
+                if self.viewer.debug:
+                    print "DEBUG> Cancelling display for '" + self.current + "'"
+
+                self.viewer.cancel_render()
+
+            if not self.running:
+                self.running = True
+                self.viewer.submit(self.run)
+
+        self.viewer.cancel_prefetch()
+
+
+  # The worker: take everything that has come in and run it, 
+  # skipping the display for superseded views, until there is
+  # nothing left
+
+    def run(self):
+
+        while True:
+
+            with self.condition:
+
+                if len(self.messages) == 0:
+                    self.running = False
+                    return
+
+                batch = self.messages
+                self.messages = []
+
+            last_view = -1
+
+            for i in range(len(batch)):
+                if self.is_view_command(batch[i]):
+                    last_view = i
+
+            for i in range(len(batch)):
+
+                with self.condition:
+                    self.viewer.renderCancelled = False
+                    self.current = batch[i]
+
+                self.viewer.deferDisplay = self.is_view_command(batch[i]) and i < last_view
+
+                try:
+                    self.viewer.from_browser(batch[i])
+
+                except Exception as e:
+
+                    if self.viewer.renderCancelled:
+
+                        if self.viewer.debug:
+                            print "DEBUG> Display for '" + batch[i] + "' cancelled."
+
+                        try:
+                            with self.viewer.renderLock:
+                                self.viewer.update_geometry()
+                        except Exception:
+                            pass
+
+                    else:
+                        print "ERROR: " + str(e)
+                        sys.stdout.write('\n>>> ')
+                        sys.stdout.flush()
+
+                finally:
+
+                    self.viewer.deferDisplay = False
+
+                    with self.condition:
+                        self.current = None
+
+#---------------------------------------------------------------------------------
+
+
+#---------------------------------------------------------------------------------
+# MVWSHANDLER  Tornado support class for browser "processing" requests.
+
+class mvWSHandler(tornado.websocket.WebSocketHandler):
+
+  # The methods of this tornado RequestHandler are
+  # predefined; we just fill in the functionality we
+  # need.  We make use of the intialization method
+  # to give the mViewer object a handle to this 
+  # webserver (which it needs for sending messages
+  # to the browser).
+
+    def initialize(self, data):
+
+        self.debug = False
+        
+        self.data      = data;
+        self.viewer    = self.data['viewer']
+        self.view      = self.viewer.view
+        self.loop      = tornado.ioloop.IOLoop.current()
+
+        self.outbox     = []
+        self.outboxSize = 1000     # Messages held before senders have to wait
+        self.flushing   = False    # A flush is scheduled or a frame is being written
+        self.closed     = False
+        self.condition  = Condition()
+        self.loopThread = current_thread().ident
+
+        self.viewer.webserver = self
+
+
+  # This is another "pre-defined" tornado method.
+  # If the browser sends a message that it is shutting
+  # down, we take the oppurtunity to delete the workspace
+
+    def open(self):
+
+        if self.debug:
+           print "mvWSHandler.open()"
+
+        self.write_message("mViewer python server connection accepted.")
+        self.write_message("")
+
+
+  # This is where we process "commands" coming
+  # from the browser.  These are things like 
+  # resize, zoom and pick events.  All we do 
+  # in the webserver code is to pass them along
+  # to mViewer for processing (through its 
+  # command queue, so we don't wait for them).
+
+    def on_message(self, message):
+
+        if self.debug:
+           print "mvWSHandler.on_message('" + message + "')"
+
+        self.viewer.queue.put(message)
+
+
+  # Messages to the browser can come from other threads (the 
+  # command queue, the Python prompt) but the websocket can only
+  # be written from the web server's own thread.  So we queue 
+  # them up and have that thread send everything that has 
+  # accumulated as one frame, one message per line.  Only one 
+  # frame is written at a time; if the browser is slow to take 
+  # them the queue grows and, once it is full, threads other 
+  # than the web server's wait for it to drain.  Binary messages
+  # (see mViewer.push_view()) go in the same queue, so everything
+  # arrives in order, but each is a frame of its own.
+
+    def send(self, message):
+
+        self.enqueue(message)
+
+
+    def send_binary(self, data):
+
+        self.enqueue(bytearray(data))
+
+
+    def enqueue(self, message):
+
+        with self.condition:
+
+            if self.closed:
+                return
+
+            if current_thread().ident != self.loopThread:
+
+                while len(self.outbox) >= self.outboxSize and not self.closed:
+                    self.condition.wait(1.)
+
+            self.outbox.append(message)
+
+            if self.flushing:
+                return
+
+            self.flushing = True
+
+        self.loop.add_callback(self.send_outbox)
+
+
+  # Write out whatever is queued (web server thread only)
+
+    def send_outbox(self):
+
+        with self.condition:
+
+            if len(self.outbox) == 0:
+                self.flushing = False
+                return
+
+            count = 0
+
+            while count < len(self.outbox) and not isinstance(self.outbox[count], bytearray):
+                count += 1
+
+            binary = count == 0
+
+            if binary:
+                count = 1
+
+            batch = self.outbox[0:count]
+            self.outbox = self.outbox[count:]
+
+            self.condition.notify_all()
+
+        try:
+            if binary:
+                future = self.write_message(bytes(batch[0]), binary=True)
+            else:
+                future = self.write_message("\n".join(batch))
+
+        except tornado.websocket.WebSocketClosedError:
+
+            with self.condition:
+                self.closed = True
+                self.outbox = []
+                self.flushing = False
+                self.condition.notify_all()
+
+            return
+
+
+      # Tornado before 4.3 doesn't say when the frame has gone;
+      # all we can do then is carry on with the next one
+
+        if future is None:
+            self.loop.add_callback(self.send_outbox)
+        else:
+            self.loop.add_future(future, lambda f: self.send_outbox())
+
+
+  # If the browser sends a message that it is shutting
+  # down, we take the oppurtunity to delete the workspace
+
+    def on_close(self):
+
+        if self.debug:
+           print "mvWSHandler.open()"
+
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+        print '\nWeb connection closed by browser. Deleting workspace.'
+
+        self.viewer.close()
+
+        print 'Exiting.\n'
+
+        os._exit(0)
+
+#---------------------------------------------------------------------------------
+
+
+#---------------------------------------------------------------------------------
+# MVTILEHANDLER  Tornado support class for tile requests (tiled mode).
+#
+# The browser asks for tiles as "tile?key=...&level=...&x=...&y=...",
+# where the key identifies the files and stretch (see mViewer.tile_state())
+# and the rest the pyramid level and tile position at that level.
+# Since a given URL always gives the same image, the browser may cache them.
+# Cached tiles are sent straight back; others are rendered on the render 
+# thread pool so the web server can carry on with other requests.
+
+class mvTileHandler(tornado.web.RequestHandler):
+
+    def initialize(self, data):
+
+        self.data   = data
+        self.viewer = self.data['viewer']
+
+
+    @tornado.gen.coroutine
+    def get(self):
+
+        key   = self.get_argument("key")
+        level = int(self.get_argument("level"))
+        x     = int(self.get_argument("x"))
+        y     = int(self.get_argument("y"))
+
+        try:
+            png = self.viewer.cached_tile(key, level, x, y)
+
+            if png is None:
+                png = yield self.viewer.submit(self.viewer.get_tile, key, level, x, y)
+
+        except Exception as e:
+
+            if self.viewer.debug:
+                print "DEBUG> Tile " + key + " [" + str(level) + ", " + str(x) + ", " + str(y) + "] failed: " + str(e)
+
+            raise tornado.web.HTTPError(404)
+
+        self.set_header("Content-Type",  "image/png")
+        self.set_header("Cache-Control", "max-age=3600")
+
+        self.write(png)
+
+#---------------------------------------------------------------------------------
+
+
+#---------------------------------------------------------------------------------
+# MVCOLORTABLEHANDLER  Tornado handler for color table requests.
+#
+# When the browser is doing the stretching (see mViewer.clientStretch)
+# it needs the color tables as RGB values.  Rather than keep a second
+# copy of them in Javascript, we have the mViewer executable draw each 
+# one (a 256 x 1 ramp through the table) the first time it is asked for.
+
+class mvColorTableHandler(tornado.web.RequestHandler):
+
+    def initialize(self, data):
+
+        self.data   = data
+        self.viewer = self.data['viewer']
+
+
+    @tornado.gen.coroutine
+    def get(self):
+
+        try:
+            color_table = int(self.get_argument("ct"))
+
+            png = yield self.viewer.submit(self.viewer.get_color_table, color_table)
+
+        except Exception as e:
+
+            if self.viewer.debug:
+                print "DEBUG> Color table " + self.get_argument("ct", "") + " failed: " + str(e)
+
+            raise tornado.web.HTTPError(404)
+
+        self.set_header("Content-Type",  "image/png")
+        self.set_header("Cache-Control", "max-age=3600")
+
+        self.write(png)
+
+#---------------------------------------------------------------------------------
+
+
+#---------------------------------------------------------------------------------
+# MVTHREAD  Second thread, for running Tornado web server.
+
+# Since we want to have the web window containing mViewer open 
+# while still allowing interactive Python processing, we need 
+# to put the Tornado connection in a separate thread.
+
+class mvThread(Thread):
+ 
+    def __init__(self, port, workspace, viewer, view):
+        
+        Thread.__init__(self)
+
+        self.remote    = None
+        self.port      = port
+        self.workspace = workspace
+        self.view      = view
+        self.viewer    = viewer
+
+        self.handler   = mvWSHandler
+
+        self.debug = False
+
+        self.daemon = True    # If we make the thread a daemon, 
+                              # it closes when the process finishes.
+ 
+    def run(self):
+
+        if self.workspace is None:
+            print "Please set a workspace location first."
+            return
+
+        data = dict(view=self.view, viewer=self.viewer, port=self.port, workspace=self.workspace)
+
+        application = tornado.web.Application([
+            (r'/ws',   mvWSHandler,                   dict(data=data)),
+            (r'/',     mvMainHandler,                 dict(data=data)),
+            (r'/tile', mvTileHandler,                 dict(data=data)),
+            (r'/colortable', mvColorTableHandler,     dict(data=data)),
+            (r"/(.*)", tornado.web.StaticFileHandler, {"path": self.workspace})
+        ])
+
+
+      # Here we would populate the workspace and configure
+      # its specific index.html to use this specific port
+
+        application.listen(self.port)
+
+        if self.debug:
+            print "DEBUG> mvThread: port = " + str(self.port)
+
+        if self.viewer.serverMode:
+
+            host = socket.getfqdn()
+
+            print "Cut/paste the following into your browser: http://" + host + ":" + str(self.port)
+
+        else:
+
+            platform = sys.platform.lower()
+
+            browser = "firefox"
+
+            if platform == 'darwin':
+                browser = "safari"
+            elif platform.find("win") == 0: 
+                browser = "C:/Program\ Files\ (x86)/Mozilla\ Firefox/firefox.exe %s"
+
+            if self.debug:
+                print "DEBUG> mvThread: browser = [" + str(browser) + "]"
+
+            webbrowser.get(browser).open("localhost:" + str(self.port))
+
+
+        tornado.ioloop.IOLoop.instance().start()
+
+#---------------------------------------------------------------------------------
+
+
+#---------------------------------------------------------------------------------
+# MVIEWER  Main entry point.  We name the three "main" parts of the
+# system (this Python entry point, the Javascript main entry point,
+# and the back-end C image generation utility all "mViewer" to 
+# identify them as a set.
+
+class mViewer():
+
+    image_suffixes = { 'png' : '.png',
+                       'png8': '.png',
+                       'jpeg': '.jpg',
+                       'webp': '.webp' }
+
+
+  # Initialization (mostly setting up the workspace)
+
+    def __init__(self, *arg):
+
+        self.debug = False
+
+        self.serverMode = False
+
+        nargs = len(arg)
+
+        if nargs == 0:
+            workspace = tempfile.mkdtemp(prefix="mvWork_", dir=".")
+        else:
+            workspace = arg[0]
+
+        workspace = workspace.replace("\\", "/")
+
+        try:
+            os.makedirs(workspace)
+
+        except OSError as exception:
+
+            if exception.errno != errno.EEXIST:
+                raise
+                return
+
+        self.workspace = workspace
+        self.view      = mvView()
+
+        self.useMemmap  = True       # In-process cutouts (NumPy); mSubimage otherwise
+        self.shrinkMode = "average"  # In-process shrinking: "average" or "sample"
+
+        self.usePyramid = True       # Render zoomed-out views from image pyramids
+        self.cacheDir   = ""         # Where pyramids go (default: the workspace)
+        self.pyramids   = {}
+
+        self.useIndex   = True       # Build indexes (sums, extremes) for pick statistics
+        self.pickRadius = 31         # Pick statistics radius (pixels)
+        self.indexes    = {}
+
+        self.cullCatalogs     = True                # Give mViewer only the catalog rows in view
+        self.catalogCacheSize = 64 * 1024 * 1024    # Cut-down catalog cache limit (bytes)
+        self.catalogCache     = None
+        self.catalogs         = {}
+
+        self.cullFootprints = True   # Give mViewer only the image footprints in view
+        self.footprints     = {}
+
+        self.tiledMode     = False              # Browser builds the view from tiles
+        self.tileSize      = 256                # Tile size (pixels at the tile's level)
+        self.tileCacheSize = 256 * 1024 * 1024  # Tile cache limit (bytes)
+        self.tileCache     = None
+        self.tileStates    = {}
+        self.stretches     = {}
+
+        self.imageInfo     = {}      # Image metadata, by file
+
+        self.stretchScope      = "global"   # Stretch limits from the whole image ("global"), 
+                                            # the view ("local") or left to mViewer ("render")
+        self.stretchResolved   = False
+        self.resolvedStretches = {}
+
+        self.overlayLayers  = False              # Overlays drawn as separate layers (always when tiled)
+        self.layerCacheSize = 64 * 1024 * 1024   # Overlay layer cache limit (bytes)
+        self.layerCache     = None
+
+        self.clientStretch  = False              # Browser applies the stretch and color table
+        self.pixelCacheSize = 64 * 1024 * 1024   # View pixel value cache limit (bytes)
+        self.pixelCache     = None
+        self.colorTables    = {}
+
+        self.channelWorkers = 3      # Color channels processed at once
+        self.channelPool    = None
+
+        self.mosaicWorkers  = 4      # Images sampled at once in mosaic mode
+        self.mosaicPool     = None
+        self.mosaics        = {}
+
+        self.stages = {}             # Last key and result of each display stage
+
+        self.renderCacheSize = 128 * 1024 * 1024   # Rendered view cache limit (bytes)
+        self.renderCache     = None
+
+        self.pushImages       = False   # Send views over the websocket (if the browser can take them)
+        self.binaryClient     = False
+
+        self.imageFormat      = "png"   # How views are sent: "png", "png8" (palette), "jpeg" or "webp"
+        self.imageQuality     = 85      # JPEG/WebP quality (1-100)
+        self.imageCompression = ""      # PNG compression level (0-9; "" leaves mViewer's PNG alone)
+        self.webpSupported    = None
+        self.formatWarned     = None
+
+        self.renderWorkers   = 4       # Threads for commands and tiles
+        self.executor        = None
+
+        self.montageWorkers  = 8       # Montage programs allowed to run at once
+        self.montageTimeout  = 300.    # Seconds before a Montage program is killed
+        self.montageBin      = ""      # Where the Montage programs are (default: PATH)
+        self.runner          = None
+
+        self.queue           = mvCommandQueue(self)   # Browser commands (from every connection)
+
+        self.renderLock      = RLock() # Held while a command or display is being made
+
+        self.deferDisplay    = False   # Set while running a superseded command
+        self.renderCancelled = False
+        self.processes       = []      # Montage processes making the display
+        self.processLock     = Lock()
+
+        self.prefetch        = False   # Render likely next views in the background
+        self.prefetchCount   = 0
+        self.prefetchCancel  = None
+        self.prefetchProcess = None
+        self.lastCommand     = ""
+
+        self.pick_callback = self.pick_location
+
+
+  # Use the webserver connection to write commands
+  # to the Javascript in the browser.
+
+    def to_browser(self, msg):
+
+        if self.debug:
+            print "DEBUG> mViewer.to_browser('" + msg + "')"
+
+        self.webserver.send(msg)
+
+
+  # Send the browser a view (image and JSON) as one binary websocket 
+  # message instead of telling it to fetch them: a 4-byte (little-
+  # endian) header length, the header (JSON: the image's file name 
+  # and type and the view) and the image file's contents.  Saves the
+  # browser two HTTP requests.  Returns False if we aren't doing this
+  # or the browser hasn't said it can take them.
+
+    def push_view(self, image_file):
+
+        if not self.pushImages or not self.binaryClient:
+            return False
+
+        fp = open(self.workspace + "/" + image_file, 'rb')
+
+        try:
+            data = fp.read()
+        finally:
+            fp.close()
+
+        mime = mimetypes.guess_type(image_file)[0]
+
+        if mime is None:
+            mime = "image/png"
+
+        header = '{"cmd": "image", "file": ' + json.dumps(image_file) + ', "mime": ' + json.dumps(mime) + ', "view": ' + repr(self.view) + '}'
+
+        if self.debug:
+            print "DEBUG> mViewer.push_view('" + image_file + "'): " + str(len(data)) + " bytes"
+
+        self.webserver.send_binary(struct.pack('<I', len(header)) + header + data)
+
+        return True
+
+
+  # Shutdown (remove workspace and delete temporary files - subimages, etc.)
+
+    def close(self):
+
+        if self.debug:
+            print "DEBUG> Cache statistics: " + str(self.cache_stats())
+
+            if self.runner is not None:
+                print "DEBUG> Montage timing: " + str(self.runner.stats())
+
+        try:
+            files = os.listdir(self.workspace)
+
+            for file in files:
+
+                if self.debug:
+                    print "Deleting " + self.workspace + "/" + file
+
+                if os.path.isdir(self.workspace + "/" + file):
+                    shutil.rmtree(self.workspace + "/" + file)
+                else:
+                    os.remove(self.workspace + "/" + file)
+        except:
+            print "Workspace cleanup failed."
+
+        try:
+            os.rmdir(self.workspace)
+        except:
+            print "Workspace directory ('" + self.workspace + "') delete failed"
+
+        try:
+            self.command("close")
+
+            print "Browser connection closed."
+
+        except:
+            print "No active browser connection."
+
+        # Failure or incomplete execution of a close may result in 
+        # extraneous temporary files in the work directory, which
+        # must be removed manually.
+
+
+  # Hit/miss counts and sizes for the render and tile caches
+
+    def cache_stats(self):
+
+        stats = {}
+
+        if self.renderCache is not None:
+            stats['render'] = self.renderCache.stats()
+
+        if self.tileCache is not None:
+            stats['tile'] = self.tileCache.stats()
+
+        return stats
+
+
+  # Utility function: set the display mode (grayscale / color)
+
+    def set_display_mode(self, mode):
+
+        mode = str(mode)
+
+        if len(mode) == 0:
+           mode = "grayscale"
+
+        if mode[0] == 'g':
+            self.view.display_mode = "grayscale"
+
+        if mode[0] == 'G':
+            self.view.display_mode = "grayscale"
+
+        if mode[0] == 'b':
+            self.view.display_mode = "grayscale"
+
+        if mode[0] == 'B':
+            self.view.display_mode = "grayscale"
+
+        if mode[0] == 'r':
+            self.view.display_mode = "color"
+
+        if mode[0] == 'R':
+            self.view.display_mode = "color"
+
+        if mode[0] == 'c':
+            self.view.display_mode = "color"
+
+        if mode[0] == 'C':
+            self.view.display_mode = "color"
+
+        if mode[0] == 'f':
+            self.view.display_mode = "color"
+
+        if mode[0] == 'F':
+            self.view.display_mode = "color"
+
+        if mode[0] == 'm':
+            self.view.display_mode = "mosaic"
+
+        if mode[0] == 'M':
+            self.view.display_mode = "mosaic"
+
+
+  # Utility function: set the gray_file
+
+    def set_gray_file(self, gray_file):
+
+        self.view.gray_file.fits_file = gray_file
+
+        self.index_file(gray_file)
+
+        if self.view.display_mode == "":
+            self.view.display_mode = "grayscale"
+
+
+  # Utility function: set the blue_file
+
+    def set_blue_file(self, blue_file):
+
+        self.view.blue_file.fits_file = blue_file
+
+        self.index_file(blue_file)
+
+        if self.view.display_mode == "":
+            if self.view.red_file.fits_file != "" and self.view.green_file.fits_file != "":
+                self.view.display_mode = "color"
+
+
+  # Utility function: set the green_file
+
+    def set_green_file(self, green_file):
+
+        self.view.green_file.fits_file = green_file
+
+        self.index_file(green_file)
+
+        if self.view.display_mode == "":
+            if self.view.red_file.fits_file != "" and self.view.blue_file.fits_file != "":
+                self.view.display_mode = "color"
+
+
+  # Utility function: set the red_file
+
+    def set_red_file(self, red_file):
+
+        self.view.red_file.fits_file = red_file
+
+        self.index_file(red_file)
+
+        if self.view.display_mode == "":
+            if self.view.green_file.fits_file != "" and self.view.blue_file.fits_file != "":
+                self.view.display_mode = "color"
+
+
+  # Utility function: view a mosaic of the images in a metadata table
+  # on the grid of a header template, without making it (see mvMosaic).
+  # The table stands in for the gray file; the stretch and color table
+  # are set as for a grayscale image.
+
+    def set_mosaic(self, table_file, header_file):
+
+        self.view.gray_file.fits_file = table_file
+        self.view.mosaic_header       = header_file
+        self.view.display_mode        = "mosaic"
+
+        if numpy is not None:
+
+            try:
+                self.get_mosaic()
+
+            except Exception as e:
+
+                if self.debug:
+                    print "DEBUG> Mosaic not set up (" + str(e) + ")"
+
+
+  # Utility function: set the current_color
+
+    def set_current_color(self, current_color):
+
+        self.view.current_color = current_color
+
+
+  # Utility function: set the currentSymbol
+
+    def set_current_symbol(self, *arg):
+    
+        nargs = len(arg)
+
+        symbol_sides    = ""
+        symbol_rotation = ""
+
+        symbol_size     = arg[0]
+        symbol_type     = arg[1]
+
+        if nargs > 2:
+            symbol_sides = arg[2]
+
+        if nargs > 3:
+            symbol_rotation = arg[3]
+
+        self.view.current_symbol_size     = symbol_size
+        self.view.current_symbol_type     = symbol_type
+        self.view.current_symbol_sides    = symbol_sides
+        self.view.current_symbol_rotation = symbol_rotation
+
+
+  # Utility function: set the coord_sys
+
+    def set_current_coord_sys(self, coord_sys):
+
+        self.view.current_coord_sys = coord_sys
+
+
+  # Utility function: set the color table (grayscale file)
+
+    def set_color_table(self, color_table):
+
+        self.view.gray_file.color_table = color_table
+
+
+  # Utility function: set the grayscale color stretch
+
+    def set_gray_stretch(self, stretch_min, stretch_max, stretch_mode):
+
+        self.view.gray_file.stretch_min  = stretch_min
+        self.view.gray_file.stretch_max  = stretch_max
+        self.view.gray_file.stretch_mode = stretch_mode
+
+
+  # Utility function: set the blue color stretch
+
+    def set_blue_stretch(self, stretch_min, stretch_max, stretch_mode):
+
+        self.view.blue_file.stretch_min  = stretch_min
+        self.view.blue_file.stretch_max  = stretch_max
+        self.view.blue_file.stretch_mode = stretch_mode
+
+
+  # Utility function: set the green color stretch
+
+    def set_green_stretch(self, stretch_min, stretch_max, stretch_mode):
+
+        self.view.green_file.stretch_min  = stretch_min
+        self.view.green_file.stretch_max  = stretch_max
+        self.view.green_file.stretch_mode = stretch_mode
+
+
+  # Utility function: set the red color stretch
+
+    def set_red_stretch(self, stretch_min, stretch_max, stretch_mode):
+
+        self.view.red_file.stretch_min  = stretch_min
+        self.view.red_file.stretch_max  = stretch_max
+        self.view.red_file.stretch_mode = stretch_mode
+
+
+  # Utility function: add a grid overlay
+
+    def add_grid(self, coord_sys):
+
+        ovly = mvViewOverlay()
+
+        ovly.type     = "grid"
+        ovly.visible  =  True
+        ovly.color    =  self.view.current_color
+        ovly.coord_sys =  coord_sys
+
+        self.view.overlay.append(ovly)
+
+        return ovly
+
+
+  # Utility function: add a catalog overlay
+
+    def add_catalog(self, data_file, data_col, data_ref, data_type):
+
+        ovly = mvViewOverlay()
+
+        ovly.type         = "catalog"
+        ovly.visible      =  True
+        ovly.sym_size     =  self.view.current_symbol_size
+        ovly.sym_type     =  self.view.current_symbol_type
+        ovly.sym_sides    =  self.view.current_symbol_sides
+        ovly.sym_rotation =  self.view.current_symbol_rotation
+        ovly.coord_sys    =  self.view.current_coord_sys
+        ovly.data_file    =  data_file
+        ovly.data_col     =  data_col
+        ovly.data_ref     =  data_ref
+        ovly.data_type    =  data_type 
+        ovly.color        =  self.view.current_color
+
+        self.view.overlay.append(ovly)
+
+        self.get_catalog_index(data_file, data_col)
+
+        return ovly
+
+
+  # Utility function: add an imginfo overlay
+
+    def add_img_info(self, data_file):
+
+        ovly = mvViewOverlay()
+
+        ovly.type      = "imginfo"
+        ovly.visible   = True
+        ovly.data_file = data_file
+        ovly.color     = self.view.current_color
+        ovly.coord_sys = self.view.current_coord_sys
+
+        self.view.overlay.append(ovly)
+
+        self.get_footprint_index(data_file)
+
+        return ovly
+
+
+  # Utility function: add a marker overlay
+
+    def add_marker(self, lon, lat):
+
+        ovly = mvViewOverlay()
+
+        ovly.type         = "mark"
+        ovly.visible      =  True
+        ovly.sym_size     =  self.view.current_symbol_size
+        ovly.sym_type     =  self.view.current_symbol_type
+        ovly.sym_sides    =  self.view.current_symbol_sides
+        ovly.sym_rotation =  self.view.current_symbol_rotation
+        ovly.lon          =  lon
+        ovly.lat          =  lat
+        ovly.coord_sys    =  self.view.current_coord_sys
+        ovly.color        =  self.view.current_color
+
+        self.view.overlay.append(ovly)
+
+        return ovly
+
+
+  # Utility function: add a label overlay
+
+    def add_label(self, lon, lat, text):
+
+        ovly = mvViewOverlay()
+
+        ovly.type      = "label"
+        ovly.visible   =  True
+        ovly.lon       =  lon
+        ovly.lat       =  lat
+        ovly.text      =  text
+        ovly.coord_sys =  self.view.current_coord_sys
+        ovly.color     =  self.view.current_color
+
+        self.view.overlay.append(ovly)
+
+        return ovly
+
+
+  # This utility function is used by load_JSON() below
+  # to convert any unicode to simple printable ASCII
+
+    def fix_unicode(self, input):
+        if isinstance(input, unicode):
+            return input.encode('ascii')
+        else:
+            return input
+
+
+  # Load the view object with data described in a JSON file
+
+    def load_JSON(self, json_file):
+
+        # Open the JSON file and parse the contents
+
+        try:
+
+            fp = open(json_file, 'r')
+
+            json_data = json.load(fp)
+
+        except:
+            print "JSON file open failed."
+            os._exit(0)
+
+            return
+
+        # Loop over the contents, loading them into the view object
+        # This is going to add to the existing view (replace in the
+        # case of image parmeters), so the user should zero the view
+        # out if they want a clean start.
+
+        # First check and see if we want modify the image parameters
+
+        if "image" in json_data:
+            
+            image = json_data["image"]
+
+            if "type" in image:
+
+                image_type = image["type"]
+
+
+                # Grayscale image parameters
+
+                if image_type == "grayscale":
+
+                    if "gray" in image:
+
+                        gray = image["gray"]
+
+                        if "file" in gray:
+                            file_name = self.fix_unicode(gray["file"])
+                        else:
+                            print "Required grayscale filename missing."
+
+                        color_table = 0
+                        if "color_table" in gray:
+                            color_table = self.fix_unicode(gray["color_table"])
+
+                        min_value = "-2s"
+                        if "min" in gray:
+                            min_value = self.fix_unicode(gray["min"])
+
+                        max_value = "max"
+                        if "max" in gray:
+                            max_value = self.fix_unicode(gray["max"])
+
+                        mode = "gaussian-log"
+                        if "mode" in gray:
+                            mode = self.fix_unicode(gray["mode"])
+
+                        self.set_gray_file(file_name)
+                        self.set_color_table(color_table)
+                        self.set_gray_stretch(min_value, max_value, mode)
+
+                    else:
+                        print "Grayscale image information missing."
+                        return
+
+
+                # Mosaic (image metadata table and header template) parameters
+
+                elif image_type == "mosaic":
+
+                    if "mosaic" in image:
+
+                        mosaic = image["mosaic"]
+
+                        if "table" in mosaic:
+                            table_file = self.fix_unicode(mosaic["table"])
+                        else:
+                            print "Required mosaic table filename missing."
+
+                        if "header" in mosaic:
+                            header_file = self.fix_unicode(mosaic["header"])
+                        else:
+                            print "Required mosaic header template filename missing."
+
+                        color_table = 0
+                        if "color_table" in mosaic:
+                            color_table = self.fix_unicode(mosaic["color_table"])
+
+                        min_value = "-2s"
+                        if "min" in mosaic:
+                            min_value = self.fix_unicode(mosaic["min"])
+
+                        max_value = "max"
+                        if "max" in mosaic:
+                            max_value = self.fix_unicode(mosaic["max"])
+
+                        mode = "gaussian-log"
+                        if "mode" in mosaic:
+                            mode = self.fix_unicode(mosaic["mode"])
+
+                        self.set_mosaic(table_file, header_file)
+                        self.set_color_table(color_table)
+                        self.set_gray_stretch(min_value, max_value, mode)
+
+                    else:
+                        print "Mosaic image information missing."
+                        return
+
+
+                # Color image parameters
+
+                elif image_type == "color":
+
+                    # BLUE
+
+                    if "blue" in image:
+
+                        blue = image["blue"]
+
+                        if "file" in blue:
+                            file_name = self.fix_unicode(blue["file"])
+                        else:
+                            print "Required blue filename missing."
+
+                        min_value = "-2s"
+                        if "min" in blue:
+                            min_value = self.fix_unicode(blue["min"])
+
+                        max_value = "max"
+                        if "max" in blue:
+                            max_value = self.fix_unicode(blue["max"])
+
+                        mode = "gaussian-log"
+                        if "mode" in blue:
+                            mode = self.fix_unicode(blue["mode"])
+
+                        self.set_blue_file(file_name)
+                        self.set_blue_stretch(min_value, max_value, mode)
+
+                    else:
+                        print "Blue image information missing."
+                        return
+
+
+                    # GREEN
+
+                    if "green" in image:
+
+                        green = image["green"]
+
+                        if "file" in green:
+                            file_name = self.fix_unicode(green["file"])
+                        else:
+                            print "Required green filename missing."
+
+                        min_value = "-2s"
+                        if "min" in green:
+                            min_value = self.fix_unicode(green["min"])
+
+                        max_value = "max"
+                        if "max" in green:
+                            max_value = self.fix_unicode(green["max"])
+
+                        mode = "gaussian-log"
+                        if "mode" in green:
+                            mode = self.fix_unicode(green["mode"])
+
+                        self.set_green_file(file_name)
+                        self.set_green_stretch(min_value, max_value, mode)
+
+                    else:
+                        print "Green image information missing."
+                        return
+
+
+                    # RED  
+
+                    if "red" in image:
+
+                        red = image["red"]
+
+                        if "file" in red:
+                            file_name = self.fix_unicode(red["file"])
+                        else:
+                            print "Required red filename missing."
+
+                        min_value = "-2s"
+                        if "min" in red:
+                            min_value = self.fix_unicode(red["min"])
+
+                        max_value = "max"
+                        if "max" in red:
+                            max_value = self.fix_unicode(red["max"])
+
+                        mode = "gaussian-log"
+                        if "mode" in red:
+                            mode = self.fix_unicode(red["mode"])
+
+                        self.set_red_file(file_name)
+                        self.set_red_stretch(min_value, max_value, mode)
+
+                    else:
+                        print "Red image information missing."
+                        return
+
+
+                else:
+                    print "Invalid image type: " + image_type
+                    return
+
+
+        # Now loop over any overlay specifications, adding them
+
+        if "overlays" in json_data:
+
+            overlays = json_data["overlays"]
+
+            noverlay = 0
+
+            for overlay in overlays:
+
+                noverlay = noverlay + 1
+
+                if "type" in overlay:
+                    overlay_type = self.fix_unicode(overlay["type"])
+                else:
+                    print "Invalid type for overlay " + noverlay
+                    return
+
+
+                # Check for all the potential overlay parameters
+                # Some can have default values
+
+                file_name       = ""
+                column          = ""
+                ref_value       = ""
+                data_type       = "flux"
+                symbol_type     = "circle"
+                symbol_size     = 1.0
+                symbol_sides    = ""
+                symbol_rotation = ""
+                color           = "white"
+                coord_sys       = "Equatorial J2000"
+                lon             = ""
+                lat             = ""
+                text            = ""
+
+                if "file" in overlay:
+                    file_name = self.fix_unicode(overlay["file"])
+
+                if "column" in overlay:
+                    column = self.fix_unicode(overlay["column"])
+
+                if "ref_value" in overlay:
+                    ref_value = self.fix_unicode(overlay["ref_value"])
+
+                if "data_type" in overlay:
+                    data_type = self.fix_unicode(overlay["data_type"])
+
+                if "symbol_size" in overlay:
+                    symbol_size = self.fix_unicode(overlay["symbol_size"])
+
+                if "symbol_type" in overlay:
+                    symbol_type = self.fix_unicode(overlay["symbol_type"])
+
+                if "symbol_sides" in overlay:
+                    symbol_sides = self.fix_unicode(overlay["symbol_sides"])
+
+                if "symbol_rotation" in overlay:
+                    symbol_rotation = self.fix_unicode(overlay["symbol_rotation"])
+
+                if "color" in overlay:
+                    color = self.fix_unicode(overlay["color"])
+
+                if "coord_sys" in overlay:
+                    coord_sys = self.fix_unicode(overlay["coord_sys"])
+
+                if "lon" in overlay:
+                    lon = self.fix_unicode(overlay["lon"])
+
+                if "lat" in overlay:
+                    lat = self.fix_unicode(overlay["lat"])
+
+                if "text" in overlay:
+                    text = self.fix_unicode(overlay["text"])
+
+
+                # For each overlay type, check for required parameters
+                # then call the appropriate overlay "add" function
+
+                # CATALOG
+
+                if overlay_type == "catalog":
+
+                    if file_name == "":
+                        print "No catalog file name given."
+                        return
+                    
+                    self.set_current_coord_sys(coord_sys)
+                    self.set_current_color(color)
+
+                    if symbol_sides == "":
+                        self.set_current_symbol(symbol_size, symbol_type)
+
+                    elif symbol_rotation == "":
+                        self.set_current_symbol(symbol_size, symbol_type, symbol_sides)
+
+                    else:
+                        self.set_current_symbol(symbol_size, symbol_type, symbol_sides, symbol_rotation)
+
+                    self.add_catalog(file_name, column, ref_value, data_type)
+
+
+                # IMAGE OUTLINES
+
+                elif overlay_type == "imginfo":
+
+                    if file_name == "":
+                        print "No image metadata file name given."
+                        return
+
+                    self.set_current_coord_sys(coord_sys)
+                    self.set_current_color(color)
+
+                    self.add_img_info(file_name)
+
+
+                # COORDINATE GRID
+
+                elif overlay_type == "grid":
+
+                    self.set_current_color(color)
+
+                    self.add_grid(coord_sys)
+
+
+                # LABEL         
+
+                elif overlay_type == "label":
+
+                    if text == "":
+                        print "No label text given."
+                        return
+
+                    if lon == "":
+                        print "No longitude given."
+                        return
+
+                    if lat == "":
+                        print "No latitude given."
+                        return
+
+                    self.set_current_coord_sys(coord_sys)
+                    self.set_current_color(color)
+
+                    self.add_label(lon, lat, text)
+
+
+                # MARKER
+
+                elif overlay_type == "marker":
+
+                    if lon == "":
+                        print "No longitude given."
+                        return
+
+                    if lat == "":
+                        print "No latitude given."
+                        return
+
+                    self.set_current_coord_sys(coord_sys)
+                    self.set_current_color(color)
+
+                    if symbol_sides == "":
+                        self.set_current_symbol(symbol_size, symbol_type)
+
+                    elif symbol_rotation == "":
+                        self.set_current_symbol(symbol_size, symbol_type, symbol_sides)
+
+                    else:
+                        self.set_current_symbol(symbol_size, symbol_type, symbol_sides, symbol_rotation)
+
+                    self.add_marker(lon, lat)
+
+
+                else:
+                    print "Invalid overlay type: " + overlay_type
+                    return
+
+
+
+  # Start a second thread to interact with the browser.
+
+    def init_browser_display(self):
+
+        self.port = random.randint(10000,60000)
+
+        template_file = resource_filename('agMontage', 'web/index.html')
+        index_file    = self.workspace + "/index.html"
+
+        host          = socket.getfqdn()
+        port_string   = str(self.port)
+
+        host = "localhost"
+
+        if self.serverMode:
+           host = socket.getfqdn()
+
+
+        with open(index_file,'w') as new_file:
+           with open(template_file) as old_file:
+              for line in old_file:
+                 new_file.write(line.replace("\\SERVER\\", host).replace("\\PORT\\", port_string))
+
+
+      # Copy all required web files into work directory 
+      # (includes Javascript, css, icons, etc.)
+      #---------------------------------------------------------------------------
+      # JSON files (coordinate "pick" statistic information)
+      #---------------------------------------------------------------------------
+
+        in_file  = resource_filename('agMontage', 'web/pick.json')
+        out_file = self.workspace + '/pick.json'
+        shutil.copy(in_file, out_file)
+
+        in_file  = resource_filename('agMontage', 'web/pick0.json')
+        out_file = self.workspace + '/pick0.json'
+        shutil.copy(in_file, out_file)
+
+        in_file  = resource_filename('agMontage', 'web/pick1.json')
+        out_file = self.workspace + '/pick1.json'
+        shutil.copy(in_file, out_file)
+
+        in_file  = resource_filename('agMontage', 'web/pick2.json')
+        out_file = self.workspace + '/pick2.json'
+        shutil.copy(in_file, out_file)
+
+      #---------------------------------------------------------------------------
+      # CSS files
+      #---------------------------------------------------------------------------
+
+        in_file  = resource_filename('agMontage', 'web/stylesheet01.css')
+        out_file = self.workspace + '/stylesheet01.css'
+        shutil.copy(in_file, out_file)
+
+        in_file  = resource_filename('agMontage', 'web/ColorStretch.css')
+        out_file = self.workspace + '/ColorStretch.css'
+        shutil.copy(in_file, out_file)
+
+        in_file  = resource_filename('agMontage', 'web/LayerControl.css')
+        out_file = self.workspace + '/LayerControl.css'
+        shutil.copy(in_file, out_file)
+
+        in_file  = resource_filename('agMontage', 'web/RegionStats.css')
+        out_file = self.workspace + '/RegionStats.css'
+        shutil.copy(in_file, out_file)
+
+        in_file  = resource_filename('agMontage', 'web/FITSHeaderViewer.css')
+        out_file = self.workspace + '/FITSHeaderViewer.css'
+        shutil.copy(in_file, out_file)
+
+        in_file  = resource_filename('agMontage', 'web/InfoDisplay.css')
+        out_file = self.workspace + '/InfoDisplay.css'
+        shutil.copy(in_file, out_file)
+
+        in_file  = resource_filename('agMontage', 'web/ZoomControl.css')
+        out_file = self.workspace + '/ZoomControl.css'
+        shutil.copy(in_file, out_file)
+
+        in_file  = resource_filename('agMontage', 'web/spectrum.css')
+        out_file = self.workspace + '/spectrum.css'
+        shutil.copy(in_file, out_file)
+
+      #---------------------------------------------------------------------------
+      # Javascript files
+      #---------------------------------------------------------------------------
+
+        in_file  = resource_filename('agMontage', 'web/WebClient.js')
+        out_file = self.workspace + '/WebClient.js'
+        shutil.copy(in_file, out_file)
+
+        in_file  = resource_filename('agMontage', 'web/mViewer.js')
+        out_file = self.workspace + '/mViewer.js'
+        shutil.copy(in_file, out_file)
+
+        in_file  = resource_filename('agMontage', 'web/iceGraphics.js')
+        out_file = self.workspace + '/iceGraphics.js'
+        shutil.copy(in_file, out_file)
+
+        in_file  = resource_filename('agMontage', 'web/ColorStretch.js')
+        out_file = self.workspace + '/ColorStretch.js'
+        shutil.copy(in_file, out_file)
+
+        in_file  = resource_filename('agMontage', 'web/LayerControl.js')
+        out_file = self.workspace + '/LayerControl.js'
+        shutil.copy(in_file, out_file)
+
+        in_file  = resource_filename('agMontage', 'web/RegionStats.js')
+        out_file = self.workspace + '/RegionStats.js'
+        shutil.copy(in_file, out_file)
+
+        in_file  = resource_filename('agMontage', 'web/FITSHeaderViewer.js')
+        out_file = self.workspace + '/FITSHeaderViewer.js'
+        shutil.copy(in_file, out_file)
+
+        in_file  = resource_filename('agMontage', 'web/InfoDisplay.js')
+        out_file = self.workspace + '/InfoDisplay.js'
+        shutil.copy(in_file, out_file)
+
+        in_file  = resource_filename('agMontage', 'web/ZoomControl.js')
+        out_file = self.workspace + '/ZoomControl.js'
+        shutil.copy(in_file, out_file)
+
+        in_file  = resource_filename('agMontage', 'web/spectrum.js')
+        out_file = self.workspace + '/spectrum.js'
+        shutil.copy(in_file, out_file)
+
+        in_file  = resource_filename('agMontage', 'web/viewerUtils.js')
+        out_file = self.workspace + '/viewerUtils.js'
+        shutil.copy(in_file, out_file)
+
+      #---------------------------------------------------------------------------
       # 30x30 Icons
       #---------------------------------------------------------------------------
 
-        in_file  = resource_filename('agMontage', 'web/colors.gif')
-        out_file = self.workspace + '/colors.gif'
-        shutil.copy(in_file, out_file)
+        in_file  = resource_filename('agMontage', 'web/colors.gif')
+        out_file = self.workspace + '/colors.gif'
+        shutil.copy(in_file, out_file)
+
+        in_file  = resource_filename('agMontage', 'web/info.gif')
+        out_file = self.workspace + '/info.gif'
+        shutil.copy(in_file, out_file)
+
+        in_file  = resource_filename('agMontage', 'web/layercontrol.gif')
+        out_file = self.workspace + '/layercontrol.gif'
+        shutil.copy(in_file, out_file)
+
+        in_file  = resource_filename('agMontage', 'web/pan_up.gif')
+        out_file = self.workspace + '/pan_up.gif'
+        shutil.copy(in_file, out_file)
+
+        in_file  = resource_filename('agMontage', 'web/pan_up_left.gif')
+        out_file = self.workspace + '/pan_up_left.gif'
+        shutil.copy(in_file, out_file)
+
+        in_file  = resource_filename('agMontage', 'web/pan_left.gif')
+        out_file = self.workspace + '/pan_left.gif'
+        shutil.copy(in_file, out_file)
+
+        in_file  = resource_filename('agMontage', 'web/pan_down_left.gif')
+        out_file = self.workspace + '/pan_down_left.gif'
+        shutil.copy(in_file, out_file)
+
+        in_file  = resource_filename('agMontage', 'web/pan_down.gif')
+        out_file = self.workspace + '/pan_down.gif'
+        shutil.copy(in_file, out_file)
+
+        in_file  = resource_filename('agMontage', 'web/pan_down_right.gif')
+        out_file = self.workspace + '/pan_down_right.gif'
+        shutil.copy(in_file, out_file)
+
+        in_file  = resource_filename('agMontage', 'web/pan_right.gif')
+        out_file = self.workspace + '/pan_right.gif'
+        shutil.copy(in_file, out_file)
+
+        in_file  = resource_filename('agMontage', 'web/pan_up_right.gif')
+        out_file = self.workspace + '/pan_up_right.gif'
+        shutil.copy(in_file, out_file)
+
+        in_file  = resource_filename('agMontage', 'web/center_30.gif')
+        out_file = self.workspace + '/center_30.gif'
+        shutil.copy(in_file, out_file)
+
+        in_file  = resource_filename('agMontage', 'web/center_30.png')
+        out_file = self.workspace + '/center_30.png'
+        shutil.copy(in_file, out_file)
+
+        in_file  = resource_filename('agMontage', 'web/pick_location.gif')
+        out_file = self.workspace + '/pick_location.gif'
+        shutil.copy(in_file, out_file)
+
+        in_file  = resource_filename('agMontage', 'web/zoom_in.gif')
+        out_file = self.workspace + '/zoom_in.gif'
+        shutil.copy(in_file, out_file)
+
+        in_file  = resource_filename('agMontage', 'web/zoom_out.gif')
+        out_file = self.workspace + '/zoom_out.gif'
+        shutil.copy(in_file, out_file)
+
+        in_file  = resource_filename('agMontage', 'web/zoom_reset.gif')
+        out_file = self.workspace + '/zoom_reset.gif'
+        shutil.copy(in_file, out_file)
+
+        in_file  = resource_filename('agMontage', 'web/zoom_reset_box.gif')
+        out_file = self.workspace + '/zoom_reset_box.gif'
+        shutil.copy(in_file, out_file)
+
+        in_file  = resource_filename('agMontage', 'web/zoom_pan.gif')
+        out_file = self.workspace + '/zoom_pan.gif'
+        shutil.copy(in_file, out_file)
+
+        in_file  = resource_filename('agMontage', 'web/header_icon.gif')
+        out_file = self.workspace + '/header_icon.gif'
+        shutil.copy(in_file, out_file)
+
+        in_file  = resource_filename('agMontage', 'web/eye02_30.gif')
+        out_file = self.workspace + '/eye02_30.gif'
+        shutil.copy(in_file, out_file)
+
+      #---------------------------------------------------------------------------
+      # Misc. Icons
+      #---------------------------------------------------------------------------
+
+        in_file  = resource_filename('agMontage', 'web/favicon.ico')
+        out_file = self.workspace + '/favicon.ico'
+        shutil.copy(in_file, out_file)
+
+        in_file  = resource_filename('agMontage', 'web/eye02_22.gif')
+        out_file = self.workspace + '/eye02_22.gif'
+        shutil.copy(in_file, out_file)
+
+      #---------------------------------------------------------------------------
+      # Other image files
+      #---------------------------------------------------------------------------
+
+        in_file  = resource_filename('agMontage', 'web/waitClock.gif')
+        out_file = self.workspace + '/waitClock.gif'
+        shutil.copy(in_file, out_file)
+
+        in_file  = resource_filename('agMontage', 'web/galplane_banner.jpg')
+        out_file = self.workspace + '/galplane_banner.jpg'
+        shutil.copy(in_file, out_file)
+
+        in_file  = resource_filename('agMontage', 'web/banner02.gif')
+        out_file = self.workspace + '/banner02.gif'
+        shutil.copy(in_file, out_file)
+
+      #---------------------------------------------------------------------------
+
+
+        self.thread = mvThread(self.port, self.workspace, self, self.view)
+
+        self.thread.start()
+
+
+  # The web browser thread receives any messages the Browser sends
+  # These will be commands (like "zoomIn") or requests to process an updated
+  # view send as JSON.  That thread forwards the command here.
+  #
+  # This from_browser() method does any local processing needed to modify
+  # the view, then calls the update_display() method to have a new PNG
+  # generated and appropriate instructions sent back to the browser.
+  #
+  # Commands change the view and write the workspace files, so only 
+  # one runs at a time (whatever thread it comes from); the render 
+  # thread pool otherwise only makes tiles and color channels.
+
+    def from_browser(self, message):
+
+        with self.renderLock:
+            self.run_command(message)
+
+
+    def run_command(self, message):
+
+        if self.debug:
+           print "mViewer.from_browser('" + message + "')"
+
+
+      # The browser telling us it can take views as binary websocket
+      # messages (see push_view()).  It says so as soon as it connects,
+      # possibly before there is anything to display.
+
+        if message == "binary":
+            self.binaryClient = True
+            return
+
+        self.cancel_prefetch()
+
+        self.lastCommand = shlex.split(message)[0]
+
+
+      # Find the image size
+
+        ref_file = self.view.gray_file.fits_file
+
+        if self.view.display_mode == "":
+            print "No images defined. Nothing to display."
+            sys.stdout.write('\n>>> ')
+            sys.stdout.flush()
+            return
+
+        if self.view.display_mode == "grayscale":
+            ref_file = self.view.gray_file.fits_file
+
+        if self.view.display_mode == "color":
+            ref_file = self.view.red_file.fits_file  # R, G, B files should have identical size 
+
+        info = self.image_info(ref_file)
+
+        if self.view.xmin == "":
+            self.view.xmin = 0
+
+        if self.view.xmax == "":
+            self.view.xmax = info.naxis1
+
+        if self.view.ymin == "":
+            self.view.ymin = 0
+
+        if self.view.ymax == "":
+            self.view.ymax = info.naxis2
+
+        self.view.image_width  = info.naxis1
+        self.view.image_height = info.naxis2
+
+
+      # ------------- Processing commands from the Browser -------------
+     
+
+      # COMMAND: "update"      
+      #
+      # Just do/redo the view as it stands.
+      #-----------------------------------------------------------------
+
+        args = shlex.split(message)
+
+        cmd = args[0]
+
+        if cmd == 'update':
+            self.update_display()
+
+      #-----------------------------------------------------------------
+
+
+      # COMMAND: submitUpdateRequest
+      #
+      # Received an updated JSON view from the browser.  This is
+      # actually the most general request as all sorts of changes
+      # might be made to the view on the browser side.  The rest
+      # of the commands below are special cases (e.g. "zoomIn")
+      # for when it makes more sense to have Python (in conjunction
+      # with the Montage executables) figure out what needs to be
+      # updated.
+      #-----------------------------------------------------------------
+
+        elif cmd == 'submitUpdateRequest':
+
+            jsonStr = args[1]
+
+            self.view.json_update(jsonStr)
+
+            self.update_display()
+
+      #-----------------------------------------------------------------
+
+
+      # COMMAND: stretch
+      #
+      # The browser has already applied a stretch or color table 
+      # change itself (see clientStretch), so there is nothing to 
+      # render; we just keep the view up to date for next time.
+      #-----------------------------------------------------------------
+
+        elif cmd == 'stretch':
+
+            jsonStr = args[1]
+
+            self.view.json_update(jsonStr)
+
+      #-----------------------------------------------------------------
+
+
+      # COMMAND: "initialize" or "resize"
+      #
+      # Initalize or resize the canvas to fit the image area.
+      #-----------------------------------------------------------------
+
+        elif cmd == 'initialize' or cmd == 'resize':
+
+            self.view.canvas_width  = args[1]
+            self.view.canvas_height = args[2]
+
+            if self.view.factor == 0:
+
+                self.view.xmin = 1
+                self.view.xmax = self.view.image_width
+                self.view.ymin = 1
+                self.view.ymax = self.view.image_height
+
+            if cmd == 'initialize':
+                self.update_display()
+            else:
+                self.to_browser("resized")
+
+      #-----------------------------------------------------------------
+
+
+      # COMMAND: "zoomReset"
+      #
+      # Reset the zoom (default zoom displays entire image on screen;
+      # may not fill canvas area).
+      #-----------------------------------------------------------------
+
+        elif cmd == 'zoomReset':
+
+            self.view.xmin = 1
+            self.view.xmax = self.view.image_width
+            self.view.ymin = 1
+            self.view.ymax = self.view.image_height
+
+            self.update_display()
+
+      #-----------------------------------------------------------------
+
+
+      # COMMAND: General Zoom/Pan Commands 
+      #          "zoom", "zoomIn", "zoomOut", 
+      #          "panUp", "panDown", 
+      #          "panLeft", "panRight"
+      #          "panUpLeft", "panUpRight",
+      #          "panDownLeft", "panDownRight"
+      #
+      # There is a lot of common code for zooming and panning, 
+      # so we group these commands together.
+      #-----------------------------------------------------------------
+
+        elif (cmd == 'zoom'        or 
+              cmd == 'zoomIn'      or cmd == 'zoomOut'       or
+              cmd == 'panUp'       or cmd == 'panDown'       or 
+              cmd == 'panLeft'     or cmd == 'panRight'      or
+              cmd == 'panUpLeft'   or cmd == 'panUpRight'    or 
+              cmd == 'panDownLeft' or cmd == 'panDownRight'):
+
+            self.view.xmin, self.view.xmax, self.view.ymin, self.view.ymax = self.zoom_pan_box(cmd, args)
+
+
+          # Update view 
+
+            self.update_display()
+
+      #-----------------------------------------------------------------
+
+
+      # COMMAND: "center"
+      #
+      # Center the current view "box" (subimage) on a reference point
+      # defined by the most recent "pick" operation (defaults to
+      # image center if no such point has been chosen).  
+      # Current zoom scale is retained.
+      #-----------------------------------------------------------------
+
+        elif cmd == "center":
+
+          # Obtain the canvas size and zoom factor
+
+            box_width   = float(self.view.canvas_width)
+            box_height  = float(self.view.canvas_height)
+
+            # box_xcenter = box_width  / 2.
+            # box_ycenter = box_height / 2.
+
+            factor = float(self.view.factor)
+
+
+          # Reference current "pick" point and redefine 
+          # subimage boundaries 
+
+            if cmd == 'center':
+                if (self.view.currentPickX != 0) and (self.view.currentPickY != 0):
+                    boxymax = self.view.currentPickY + ((box_height * factor)/2)
+                    boxymin = self.view.currentPickY - ((box_height * factor)/2)
+                    boxxmax = self.view.currentPickX + ((box_width * factor)/2)
+                    boxxmin = self.view.currentPickX - ((box_width * factor)/2)
+                else:
+                    boxymax = (self.view.image_height + box_height * factor) / 2
+                    boxymin = (self.view.image_height - box_height * factor) / 2
+                    boxxmax = (self.view.image_width + box_width  * factor)  / 2
+                    boxxmin = (self.view.image_width - box_width  * factor)  / 2
+
+
+                if (boxxmax > self.view.image_width):
+                    boxxmax = self.view.image_width
+                    boxxmin = self.view.image_width - (box_width * factor)
+
+                if (boxxmin <= 0):
+                    boxxmin = 1
+                    boxxmax = (box_width * factor)
+
+                if (boxymax > self.view.image_height):
+                    boxymax = self.view.image_height
+                    boxymin = self.view.image_height - (box_height * factor)                
+
+                if (boxymin <= 0):
+                    boxymin = 1
+                    boxymax = (box_height * factor)
+
+
+            self.view.xmin = int(boxxmin)
+            self.view.xmax = int(boxxmax)
+            self.view.ymin = int(boxymin)
+            self.view.ymax = int(boxymax)
+
+            self.update_display()
+
+      #-----------------------------------------------------------------
+
+
+      # COMMAND: "pick"
+      #
+      # Examine a user-selected location
+      #-----------------------------------------------------------------
+
+        elif cmd == 'pick':
+
+            factor = float(self.view.factor)
+
+            if factor == 0.:
+                factor = 1.
+
+            boxx = float(args[1])
+            boxy = float(args[2])
+
+            self.view.currentPickX = self.view.xmin + boxx * factor
+            self.view.currentPickY = self.view.ymin + boxy * factor
+
+            if (self.view.currentPickX >= 0 and 
+                self.view.currentPickY >= 0 and
+                self.view.currentPickX <= self.view.image_width and                
+                self.view.currentPickX <= self.view.image_height): 
+
+                self.pick_location(self.view.currentPickX, self.view.currentPickY)
+
+            else:
+                print "Pick location not within image."
+
+            # self.update_display()
+
+            # Updating the current "pick" location does not update 
+            # the view, so the "currentPickX" and "currentPickY"
+            # values stored in the mView representation (JSON) 
+            # may be obsolete.  
+            #
+            # This does not affect the pick calculations, as they
+            # they use the internal, up-to-date x and y values.
+
+      #-----------------------------------------------------------------
+
+
+        # COMMAND: "header"
+        #
+        # Get FITS header
+      #-----------------------------------------------------------------
+
+        elif cmd == 'header':
+
+            self.get_header()
+
+      #-----------------------------------------------------------------
+
+
+  # The new view box (xmin, xmax, ymin, ymax) for a zoom or pan command
+  # ("zoom" takes the box drawn on the canvas as its arguments).  This
+  # only looks at the view, so it can also be used to work out where
+  # the user is likely to go next (see start_prefetch(), which asks
+  # for it quietly).
+
+    def zoom_pan_box(self, cmd, args, quiet=False):
+
+        boxxmin = 0.
+        boxxmax = float(self.view.canvas_width)
+        boxymin = 0.
+        boxymax = float(self.view.canvas_height)
+
+        if self.debug and not quiet:
+            print ""
+            print ""
+            print "ZOOMPAN> cmd: [" + cmd + "]"
+
+            print "ZOOMPAN> Size of currently-diplayed PNG"
+            print "ZOOMPAN> " + str(self.view.disp_width) + " X " + str(self.view.disp_height)
+            print ""
+            print "ZOOMPAN> Canvas:"
+            print "ZOOMPAN> " + str(self.view.canvas_width) + " X " + str(self.view.canvas_height)
+
+ 
+      # Obtain "current" subimage boundaries 
+
+        oldxmin = float(self.view.xmin)
+        oldxmax = float(self.view.xmax)
+        oldymin = float(self.view.ymin)
+        oldymax = float(self.view.ymax)
+
+        if self.debug and not quiet:
+            print ""
+            print "ZOOMPAN> Pixel ranges from the previous cutout"
+            print "ZOOMPAN> oldx: " + str(oldxmin) + " to " + str(oldxmax)
+            print "ZOOMPAN> oldy: " + str(oldymin) + " to " + str(oldymax)
+ 
+
+      # For box zooming, we are given the box boundaries 
+      # but for zoom in/out and panning we need to calculate  
+      # them based on the canvas
+      #-------------------------------------------------------------
+
+      # Zoom based on explicitly-set subimage boundaries 
+      # (x and y limits).
+      #
+      # In the browser interface, these boundaries are set by
+      # drawing a box on the canvas using the mouse.
+
+        if cmd == 'zoom': 
+
+            if self.debug and not quiet:
+                print ""
+                print "ZOOMPAN> Box from command line"
+
+            boxxmin = float(args[1])
+            boxxmax = float(args[2])
+            boxymin = float(args[3])
+            boxymax = float(args[4])
+
+
+      # Zoom In (new subimage boundaries are calculated based on 
+      # current subimage boundaries).
+
+        elif cmd == 'zoomIn':
+
+            if self.debug and not quiet:
+                print ""
+                print "ZOOMPAN> Box by zooming in"
+
+            box_width  = float(self.view.canvas_width)
+
+            box_center = box_width / 2.
+
+            boxxmin = box_center - box_width / 4.
+            boxxmax = box_center + box_width / 4.
+
+            box_height  = float(self.view.canvas_height)
+
+            box_center = box_height / 2.
+
+            boxymin = box_center - box_height / 4.
+            boxymax = box_center + box_height / 4.
+
+
+      # Zoom Out (new subimage boundaries are calculated based on 
+      # current subimage boundaries).
+
+        elif cmd == 'zoomOut':
+
+            if self.debug and not quiet:
+                print ""
+                print "ZOOMPAN> Box by zooming out"
+
+            box_width  = float(self.view.canvas_width)
+            box_center = box_width / 2.
+
+            boxxmin = box_center - box_width
+            boxxmax = box_center + box_width
+
+            box_height = float(self.view.canvas_height)
+            box_center = box_height / 2.
+
+            boxymin = box_center - box_height
+            boxymax = box_center + box_height
+
+      #-------------------------------------------------------------
+
+
+      # Pan the view region without altering the current zoom 
+      # scale.  Implemented panning directions are multiples
+      # of 45 degrees.
+      #-------------------------------------------------------------
+
+        elif cmd == 'panUp':
+
+            if self.debug and not quiet:
+                print ""
+                print "ZOOMPAN> Box by panning up"
+
+            box_height = float(self.view.canvas_height)
+
+            boxymin = boxymin + box_height / 4.
+            boxymax = boxymax + box_height / 4.
+
+
+        elif cmd == 'panDown':
+
+            if self.debug and not quiet:
+                print ""
+                print "ZOOMPAN> Box by panning down"
+
+            box_height = float(self.view.canvas_height)
+
+            boxymin = boxymin - box_height / 4.
+            boxymax = boxymax - box_height / 4.
+
+
+        elif cmd == 'panLeft':
+
+            if self.debug and not quiet:
+                print ""
+                print "ZOOMPAN> Box by panning left"
+
+            box_width = float(self.view.canvas_width)
+
+            boxxmin = boxxmin - box_width / 4.
+            boxxmax = boxxmax - box_width / 4.
+
+
+        elif cmd == 'panRight':
+
+            if self.debug and not quiet:
+                print ""
+                print "ZOOMPAN> Box by panning right"
+
+            box_width = float(self.view.canvas_width)
+
+            boxxmin = boxxmin + box_width / 4.
+            boxxmax = boxxmax + box_width / 4.
+
+
+        elif cmd == 'panUpLeft':
+
+            if self.debug and not quiet:
+                print ""
+                print "ZOOMPAN> Box by panning up and left"
+
+            box_height = float(self.view.canvas_height)
+            box_width = float(self.view.canvas_width)
+
+            boxymin = boxymin + box_height / (4. * math.sqrt(2))
+            boxymax = boxymax + box_height / (4. * math.sqrt(2))
+            boxxmin = boxxmin - box_width  / (4. * math.sqrt(2))
+            boxxmax = boxxmax - box_width  / (4. * math.sqrt(2))
+
+
+        elif cmd == 'panUpRight':
+
+            if self.debug and not quiet:
+                print ""
+                print "ZOOMPAN> Box by panning up and right"
+
+            box_height = float(self.view.canvas_height)
+            box_width = float(self.view.canvas_width)
+
+            boxymin = boxymin + box_height / (4. * math.sqrt(2))
+            boxymax = boxymax + box_height / (4. * math.sqrt(2))
+            boxxmin = boxxmin + box_width  / (4. * math.sqrt(2))
+            boxxmax = boxxmax + box_width  / (4. * math.sqrt(2))
+
+
+        elif cmd == 'panDownLeft':
+
+            if self.debug and not quiet:
+                print ""
+                print "ZOOMPAN> Box by panning down and left"
+
+            box_height = float(self.view.canvas_height)
+            box_width = float(self.view.canvas_width)
+
+            boxymin = boxymin - box_height / (4. * math.sqrt(2))
+            boxymax = boxymax - box_height / (4. * math.sqrt(2))
+            boxxmin = boxxmin - box_width  / (4. * math.sqrt(2))
+            boxxmax = boxxmax - box_width  / (4. * math.sqrt(2))
+
+
+        elif cmd == 'panDownRight':
+
+            if self.debug and not quiet:
+                print ""
+                print "ZOOMPAN> Box by panning down and right"
+
+            box_height = float(self.view.canvas_height)
+            box_width = float(self.view.canvas_width)
+
+            boxymin = boxymin - box_height / (4. * math.sqrt(2))
+            boxymax = boxymax - box_height / (4. * math.sqrt(2))
+            boxxmin = boxxmin + box_width  / (4. * math.sqrt(2))
+            boxxmax = boxxmax + box_width  / (4. * math.sqrt(2))
+
+      #-------------------------------------------------------------
+
+
+      # The box (especially for draw box zooming) will
+      # not necessarily have the proportions of the canvas. 
+      # Correct the aspect ratio here.
+
+        box_width  = boxxmax-boxxmin
+        box_height = boxymax-boxymin
+
+        if self.debug and not quiet:
+            print ""
+            print "ZOOMPAN> Input:"
+            print "ZOOMPAN> boxx: " + str(boxxmin) + " to " + str(boxxmax) + " [" + str(box_width)  + "]"
+            print "ZOOMPAN> boxy: " + str(boxymin) + " to " + str(boxymax) + " [" + str(box_height) + "]"
+
+        box_aspect    = float(box_height)              / float(box_width)
+        canvas_aspect = float(self.view.canvas_height) / float(self.view.canvas_width)
+
+        if self.debug and not quiet:
+            print ""
+            print "ZOOMPAN> Aspect:"
+            print "ZOOMPAN> box:    " + str(box_aspect) 
+            print "ZOOMPAN> canvas: " + str(canvas_aspect)
+
+
+      # Based on the ratio of box aspect ratio to canvas,
+      # if the box is taller and skinner than the canvas;
+      # make it wider.
+
+        ratio = box_aspect / canvas_aspect
+
+        if self.debug and not quiet:
+            print ""
+            print "ZOOMPAN> Apect ratio adjusment factor: " + str(ratio)
+
+        if ratio > 1.:
+
+            box_width = int(box_width * ratio)
+
+            box_center = (boxxmax + boxxmin) / 2.
+ 
+            boxxmin = box_center - box_width / 2.
+            boxxmax = box_center + box_width / 2.
+
+
+      # The box is shorter and fatter than the canvas;
+      # make it taller.
+
+        else:
+
+            box_height = int(box_height / ratio)
+
+            box_center = (boxymax + boxymin) / 2.
+ 
+            boxymin = box_center - box_height / 2.
+            boxymax = box_center + box_height / 2.
+
+
+        box_width  = boxxmax-boxxmin
+        box_height = boxymax-boxymin
+
+        box_aspect = float(box_height) / float(box_width)
+
+        if self.debug and not quiet:
+            print ""
+            print "ZOOMPAN> Adjust to canvas aspect:"
+            print "ZOOMPAN> boxx: " + str(boxxmin) + " to " + str(boxxmax) + " [" + str(box_width)  + "]"
+            print "ZOOMPAN> boxy: " + str(boxymin) + " to " + str(boxymax) + " [" + str(box_height) + "]"
+
+
+      # If we are zoomed out far enough that we see the whole image,
+      # part of the canvas may not be covered due to a difference in the
+      # image and canvas aspect ratios.  In this case (and when zooming
+      # part of the zoom box may be off the image.  If we detect this,
+      # we shift the zoom box to be as much on the image as possible,
+      # with the same sizing.
+
+        if cmd == 'zoom' or cmd == 'zoomIn':
+
+            if boxxmax > self.view.disp_width:
+
+                diff = boxxmax - self.view.disp_width
+
+                boxxmax = boxxmax - diff
+                boxxmin = boxxmin - diff
+
+            if boxxmin < 0:
+
+                diff = boxxmin
+
+                boxxmin = boxxmin - diff
+                boxxmax = boxxmax - diff
+
+            if boxymax > self.view.disp_height:
+
+                diff = boxymax - self.view.disp_height
+
+                boxymax = boxymax - diff
+                boxymin = boxymin - diff
+
+            if boxymin < 0:
+
+                diff = boxymin
+
+                boxymin = boxymin - diff
+                boxymax = boxymax - diff
+
+            if self.debug and not quiet:
+                print ""
+                print "ZOOMPAN> After shifting:"
+                print "ZOOMPAN> boxx: " + str(boxxmin) + " to " + str(boxxmax) 
+                print "ZOOMPAN> boxy: " + str(boxymin) + " to " + str(boxymax) 
+
+
+      # Convert the box back to image coordinates
+
+        factor = float(self.view.factor)
+
+        boxxmin = boxxmin * factor
+        boxxmax = boxxmax * factor
+        boxymin = boxymin * factor
+        boxymax = boxymax * factor
+
+        boxxmin = boxxmin + oldxmin
+        boxxmax = boxxmax + oldxmin
+        boxymin = boxymin + oldymin
+        boxymax = boxymax + oldymin
+
+        if self.debug and not quiet:
+            print ""
+            print "ZOOMPAN> In image pixel coordinates:"
+            print "ZOOMPAN> boxx: " + str(boxxmin) + " to " + str(oldxmax) 
+            print "ZOOMPAN> boxy: " + str(boxymin) + " to " + str(oldymax) 
+
+
+        if boxxmin < 0:
+            boxxmax = boxxmax - boxxmin
+            boxxmin = 0
+
+        if boxxmax > self.view.image_width:
+            boxxmax = self.view.image_width
+            boxxmin = boxxmax - box_width*factor
+
+        if boxymin < 0:
+            boxymax = boxymax - boxymin
+            boxymin = 0
+
+        if boxymax > self.view.image_height:
+            boxymax = self.view.image_height
+            boxymin = boxxmax - box_height*factor
+
+        if self.debug and not quiet:
+            print ""
+            print "ZOOMPAN> Clipped by the image dimensions:"
+            print "ZOOMPAN> boxx: " + str(boxxmin) + " to " + str(oldxmax) 
+            print "ZOOMPAN> boxy: " + str(boxymin) + " to " + str(oldymax) 
+
+
+      # New subimage boundaries
+
+        return int(boxxmin), int(boxxmax), int(boxymin), int(boxymax)
+
+
+  # Updating the  display entails generating the subimage to be shown
+  # in the viewport, and packaging relevant information about the
+  # view in the data structure that is passed to the back end.
+  # (Under the render lock, like from_browser().)
+
+    def update_display(self):
+
+        with self.renderLock:
+            self.make_display()
+
+
+    def make_display(self):
+
+        self.cancel_prefetch()
+
+        if self.view.display_mode == "":
+            print "No images defined. Nothing to display."
+            sys.stdout.write('\n>>> ')
+            sys.stdout.flush()
+            return
+
+      # If another view change is already waiting, this display would
+      # be replaced straight away; just keep the geometry up to date.
+
+        if self.deferDisplay:
+
+            if self.debug:
+                print "DEBUG> Display update skipped (superseded)."
+
+            self.update_geometry()
+            return
+
+      # In tiled mode the browser puts the picture together from tiles
+      # it asks for separately; all we need to do here is work out the 
+      # geometry and stretch.
+
+        if self.tiledMode and numpy is not None and self.view.display_mode != "mosaic":
+
+            try:
+                self.update_tiles()
+                return
+
+            except Exception as e:
+
+                if self.debug:
+                    print "DEBUG> Tiled display failed (" + str(e) + "); rendering whole view."
+
+        self.view.tile_key   = ""
+        self.view.tile_level = ""
+        self.view.tile_size  = ""
+
+      # The display is built in stages, each only re-run if its
+      # inputs have changed since last time (see run_stage()):
+      #
+      #    shrink  --  the image(s) cut out and shrunk to fit the canvas;
+      #                depends on the files, view box and canvas size.
+      #
+      #    render  --  the PNG from mViewer; depends on the shrunken
+      #                images and on the stretch, color table and 
+      #                overlays (all of which are in the mViewer 
+      #                command line).  Overlays can instead be drawn
+      #                as separate layers (see update_layers()).
+      #
+      #    encode  --  the PNG re-encoded in the format the view is 
+      #                sent in, if that isn't mViewer's own PNG 
+      #                (see encoding()).
+      #
+      # So a stretch change or overlay toggle skips straight to mViewer.
+      # (With clientStretch on, the browser does stretch changes itself
+      # from the pixel values we send it; see update_pixels().)
+      #
+      # On top of that, finished views are kept in a render cache (keyed
+      # by all of them), so going back to a recent view needs no Montage
+      # calls.
+
+        box = (self.view.xmin, self.view.xmax, self.view.ymin, self.view.ymax)
+
+        shrink_key = self.shrink_key(box)
+
+
+      # Finally, generate the PNG (and, if the view is to be sent in
+      # another format, encode it; see encode())
+
+        encoding = self.encoding()
+
+        render_file, image_file = self.output_files(encoding)
+
+        command = self.view_command(self.workspace)
+
+        command += " -png " + self.workspace + "/" + render_file
+
+        if encoding is None:
+            self.view.image_type = "png"
+        else:
+            self.view.image_type = encoding[0]
+
+        self.view.image_file = image_file
+
+        suffix = self.image_suffixes[self.view.image_type]
+
+        if self.renderCache is not None and self.renderCache.suffix != suffix:
+            self.renderCache.clear()
+            self.renderCache = None
+
+        if self.renderCache is None:
+            self.renderCache = mvFileCache(self.workspace + "/cache", self.renderCacheSize, suffix)
+
+        render_key = self.render_key(shrink_key, command, encoding)
+
+        cached = self.renderCache.get(render_key)
+
+        if cached is not None:
+
+            if self.debug:
+                print "DEBUG> Render cache hit: " + render_key
+
+            retval, factor = cached
+
+            image_file = "cache/" + render_key + suffix
+
+        else:
+
+            outputs = [self.workspace + "/" + prefix + "shrunken.fits" for view_file, prefix in self.display_files()]
+
+            factor = self.run_stage("shrink", shrink_key, outputs, self.shrink_images)
+
+            retval = self.run_stage("render", repr((shrink_key, command)), [self.workspace + "/" + render_file], lambda: self.render(command))
+
+            if retval.stat == "OK" and encoding is not None:
+                self.run_stage("encode", repr((shrink_key, command, encoding)), [self.workspace + "/" + image_file], 
+                               lambda: self.encode(self.workspace + "/" + render_file, self.workspace + "/" + image_file, encoding))
+
+            if retval.stat == "OK":
+                self.renderCache.put(render_key, self.workspace + "/" + image_file, (retval, factor), copy=True)
+
+        self.view.factor = factor
+
+        if retval.stat == "WARNING" or retval.stat == "ERROR":
+            self.stages.pop("render", None)
+
+        if retval.stat == "WARNING":
+            print "\nWARNING: " + retval.msg
+            sys.stdout.write('\n>>> ')
+            sys.stdout.flush()
+            return
+
+        if retval.stat == "ERROR":
+            print "\nERROR: " + retval.msg
+            sys.stdout.write('\n>>> ')
+            sys.stdout.flush()
+            return
+
+        self.view.disp_width  = retval.width
+        self.view.disp_height = retval.height
+
+        if self.view.display_mode != "color":
+
+			# self.view.gray_file.bunit        = retval.bunit
+			self.view.gray_file.min          = retval.min
+			self.view.gray_file.max          = retval.max
+			self.view.gray_file.data_min     = retval.datamin
+			self.view.gray_file.data_max     = retval.datamax
+			self.view.gray_file.min_sigma    = retval.minsigma
+			self.view.gray_file.max_sigma    = retval.maxsigma 
+			self.view.gray_file.min_percent  = retval.minpercent
+			self.view.gray_file.max_percent  = retval.maxpercent
+
+        else:
+
+			# self.view.blue_file.bunit        = retval.bunit
+			self.view.blue_file.min          = retval.bmin
+			self.view.blue_file.max          = retval.bmax
+			self.view.blue_file.data_min     = retval.bdatamin
+			self.view.blue_file.data_max     = retval.bdatamax
+			self.view.blue_file.min_sigma    = retval.bminsigma
+			self.view.blue_file.max_sigma    = retval.bmaxsigma 
+			self.view.blue_file.min_percent  = retval.bminpercent
+			self.view.blue_file.max_percent  = retval.bmaxpercent
+
+			# self.view.green_file.bunit       = retval.bunit
+			self.view.green_file.min         = retval.gmin
+			self.view.green_file.max         = retval.gmax
+			self.view.green_file.data_min    = retval.gdatamin
+			self.view.green_file.data_max    = retval.gdatamax
+			self.view.green_file.min_sigma   = retval.gminsigma
+			self.view.green_file.max_sigma   = retval.gmaxsigma 
+			self.view.green_file.min_percent = retval.gminpercent
+			self.view.green_file.max_percent = retval.gmaxpercent
+
+			# self.view.red_file.bunit         = retval.bunit
+			self.view.red_file.min           = retval.rmin
+			self.view.red_file.max           = retval.rmax
+			self.view.red_file.data_min      = retval.rdatamin
+			self.view.red_file.data_max      = retval.rdatamax
+			self.view.red_file.min_sigma     = retval.rminsigma
+			self.view.red_file.max_sigma     = retval.rmaxsigma 
+			self.view.red_file.min_percent   = retval.rminpercent
+			self.view.red_file.max_percent   = retval.rmaxpercent
+
+        self.view.bunit = retval.bunit
+
+        if self.stretchResolved:
+
+            for view_file, prefix in self.display_files():
+                self.describe_stretch(view_file, *self.resolvedStretches[view_file.fits_file])
+
+
+      # Overlays drawn separately (if they aren't in the image)
+
+        self.update_layers()
+
+
+      # If the browser is to do its own stretching, it also 
+      # needs the pixel values
+
+        self.view.pixel_key = ""
+
+        if self.clientStretch and numpy is not None:
+
+            try:
+                self.view.pixel_key = self.update_pixels(shrink_key)
+
+            except Exception as e:
+
+                if self.debug:
+                    print "DEBUG> Pixel values not sent (" + str(e) + "); stretching on the server."
+
+
+      # Write the current mvView info to a JSON file in the workspace
+
+        json_file = self.workspace + "/view.json"
+
+        jfile = open(json_file, "w+")
+
+        jfile.write(repr(self.view))
+
+        jfile.close()
+
+
+      # Send the browser the new image (and JSON), or tell it
+      # to get them
+
+        if not self.push_view(image_file):
+            self.to_browser("image " + image_file)
+
+
+      # And get a start on where the user is likely to go next
+
+        if self.prefetch:
+            self.start_prefetch()
+
+
+  # The mViewer command for the current view (everything but the
+  # output file), using the shrunken images in a given directory.
+  # Also notes the stretch limits resolved for it, for the browser
+  # (see describe_stretch()).
+
+    def view_command(self, workdir):
+
+        command, resolved = self.build_command(workdir)
+
+        self.stretchResolved   = None not in resolved.values()
+        self.resolvedStretches = resolved
+
+        return command
+
+
+  # The mViewer command for a view box (xmin, xmax, ymin, ymax; by
+  # default the current one), without touching the viewer's state:
+  # returns the command and the stretch resolved for each file (None
+  # where it was left to mViewer).  Quiet leaves out the debugging 
+  # output (for prefetching, where it would just be noise).
+
+    def build_command(self, workdir, box=None, quiet=False):
+
+        command = "mViewer"
+
+        resolved = {}
+
+        if not self.use_layers():
+
+            for overlay in self.view.overlay:
+
+                if overlay.visible == True:
+                    command += self.overlay_command(overlay, box=box, quiet=quiet)
+
+
+        if self.view.display_mode != "color":
+
+            fits_file    = workdir + "/shrunken.fits"
+            color_table  = self.view.gray_file.color_table
+            stretch_min  = self.view.gray_file.stretch_min
+            stretch_max  = self.view.gray_file.stretch_max
+            stretch_mode = self.view.gray_file.stretch_mode
+
+            if color_table == "":
+               color_table = 0
+
+            if stretch_min == "":
+               stretch_min = "-1s"
+
+            if stretch_max == "":
+               stretch_max = "max"
+
+            if stretch_mode == "":
+               stretch_mode = "gaussian-log"
+
+            stretch_min, stretch_max = self.stretch_values(self.view.gray_file, stretch_min, stretch_max, resolved, box, quiet)
+
+            command += " -ct " + str(color_table)
+            command += " -gray " + str(fits_file) + " " + str(stretch_min) + " " + str(stretch_max) + " " + str(stretch_mode)
+
+
+        else:
+
+            fits_file    = workdir + "/red_shrunken.fits"
+            stretch_min  = self.view.red_file.stretch_min
+            stretch_max  = self.view.red_file.stretch_max
+            stretch_mode = self.view.red_file.stretch_mode
+ 
+            if stretch_min == "":
+               stretch_min = "-1s"
+
+            if stretch_max == "":
+               stretch_max = "max"
+
+            if stretch_mode == "":
+               stretch_mode = "gaussian-log"
+
+            stretch_min, stretch_max = self.stretch_values(self.view.red_file, stretch_min, stretch_max, resolved, box, quiet)
+
+            command += " -red " + str(fits_file) + " " + str(stretch_min) + " " + str(stretch_max) + " " + str(stretch_mode)
+ 
+            fits_file    = workdir + "/green_shrunken.fits"
+            stretch_min  = self.view.green_file.stretch_min
+            stretch_max  = self.view.green_file.stretch_max
+            stretch_mode = self.view.green_file.stretch_mode
+ 
+            if stretch_min == "":
+               stretch_min = "-1s"
+
+            if stretch_max == "":
+               stretch_max = "max"
+
+            if stretch_mode == "":
+               stretch_mode = "gaussian-log"
+
+            stretch_min, stretch_max = self.stretch_values(self.view.green_file, stretch_min, stretch_max, resolved, box, quiet)
+
+            command += " -green " + str(fits_file) + " " + str(stretch_min) + " " + str(stretch_max) + " " + str(stretch_mode)
+ 
+            fits_file    = workdir + "/blue_shrunken.fits"
+            stretch_min  = self.view.blue_file.stretch_min
+            stretch_max  = self.view.blue_file.stretch_max
+            stretch_mode = self.view.blue_file.stretch_mode
+
+            if stretch_min == "":
+               stretch_min = "-1s"
+
+            if stretch_max == "":
+               stretch_max = "max"
+
+            if stretch_mode == "":
+               stretch_mode = "gaussian-log"
+
+            stretch_min, stretch_max = self.stretch_values(self.view.blue_file, stretch_min, stretch_max, resolved, box, quiet)
+
+            command += " -blue " + str(fits_file) + " " + str(stretch_min) + " " + str(stretch_max) + " " + str(stretch_mode)
+
+        return command, resolved
+
+
+  # The mViewer arguments for drawing an overlay, in its own color
+  # unless given another, for the current view box unless given 
+  # another
+
+    def overlay_command(self, overlay, color=None, box=None, quiet=False):
+
+        command = ""
+
+        type = overlay.type
+
+        if color is None:
+            color = overlay.color
+
+        if   type == 'grid':
+
+            coord_sys = overlay.coord_sys
+
+            if color != "":
+                command += " -color " + str(color)
+
+            command += " -grid "  + str(coord_sys)
+
+
+        elif type == 'catalog':
+
+            data_file    = overlay.data_file
+            data_col     = overlay.data_col
+            data_ref     = overlay.data_ref
+            data_type    = overlay.data_type
+            sym_size     = overlay.sym_size
+            sym_type     = overlay.sym_type
+            sym_sides    = overlay.sym_sides
+            sym_rotation = overlay.sym_rotation
+
+            if color != "":
+                command += " -color " + str(color)
+
+            if sym_type != "" and sym_size != "":
+                command += " -symbol " + str(sym_size) + " " + str(sym_type) + " " + str(sym_sides) + " " + str(sym_rotation)
+
+            data_file = self.view_catalog(data_file, data_col, box, quiet)
+
+            command += " -catalog "  + str(data_file) + " " + str(data_col) + " " + str(data_ref) + " " + str(data_type)
+
+
+        elif type == 'imginfo':
+
+            data_file = overlay.data_file
+
+            if color != "":
+                command += " -color " + str(color)
+
+            data_file = self.view_footprints(data_file, box, quiet)
+
+            command += " -imginfo "  + str(data_file)
+
+
+        elif type == 'mark':
+
+            lon          = overlay.lon
+            lat          = overlay.lat
+            sym_size     = overlay.sym_size
+            sym_type     = overlay.sym_type
+            sym_sides    = overlay.sym_sides
+            sym_rotation = overlay.sym_rotation
+
+            if color != "":
+                command += " -color " + str(color)
+
+            if sym_type != "" and sym_size != "":
+                command += " -symbol " + str(sym_size) + " " + str(sym_type) + " " + str(sym_sides) + " " + str(sym_rotation)
+
+            command += " -mark "  + str(lon) + " " + str(lat)
+
+
+        elif type == 'label':
+
+            lon  = overlay.lon
+            lat  = overlay.lat
+            text = overlay.text
+
+            if color != "":
+                command += " -color " + str(color)
+
+            command += " -label "  + str(lon) + " " + str(lat) + ' "' + str(text) + '"'
+
+
+        else:
+            print "Invalid overlay type '" + str(type) + "' in view specification."
+
+        return command
+
+
+  # Whether overlays are drawn as layers of their own rather than 
+  # into the image.  Tiles never have overlays in them, so in tiled 
+  # mode layers are the only way to show them.
+
+    def use_layers(self):
+
+        return (self.overlayLayers or self.tiledMode) and numpy is not None
+
+
+  # Overlay layers.  Each visible overlay is drawn by mViewer on its 
+  # own, in white on a blank (black) image with the WCS of the view,
+  # and the browser uses that as a mask to paint the overlay in its 
+  # color over the image.  So the image doesn't change when overlays
+  # are switched on and off, and neither turning an overlay off nor 
+  # changing its color needs anything drawn.  Layers are cached by the
+  # overlay (less its color) and the view geometry; their keys go to
+  # the browser as a comma-separated list (one per overlay, blank for
+  # those not shown).
+
+    def update_layers(self):
+
+        self.view.layer_keys = ""
+
+        if not self.use_layers() or len(self.view.overlay) == 0:
+            return
+
+        if self.layerCache is None:
+            self.layerCache = mvFileCache(self.workspace + "/layers", self.layerCacheSize)
+
+      # The reference image (in mosaic mode the mosaic, which 
+      # has the header but no file of its own)
+
+        ref_file = self.display_files()[0][0].fits_file
+
+        fits = self.image_info(ref_file)
+
+        if not isinstance(fits, mvFITS):
+            fits = mvFITS(ref_file)
+
+        x0, y0, x1, y1, factor, nx, ny = self.view_geometry(fits)
+
+        geometry = (fits.fits_file, self.file_stamp(fits.fits_file), x0, y0, x1, y1, nx, ny)
+
+        if isinstance(fits, mvMosaic):
+            geometry = geometry + (fits.header_file, fits.stamp)
+
+        blank_file = None
+
+        keys = []
+
+        for overlay in self.view.overlay:
+
+            if overlay.visible != True:
+                keys.append("")
+                continue
+
+            args = self.overlay_command(overlay, "white")
+
+            stamp = None
+
+            if overlay.data_file != "" and os.path.exists(str(overlay.data_file)):
+                stamp = self.file_stamp(str(overlay.data_file))
+
+            key = "l" + hashlib.md5(repr((geometry, args, stamp))).hexdigest()
+
+            if not self.layerCache.contains(key):
+
+                if blank_file is None:
+
+                    blank_file = self.workspace + "/blank.fits"
+
+                    fits.write(blank_file, numpy.zeros((ny, nx), dtype='f4'), fits.downsample_cards(x0, y0, x1, y1, nx, ny))
+
+                try:
+                    self.render_layer(key, args, blank_file)
+
+                except Exception as e:
+
+                    print "\nWARNING: Overlay not drawn (" + str(e) + ")"
+
+                    key = ""
+
+            keys.append(key)
+
+        self.view.layer_keys = ",".join(keys)
+
+
+  # Draw one overlay layer (into the layer cache)
+
+    def render_layer(self, key, args, blank_file):
+
+        png_file = self.workspace + "/" + key + ".png"
+
+        command = "mViewer" + args + " -ct 0 -gray " + blank_file + " 0 1 lin -png " + png_file
+
+        if self.debug:
+            print "\nMONTAGE Command:\n---------------\n" + command
+
+        retval = self.montage_runner().call(command)
+
+        if retval.stat != "OK":
+            raise Exception(retval.msg)
+
+        self.layerCache.put(key, png_file)
+
+
+  # Run a display stage, or reuse its last result if it was last run 
+  # with the same inputs (key) and its output files are still there.
+  # Since each stage's key includes those of the stages it depends on,
+  # a change re-runs just the stages downstream of it.
+
+    def run_stage(self, name, key, outputs, function):
+
+        if name in self.stages and self.stages[name][0] == key:
+
+            if len([output for output in outputs if not os.path.exists(output)]) == 0:
+
+                if self.debug:
+                    print "DEBUG> Stage " + name + ": hit"
+
+                return self.stages[name][1]
+
+        if self.debug:
+            print "DEBUG> Stage " + name + ": miss"
+
+        self.stages.pop(name, None)
+
+        result = function()
+
+        self.stages[name] = (key, result)
+
+        return result
+
+
+  # Key for the shrink stage for a given view box (xmin, xmax, 
+  # ymin, ymax): everything the shrunken images depend on
+
+    def shrink_key(self, box):
+
+        return repr((self.view.display_mode,
+                     [(view_file.fits_file, self.file_stamp(view_file.fits_file)) for view_file, prefix in self.display_files()],
+                     str(box[0]), str(box[2]), str(box[1]), str(box[3]),
+                     str(self.view.canvas_width), str(self.view.canvas_height),
+                     self.useMemmap, self.usePyramid, self.shrinkMode))
+
+
+  # Size and modification time of a file (part of stage keys, 
+  # so that changing a file invalidates everything made from it)
+
+    def file_stamp(self, fits_file):
+
+        info = os.stat(fits_file)
+
+        return (info.st_size, info.st_mtime)
+
+
+  # Shrink stage: go straight from the original file(s) to the shrunken
+  # image(s) the size of the canvas if we can.  Otherwise cut the region 
+  # out and shrink it in two steps.  Returns the shrink factor.
+
+    def shrink_images(self):
+
+        if self.useMemmap and numpy is not None:
+
+            try:
+                factors = self.run_channels(lambda view_file, prefix: self.make_shrunken(view_file.fits_file, self.workspace + "/" + prefix + "shrunken.fits"))
+
+                return factors[-1]
+
+            except Exception as e:
+
+                if self.view.display_mode == "mosaic":
+                    raise
+
+                if self.debug:
+                    print "DEBUG> Fused cutout/shrink failed (" + str(e) + "); using cutouts."
+
+        self.cutout_and_shrink()
+
+        return self.view.factor
+
+
+  # Render stage: run mViewer (stretch, color, overlays 
+  # and PNG all in one) and return its return structure
+
+    def render(self, command):
+
+        if self.debug:
+           print "\nMONTAGE Command:\n---------------\n" + command
+
+        stdout, stderr = self.run_montage(command)
+
+        if stderr:
+            raise Exception(stderr)
+
+        retval = mvStruct("mViewer", stdout.strip())
+
+        if self.debug:
+            print "\nRETURN Struct:\n-------------\n"
+            print retval
+            sys.stdout.write('\n>>> ')
+            sys.stdout.flush()
+
+        return retval
+
+
+  # How views are sent: None for mViewer's own PNG, otherwise the
+  # (format, quality, compression) for encode().  Anything else needs
+  # PIL.  A palette PNG is only for grayscale, where the color table 
+  # is a palette anyway (color views get a full PNG).
+
+    def encoding(self):
+
+        image_format = self.imageFormat
+
+        if image_format not in self.image_suffixes:
+            self.format_warning("unknown image format")
+            return None
+
+        if Image is None:
+
+            if image_format != "png" or self.imageCompression != "":
+                self.format_warning("PIL (Pillow) is not installed")
+
+            return None
+
+        if image_format == "png8" and self.view.display_mode == "color":
+            image_format = "png"
+
+        if image_format == "webp" and not self.webp_supported():
+            self.format_warning("this PIL was built without WebP")
+            return None
+
+        if image_format == "png" and self.imageCompression == "":
+            return None
+
+        return (image_format, int(self.imageQuality), self.imageCompression)
+
+
+  # Say (once per format setting) why views are going out as
+  # mViewer's PNG rather than as asked
+
+    def format_warning(self, reason):
+
+        setting = (self.imageFormat, self.imageCompression)
 
-        in_file  = resource_filename('agMontage', 'web/info.gif')
-        out_file = self.workspace + '/info.gif'
-        shutil.copy(in_file, out_file)
+        if self.formatWarned == setting:
+            return
 
-        in_file  = resource_filename('agMontage', 'web/layercontrol.gif')
-        out_file = self.workspace + '/layercontrol.gif'
-        shutil.copy(in_file, out_file)
+        self.formatWarned = setting
 
-        in_file  = resource_filename('agMontage', 'web/pan_up.gif')
-        out_file = self.workspace + '/pan_up.gif'
-        shutil.copy(in_file, out_file)
+        requested = str(self.imageFormat)
 
-        in_file  = resource_filename('agMontage', 'web/pan_up_left.gif')
-        out_file = self.workspace + '/pan_up_left.gif'
-        shutil.copy(in_file, out_file)
+        if requested == "png":
+            requested = "PNG with compression level " + str(self.imageCompression)
 
-        in_file  = resource_filename('agMontage', 'web/pan_left.gif')
-        out_file = self.workspace + '/pan_left.gif'
-        shutil.copy(in_file, out_file)
+        print "\nWARNING: Sending views as mViewer's PNG, not " + requested + " (" + reason + ")"
 
-        in_file  = resource_filename('agMontage', 'web/pan_down_left.gif')
-        out_file = self.workspace + '/pan_down_left.gif'
-        shutil.copy(in_file, out_file)
 
-        in_file  = resource_filename('agMontage', 'web/pan_down.gif')
-        out_file = self.workspace + '/pan_down.gif'
-        shutil.copy(in_file, out_file)
+  # The PNG file mViewer writes and the file the browser gets
+  # (in the workspace) for an encoding
 
-        in_file  = resource_filename('agMontage', 'web/pan_down_right.gif')
-        out_file = self.workspace + '/pan_down_right.gif'
-        shutil.copy(in_file, out_file)
+    def output_files(self, encoding):
 
-        in_file  = resource_filename('agMontage', 'web/pan_right.gif')
-        out_file = self.workspace + '/pan_right.gif'
-        shutil.copy(in_file, out_file)
+        if encoding is None:
+            return "viewer.png", "viewer.png"
 
-        in_file  = resource_filename('agMontage', 'web/pan_up_right.gif')
-        out_file = self.workspace + '/pan_up_right.gif'
-        shutil.copy(in_file, out_file)
+        return "render.png", "viewer" + self.image_suffixes[encoding[0]]
 
-        in_file  = resource_filename('agMontage', 'web/center_30.gif')
-        out_file = self.workspace + '/center_30.gif'
-        shutil.copy(in_file, out_file)
 
-        in_file  = resource_filename('agMontage', 'web/center_30.png')
-        out_file = self.workspace + '/center_30.png'
-        shutil.copy(in_file, out_file)
+  # Not every PIL is built with WebP; try it once
 
-        in_file  = resource_filename('agMontage', 'web/pick_location.gif')
-        out_file = self.workspace + '/pick_location.gif'
-        shutil.copy(in_file, out_file)
+    def webp_supported(self):
 
-        in_file  = resource_filename('agMontage', 'web/zoom_in.gif')
-        out_file = self.workspace + '/zoom_in.gif'
-        shutil.copy(in_file, out_file)
+        if self.webpSupported is None:
 
-        in_file  = resource_filename('agMontage', 'web/zoom_out.gif')
-        out_file = self.workspace + '/zoom_out.gif'
-        shutil.copy(in_file, out_file)
+            try:
+                Image.new("RGB", (1, 1)).save(tempfile.TemporaryFile(), "WEBP")
 
-        in_file  = resource_filename('agMontage', 'web/zoom_reset.gif')
-        out_file = self.workspace + '/zoom_reset.gif'
-        shutil.copy(in_file, out_file)
+                self.webpSupported = True
 
-        in_file  = resource_filename('agMontage', 'web/zoom_reset_box.gif')
-        out_file = self.workspace + '/zoom_reset_box.gif'
-        shutil.copy(in_file, out_file)
+            except Exception:
+                self.webpSupported = False
 
-        in_file  = resource_filename('agMontage', 'web/zoom_pan.gif')
-        out_file = self.workspace + '/zoom_pan.gif'
-        shutil.copy(in_file, out_file)
+        return self.webpSupported
 
-        in_file  = resource_filename('agMontage', 'web/header_icon.gif')
-        out_file = self.workspace + '/header_icon.gif'
-        shutil.copy(in_file, out_file)
 
-        in_file  = resource_filename('agMontage', 'web/eye02_30.gif')
-        out_file = self.workspace + '/eye02_30.gif'
-        shutil.copy(in_file, out_file)
+  # Encode stage: convert mViewer's PNG to the format it is to be sent 
+  # in (see encoding())
 
-      #---------------------------------------------------------------------------
-      # Misc. Icons
-      #---------------------------------------------------------------------------
+    def encode(self, png_file, out_file, encoding):
 
-        in_file  = resource_filename('agMontage', 'web/favicon.ico')
-        out_file = self.workspace + '/favicon.ico'
-        shutil.copy(in_file, out_file)
+        image_format, quality, compression = encoding
 
-        in_file  = resource_filename('agMontage', 'web/eye02_22.gif')
-        out_file = self.workspace + '/eye02_22.gif'
-        shutil.copy(in_file, out_file)
+        if compression == "":
+            compression = 6
 
-      #---------------------------------------------------------------------------
-      # Other image files
-      #---------------------------------------------------------------------------
+        image = Image.open(png_file)
 
-        in_file  = resource_filename('agMontage', 'web/waitClock.gif')
-        out_file = self.workspace + '/waitClock.gif'
-        shutil.copy(in_file, out_file)
+        if image_format == "png8":
+            image.convert("RGB").convert("P", palette=Image.ADAPTIVE, colors=256).save(out_file + ".part", "PNG", compress_level=int(compression))
 
-        in_file  = resource_filename('agMontage', 'web/galplane_banner.jpg')
-        out_file = self.workspace + '/galplane_banner.jpg'
-        shutil.copy(in_file, out_file)
+        elif image_format == "png":
+            image.save(out_file + ".part", "PNG", compress_level=int(compression))
 
-        in_file  = resource_filename('agMontage', 'web/banner02.gif')
-        out_file = self.workspace + '/banner02.gif'
-        shutil.copy(in_file, out_file)
+        elif image_format == "jpeg":
+            image.convert("RGB").save(out_file + ".part", "JPEG", quality=quality)
 
-      #---------------------------------------------------------------------------
+        else:
+            image.convert("RGB").save(out_file + ".part", "WEBP", quality=quality)
 
+        os.rename(out_file + ".part", out_file)
 
-        self.thread = mvThread(self.port, self.workspace, self, self.view)
+        if self.debug:
+            print "DEBUG> Encoded " + image_format + ": " + str(os.path.getsize(png_file)) + " -> " + str(os.path.getsize(out_file)) + " bytes"
 
-        self.thread.start()
 
+  # Run one of the Montage display programs (mSubimage, mShrink,
+  # mViewer).  The process is registered while it runs so that
+  # cancel_render() can kill it if the view it is working on is
+  # no longer wanted.  Returns stdout and stderr.
 
-  # The web browser thread receives any messages the Browser sends
-  # These will be commands (like "zoomIn") or requests to process an updated
-  # view send as JSON.  That thread forwards the command here.
-  #
-  # This from_browser() method does any local processing needed to modify
-  # the view, then calls the update_display() method to have a new PNG
-  # generated and appropriate instructions sent back to the browser.
+    def run_montage(self, command):
+
+        if self.renderCancelled:
+            raise Exception("Cancelled.")
+
+        stdout, stderr = self.montage_runner().run(command, started=self.add_process, finished=self.remove_process)
+
+        if self.renderCancelled:
+            raise Exception("Cancelled.")
+
+        return stdout, stderr
+
+
+  # Process registration for run_montage() (a process that 
+  # starts just after a cancel is killed straight away)
+
+    def add_process(self, p):
+
+        with self.processLock:
+
+            self.processes.append(p)
+
+            if self.renderCancelled:
+
+                try:
+                    p.kill()
+                except OSError:
+                    pass
+
+
+    def remove_process(self, p):
+
+        with self.processLock:
+            self.processes.remove(p)
+
+
+  # The Montage runner (see mvMontageRunner), made when first needed
+
+    def montage_runner(self):
+
+        with self.processLock:
+
+            if self.runner is None:
+                self.runner = mvMontageRunner(self.montageWorkers, self.montageTimeout, self.montageBin)
+                self.runner.debug = self.debug
+
+        return self.runner
+
+
+  # Abandon the display being made (see mvCommandQueue): kill any
+  # Montage processes for it and stop any more from starting
+
+    def cancel_render(self):
+
+        with self.processLock:
+
+            self.renderCancelled = True
+
+            for p in self.processes:
+
+                try:
+                    p.kill()
+                except OSError:
+                    pass
 
-    def from_browser(self, message):
+
+  # Bring the view geometry (shrink factor and displayed size) up 
+  # to date with the view box without making the image.  Used when 
+  # a display update is skipped (a later command replaces it) so the
+  # next zoom or pan works from the right place.
+
+    def update_geometry(self):
+
+        info = self.image_info(self.display_files()[-1][0].fits_file)
+
+        x0, y0, x1, y1, factor, nx, ny = self.view_geometry(info)
+
+        self.view.factor      = factor
+        self.view.disp_width  = nx
+        self.view.disp_height = ny
+
+
+  # The files being displayed (gray or blue, green, red) and the
+  # prefix used for their intermediate files in the workspace
+
+    def display_files(self):
+
+        if self.view.display_mode != "color":
+            return [(self.view.gray_file, "")]
+
+        return [(self.view.blue_file,  "blue_"),
+                (self.view.green_file, "green_"),
+                (self.view.red_file,   "red_")]
+
+
+  # Fused cutout and shrink: read just the pixels needed for the canvas
+  # straight from the original file and write the shrunken image
+  # (which is all mViewer needs).  No full-resolution copy of the
+  # region is ever made.  Returns the shrink factor.
+
+    def make_shrunken(self, fits_file, out_file, box=None):
+
+        if self.view.display_mode == "mosaic":
+            return self.make_mosaic_shrunken(out_file, box)
+
+        fits = mvFITS(fits_file)
+
+        x0, y0, x1, y1, factor, nx, ny = self.view_geometry(fits, box)
+
+        width  = x1 - x0
+        height = y1 - y0
+
+
+      # If we are zoomed out, work from the coarsest pyramid 
+      # level that has enough resolution
+
+        level = 0
+        box   = (x0 + 1, y0 + 1, x1 + 1, y1 + 1)
+
+        if self.usePyramid:
+
+            pyramid = self.get_pyramid(fits_file)
+
+            level = pyramid.choose(factor)
+
+            if level > 0:
+                fits = mvFITS(pyramid.level_file(level))
+                box  = pyramid.level_box(level, x0, y0, x1, y1)
 
         if self.debug:
-           print "mViewer.from_browser('" + message + "')"
+            print "\nIN-PROCESS Shrink (" + self.shrinkMode + "):\n-------------------\n" + fits.fits_file + " -> " + out_file
+            print "[" + str(width) + " X " + str(height) + "] -> [" + str(nx) + " X " + str(ny) + "]  factor: " + str(factor) + "  level: " + str(level)
 
+        data, cards = fits.downsample(box[0], box[1], box[2], box[3], nx, ny, self.shrinkMode)
 
-      # Find the image size
+        fits.write(out_file, data, cards)
 
-        ref_file = self.view.gray_file.fits_file
+        return factor
 
-        if self.view.display_mode == "":
-            print "No images defined. Nothing to display."
-            sys.stdout.write('\n>>> ')
-            sys.stdout.flush()
-            return
 
-        if self.view.display_mode == "grayscale":
-            ref_file = self.view.gray_file.fits_file
+  # The mosaic mode version of make_shrunken(): sample the images in
+  # view (several at once) straight onto the canvas grid and average
+  # them where they overlap.  Each image is read from the coarsest of
+  # its pyramid levels that is still fine enough, as for single images.
 
-        if self.view.display_mode == "color":
-            ref_file = self.view.red_file.fits_file  # R, G, B files should have identical size 
+    def make_mosaic_shrunken(self, out_file, box=None):
+
+        mosaic = self.get_mosaic()
+
+        x0, y0, x1, y1, factor, nx, ny = self.view_geometry(mosaic, box)
+
+        frames = mosaic.frames(x0, y0, x1, y1)
+
+        scale = abs(mosaic.projection.cdelt2) * factor
+
+        def sample(frame_file):
+
+            try:
+                fits = self.image_info(frame_file)
+
+                if self.usePyramid:
+
+                    pyramid = self.get_pyramid(frame_file)
+
+                    level = pyramid.choose(scale / abs(mvWCS(fits.wcs).cdelt2))
+
+                    if level > 0:
+                        fits = mvFITS(pyramid.level_file(level))
+
+                return mosaic.sample_frame(fits, x0, y0, x1, y1, nx, ny)
 
-        command = "mExamine " + ref_file
+            except Exception as e:
+
+                if self.debug:
+                    print "DEBUG> Mosaic image " + frame_file + " skipped (" + str(e) + ")"
+
+                return None
+
+        if len(frames) <= 1 or self.mosaicWorkers <= 1:
+            samples = [sample(frame_file) for frame_file in frames]
+
+        else:
+            if self.mosaicPool is None:
+                self.mosaicPool = ThreadPool(self.mosaicWorkers)
+
+            samples = self.mosaicPool.map(sample, frames)
+
+        sums   = numpy.zeros((ny, nx))
+        counts = numpy.zeros((ny, nx))
+
+        for result in samples:
+
+            if result is None:
+                continue
+
+            j0, j1, i0, i1, values = result
+
+            valid = numpy.isfinite(values)
+
+            sums  [j0:j1, i0:i1][valid] += values[valid]
+            counts[j0:j1, i0:i1][valid] += 1.
+
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            data = (sums / counts).astype('f4')
 
         if self.debug:
-           print "\nMONTAGE Command:\n---------------\n" + command
+            print "\nIN-PROCESS Mosaic:\n-----------------\n" + mosaic.fits_file + " -> " + out_file
+            print str(len(frames)) + " images in view -> [" + str(nx) + " X " + str(ny) + "]  factor: " + str(factor)
 
-        p = subprocess.Popen(shlex.split(command), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if box is None:
+            self.view.mosaic_frames = len(frames)
 
-        stderr = p.stderr.read()
+        mosaic.write(out_file, data, mosaic.downsample_cards(x0, y0, x1, y1, nx, ny))
 
-        if stderr:
-            print stderr
-            raise Exception(stderr)
+        return factor
+
+
+  # The part of the image in view (as array index ranges), the
+  # shrink factor that fits it to the canvas and the resulting size.
+  # The view box (xmin, xmax, ymin, ymax) defaults to the current one.
+
+    def view_geometry(self, fits, box=None):
+
+        if box is None:
+            box = (self.view.xmin, self.view.xmax, self.view.ymin, self.view.ymax)
+
+        x0, y0, x1, y1 = fits.bounds(box[0], box[2], box[1], box[3])
+
+        width  = x1 - x0
+        height = y1 - y0
+
+        xfactor = float(width)  / float(self.view.canvas_width)
+        yfactor = float(height) / float(self.view.canvas_height)
+
+        factor = max(xfactor, yfactor)
+
+        nx = max(1, int(width  / factor + 0.5))
+        ny = max(1, int(height / factor + 0.5))
+
+        return x0, y0, x1, y1, factor, nx, ny
+
+
+  # The render cache key for a view: its shrink key and mViewer command
+  # (for the workspace), and the encoding
+
+    def render_key(self, shrink_key, command, encoding):
+
+        return hashlib.md5(repr((shrink_key, command, encoding))).hexdigest()
+
+
+  # Speculative rendering.  After a view is displayed, the views the
+  # pan and zoom buttons would give next (repeating the last command
+  # first) are rendered in the background, straight into the render
+  # cache, so if the user does go there the display is just a cache
+  # lookup.  Everything the renders depend on is worked out here, up
+  # front; the background thread only makes the images (in a directory
+  # of its own, with the Montage process at low priority).  Any new
+  # request cancels the prefetch, killing its mViewer process.
+
+    def start_prefetch(self):
+
+        if self.tiledMode or not self.useMemmap or numpy is None:
             return
 
-        retval = mvStruct("mExamine", p.stdout.read().strip())
+        commands = ['panUp',     'panDown',     'panLeft',     'panRight',
+                    'panUpLeft', 'panUpRight',  'panDownLeft', 'panDownRight',
+                    'zoomIn',    'zoomOut']
+
+        if self.lastCommand in commands:
+            commands.remove(self.lastCommand)
+            commands.insert(0, self.lastCommand)
+
+        current = (int(float(self.view.xmin)), int(float(self.view.xmax)), int(float(self.view.ymin)), int(float(self.view.ymax)))
+
+        self.prefetchCount += 1
+
+        workdir = self.workspace + "/prefetch/" + str(self.prefetchCount)
+
+        encoding = self.encoding()
+
+        render_file = self.output_files(encoding)[0]
+
+        jobs = []
+
+        for cmd in commands:
+
+            box = self.zoom_pan_box(cmd, None, quiet=True)
+
+            if box == current:
+                continue
+
+            command = self.build_command(workdir, box, quiet=True)[0]
+
+
+          # The key is the one update_display() would use: the same
+          # command, but on the shrunken images in the workspace
+
+            key = self.render_key(self.shrink_key(box), command.replace(workdir + "/", self.workspace + "/") 
+                                  + " -png " + self.workspace + "/" + render_file, encoding)
+
+            if self.renderCache.contains(key) or key in [job[0] for job in jobs]:
+                continue
+
+            jobs.append((key, box, command + " -png " + workdir + "/view.png"))
+
+        if len(jobs) == 0:
+            return
 
         if self.debug:
-            print "\nRETURN Struct:\n-------------\n"
-            print retval
-            sys.stdout.write('\n>>> ')
-            sys.stdout.flush()
+            print "DEBUG> Prefetching " + str(len(jobs)) + " views"
 
-        subimage_width  = retval.naxis1
-        subimage_height = retval.naxis2
+        self.prefetchCancel = Event()
 
-        if self.view.xmin == "":
-            self.view.xmin = 0
+        thread = Thread(target=self.run_prefetch, args=(jobs, self.display_files(), workdir, encoding, self.prefetchCancel))
+        thread.daemon = True
+        thread.start()
 
-        if self.view.xmax == "":
-            self.view.xmax = retval.naxis1
 
-        if self.view.ymin == "":
-            self.view.ymin = 0
+    def cancel_prefetch(self):
+
+        if self.prefetchCancel is None:
+            return
+
+        self.prefetchCancel.set()
+
+        process = self.prefetchProcess
+
+        if process is not None:
+
+            try:
+                process.kill()
+            except OSError:
+                pass
+
+
+  # The prefetch mViewer process (so cancel_prefetch() can kill it)
+
+    def set_prefetch_process(self, p):
+
+        self.prefetchProcess = p
+
+
+  # The background half of the prefetch
+
+    def run_prefetch(self, jobs, files, workdir, encoding, cancel):
+
+        try:
+            os.makedirs(workdir)
+
+            for key, box, command in jobs:
 
-        if self.view.ymax == "":
-            self.view.ymax = retval.naxis2
+                factor = 0.
 
-        self.view.image_width  = retval.naxis1
-        self.view.image_height = retval.naxis2
+                for view_file, prefix in files:
 
+                    if cancel.is_set():
+                        return
 
-      # ------------- Processing commands from the Browser -------------
-     
+                    factor = self.make_shrunken(view_file.fits_file, workdir + "/" + prefix + "shrunken.fits", box)
 
-      # COMMAND: "update"      
-      #
-      # Just do/redo the view as it stands.
-      #-----------------------------------------------------------------
+                if cancel.is_set():
+                    return
 
-        args = shlex.split(message)
+                stdout, stderr = self.montage_runner().run(command, started=self.set_prefetch_process, 
+                                                           finished=lambda p: self.set_prefetch_process(None), nice=10)
 
-        cmd = args[0]
+                if cancel.is_set() or stderr:
+                    return
 
-        if cmd == 'update':
-            self.update_display()
+                retval = mvStruct("mViewer", stdout.strip())
 
-      #-----------------------------------------------------------------
+                if retval.stat == "OK":
 
+                    image_file = workdir + "/view.png"
 
-      # COMMAND: submitUpdateRequest
-      #
-      # Received an updated JSON view from the browser.  This is
-      # actually the most general request as all sorts of changes
-      # might be made to the view on the browser side.  The rest
-      # of the commands below are special cases (e.g. "zoomIn")
-      # for when it makes more sense to have Python (in conjunction
-      # with the Montage executables) figure out what needs to be
-      # updated.
-      #-----------------------------------------------------------------
+                    if encoding is not None:
 
-        elif cmd == 'submitUpdateRequest':
+                        image_file = workdir + "/view" + self.image_suffixes[encoding[0]]
 
-            jsonStr = args[1]
+                        self.encode(workdir + "/view.png", image_file, encoding)
 
-            self.view.json_update(jsonStr)
+                    self.renderCache.put(key, image_file, (retval, factor))
 
-            self.update_display()
+                    if self.debug:
+                        print "DEBUG> Prefetched view " + str(box)
 
-      #-----------------------------------------------------------------
+        except Exception as e:
 
+            if self.debug:
+                print "DEBUG> Prefetch failed: " + str(e)
 
-      # COMMAND: "initialize" or "resize"
-      #
-      # Initalize or resize the canvas to fit the image area.
-      #-----------------------------------------------------------------
+        finally:
+            shutil.rmtree(workdir, True)
 
-        elif cmd == 'initialize' or cmd == 'resize':
 
-            self.view.canvas_width  = args[1]
-            self.view.canvas_height = args[2]
+  # Tiled mode version of update_display().  The view JSON gets the
+  # usual geometry plus the tile key, level and size; the browser
+  # works out which tiles cover the canvas and asks for them
+  # (see mvTileHandler).  Panning only needs the newly exposed tiles,
+  # as the others are in the tile cache (or the browser's own).
 
-            if self.view.factor == 0:
+    def update_tiles(self):
 
-                self.view.xmin = 1
-                self.view.xmax = self.view.image_width
-                self.view.ymin = 1
-                self.view.ymax = self.view.image_height
+        key = self.tile_state()
 
-            if cmd == 'initialize':
-                self.update_display()
-            else:
-                self.to_browser("resized")
+        files = self.display_files()
 
-      #-----------------------------------------------------------------
+        fits = mvFITS(files[0][0].fits_file)
 
+        x0, y0, x1, y1, factor, nx, ny = self.view_geometry(fits)
 
-      # COMMAND: "zoomReset"
-      #
-      # Reset the zoom (default zoom displays entire image on screen;
-      # may not fill canvas area).
-      #-----------------------------------------------------------------
 
-        elif cmd == 'zoomReset':
+      # Tiles come from the coarsest pyramid level 
+      # available for all the files
 
-            self.view.xmin = 1
-            self.view.xmax = self.view.image_width
-            self.view.ymin = 1
-            self.view.ymax = self.view.image_height
+        level = 0
 
-            self.update_display()
+        if self.usePyramid:
+            level = min([self.get_pyramid(view_file.fits_file).choose(factor) for view_file, prefix in files])
 
-      #-----------------------------------------------------------------
+        self.view.factor          = factor
+        self.view.disp_width      = nx
+        self.view.disp_height     = ny
+        self.view.cutout_x_offset = x0
+        self.view.cutout_y_offset = y0
+        self.view.tile_key        = key
+        self.view.tile_level      = level
+        self.view.tile_size       = self.tileSize
+        self.view.pixel_key       = ""
 
+        self.update_layers()
 
-      # COMMAND: General Zoom/Pan Commands 
-      #          "zoom", "zoomIn", "zoomOut", 
-      #          "panUp", "panDown", 
-      #          "panLeft", "panRight"
-      #          "panUpLeft", "panUpRight",
-      #          "panDownLeft", "panDownRight"
-      #
-      # There is a lot of common code for zooming and panning, 
-      # so we group these commands together.
-      #-----------------------------------------------------------------
+        if self.debug:
+            print "\nTILES: key " + key + "  level " + str(level) + "  [" + str(nx) + " X " + str(ny) + "]  factor: " + str(factor)
 
-        elif (cmd == 'zoom'        or 
-              cmd == 'zoomIn'      or cmd == 'zoomOut'       or
-              cmd == 'panUp'       or cmd == 'panDown'       or 
-              cmd == 'panLeft'     or cmd == 'panRight'      or
-              cmd == 'panUpLeft'   or cmd == 'panUpRight'    or 
-              cmd == 'panDownLeft' or cmd == 'panDownRight'):
 
-            boxxmin = 0.
-            boxxmax = float(self.view.canvas_width)
-            boxymin = 0.
-            boxymax = float(self.view.canvas_height)
+      # Write the current mvView info to a JSON file in the workspace
 
-            if self.debug:
-                print ""
-                print ""
-                print "ZOOMPAN> cmd: [" + cmd + "]"
+        json_file = self.workspace + "/view.json"
 
-                print "ZOOMPAN> Size of currently-diplayed PNG"
-                print "ZOOMPAN> " + str(self.view.disp_width) + " X " + str(self.view.disp_height)
-                print ""
-                print "ZOOMPAN> Canvas:"
-                print "ZOOMPAN> " + str(self.view.canvas_width) + " X " + str(self.view.canvas_height)
+        jfile = open(json_file, "w+")
 
- 
-          # Obtain "current" subimage boundaries 
+        jfile.write(repr(self.view))
 
-            oldxmin = float(self.view.xmin)
-            oldxmax = float(self.view.xmax)
-            oldymin = float(self.view.ymin)
-            oldymax = float(self.view.ymax)
+        jfile.close()
 
-            if self.debug:
-                print ""
-                print "ZOOMPAN> Pixel ranges from the previous cutout"
-                print "ZOOMPAN> oldx: " + str(oldxmin) + " to " + str(oldxmax)
-                print "ZOOMPAN> oldy: " + str(oldymin) + " to " + str(oldymax)
- 
 
-          # For box zooming, we are given the box boundaries 
-          # but for zoom in/out and panning we need to calculate  
-          # them based on the canvas
-          #-------------------------------------------------------------
+      # Tell the browser to get the new JSON (and tiles)
 
-          # Zoom based on explicitly-set subimage boundaries 
-          # (x and y limits).
-          #
-          # In the browser interface, these boundaries are set by
-          # drawing a box on the canvas using the mouse.
+        self.to_browser("tiles")
 
-            if cmd == 'zoom': 
 
-                if self.debug:
-                    print ""
-                    print "ZOOMPAN> Box from command line"
+  # Everything that goes into the look of the tiles (files, stretches 
+  # and color table), saved under a key for the tile URLs.  Stretch
+  # limits are resolved to data values against the whole image here so
+  # all the tiles match.  This also fills in the stretch information
+  # in the view (as the mViewer return structure does otherwise).
 
-                boxxmin = float(args[1])
-                boxxmax = float(args[2])
-                boxymin = float(args[3])
-                boxymax = float(args[4])
+    def tile_state(self):
 
+        color_table = self.view.gray_file.color_table
 
-          # Zoom In (new subimage boundaries are calculated based on 
-          # current subimage boundaries).
+        if color_table == "":
+           color_table = 0
 
-            elif cmd == 'zoomIn':
+        channels = []
+        key      = []
 
-                if self.debug:
-                    print ""
-                    print "ZOOMPAN> Box by zooming in"
+        for view_file, prefix in self.display_files():
 
-                box_width  = float(self.view.canvas_width)
+            stretch = self.get_stretch(view_file.fits_file)
 
-                box_center = box_width / 2.
+            stretch_min  = view_file.stretch_min
+            stretch_max  = view_file.stretch_max
+            stretch_mode = view_file.stretch_mode
 
-                boxxmin = box_center - box_width / 4.
-                boxxmax = box_center + box_width / 4.
+            if stretch_min == "":
+               stretch_min = "-1s"
 
-                box_height  = float(self.view.canvas_height)
+            if stretch_max == "":
+               stretch_max = "max"
 
-                box_center = box_height / 2.
+            if stretch_mode == "":
+               stretch_mode = "gaussian-log"
 
-                boxymin = box_center - box_height / 4.
-                boxymax = box_center + box_height / 4.
+            vmin = stretch.resolve(stretch_min)
+            vmax = stretch.resolve(stretch_max)
 
+            self.describe_stretch(view_file, stretch, stretch.sketch, vmin, vmax)
 
-          # Zoom Out (new subimage boundaries are calculated based on 
-          # current subimage boundaries).
+            channels.append((view_file.fits_file, stretch, vmin, vmax, str(stretch_mode)))
+            key     .append((view_file.fits_file, stretch.stamp, vmin, vmax, str(stretch_mode)))
 
-            elif cmd == 'zoomOut':
+        key = "t" + hashlib.md5(repr((self.view.display_mode, str(color_table), key))).hexdigest()
 
-                if self.debug:
-                    print ""
-                    print "ZOOMPAN> Box by zooming out"
+        self.tileStates[key] = (str(color_table), channels)
 
-                box_width  = float(self.view.canvas_width)
-                box_center = box_width / 2.
+        return key
 
-                boxxmin = box_center - box_width
-                boxxmax = box_center + box_width
 
-                box_height = float(self.view.canvas_height)
-                box_center = box_height / 2.
+  # The value distribution (for stretching) of a file
 
-                boxymin = box_center - box_height
-                boxymax = box_center + box_height
+    def get_stretch(self, fits_file):
 
-          #-------------------------------------------------------------
+        if fits_file in self.stretches and self.stretches[fits_file].current():
+            return self.stretches[fits_file]
 
+        stretch = mvStretch(fits_file)
 
-          # Pan the view region without altering the current zoom 
-          # scale.  Implemented panning directions are multiples
-          # of 45 degrees.
-          #-------------------------------------------------------------
+        self.stretches[fits_file] = stretch
 
-            elif cmd == 'panUp':
+        return stretch
 
-                if self.debug:
-                    print ""
-                    print "ZOOMPAN> Box by panning up"
 
-                box_height = float(self.view.canvas_height)
+  # Resolve a file's stretch limits for the mViewer command line (see 
+  # mvStretch), against the whole image or the view box (by default
+  # the current one) depending on stretchScope.  Returns the limits as
+  # data values or, if they are being left to mViewer (or can't be 
+  # worked out here), unchanged.  What was resolved goes in the 
+  # "resolved" dictionary (None if nothing was).
 
-                boxymin = boxymin + box_height / 4.
-                boxymax = boxymax + box_height / 4.
+    def stretch_values(self, view_file, stretch_min, stretch_max, resolved, box=None, quiet=False):
 
+        resolved[view_file.fits_file] = None
 
-            elif cmd == 'panDown':
+        if self.stretchScope == "render" or numpy is None or self.view.display_mode == "mosaic":
+            return stretch_min, stretch_max
 
-                if self.debug:
-                    print ""
-                    print "ZOOMPAN> Box by panning down"
+        if box is None:
+            box = (self.view.xmin, self.view.xmax, self.view.ymin, self.view.ymax)
 
-                box_height = float(self.view.canvas_height)
+        try:
+            stretch = self.get_stretch(view_file.fits_file)
 
-                boxymin = boxymin - box_height / 4.
-                boxymax = boxymax - box_height / 4.
+            sketch = stretch.sketch
 
+            if self.stretchScope == "local":
+                sketch = stretch.local(box[0], box[2], box[1], box[3])
 
-            elif cmd == 'panLeft':
+            vmin = stretch.resolve(stretch_min, sketch)
+            vmax = stretch.resolve(stretch_max, sketch)
 
-                if self.debug:
-                    print ""
-                    print "ZOOMPAN> Box by panning left"
+        except Exception as e:
 
-                box_width = float(self.view.canvas_width)
+            if self.debug and not quiet:
+                print "DEBUG> Stretch not resolved (" + str(e) + "); leaving it to mViewer."
 
-                boxxmin = boxxmin - box_width / 4.
-                boxxmax = boxxmax - box_width / 4.
+            return stretch_min, stretch_max
 
+        resolved[view_file.fits_file] = (stretch, sketch, vmin, vmax)
 
-            elif cmd == 'panRight':
+        return repr(vmin), repr(vmax)
 
-                if self.debug:
-                    print ""
-                    print "ZOOMPAN> Box by panning right"
 
-                box_width = float(self.view.canvas_width)
+  # Fill in the actual stretch values (limits, and where they fall 
+  # in the distribution) for the browser
 
-                boxxmin = boxxmin + box_width / 4.
-                boxxmax = boxxmax + box_width / 4.
+    def describe_stretch(self, view_file, stretch, sketch, vmin, vmax):
 
+        median = sketch.median()
+        sigma  = sketch.sigma()
 
-            elif cmd == 'panUpLeft':
+        view_file.min         = vmin
+        view_file.max         = vmax
+        view_file.data_min    = sketch.data_min
+        view_file.data_max    = sketch.data_max
+        view_file.min_sigma   = (vmin - median) / sigma
+        view_file.max_sigma   = (vmax - median) / sigma
+        view_file.min_percent = sketch.percent_at(vmin)
+        view_file.max_percent = sketch.percent_at(vmax)
 
-                if self.debug:
-                    print ""
-                    print "ZOOMPAN> Box by panning up and left"
+        if stretch.bunit != "":
+            self.view.bunit = stretch.bunit
 
-                box_height = float(self.view.canvas_height)
-                box_width = float(self.view.canvas_width)
 
-                boxymin = boxymin + box_height / (4. * math.sqrt(2))
-                boxymax = boxymax + box_height / (4. * math.sqrt(2))
-                boxxmin = boxxmin - box_width  / (4. * math.sqrt(2))
-                boxxmax = boxxmax - box_width  / (4. * math.sqrt(2))
+  # Pixel values of the current view for the browser to stretch 
+  # itself.  Each value is quantized to 16 bits by where it falls in
+  # the whole-image distribution (65535 is blank), which keeps the 
+  # most levels where most of the pixels are.  The file (served as
+  # "pixels/<key>.bin" from the workspace) is:
+  #
+  #    4-byte (little-endian) length of a JSON header, the header
+  #    (padded to a multiple of 8 bytes), then for each channel the
+  #    sketch bin edges, the fraction of the image below each edge
+  #    (to undo the quantization) and the same for the sketch the 
+  #    stretch limits are resolved against (see stretchScope), all 
+  #    float64, then each channel's values (uint16) in screen order,
+  #    i.e. top row first.
+  #
+  # Channels are gray or blue, green, red (as display_files()).
+  # Returns the key.
 
+    def update_pixels(self, shrink_key):
 
-            elif cmd == 'panUpRight':
+        files = self.display_files()
 
-                if self.debug:
-                    print ""
-                    print "ZOOMPAN> Box by panning up and right"
+        stretches = [self.get_stretch(view_file.fits_file) for view_file, prefix in files]
 
-                box_height = float(self.view.canvas_height)
-                box_width = float(self.view.canvas_width)
+        key = "p" + hashlib.md5(repr((shrink_key, self.stretchScope, [stretch.stamp for stretch in stretches]))).hexdigest()
 
-                boxymin = boxymin + box_height / (4. * math.sqrt(2))
-                boxymax = boxymax + box_height / (4. * math.sqrt(2))
-                boxxmin = boxxmin + box_width  / (4. * math.sqrt(2))
-                boxxmax = boxxmax + box_width  / (4. * math.sqrt(2))
+        if self.pixelCache is None:
+            self.pixelCache = mvFileCache(self.workspace + "/pixels", self.pixelCacheSize, ".bin")
 
+        if self.pixelCache.contains(key):
+            return key
 
-            elif cmd == 'panDownLeft':
 
-                if self.debug:
-                    print ""
-                    print "ZOOMPAN> Box by panning down and left"
+      # A render cache hit skips the shrink stage, 
+      # so the shrunken images may be out of date
 
-                box_height = float(self.view.canvas_height)
-                box_width = float(self.view.canvas_width)
+        outputs = [self.workspace + "/" + prefix + "shrunken.fits" for view_file, prefix in files]
 
-                boxymin = boxymin - box_height / (4. * math.sqrt(2))
-                boxymax = boxymax - box_height / (4. * math.sqrt(2))
-                boxxmin = boxxmin - box_width  / (4. * math.sqrt(2))
-                boxxmax = boxxmax - box_width  / (4. * math.sqrt(2))
+        self.run_stage("shrink", shrink_key, outputs, self.shrink_images)
 
+        header = { 'width': 0, 'height': 0, 'channels': [] }
+        tables = []
+        values = []
 
-            elif cmd == 'panDownRight':
+        for (view_file, prefix), stretch in zip(files, stretches):
 
-                if self.debug:
-                    print ""
-                    print "ZOOMPAN> Box by panning down and right"
+            fits = mvFITS(self.workspace + "/" + prefix + "shrunken.fits")
 
-                box_height = float(self.view.canvas_height)
-                box_width = float(self.view.canvas_width)
+            data = fits.physical(fits.data())[::-1]
 
-                boxymin = boxymin - box_height / (4. * math.sqrt(2))
-                boxymax = boxymax - box_height / (4. * math.sqrt(2))
-                boxxmin = boxxmin + box_width  / (4. * math.sqrt(2))
-                boxxmax = boxxmax + box_width  / (4. * math.sqrt(2))
+            if self.stretchScope == "local":
+                sketch = stretch.local(self.view.xmin, self.view.ymin, self.view.xmax, self.view.ymax)
 
-          #-------------------------------------------------------------
+            elif self.stretchScope == "render":
 
+                sketch = mvSketch(stretch.sketch.edges)
 
-          # The box (especially for draw box zooming) will
-          # not necessarily have the proportions of the canvas. 
-          # Correct the aspect ratio here.
+                sketch.add(data)
 
-            box_width  = boxxmax-boxxmin
-            box_height = boxymax-boxymin
+                if sketch.count == 0:
+                    sketch = stretch.sketch
 
-            if self.debug:
-                print ""
-                print "ZOOMPAN> Input:"
-                print "ZOOMPAN> boxx: " + str(boxxmin) + " to " + str(boxxmax) + " [" + str(box_width)  + "]"
-                print "ZOOMPAN> boxy: " + str(boxymin) + " to " + str(boxymax) + " [" + str(box_height) + "]"
+            else:
+                sketch = stretch.sketch
 
-            box_aspect    = float(box_height)              / float(box_width)
-            canvas_aspect = float(self.view.canvas_height) / float(self.view.canvas_width)
+            valid = numpy.isfinite(data)
 
-            if self.debug:
-                print ""
-                print "ZOOMPAN> Aspect:"
-                print "ZOOMPAN> box:    " + str(box_aspect) 
-                print "ZOOMPAN> canvas: " + str(canvas_aspect)
+            quantized = numpy.floor(stretch.sketch.cdf(numpy.where(valid, data, 0.)) * 65534. + 0.5)
 
+            values.append(numpy.where(valid, quantized, 65535.).astype('<u2'))
 
-          # Based on the ratio of box aspect ratio to canvas,
-          # if the box is taller and skinner than the canvas;
-          # make it wider.
+            tables.extend([stretch.sketch.edges, stretch.sketch.cumulative(), sketch.cumulative()])
 
-            ratio = box_aspect / canvas_aspect
+            header['width']  = fits.naxis1
+            header['height'] = fits.naxis2
 
-            if self.debug:
-                print ""
-                print "ZOOMPAN> Apect ratio adjusment factor: " + str(ratio)
+            header['channels'].append({ 'nedge':    len(stretch.sketch.edges),
+                                        'data_min': sketch.data_min,
+                                        'data_max': sketch.data_max })
 
-            if ratio > 1.:
+        text = json.dumps(header)
 
-                box_width = int(box_width * ratio)
+        text += " " * (-(len(text) + 4) % 8)
 
-                box_center = (boxxmax + boxxmin) / 2.
- 
-                boxxmin = box_center - box_width / 2.
-                boxxmax = box_center + box_width / 2.
+        pixel_file = self.workspace + "/" + key + ".bin"
 
+        fp = open(pixel_file, 'wb')
 
-          # The box is shorter and fatter than the canvas;
-          # make it taller.
+        try:
+            fp.write(numpy.array([len(text)], dtype='<u4').tostring())
+            fp.write(text)
 
-            else:
+            for table in tables:
+                fp.write(numpy.asarray(table, dtype='<f8').tostring())
 
-                box_height = int(box_height / ratio)
+            for value in values:
+                fp.write(value.tostring())
+        finally:
+            fp.close()
 
-                box_center = (boxymax + boxymin) / 2.
- 
-                boxymin = box_center - box_height / 2.
-                boxymax = box_center + box_height / 2.
+        self.pixelCache.put(key, pixel_file)
 
+        if self.debug:
+            print "DEBUG> Pixel values: " + key + " [" + str(header['width']) + " X " + str(header['height']) + "]"
 
-            box_width  = boxxmax-boxxmin
-            box_height = boxymax-boxymin
+        return key
 
-            box_aspect = float(box_height) / float(box_width)
 
-            if self.debug:
-                print ""
-                print "ZOOMPAN> Adjust to canvas aspect:"
-                print "ZOOMPAN> boxx: " + str(boxxmin) + " to " + str(boxxmax) + " [" + str(box_width)  + "]"
-                print "ZOOMPAN> boxy: " + str(boxymin) + " to " + str(boxymax) + " [" + str(box_height) + "]"
+  # A color table as a 256 x 1 PNG (for the browser to read the 
+  # colors from), drawn by mViewer from a ramp of byte values.  The 
+  # ramp borrows the header (for the WCS) of the file being viewed.
 
+    def get_color_table(self, color_table):
 
-          # If we are zoomed out far enough that we see the whole image,
-          # part of the canvas may not be covered due to a difference in the
-          # image and canvas aspect ratios.  In this case (and when zooming
-          # part of the zoom box may be off the image.  If we detect this,
-          # we shift the zoom box to be as much on the image as possible,
-          # with the same sizing.
+        color_table = int(color_table)
 
-            if cmd == 'zoom' or cmd == 'zoomIn':
-            
-                if boxxmax > self.view.disp_width:
+        if color_table in self.colorTables:
+            return self.colorTables[color_table]
 
-                    diff = boxxmax - self.view.disp_width
+        fits = mvFITS(self.display_files()[0][0].fits_file)
 
-                    boxxmax = boxxmax - diff
-                    boxxmin = boxxmin - diff
+        cards = fits.update_cards({ 'NAXIS1': 256,
+                                    'NAXIS2': 1,
+                                    'BITPIX': 8,
+                                    'BSCALE': None,
+                                    'BZERO':  None,
+                                    'BLANK':  None })
 
-                if boxxmin < 0:
+        base = self.workspace + "/ct" + str(color_table) + "_" + str(current_thread().ident)
 
-                    diff = boxxmin
+        fits.write(base + ".fits", numpy.arange(256, dtype='u1').reshape(1, 256), cards)
 
-                    boxxmin = boxxmin - diff
-                    boxxmax = boxxmax - diff
+        command = "mViewer -ct " + str(color_table) + " -gray " + base + ".fits 0 255 lin -png " + base + ".png"
 
-                if boxymax > self.view.disp_height:
+        if self.debug:
+           print "\nMONTAGE Command:\n---------------\n" + command
 
-                    diff = boxymax - self.view.disp_height
+        try:
+            retval = self.montage_runner().call(command)
 
-                    boxymax = boxymax - diff
-                    boxymin = boxymin - diff
+            if retval.stat != "OK":
+                raise Exception(retval.msg)
 
-                if boxymin < 0:
+            fp = open(base + ".png", 'rb')
 
-                    diff = boxymin
+            try:
+                png = fp.read()
+            finally:
+                fp.close()
 
-                    boxymin = boxymin - diff
-                    boxymax = boxymax - diff
+        finally:
+            for suffix in [".fits", ".png"]:
+                if os.path.exists(base + suffix):
+                    os.remove(base + suffix)
 
-                if self.debug:
-                    print ""
-                    print "ZOOMPAN> After shifting:"
-                    print "ZOOMPAN> boxx: " + str(boxxmin) + " to " + str(boxxmax) 
-                    print "ZOOMPAN> boxy: " + str(boxymin) + " to " + str(boxymax) 
+        self.colorTables[color_table] = png
 
+        return png
 
-          # Convert the box back to image coordinates
 
-            factor = float(self.view.factor)
+  # Render a tile (or get it from the cache).  Tile x, y are counted
+  # from the lower left corner in tileSize steps at the given pyramid
+  # level.  Each file's tile is stretched to bytes and written as a 
+  # small FITS file; the mViewer executable then only has to apply 
+  # the color table (or combine the colors) and make the PNG.
 
-            boxxmin = boxxmin * factor
-            boxxmax = boxxmax * factor
-            boxymin = boxymin * factor
-            boxymax = boxymax * factor
+    def get_tile(self, key, level, tx, ty):
 
-            boxxmin = boxxmin + oldxmin
-            boxxmax = boxxmax + oldxmin
-            boxymin = boxymin + oldymin
-            boxymax = boxymax + oldymin
+        png = self.cached_tile(key, level, tx, ty)
 
-            if self.debug:
-                print ""
-                print "ZOOMPAN> In image pixel coordinates:"
-                print "ZOOMPAN> boxx: " + str(boxxmin) + " to " + str(oldxmax) 
-                print "ZOOMPAN> boxy: " + str(boxymin) + " to " + str(oldymax) 
+        if png is not None:
+            return png
 
+        tile_key = key + "_" + str(level) + "_" + str(tx) + "_" + str(ty)
 
-            if boxxmin < 0:
-                boxxmax = boxxmax - boxxmin
-                boxxmin = 0
+        if key not in self.tileStates:
+            raise Exception("Unknown tile key " + key)
 
-            if boxxmax > self.view.image_width:
-                boxxmax = self.view.image_width
-                boxxmin = boxxmax - box_width*factor
+        color_table, channels = self.tileStates[key]
 
-            if boxymin < 0:
-                boxymax = boxymax - boxymin
-                boxymin = 0
+        if len(channels) == 1:
+            flags = ["-gray"]
+        else:
+            flags = ["-blue", "-green", "-red"]
 
-            if boxymax > self.view.image_height:
-                boxymax = self.view.image_height
-                boxymin = boxxmax - box_height*factor
+        size = self.tileSize
 
-            if self.debug:
-                print ""
-                print "ZOOMPAN> Clipped by the image dimensions:"
-                print "ZOOMPAN> boxx: " + str(boxxmin) + " to " + str(oldxmax) 
-                print "ZOOMPAN> boxy: " + str(boxymin) + " to " + str(oldymax) 
+        command   = "mViewer -ct " + color_table
+        fits_list = []
 
+        for channel, flag in zip(channels, flags):
 
-          # Save new subimage boundaries
+            fits_file, stretch, vmin, vmax, mode = channel
 
-            self.view.xmin = int(boxxmin)
-            self.view.xmax = int(boxxmax)
-            self.view.ymin = int(boxymin)
-            self.view.ymax = int(boxymax)
+            if level > 0:
+                fits_file = self.get_pyramid(fits_file).level_file(level)
 
+            fits = mvFITS(fits_file)
 
-          # Update view 
+            raw, cards = fits.cutout(tx*size + 1, ty*size + 1, (tx+1)*size + 1, (ty+1)*size + 1, bitpix=8)
 
-            self.update_display()
+            tile_fits = self.tileCache.directory + "/" + tile_key + "_" + str(current_thread().ident) + flag + ".fits"
 
-      #-----------------------------------------------------------------
+            fits.write(tile_fits, stretch.apply(fits.physical(raw), vmin, vmax, mode), cards)
 
+            fits_list.append(tile_fits)
 
-      # COMMAND: "center"
-      #
-      # Center the current view "box" (subimage) on a reference point
-      # defined by the most recent "pick" operation (defaults to
-      # image center if no such point has been chosen).  
-      # Current zoom scale is retained.
-      #-----------------------------------------------------------------
+            command += " " + flag + " " + tile_fits + " 0 255 lin"
 
-        elif cmd == "center":
+        png_file = self.tileCache.directory + "/" + tile_key + "_" + str(current_thread().ident) + ".png"
 
-          # Obtain "current" subimage boundaries 
+        command += " -png " + png_file
 
-            oldxmin = float(self.view.xmin)
-            oldxmax = float(self.view.xmax)
-            oldymin = float(self.view.ymin)
-            oldymax = float(self.view.ymax)
+        if self.debug:
+           print "\nMONTAGE Command:\n---------------\n" + command
 
-            box_width   = float(self.view.canvas_width)
-            box_height  = float(self.view.canvas_height)
+        try:
+            retval = self.montage_runner().call(command)
 
-            # box_xcenter = box_width  / 2.
-            # box_ycenter = box_height / 2.
+            if retval.stat != "OK":
+                raise Exception(retval.msg)
 
-            factor = float(self.view.factor)
+        finally:
+            for tile_fits in fits_list:
+                os.remove(tile_fits)
 
+        fp = open(png_file, 'rb')
 
-          # Reference current "pick" point and redefine 
-          # subimage boundaries 
+        try:
+            png = fp.read()
+        finally:
+            fp.close()
 
-            if cmd == 'center':
-                if (self.view.currentPickX != 0) and (self.view.currentPickY != 0):
-                    boxymax = self.view.currentPickY + ((box_height * factor)/2)
-                    boxymin = self.view.currentPickY - ((box_height * factor)/2)
-                    boxxmax = self.view.currentPickX + ((box_width * factor)/2)
-                    boxxmin = self.view.currentPickX - ((box_width * factor)/2)
-                else:
-                    boxymax = (self.view.image_height + box_height * factor) / 2
-                    boxymin = (self.view.image_height - box_height * factor) / 2
-                    boxxmax = (self.view.image_width + box_width  * factor)  / 2
-                    boxxmin = (self.view.image_width - box_width  * factor)  / 2
+        self.tileCache.put(tile_key, png_file)
 
+        return png
 
-                if (boxxmax > self.view.image_width):
-                    boxxmax = self.view.image_width
-                    boxxmin = self.view.image_width - (box_width * factor)
 
-                if (boxxmin <= 0):
-                    boxxmin = 1
-                    boxxmax = (box_width * factor)
+  # A tile from the cache (None if it hasn't been rendered)
 
-                if (boxymax > self.view.image_height):
-                    boxymax = self.view.image_height
-                    boxymin = self.view.image_height - (box_height * factor)                
+    def cached_tile(self, key, level, tx, ty):
 
-                if (boxymin <= 0):
-                    boxymin = 1
-                    boxymax = (box_height * factor)
+        if self.tileCache is None:
+            self.tileCache = mvFileCache(self.workspace + "/tiles", self.tileCacheSize)
 
+        return self.tileCache.read(key + "_" + str(level) + "_" + str(tx) + "_" + str(ty))
 
-            self.view.xmin = int(boxxmin)
-            self.view.xmax = int(boxxmax)
-            self.view.ymin = int(boxymin)
-            self.view.ymax = int(boxymax)
 
-            self.update_display()
+  # Run a function on the render thread pool (which is 
+  # started the first time it is needed).  Returns a Future.
 
-      #-----------------------------------------------------------------
+    def submit(self, function, *args):
 
+        with self.processLock:
 
-      # COMMAND: "pick"
-      #
-      # Examine a user-selected location
-      #-----------------------------------------------------------------
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(self.renderWorkers)
 
-        elif cmd == 'pick':
+        return self.executor.submit(function, *args)
 
-            factor = float(self.view.factor)
 
-            if factor == 0.:
-                factor = 1.
+  # Metadata (size, WCS, BUNIT) for a file.  This is looked up once
+  # and kept until the file's size or modification time changes.
 
-            boxx = float(args[1])
-            boxy = float(args[2])
+    def image_info(self, fits_file):
 
-            self.view.currentPickX = self.view.xmin + boxx * factor
-            self.view.currentPickY = self.view.ymin + boxy * factor
+        if self.view.display_mode == "mosaic" and fits_file == self.view.gray_file.fits_file:
+            return self.get_mosaic()
 
-            if (self.view.currentPickX >= 0 and 
-                self.view.currentPickY >= 0 and
-                self.view.currentPickX <= self.view.image_width and                
-                self.view.currentPickX <= self.view.image_height): 
+        stamp = self.file_stamp(fits_file)
 
-                self.pick_location(self.view.currentPickX, self.view.currentPickY)
+        key = os.path.abspath(fits_file)
 
-            else:
-                print "Pick location not within image."
+        if key in self.imageInfo and self.imageInfo[key][0] == stamp:
+            return self.imageInfo[key][1]
 
-            # self.update_display()
+        try:
+            info = mvFITS(fits_file)
 
-            # Updating the current "pick" location does not update 
-            # the view, so the "currentPickX" and "currentPickY"
-            # values stored in the mView representation (JSON) 
-            # may be obsolete.  
-            #
-            # This does not affect the pick calculations, as they
-            # they use the internal, up-to-date x and y values.
+        except Exception as e:
 
-      #-----------------------------------------------------------------
+            if self.debug:
+                print "DEBUG> Header read failed (" + str(e) + "); using mExamine."
 
+            info = self.examine(fits_file)
 
-        # COMMAND: "header"
-        #
-        # Get FITS header
-      #-----------------------------------------------------------------
+        self.imageInfo[key] = (stamp, info)
 
-        elif cmd == 'header':
+        return info
 
-            self.get_header()
 
-      #-----------------------------------------------------------------
+  # The virtual mosaic (see mvMosaic) for the current table and 
+  # header template
 
+    def get_mosaic(self):
 
-  # Updating the  display entails generating the subimage to be shown
-  # in the viewport, and packaging relevant information about the
-  # view in the data structure that is passed to the back end.
+        key = (self.view.gray_file.fits_file, self.view.mosaic_header)
 
-    def update_display(self):
+        if key in self.mosaics and self.mosaics[key].current():
+            return self.mosaics[key]
 
-        if self.view.display_mode == "":
-            print "No images defined. Nothing to display."
-            sys.stdout.write('\n>>> ')
-            sys.stdout.flush()
-            return
+        mosaic = mvMosaic(key[0], key[1], self.cache_directory())
 
-        if self.view.display_mode == "grayscale":
+        self.mosaics[key] = mosaic
 
-          # First cut out the part of the original grayscale image we want
+        return mosaic
 
-            command = "mSubimage -p" 
-            command += " " + self.view.gray_file.fits_file 
-            command += " " + self.workspace + "/subimage.fits" 
-            command += " " + str(self.view.xmin)
-            command += " " + str(self.view.ymin)
-            command += " " + str(int(self.view.xmax) - int(self.view.xmin))
-            command += " " + str(int(self.view.ymax) - int(self.view.ymin))
 
-            if self.debug:
-               print "\nMONTAGE Command:\n---------------\n" + command
+  # Metadata from mExamine, for files we can't read ourselves
 
-            p = subprocess.Popen(shlex.split(command), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    def examine(self, fits_file):
 
-            stderr = p.stderr.read()
+        command = "mExamine " + fits_file
 
-            if stderr:
-                raise Exception(stderr)
-                return
+        if self.debug:
+           print "\nMONTAGE Command:\n---------------\n" + command
 
-            retval = mvStruct("mSubimage", p.stdout.read().strip())
+        retval = self.montage_runner().call(command)
 
-            if self.debug:
-                print "\nRETURN Struct:\n-------------\n"
-                print retval
-                sys.stdout.write('\n>>> ')
-                sys.stdout.flush()
+        if self.debug:
+            print "\nRETURN Struct:\n-------------\n"
+            print retval
+            sys.stdout.write('\n>>> ')
+            sys.stdout.flush()
 
+        wcs = {}
 
-        else:
+        for keyword in ['crval1', 'crval2', 'crpix1', 'crpix2', 'cdelt1', 'cdelt2', 'crota2', 'equinox']:
+            if hasattr(retval, keyword):
+                wcs[keyword.upper()] = getattr(retval, keyword)
 
-          # Or if in color mode, cut out the three images
+        return mvImageInfo(fits_file, retval.naxis1, retval.naxis2, getattr(retval, 'bunit', ""), wcs)
 
-          # Blue
 
-            command = "mSubimage -p" 
-            command += " " + self.view.blue_file.fits_file 
-            command += " " + self.workspace + "/blue_subimage.fits" 
-            command += " " + str(self.view.xmin)
-            command += " " + str(self.view.ymin)
-            command += " " + str(int(self.view.xmax) - int(self.view.xmin))
-            command += " " + str(int(self.view.ymax) - int(self.view.ymin))
+  # The pyramid for a file (started building in the 
+  # background the first time we ask for it)
 
-            if self.debug:
-               print "\nMONTAGE Command:\n---------------\n" + command
+    def get_pyramid(self, fits_file):
 
-            p = subprocess.Popen(shlex.split(command), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if fits_file in self.pyramids and self.pyramids[fits_file].current():
+            return self.pyramids[fits_file]
 
-            stderr = p.stderr.read()
+        pyramid = mvPyramid(fits_file, self.cache_directory())
 
-            if stderr:
-                raise Exception(stderr)
-                return
+        pyramid.build_in_background()
 
-            retval = mvStruct("mSubimage", p.stdout.read().strip())
+        self.pyramids[fits_file] = pyramid
 
-            if self.debug:
-                print "\nRETURN Struct:\n-------------\n"
-                print retval
+        return pyramid
 
 
-          # Green
+  # Where the per-file caches (pyramids, indexes) go
 
-            command = "mSubimage -p" 
-            command += " " + self.view.green_file.fits_file 
-            command += " " + self.workspace + "/green_subimage.fits" 
-            command += " " + str(self.view.xmin)
-            command += " " + str(self.view.ymin)
-            command += " " + str(int(self.view.xmax) - int(self.view.xmin))
-            command += " " + str(int(self.view.ymax) - int(self.view.ymin))
+    def cache_directory(self):
 
-            if self.debug:
-               print "\nMONTAGE Command:\n---------------\n" + command
+        if self.cacheDir == "":
+            return self.workspace + "/pyramid"
 
-            p = subprocess.Popen(shlex.split(command), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        return self.cacheDir
 
-            stderr = p.stderr.read()
 
-            if stderr:
-                raise Exception(stderr)
-                return
+  # An index (mvIntegral or mvMinMax) for a file (None if we aren't
+  # using them or the file can't have one).  It is kept in the same
+  # directory as the file's pyramid and built in the background.
 
-            retval = mvStruct("mSubimage", p.stdout.read().strip())
+    def get_index(self, fits_file, index_class):
 
-            if self.debug:
-                print "\nRETURN Struct:\n-------------\n"
-                print retval
+        if not self.useIndex or numpy is None:
+            return None
+
+        key = (index_class.__name__, fits_file)
 
+        if key in self.indexes and self.indexes[key].current():
+            return self.indexes[key]
 
-          # Red
+        try:
+            index = index_class(mvPyramid(fits_file, self.cache_directory()))
+
+            index.build_in_background()
 
-            command = "mSubimage -p" 
-            command += " " + self.view.red_file.fits_file 
-            command += " " + self.workspace + "/red_subimage.fits" 
-            command += " " + str(self.view.xmin)
-            command += " " + str(self.view.ymin)
-            command += " " + str(int(self.view.xmax) - int(self.view.xmin))
-            command += " " + str(int(self.view.ymax) - int(self.view.ymin))
+        except Exception as e:
 
             if self.debug:
-               print "\nMONTAGE Command:\n---------------\n" + command
+                print "DEBUG> No " + index_class.__name__ + " index for " + fits_file + " (" + str(e) + ")"
 
-            p = subprocess.Popen(shlex.split(command), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            return None
 
-            stderr = p.stderr.read()
+        self.indexes[key] = index
 
-            if stderr:
-                raise Exception(stderr)
-                return
+        return index
 
-            retval = mvStruct("mSubimage", p.stdout.read().strip())
 
-            if self.debug:
-                print "\nRETURN Struct:\n-------------\n"
-                print retval
-                sys.stdout.write('\n>>> ')
-                sys.stdout.flush()
+  # Start building the indexes for a newly-set file
 
+    def index_file(self, fits_file):
 
-      # Get the size (all three are the same)
+        if fits_file != "":
+            self.get_index(fits_file, mvIntegral)
+            self.get_index(fits_file, mvMinMax)
 
-        if self.view.display_mode == "grayscale":
-            command = "mExamine " + self.workspace + "/subimage.fits"
-        else:
-            command = "mExamine " + self.workspace + "/red_subimage.fits"
 
-        if self.debug:
-           print "\nMONTAGE Command:\n---------------\n" + command
+  # The sky index (mvCatalogIndex) for a catalog table, or None.  Like
+  # the image indexes it is built in the background on first use, along
+  # with the table's binary columns (mvTable), including the column
+  # that sets the symbol sizes.
 
-        p = subprocess.Popen(shlex.split(command), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    def get_catalog_index(self, table_file, data_col="", quiet=False):
 
-        stderr = p.stderr.read()
+        if not self.cullCatalogs or numpy is None:
+            return None
 
-        if stderr:
-            raise Exception(stderr)
-            return
+        if table_file in self.catalogs and self.catalogs[table_file].current():
 
-        retval = mvStruct("mExamine", p.stdout.read().strip())
+            index = self.catalogs[table_file]
 
-        if self.debug:
-            print "\nRETURN Struct:\n-------------\n"
-            print retval
-            sys.stdout.write('\n>>> ')
-            sys.stdout.flush()
+            index.want(data_col)
+            index.build_in_background()
 
-        subimage_width  = retval.naxis1
-        subimage_height = retval.naxis2
+            return index
 
+        try:
+            index = mvCatalogIndex(mvTable(table_file, self.cache_directory()))
 
-        xfactor = float(subimage_width)  / float(self.view.canvas_width)
-        yfactor = float(subimage_height) / float(self.view.canvas_height)
+            index.want(data_col)
+            index.build_in_background()
 
-        if float(yfactor) > float(xfactor):
-            xfactor = yfactor
+        except Exception as e:
 
-        self.view.factor = xfactor
+            if self.debug and not quiet:
+                print "DEBUG> No index for catalog " + str(table_file) + " (" + str(e) + ")"
 
+            return None
 
-        if self.view.display_mode == "grayscale":
+        self.catalogs[table_file] = index
 
-          # Shrink/expand the grayscale cutout to the right size
+        return index
 
-            xfactor = float(subimage_width)  / float(self.view.canvas_width)
-            yfactor = float(subimage_height) / float(self.view.canvas_height)
 
-            if float(yfactor) > float(xfactor):
-                xfactor = yfactor
+  # A cone (RA, Dec and radius in degrees) covering a view box (xmin, 
+  # xmax, ymin, ymax; by default the current one) with a bit to spare
+  # for symbols drawn around positions just outside it
 
-            self.view.factor = xfactor
+    def view_cone(self, box=None):
 
-            command = "mShrink" 
-            command += " " + self.workspace + "/subimage.fits" 
-            command += " " + self.workspace + "/shrunken.fits" 
-            command += " " + str(xfactor)
+        if box is None:
+            box = (self.view.xmin, self.view.xmax, self.view.ymin, self.view.ymax)
 
-            if self.debug:
-               print "\nMONTAGE Command:\n---------------\n" + command
+        info = self.image_info(self.display_files()[0][0].fits_file)
 
-            p = subprocess.Popen(shlex.split(command), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        wcs = mvWCS(info.wcs)
 
-            stderr = p.stderr.read()
+        x0, y0, x1, y1 = info.bounds(box[0], box[2], box[1], box[3])
 
-            if stderr:
-                raise Exception(stderr)
-                return
+        x = numpy.array([x0, x1, x0, x1, (x0 + x1) / 2.]) + 0.5
+        y = numpy.array([y0, y0, y1, y1, (y0 + y1) / 2.]) + 0.5
 
-            retval = mvStruct("mShrink", p.stdout.read().strip())
+        ra, dec = wcs.pix2sky(x, y)
 
-            if self.debug:
-                print "\nRETURN Struct:\n-------------\n"
-                print retval
-                sys.stdout.write('\n>>> ')
-                sys.stdout.flush()
+        xyz = mvSkyGrid().unit_vectors(ra, dec)
 
+        radius = math.degrees(numpy.arccos(numpy.clip(numpy.dot(xyz[0:4], xyz[4]), -1., 1.)).max())
 
-        else:
+        return float(ra[4]), float(dec[4]), 1.1 * radius + 2. * abs(wcs.cdelt2)
 
-          # Shrink/expand the three color cutouts to the right size
 
-          # Blue
+  # The catalog table mViewer should draw for a view: if the table's
+  # index is ready, a copy with only the rows in (and just around) the
+  # view, otherwise the table itself.  The copies are kept in a cache
+  # under a key made from the table's index and the cone.
 
-            command = "mShrink" 
-            command += " " + self.workspace + "/blue_subimage.fits" 
-            command += " " + self.workspace + "/blue_shrunken.fits" 
-            command += " " + str(xfactor)
+    def view_catalog(self, table_file, data_col="", box=None, quiet=False):
 
-            if self.debug:
-               print "\nMONTAGE Command:\n---------------\n" + command
+        index = self.get_catalog_index(table_file, data_col, quiet)
 
-            p = subprocess.Popen(shlex.split(command), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if index is None or not index.ready():
+            return table_file
 
-            stderr = p.stderr.read()
+        try:
+            ra, dec, radius = self.view_cone(box)
 
-            if stderr:
-                raise Exception(stderr)
-                return
+            key = "c" + hashlib.md5(repr((index.directory, data_col.lower(), "%.6f" % ra, "%.6f" % dec, "%.6f" % radius))).hexdigest()
 
-            retval = mvStruct("mShrink", p.stdout.read().strip())
+            if self.catalogCache is None:
+                self.catalogCache = mvFileCache(self.workspace + "/catalogs", self.catalogCacheSize, ".tbl")
 
-            if self.debug:
-                print "\nRETURN Struct:\n-------------\n"
-                print retval
+            if self.catalogCache.get(key) is None:
 
+                rows = index.cone(ra, dec, radius)
 
-          # Green
+                out_file = self.workspace + "/" + key + ".tbl"
 
-            command = "mShrink" 
-            command += " " + self.workspace + "/green_subimage.fits" 
-            command += " " + self.workspace + "/green_shrunken.fits" 
-            command += " " + str(xfactor)
+                index.write_subset(rows, out_file, data_col)
 
-            if self.debug:
-               print "\nMONTAGE Command:\n---------------\n" + command
+                self.catalogCache.put(key, out_file)
 
-            p = subprocess.Popen(shlex.split(command), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                if self.debug and not quiet:
+                    print "DEBUG> Catalog " + str(table_file) + ": " + str(len(rows)) + " rows in view"
 
-            stderr = p.stderr.read()
+            return self.catalogCache.file_name(key)
 
-            if stderr:
-                raise Exception(stderr)
-                return
+        except Exception as e:
 
-            retval = mvStruct("mShrink", p.stdout.read().strip())
+            if self.debug and not quiet:
+                print "DEBUG> Catalog " + str(table_file) + " not cut down (" + str(e) + ")"
 
-            if self.debug:
-                print "\nRETURN Struct:\n-------------\n"
-                print retval
+            return table_file
 
 
-          # Red
+  # The footprint index (mvFootprintIndex) for an image metadata 
+  # table, or None.  Built in the background like the catalog ones.
 
-            command = "mShrink" 
-            command += " " + self.workspace + "/red_subimage.fits" 
-            command += " " + self.workspace + "/red_shrunken.fits" 
-            command += " " + str(xfactor)
+    def get_footprint_index(self, table_file, quiet=False):
 
-            if self.debug:
-               print "\nMONTAGE Command:\n---------------\n" + command
+        if not self.cullFootprints or numpy is None:
+            return None
 
-            p = subprocess.Popen(shlex.split(command), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if table_file in self.footprints and self.footprints[table_file].current():
+            return self.footprints[table_file]
 
-            stderr = p.stderr.read()
+        try:
+            index = mvFootprintIndex(mvTable(table_file, self.cache_directory()))
 
-            if stderr:
-                raise Exception(stderr)
-                return
+            index.build_in_background()
 
-            retval = mvStruct("mShrink", p.stdout.read().strip())
+        except Exception as e:
 
-            if self.debug:
-                print "\nRETURN Struct:\n-------------\n"
-                print retval
-                sys.stdout.write('\n>>> ')
-                sys.stdout.flush()
+            if self.debug and not quiet:
+                print "DEBUG> No index for image table " + str(table_file) + " (" + str(e) + ")"
 
+            return None
 
-      # Finally, generate the PNG
+        self.footprints[table_file] = index
 
-        command = "mViewer"
+        return index
 
-        noverlay = len(self.view.overlay)
 
-        for i in range(0, noverlay):
+  # The image metadata table to hand mViewer for a view box: just the
+  # rows whose footprints might be in view, once the index is ready.
 
-            type = self.view.overlay[i].type
+    def view_footprints(self, table_file, box=None, quiet=False):
 
-            if   type == 'grid':
+        index = self.get_footprint_index(table_file, quiet)
 
-                visible  = self.view.overlay[i].visible
-                coord_sys = self.view.overlay[i].coord_sys
-                color    = self.view.overlay[i].color
+        if index is None or not index.ready():
+            return table_file
 
-                if visible == True:
+        try:
+            ra, dec, radius = self.view_cone(box)
 
-                    if color != "":
-                        command += " -color " + str(color)
+            key = "f" + hashlib.md5(repr((index.directory, "%.6f" % ra, "%.6f" % dec, "%.6f" % radius))).hexdigest()
 
-                    command += " -grid "  + str(coord_sys)
+            if self.catalogCache is None:
+                self.catalogCache = mvFileCache(self.workspace + "/catalogs", self.catalogCacheSize, ".tbl")
 
+            if self.catalogCache.get(key) is None:
 
-            elif type == 'catalog':
+                rows = index.cone(ra, dec, radius)
 
-                visible      = self.view.overlay[i].visible
-                data_file    = self.view.overlay[i].data_file
-                data_col     = self.view.overlay[i].data_col
-                data_ref     = self.view.overlay[i].data_ref
-                data_type    = self.view.overlay[i].data_type
-                sym_size     = self.view.overlay[i].sym_size
-                sym_type     = self.view.overlay[i].sym_type
-                sym_sides    = self.view.overlay[i].sym_sides
-                sym_rotation = self.view.overlay[i].sym_rotation
-                color        = self.view.overlay[i].color
+                out_file = self.workspace + "/" + key + ".tbl"
 
-                if visible == True:
+                index.write_subset(rows, out_file)
 
-                    if color != "":
-                        command += " -color " + str(color)
+                self.catalogCache.put(key, out_file)
 
-                    if sym_type != "" and sym_size != "":
-                        command += " -symbol " + str(sym_size) + " " + str(sym_type) + " " + str(sym_sides) + " " + str(sym_rotation)
+                if self.debug and not quiet:
+                    print "DEBUG> Image table " + str(table_file) + ": " + str(len(rows)) + " footprints in view"
 
-                    command += " -catalog "  + str(data_file) + " " + str(data_col) + " " + str(data_ref) + " " + str(data_type)
+            return self.catalogCache.file_name(key)
 
+        except Exception as e:
 
-            elif type == 'imginfo':
+            if self.debug and not quiet:
+                print "DEBUG> Image table " + str(table_file) + " not cut down (" + str(e) + ")"
 
-                visible   = self.view.overlay[i].visible
-                data_file = self.view.overlay[i].data_file
-                color     = self.view.overlay[i].color
+            return table_file
 
-                if visible == True:
 
-                    if color != "":
-                        command += " -color " + str(color)
+  # The images (from the imginfo overlays' tables) whose footprints
+  # contain a sky position (equatorial, degrees): a list of (table, 
+  # [file names]).  Tables whose index isn't ready yet are skipped.
 
-                    command += " -imginfo "  + str(data_file)
+    def frames_at(self, ra, dec):
 
+        frames = []
 
-            elif type == 'mark':
+        for overlay in self.view.overlay:
 
-                visible      = self.view.overlay[i].visible
-                lon          = self.view.overlay[i].lon
-                lat          = self.view.overlay[i].lat
-                sym_size     = self.view.overlay[i].sym_size
-                sym_type     = self.view.overlay[i].sym_type
-                sym_sides    = self.view.overlay[i].sym_sides
-                sym_rotation = self.view.overlay[i].sym_rotation
-                color        = self.view.overlay[i].color
+            if overlay.type != "imginfo":
+                continue
 
-                if visible == True:
+            index = self.get_footprint_index(overlay.data_file)
 
-                    if color != "":
-                        command += " -color " + str(color)
+            if index is None or not index.ready():
+                continue
 
-                    if sym_type != "" and sym_size != "":
-                        command += " -symbol " + str(sym_size) + " " + str(sym_type) + " " + str(sym_sides) + " " + str(sym_rotation)
+            lines = index.table.lines(index.covering(ra, dec))
 
-                    command += " -mark "  + str(lon) + " " + str(lat)
+            if "fname" in index.table.names:
+                names = [index.table.field(line, "fname") for line in lines]
+            else:
+                names = [line.strip() for line in lines]
 
+            frames.append((overlay.data_file, names))
 
-            elif type == 'label':
+        return frames
 
-                visible  = self.view.overlay[i].visible
-                lon      = self.view.overlay[i].lon
-                lat      = self.view.overlay[i].lat
-                text     = self.view.overlay[i].text
-                color    = self.view.overlay[i].color
 
-                if visible == True:
+  # Run a per-channel stage for each of the display files.  In color
+  # mode the three channels are independent until the final mViewer
+  # call combines them, so they are run at the same time (on a small
+  # pool of threads; the real work is in the Montage processes or in
+  # NumPy, neither of which holds the Python interpreter lock).  The
+  # function is called with the mvViewFile and file prefix.  Failures
+  # are collected by channel and reported together.  Returns the list
+  # of function results.
 
-                    if color != "":
-                        command += " -color " + str(color)
+    def run_channels(self, function):
 
-                    command += " -label "  + str(lon) + " " + str(lat) + ' "' + str(text) + '"'
+        files = self.display_files()
 
+        def run(item):
 
-            else:
-                print "Invalid overlay type '" + str(type) + "' in view specification."
+            view_file, prefix = item
 
+            try:
+                return function(view_file, prefix), None
 
-        if self.view.display_mode == "grayscale":
+            except Exception as e:
+                return None, str(e)
 
-            fits_file    = self.workspace + "/shrunken.fits"
-            color_table  = self.view.gray_file.color_table
-            stretch_min  = self.view.gray_file.stretch_min
-            stretch_max  = self.view.gray_file.stretch_max
-            stretch_mode = self.view.gray_file.stretch_mode
+        if len(files) == 1 or self.channelWorkers <= 1:
+            results = [run(item) for item in files]
 
-            if color_table == "":
-               color_table = 0
+        else:
+            if self.channelPool is None:
+                self.channelPool = ThreadPool(self.channelWorkers)
 
-            if stretch_min == "":
-               stretch_min = "-1s"
+            results = self.channelPool.map(run, files)
 
-            if stretch_max == "":
-               stretch_max = "max"
+        errors = []
 
-            if stretch_mode == "":
-               stretch_mode = "gaussian-log"
+        for item, result in zip(files, results):
 
-            command += " -ct " + str(color_table)
-            command += " -gray " + str(fits_file) + " " + str(stretch_min) + " " + str(stretch_max) + " " + str(stretch_mode)
+            if result[1] is not None:
 
+                channel = item[1].rstrip("_")
 
-        else:
+                if channel == "":
+                    channel = "gray"
 
-            fits_file    = self.workspace + "/red_shrunken.fits"
-            stretch_min  = self.view.red_file.stretch_min
-            stretch_max  = self.view.red_file.stretch_max
-            stretch_mode = self.view.red_file.stretch_mode
- 
-            if stretch_min == "":
-               stretch_min = "-1s"
+                errors.append(channel + ": " + result[1])
 
-            if stretch_max == "":
-               stretch_max = "max"
+        if len(errors) > 0:
+            raise Exception("\n".join(errors))
 
-            if stretch_mode == "":
-               stretch_mode = "gaussian-log"
+        return [result[0] for result in results]
 
-            command += " -red " + str(fits_file) + " " + str(stretch_min) + " " + str(stretch_max) + " " + str(stretch_mode)
- 
-            fits_file    = self.workspace + "/green_shrunken.fits"
-            stretch_min  = self.view.green_file.stretch_min
-            stretch_max  = self.view.green_file.stretch_max
-            stretch_mode = self.view.green_file.stretch_mode
- 
-            if stretch_min == "":
-               stretch_min = "-1s"
 
-            if stretch_max == "":
-               stretch_max = "max"
+  # The original two-step processing: cut the region out of the 
+  # original file(s), then shrink/expand the cutout(s) to fit the
+  # canvas with mShrink.  The cutout size (the same for all three
+  # colors) follows from the view box and the image size, so each
+  # channel can go straight through both steps on its own.
 
-            if stretch_mode == "":
-               stretch_mode = "gaussian-log"
+    def cutout_and_shrink(self):
 
-            command += " -green " + str(fits_file) + " " + str(stretch_min) + " " + str(stretch_max) + " " + str(stretch_mode)
- 
-            fits_file    = self.workspace + "/blue_shrunken.fits"
-            stretch_min  = self.view.blue_file.stretch_min
-            stretch_max  = self.view.blue_file.stretch_max
-            stretch_mode = self.view.blue_file.stretch_mode
+        x0, y0, x1, y1 = self.image_info(self.display_files()[-1][0].fits_file).bounds(self.view.xmin, self.view.ymin, self.view.xmax, self.view.ymax)
 
-            if stretch_min == "":
-               stretch_min = "-1s"
+        subimage_width  = x1 - x0
+        subimage_height = y1 - y0
 
-            if stretch_max == "":
-               stretch_max = "max"
+        xfactor = float(subimage_width)  / float(self.view.canvas_width)
+        yfactor = float(subimage_height) / float(self.view.canvas_height)
 
-            if stretch_mode == "":
-               stretch_mode = "gaussian-log"
+        if float(yfactor) > float(xfactor):
+            xfactor = yfactor
 
-            command += " -blue " + str(fits_file) + " " + str(stretch_min) + " " + str(stretch_max) + " " + str(stretch_mode)
+        self.view.factor = xfactor
+
+        self.run_channels(lambda view_file, prefix: self.cutout_and_shrink_channel(view_file.fits_file, prefix, xfactor))
+
+
+  # Cutout and shrink for one file (prefix "" for grayscale, 
+  # "blue_", "green_" or "red_" for color)
 
+    def cutout_and_shrink_channel(self, fits_file, prefix, xfactor):
 
-        image_file = self.view.image_file
+        self.make_cutout(fits_file, self.workspace + "/" + prefix + "subimage.fits")
 
-        command += " -png " + self.workspace + "/" + str(image_file)  # Set image format here
+        command = "mShrink" 
+        command += " " + self.workspace + "/" + prefix + "subimage.fits" 
+        command += " " + self.workspace + "/" + prefix + "shrunken.fits" 
+        command += " " + str(xfactor)
 
         if self.debug:
            print "\nMONTAGE Command:\n---------------\n" + command
 
-        p = subprocess.Popen(shlex.split(command), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-
-        stderr = p.stderr.read()
+        stdout, stderr = self.run_montage(command)
 
         if stderr:
             raise Exception(stderr)
-            return
 
-        retval = mvStruct("mViewer", p.stdout.read().strip())
+        retval = mvStruct("mShrink", stdout.strip())
 
         if self.debug:
             print "\nRETURN Struct:\n-------------\n"
             print retval
-            sys.stdout.write('\n>>> ')
-            sys.stdout.flush()
-
-        if stderr:
-            raise Exception(stderr)
-            return
-
-        if retval.stat == "WARNING":
-            print "\nWARNING: " + retval.msg
-            sys.stdout.write('\n>>> ')
-            sys.stdout.flush()
-            return
 
         if retval.stat == "ERROR":
-            print "\nERROR: " + retval.msg
-            sys.stdout.write('\n>>> ')
-            sys.stdout.flush()
-            return
+            raise Exception(retval.msg)
 
-        self.view.disp_width  = retval.width
-        self.view.disp_height = retval.height
 
-        if self.view.display_mode == "grayscale":
+  # Cut the current view box out of a FITS file.  Where we can, this
+  # is done in-process from a memory-mapped copy of the file (no fork,
+  # and only the pixels in the region are ever read).  Otherwise, or
+  # if that fails for any reason, we fall back on mSubimage.  Returns
+  # the (width, height) of the cutout if known, None otherwise.
 
-			# self.view.gray_file.bunit        = retval.bunit
-			self.view.gray_file.min          = retval.min
-			self.view.gray_file.max          = retval.max
-			self.view.gray_file.data_min     = retval.datamin
-			self.view.gray_file.data_max     = retval.datamax
-			self.view.gray_file.min_sigma    = retval.minsigma
-			self.view.gray_file.max_sigma    = retval.maxsigma 
-			self.view.gray_file.min_percent  = retval.minpercent
-			self.view.gray_file.max_percent  = retval.maxpercent
+    def make_cutout(self, fits_file, out_file):
 
-        else:
+        if self.useMemmap and numpy is not None:
 
-			# self.view.blue_file.bunit        = retval.bunit
-			self.view.blue_file.min          = retval.bmin
-			self.view.blue_file.max          = retval.bmax
-			self.view.blue_file.data_min     = retval.bdatamin
-			self.view.blue_file.data_max     = retval.bdatamax
-			self.view.blue_file.min_sigma    = retval.bminsigma
-			self.view.blue_file.max_sigma    = retval.bmaxsigma 
-			self.view.blue_file.min_percent  = retval.bminpercent
-			self.view.blue_file.max_percent  = retval.bmaxpercent
+            try:
+                fits = mvFITS(fits_file)
 
-			# self.view.green_file.bunit       = retval.bunit
-			self.view.green_file.min         = retval.gmin
-			self.view.green_file.max         = retval.gmax
-			self.view.green_file.data_min    = retval.gdatamin
-			self.view.green_file.data_max    = retval.gdatamax
-			self.view.green_file.min_sigma   = retval.gminsigma
-			self.view.green_file.max_sigma   = retval.gmaxsigma 
-			self.view.green_file.min_percent = retval.gminpercent
-			self.view.green_file.max_percent = retval.gmaxpercent
+                data, cards = fits.cutout(self.view.xmin, self.view.ymin, self.view.xmax, self.view.ymax)
 
-			# self.view.red_file.bunit         = retval.bunit
-			self.view.red_file.min           = retval.rmin
-			self.view.red_file.max           = retval.rmax
-			self.view.red_file.data_min      = retval.rdatamin
-			self.view.red_file.data_max      = retval.rdatamax
-			self.view.red_file.min_sigma     = retval.rminsigma
-			self.view.red_file.max_sigma     = retval.rmaxsigma 
-			self.view.red_file.min_percent   = retval.rminpercent
-			self.view.red_file.max_percent   = retval.rmaxpercent
+                if self.debug:
+                    print "\nIN-PROCESS Cutout:\n------------------\n" + fits_file + " -> " + out_file
+                    print "[" + str(data.shape[1]) + " X " + str(data.shape[0]) + "]"
 
-        self.view.bunit = retval.bunit
+                fits.write(out_file, data, cards)
 
+                return data.shape[1], data.shape[0]
 
-      # Write the current mvView info to a JSON file in the workspace
+            except Exception as e:
 
-        json_file = self.workspace + "/view.json"
+                if self.debug:
+                    print "DEBUG> In-process cutout failed (" + str(e) + "); using mSubimage."
 
-        jfile = open(json_file, "w+")
+        command = "mSubimage -p" 
+        command += " " + fits_file 
+        command += " " + out_file 
+        command += " " + str(self.view.xmin)
+        command += " " + str(self.view.ymin)
+        command += " " + str(int(self.view.xmax) - int(self.view.xmin))
+        command += " " + str(int(self.view.ymax) - int(self.view.ymin))
 
-        jfile.write(repr(self.view))
+        if self.debug:
+           print "\nMONTAGE Command:\n---------------\n" + command
 
-        jfile.close()
+        stdout, stderr = self.run_montage(command)
+
+        if stderr:
+            raise Exception(stderr)
 
+        retval = mvStruct("mSubimage", stdout.strip())
 
-      # Tell the browser to get the new images (and JSON)
+        if self.debug:
+            print "\nRETURN Struct:\n-------------\n"
+            print retval
+            sys.stdout.write('\n>>> ')
+            sys.stdout.flush()
 
-        self.to_browser("image " + image_file)
+        return None
 
 
   # Default function to be used when the user picks a location
@@ -3105,7 +8350,24 @@ class mViewer():
             ref_file.append(self.view.green_file.fits_file)
             ref_file.append(self.view.red_file.fits_file)
 
-        radius = 31
+        radius = self.pickRadius
+
+
+      # A mosaic only exists as the shrunken image on the display
+      # grid, so that is what gets measured (and the pick location
+      # and radius are scaled to it)
+
+        if self.view.display_mode == "mosaic":
+
+            ref_file.extend(self.current_shrunken())
+
+            x0, y0, x1, y1 = self.get_mosaic().bounds(self.view.xmin, self.view.ymin, self.view.xmax, self.view.ymax)
+
+            factor = float(self.view.factor)
+
+            boxx   = (float(boxx) - 0.5 - x0) / factor + 0.5
+            boxy   = (float(boxy) - 0.5 - y0) / factor + 0.5
+            radius = max(1, int(radius / factor + 0.5))
 
         json_file = self.workspace + "/pick.json"
         jfile = open(json_file, "w+")
@@ -3114,20 +8376,8 @@ class mViewer():
         nfile = len(ref_file)
 
         for i in range(0, nfile):
-            command = "mExamine -p " + repr(boxx) + "p " + repr(boxy) + "p " + repr(radius) + "p " + ref_file[i]
-
-            if self.debug:
-                print "\nMONTAGE Command:\n---------------\n" + command
-
-            p = subprocess.Popen(shlex.split(command), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-
-            stderr = p.stderr.read()
-
-            if stderr:
-                raise Exception(stderr)
-                return
 
-            retval = mvStruct("mExamine", p.stdout.read().strip())
+            retval = self.region_stats(ref_file[i], boxx, boxy, radius, self.view.display_mode != "mosaic")
 
             if self.debug:
                 print "\nRETURN Struct:\n-------------\n"
@@ -3147,6 +8397,16 @@ class mViewer():
                 print "      Radius:   " + repr(retval.radius) + " degrees (" + repr(retval.radpix) + " pixels) / Total area: " + repr(retval.npixel) + " pixels (" + repr(retval.nnull) + " nulls)"
                 print ""
 
+                if numpy is not None and i == 0:
+
+                    for table_file, names in self.frames_at(retval.raref, retval.decref):
+                        print "      Images in " + table_file + " covering the center: " + str(len(names))
+
+                        for name in names:
+                            print "         " + name
+
+                        print ""
+
 
           # Write the current mvView info to a JSON file in the workspace
 
@@ -3163,6 +8423,51 @@ class mViewer():
         self.to_browser("pick")
 
 
+  # Region statistics for one file.  Normally these are worked out
+  # here (see mvFITS.region_stats()), which only has to read a small
+  # box of pixels around the point; for files or coordinate systems 
+  # that it can't handle we run mExamine.  Files that are only there
+  # for the moment (the mosaic) aren't worth indexing.
+
+    def region_stats(self, fits_file, x, y, radius, indexed=True):
+
+        if numpy is not None:
+
+            try:
+                if indexed:
+                    return mvFITS(fits_file).region_stats(x, y, radius, self.get_index(fits_file, mvIntegral), 
+                                                                        self.get_index(fits_file, mvMinMax))
+
+                return mvFITS(fits_file).region_stats(x, y, radius)
+
+            except Exception as e:
+
+                if self.debug:
+                    print "DEBUG> In-process statistics failed (" + str(e) + "); using mExamine."
+
+        command = "mExamine -p " + repr(x) + "p " + repr(y) + "p " + repr(radius) + "p " + fits_file
+
+        if self.debug:
+            print "\nMONTAGE Command:\n---------------\n" + command
+
+        return self.montage_runner().call(command)
+
+
+  # The shrunken image(s) for the current view.  A render cache hit
+  # (or a prefetched view) skips the shrink stage, so the ones in the
+  # workspace may be left over from another view.
+
+    def current_shrunken(self):
+
+        box = (self.view.xmin, self.view.xmax, self.view.ymin, self.view.ymax)
+
+        outputs = [self.workspace + "/" + prefix + "shrunken.fits" for view_file, prefix in self.display_files()]
+
+        self.run_stage("shrink", self.shrink_key(box), outputs, self.shrink_images)
+
+        return outputs
+
+
   # Get the FITS header(s) for the image(s) being displayed.
 
     def get_header(self):
@@ -3174,6 +8479,11 @@ class mViewer():
             ref_file.append(self.view.gray_file.fits_file)
 
 
+        if self.view.display_mode == "mosaic":
+
+            ref_file.extend(self.current_shrunken())
+
+
         if self.view.display_mode == "color":
 
             ref_file.append(self.view.blue_file.fits_file)
@@ -3189,15 +8499,7 @@ class mViewer():
             if self.debug:
                 print "\nMONTAGE Command:\n---------------\n" + command
 
-            p = subprocess.Popen(shlex.split(command), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-
-            stderr = p.stderr.read()
-
-            if stderr:
-                raise Exception(stderr)
-                return
-
-            retval = mvStruct("mGetHdr", p.stdout.read().strip())
+            retval = self.montage_runner().call(command)
 
             if self.debug:
                 print "\nRETURN Struct:\n-------------\n"
@@ -29,6 +29,10 @@
 /*  Most of the control is the same, though we need to track the    */
 /*  state of the three planes separately in that case and           */
 /*  this adds the need for maintaining some state information.      */
+/*                                                                  */
+/*  If the viewer has the pixel values of the view (the server's    */
+/*  "clientStretch" mode) the image follows the sliders as they     */
+/*  are dragged, with the stretch applied in the browser.           */
 /********************************************************************/
 
 function ColorStretch(controlDivName, viewer)
@@ -102,6 +106,8 @@ function ColorStretch(controlDivName, viewer)
                 dataVal = me.data2Str(dataVal, jQuery(me.controlDiv).find('.minUnits').val());
 
                 jQuery(me.controlDiv).find('.minValue').val(dataVal);
+
+                me.previewVals();
            }
         });
 
@@ -122,6 +128,8 @@ function ColorStretch(controlDivName, viewer)
                 dataVal = me.data2Str(dataVal, jQuery(me.controlDiv).find('.maxUnits').val());
    
                 jQuery(me.controlDiv).find('.maxValue').val(dataVal);
+
+                me.previewVals();
             }
         });
 
@@ -213,6 +221,9 @@ function ColorStretch(controlDivName, viewer)
 
         me.mode = me.viewer.updateJSON.display_mode;
 
+        if(me.mode == "mosaic")
+            me.mode = "grayscale";
+
         if(typeof(me.viewer.colorState) != "undefined")
         {
             me.viewer.colorState.mode        = me.mode;
@@ -660,6 +671,33 @@ function ColorStretch(controlDivName, viewer)
         if(me.debug)
             console.log("DEBUG> stretchVals()");
 
+        me.setStretchVals();
+
+        me.viewer.submitStretchRequest();
+    }
+
+
+//  While a slider is being dragged, redraw the image with the 
+//  stretch so far if the viewer can do that itself.
+
+    me.previewVals = function()
+    {
+        if(me.viewer.pixels == null)
+            return;
+
+        me.setStretchVals();
+
+        me.viewer.restretch();
+    }
+
+
+//  Copy the stretch info from the control to the viewer's JSON.
+
+    me.setStretchVals = function()
+    {
+        if(me.debug)
+            console.log("DEBUG> setStretchVals()");
+
 
     //  Get the GUI settings for stretch. 
 
@@ -739,9 +777,9 @@ function ColorStretch(controlDivName, viewer)
             maxValue = 100.;
 
 
-    //  Send the new parameters to the viewer and request an update
-    //  Do not forget to keep a record of the control state since
-    //  the user may kill the control at any time.
+    //  Give the new parameters to the viewer.  Do not forget to 
+    //  keep a record of the control state since the user may kill
+    //  the control at any time.
 
         if(minUnits == "DN") minUnits = "";
         if(maxUnits == "DN") maxUnits = "";
@@ -798,8 +836,6 @@ function ColorStretch(controlDivName, viewer)
 
             //  me.viewer.colorState.redStretchMode = me.stretchMode;
         }
-
-        me.viewer.submitUpdateRequest();
     }
 
 
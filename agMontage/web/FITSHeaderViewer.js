@@ -32,6 +32,9 @@ function FITSHeaderViewer(fitsDivName, viewer)
     me.init = function()
     {     
         me.mode = viewer.updateJSON.display_mode;
+
+        if(me.mode == "mosaic")
+            me.mode = "grayscale";
                
         me.makeControl();
 
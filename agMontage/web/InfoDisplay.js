@@ -38,6 +38,9 @@ function InfoDisplay(displayDivName, viewer)
 
         me.mode = me.viewer.updateJSON.display_mode;
 
+        if(me.mode == "mosaic")
+            me.mode = "grayscale";
+
         me.makeDisplay();
         me.processUpdate();
     }
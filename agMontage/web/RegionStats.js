@@ -242,7 +242,7 @@ function RegionStats(statsDivName, viewer)
 
     //  Remove color plane select box if image is grayscale
 
-        if(me.updateJSON.display_mode == 'grayscale')
+        if(me.updateJSON.display_mode != 'color')
             jQuery(me.statsDiv).find('.colorPlane').hide();
 
 
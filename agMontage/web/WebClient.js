@@ -4,7 +4,8 @@ function WebClient(server, port)
 
    me.debug = false;
 
-   me.msgCallbacks = [];
+   me.msgCallbacks    = [];
+   me.binaryCallbacks = [];
 
 
 
@@ -19,6 +20,8 @@ function WebClient(server, port)
     
    me.socket = new WebSocket(me.host);
 
+   me.socket.binaryType = "arraybuffer";
+
    if(me.debug)
       console.log("DEBUG> socket status: " + me.socket.readyState);   
     
@@ -37,7 +40,10 @@ function WebClient(server, port)
 
       me.socket.onmessage = function(msg)
       {
-          me.receive(msg.data);
+          if(typeof(msg.data) == "string")
+             me.receive(msg.data);
+          else
+             me.receiveBinary(msg.data);
       }
 
 
@@ -95,15 +101,19 @@ function WebClient(server, port)
 }
 
 
-   // RECEIVE from server
+   // RECEIVE from server (the server may pack
+   // several messages into one, one per line)
 
    me.receive = function(msg)
    {
       if(me.debug)
          console.log("DEBUG>  Receiving: " + msg);
 
-      for(i=0; i<me.msgCallbacks.length; ++i)
-         me.msgCallbacks[i](msg);
+      var msgs = msg.split("\n");
+
+      for(var j=0; j<msgs.length; ++j)
+         for(var i=0; i<me.msgCallbacks.length; ++i)
+            me.msgCallbacks[i](msgs[j]);
    } 
 
 
@@ -111,4 +121,22 @@ function WebClient(server, port)
    {
       me.msgCallbacks.push(method);
    }
+
+
+   // RECEIVE binary messages (ArrayBuffers) from the server
+
+   me.receiveBinary = function(data)
+   {
+      if(me.debug)
+         console.log("DEBUG>  Receiving " + data.byteLength + " bytes");
+
+      for(var i=0; i<me.binaryCallbacks.length; ++i)
+         me.binaryCallbacks[i](data);
+   } 
+
+
+   me.addBinaryCallback = function(method)
+   {
+      me.binaryCallbacks.push(method);
+   }
 }
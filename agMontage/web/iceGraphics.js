@@ -6,7 +6,8 @@
 /*  loading (drawing) the original image (and subsequent cutout  */
 /*  subimages) onto the canvas, drawing the outline of the zoom  */
 /*  boxes, and clearing said visual elements when the image is   */
-/*  updated.                                                     */
+/*  updated.  Overlays drawn as separate layers by the server    */
+/*  go on a canvas of their own between the two.                 */
 /*****************************************************************/
 
 function iceGraphics(divID)
@@ -42,6 +43,9 @@ function iceGraphics(divID)
 
     var color;
     var image;
+    var imageData = null;
+    var tiles = [];
+    var tileGeneration = 0;
     var iceImCanvas = document.createElement("canvas");
 
     iceImCanvas.style.position = "absolute";
@@ -58,6 +62,24 @@ function iceGraphics(divID)
 
 
     var dcimg = iceImCanvas.getContext("2d");
+    var iceLayerCanvas = document.createElement("canvas");
+
+    iceLayerCanvas.style.position = "absolute";
+    iceLayerCanvas.style.left     = 0;
+    iceLayerCanvas.style.top      = 0;
+    iceLayerCanvas.style.width    = width;
+    iceLayerCanvas.style.height   = height;
+    iceLayerCanvas.style.zIndex   = 1;
+
+    iceLayerCanvas.width          = width;
+    iceLayerCanvas.height         = height;
+
+    iceDiv.appendChild(iceLayerCanvas);
+
+
+    var dclayer = iceLayerCanvas.getContext("2d");
+    var layers = [];
+    var layerGeneration = 0;
     var iceCanvas = document.createElement("canvas");
 
     iceCanvas.style.position = "absolute";
@@ -65,7 +87,7 @@ function iceGraphics(divID)
     iceCanvas.style.top      = 0;
     iceCanvas.style.width    = width;
     iceCanvas.style.height   = height;
-    iceCanvas.style.zIndex   = 1;
+    iceCanvas.style.zIndex   = 2;
 
     iceCanvas.width          = width;
     iceCanvas.height         = height;
@@ -90,12 +112,180 @@ function iceGraphics(divID)
 
         img.onload = function() 
         {
-            dcimg.drawImage(img, 0, 0);
+            if(imageData == null)
+                dcimg.drawImage(img, 0, 0);
         }
 
         img.src = inImage;
 
         image = inImage;
+
+        imageData = null;
+
+        tiles = [];
+    }
+
+
+//  Browser-stretched mode: the image is one we have put 
+//  together ourselves, pixel by pixel (see mViewer.restretch()).
+
+    me.createImageData = function(w, h)
+    {
+        return dcimg.createImageData(w, h);
+    }
+
+
+    me.setImageData = function(inImageData)
+    {
+        imageData = inImageData;
+
+        clearImage();
+
+        dcimg.putImageData(imageData, 0, 0);
+    }
+
+
+//  Tiled mode: the image is made up of tiles, each drawn
+//  (scaled) into a box on the canvas and clipped to the 
+//  displayed area.  Tiles from a previous view that are 
+//  still loading when the view changes are not drawn.
+
+    me.startTiles = function()
+    {
+        ++tileGeneration;
+
+        tiles     = [];
+        image     = null;
+        imageData = null;
+    }
+
+
+    me.addTile = function(inImage, x, y, w, h, clipWidth, clipHeight)
+    {
+        var tile = new Object();
+
+        tile.src        = inImage;
+        tile.x          = x;
+        tile.y          = y;
+        tile.w          = w;
+        tile.h          = h;
+        tile.clipWidth  = clipWidth;
+        tile.clipHeight = clipHeight;
+
+        tiles.push(tile);
+
+        drawTile(tile, tileGeneration);
+    }
+
+
+    function drawTile(tile, generation)
+    {
+        var img = new Image();
+
+        img.onload = function()
+        {
+            if(generation != tileGeneration)
+                return;
+
+            dcimg.save();
+
+            dcimg.beginPath();
+            dcimg.rect(0, 0, tile.clipWidth, tile.clipHeight);
+            dcimg.clip();
+
+            dcimg.drawImage(img, tile.x, tile.y, tile.w, tile.h);
+
+            dcimg.restore();
+        }
+
+        img.src = tile.src;
+    }
+
+
+//  Overlay layers: each is a mask (the overlay drawn in white on
+//  black) which we paint in the overlay's color.  The layers are 
+//  drawn in order once they have all loaded; if the set of layers 
+//  changes in the meantime, the old set is never drawn.
+
+    me.setLayers = function(inLayers)
+    {
+        ++layerGeneration;
+
+        layers = inLayers;
+
+        drawLayers(layerGeneration);
+    }
+
+
+    function drawLayers(generation)
+    {
+        var nloaded = 0;
+
+        if(layers.length == 0)
+        {
+            clearLayers();
+            return;
+        }
+
+        var images = [];
+
+        for(var i=0; i<layers.length; ++i)
+        {
+            var img = new Image();
+
+            img.onload = function()
+            {
+                ++nloaded;
+
+                if(generation != layerGeneration || nloaded < layers.length)
+                    return;
+
+                clearLayers();
+
+                for(var j=0; j<layers.length; ++j)
+                    drawLayer(images[j], layers[j].color);
+            }
+
+            img.src = layers[i].src;
+
+            images.push(img);
+        }
+    }
+
+
+    function drawLayer(img, color)
+    {
+        var canvas = document.createElement("canvas");
+
+        canvas.width  = img.width;
+        canvas.height = img.height;
+
+        var context = canvas.getContext("2d");
+
+        context.drawImage(img, 0, 0);
+
+        var mask = context.getImageData(0, 0, img.width, img.height);
+        var data = mask.data;
+
+        for(var i=0; i<data.length; i+=4)
+        {
+            data[i+3] = data[i];
+            data[i]   = 0;
+            data[i+1] = 0;
+            data[i+2] = 0;
+        }
+
+        context.putImageData(mask, 0, 0);
+
+        if(/^[0-9a-fA-F]{6}$/.test(color))
+            color = "#" + color;
+
+        context.globalCompositeOperation = "source-in";
+        context.fillStyle                = color;
+
+        context.fillRect(0, 0, img.width, img.height);
+
+        dclayer.drawImage(canvas, 0, 0);
     }
 
 
@@ -112,6 +302,7 @@ function iceGraphics(divID)
     {
         clearDrawing();
         clearImage();
+        clearLayers();
     }
 
 
@@ -140,6 +331,15 @@ function iceGraphics(divID)
         iceImCanvas.setAttribute("width", parentWidth);
         iceImCanvas.setAttribute("height", parentHeight);
 
+        iceLayerCanvas.style.width  = parentWidth;
+        iceLayerCanvas.style.height = parentHeight;
+
+        iceLayerCanvas.width        = parentWidth;
+        iceLayerCanvas.height       = parentHeight;
+
+        iceLayerCanvas.setAttribute("width", parentWidth);
+        iceLayerCanvas.setAttribute("height", parentHeight);
+
         iceCanvas.style.width    = parentWidth;
         iceCanvas.style.height   = parentHeight;
 
@@ -159,13 +359,31 @@ function iceGraphics(divID)
         var dx = rect.left - oldRect.left;
         var dy = rect.top  - oldRect.top;
 
-        var img = new Image();
+        if(tiles.length > 0)
+        {
+            ++tileGeneration;
 
-        img.onload = function() {
-            dcimg.drawImage(img, 0, 0);
+            for(var i=0; i<tiles.length; ++i)
+                drawTile(tiles[i], tileGeneration);
         }
+        else if(imageData != null)
+        {
+            dcimg.putImageData(imageData, 0, 0);
+        }
+        else
+        {
+            var img = new Image();
+
+            img.onload = function() {
+                dcimg.drawImage(img, 0, 0);
+            }
 
-        img.src = image;
+            img.src = image;
+        }
+
+        ++layerGeneration;
+
+        drawLayers(layerGeneration);
 
         if(shape == "BOX")
         {
@@ -198,6 +416,15 @@ function iceGraphics(divID)
         iceImCanvas.setAttribute("width",  divWidth);
         iceImCanvas.setAttribute("height", divHeight);
 
+        iceLayerCanvas.style.width  = divWidth;
+        iceLayerCanvas.style.height = divHeight;
+
+        iceLayerCanvas.width        = divWidth;
+        iceLayerCanvas.height       = divHeight;
+
+        iceLayerCanvas.setAttribute("width",  divWidth);
+        iceLayerCanvas.setAttribute("height", divHeight);
+
         iceCanvas.style.width    = divWidth;
         iceCanvas.style.height   = divHeight;
 
@@ -492,5 +719,11 @@ function iceGraphics(divID)
         dcimg.clearRect(0, 0, iceCanvas.width, iceCanvas.height);
     }
 
+
+    function clearLayers()
+    {
+        dclayer.clearRect(0, 0, iceCanvas.width, iceCanvas.height);
+    }
+
     return me;
 }
@@ -30,8 +30,14 @@ function mViewer(client, imgDivID)
 
     me.jsonText;
     me.updateJSON; // Contains general view information
+
+    me.tiled = false; // View is built from tiles rather than one image
     me.pickJSON;   // Contains current reference point information
 
+    me.pixels      = null; // Pixel values of the view, if the server sent them
+    me.colorTables = {};   // Color table RGB values, by table number
+    me.imageURL    = null; // Object URL of the last image sent over the websocket
+
 
 //  Current reference point coordinates
 
@@ -43,6 +49,12 @@ function mViewer(client, imgDivID)
 
     me.updateCallbacks = [];
 
+
+//  Tell the server we can take views as binary messages 
+//  (see processView)
+
+    me.client.send("binary");
+
     var resizeTimeout = 0;
     var initializeTimeout = 0;
 
@@ -196,11 +208,24 @@ function mViewer(client, imgDivID)
             if(me.debug)
                 console.log("DEBUG> Retrieving new PNG.");
 
+            me.tiled = false;
+
             me.gc.setImage(args[1] + "?seed=" + (new Date()).valueOf());
 
             me.getJSON();
         }
 
+    //  TILES Command 
+        else if(cmd == "tiles")
+        {
+            if(me.debug)
+                console.log("DEBUG> Retrieving tiled view.");
+
+            me.tiled = true;
+
+            me.getJSON();
+        }
+
     //  RESIZED Command 
         else if(cmd == "resized")
         {
@@ -278,18 +303,532 @@ function mViewer(client, imgDivID)
         {
             if (xmlhttp.readyState==4 && xmlhttp.status==200)
             {
-                me.jsonText = xmlhttp.responseText;
+                me.setJSON(xmlhttp.responseText);
+            }
+            else if(xmlhttp.status != 200)
+                alert("Remote service error[1].");
+        }
+    }
+
+
+//  Take in a new view JSON (from view.json or a binary message)
+
+    me.setJSON = function(jsonText)
+    {
+        me.jsonText = jsonText;
+
+        me.updateJSON = jQuery.parseJSON(jsonText);
+
+        if(me.tiled)
+            me.drawTiles();
+        else
+            me.getPixels();
+
+        me.drawLayers();
+
+        for(var i=0; i<me.updateCallbacks.length; ++i)
+        {
+            me.updateCallbacks[i]();
+        }
+    }
+
+
+//  A view sent as one binary websocket message rather than an "image"
+//  command: a 4-byte (little-endian) header length, the header (JSON
+//  with the image file name and MIME type and the view itself) and
+//  the encoded image.  The image is shown from an object URL.
+
+    me.processView = function(data)
+    {
+        var length = new DataView(data).getUint32(0, true);
+
+        var header = jQuery.parseJSON(new TextDecoder("utf-8").decode(new Uint8Array(data, 4, length)));
+
+        if(header.cmd != "image")
+            return;
+
+        if(me.debug)
+            console.log("DEBUG> Received view image " + header.file + " (" + header.mime + ")");
+
+        var blob = new Blob([new Uint8Array(data, 4 + length)], {type: header.mime});
+
+        if(me.imageURL != null)
+            URL.revokeObjectURL(me.imageURL);
+
+        me.imageURL = URL.createObjectURL(blob);
+
+        me.gc.clear();
+
+        me.gc.refitCanvas();
+
+        me.tiled = false;
+
+        me.gc.setImage(me.imageURL);
+
+        me.setJSON(JSON.stringify(header.view));
+    }
+
+
+//  Draw the tiles covering the current view.  Tiles are tile_size
+//  pixels square at pyramid level tile_level (where pixels are 
+//  2^level original pixels) and are numbered from the lower left 
+//  corner of the image.  They are scaled to the display (factor
+//  original pixels per screen pixel); FITS Y runs up the screen.
+//  The server and browser both cache tiles, so after a pan only
+//  the newly exposed ones actually get rendered.
+
+    me.drawTiles = function()
+    {
+        var view = me.updateJSON;
+
+        var scale  = Math.pow(2, view.tile_level);
+        var size   = view.tile_size * scale;
+        var factor = view.factor;
+
+        var x0 = view.cutout_x_offset;
+        var y0 = view.cutout_y_offset;
+
+        var width  = view.disp_width;
+        var height = view.disp_height;
+
+    //  Levels are cropped to an even number of pixels at each 
+    //  step, so may not quite reach the edge of the image
+
+        var levelWidth  = Math.floor(view.image_width  / scale) * scale;
+        var levelHeight = Math.floor(view.image_height / scale) * scale;
+
+        var x1 = Math.min(x0 + width  * factor, levelWidth);
+        var y1 = Math.min(y0 + height * factor, levelHeight);
+
+        var txmin = Math.floor(x0 / size);
+        var tymin = Math.floor(y0 / size);
+        var txmax = Math.ceil (x1 / size) - 1;
+        var tymax = Math.ceil (y1 / size) - 1;
+
+        if(me.debug)
+            console.log("DEBUG> drawTiles(): level " + view.tile_level 
+                      + ", tiles [" + txmin + "-" + txmax + "] x [" + tymin + "-" + tymax + "]");
+
+        me.gc.clear();
+
+        me.gc.refitCanvas();
+
+        me.gc.startTiles();
+
+        for(var ty=tymin; ty<=tymax; ++ty)
+        {
+            for(var tx=txmin; tx<=txmax; ++tx)
+            {
+                var w = Math.min(size, levelWidth  - tx*size);
+                var h = Math.min(size, levelHeight - ty*size);
+
+                var url = "tile?key=" + view.tile_key 
+                        + "&level="   + view.tile_level 
+                        + "&x="       + tx 
+                        + "&y="       + ty;
+
+                me.gc.addTile(url,
+                              (tx*size - x0) / factor,
+                              height - (ty*size + h - y0) / factor,
+                              w / factor,
+                              h / factor,
+                              width, height);
+            }
+        }
+    }
+
+
+//  Overlays the server has drawn as separate layers (layer_keys: one
+//  per overlay, blank if it isn't shown).  Each layer is a mask the
+//  overlay's color is painted through, so a color change needs 
+//  nothing new from the server.
+
+    me.drawLayers = function()
+    {
+        var layers = [];
+
+        var keys    = me.updateJSON.layer_keys;
+        var overlay = me.updateJSON.overlay;
+
+        if(typeof(keys) != "undefined" && typeof(overlay) != "undefined")
+        {
+            keys = keys.split(",");
+
+            for(var i=0; i<keys.length && i<overlay.length; ++i)
+            {
+                if(keys[i] == "" || !overlay[i].visible)
+                    continue;
+
+                var color = overlay[i].color;
+
+                if(typeof(color) == "undefined" || color == "")
+                    color = "white";
+
+                layers.push({src: "layers/" + keys[i] + ".png", color: color});
+            }
+        }
+
+        me.gc.setLayers(layers);
+    }
 
-                me.updateJSON = jQuery.parseJSON(xmlhttp.responseText);
 
-   	        for(i=0; i<me.updateCallbacks.length; ++i)
+//  If the server is sending the pixel values of the view (pixel_key
+//  in the JSON), stretch and color table changes can be done here 
+//  without going back to the server.  The values are quantized to 
+//  16 bits by where they fall in the whole-image distribution, with
+//  the distribution sent along to turn them back into data values 
+//  and another (whole image, view or shrunken image, depending on 
+//  the server's stretch scope) to work out the stretch limits from.
+//  See mViewer.update_pixels() on the Python side for the layout.
+
+    me.getPixels = function()
+    {
+        var key = me.updateJSON.pixel_key;
+
+        if(typeof(key) == "undefined")
+        {
+            me.pixels = null;
+            return;
+        }
+
+        if(me.pixels != null && me.pixels.key == key)
+            return;
+
+        me.pixels = null;
+
+        if(me.debug)
+            console.log("DEBUG> getPixels(" + key + ")");
+
+        var xmlhttp = new XMLHttpRequest();
+
+        xmlhttp.open("GET", "pixels/" + key + ".bin");
+
+        xmlhttp.responseType = "arraybuffer";
+
+        xmlhttp.onload = function()
+        {
+            if(xmlhttp.status != 200 || me.tiled || me.updateJSON.pixel_key != key)
+                return;
+
+            var buffer = xmlhttp.response;
+
+            var length = new DataView(buffer).getUint32(0, true);
+
+            var header = JSON.parse(String.fromCharCode.apply(null, new Uint8Array(buffer, 4, length)));
+
+            var offset = 4 + length;
+
+            var npix = header.width * header.height;
+
+            for(var i=0; i<header.channels.length; ++i)
+            {
+                var channel = header.channels[i];
+                var nedge   = channel.nedge;
+
+                channel.edges = new Float64Array(buffer, offset, nedge);  offset += 8 * nedge;
+                channel.quant = new Float64Array(buffer, offset, nedge);  offset += 8 * nedge;
+                channel.cdf   = new Float64Array(buffer, offset, nedge);  offset += 8 * nedge;
+            }
+
+            for(var i=0; i<header.channels.length; ++i)
+            {
+                header.channels[i].values = new Uint16Array(buffer, offset, npix);
+
+                offset += 2 * npix;
+            }
+
+            header.key = key;
+
+            me.pixels = header;
+        }
+
+        xmlhttp.send(null);
+    }
+
+
+//  Redraw the view from the pixel values with the stretch and color
+//  table currently in updateJSON.  Returns false if we don't have 
+//  the pixel values (so the server has to do it).
+
+    me.restretch = function()
+    {
+        var pixels = me.pixels;
+
+        if(pixels == null)
+            return false;
+
+        var view = me.updateJSON;
+
+        var files, offsets, colors;
+
+        if(view.display_mode != "color")
+        {
+            files   = [view.gray_file];
+            offsets = [0];
+
+            var colorTable = view.gray_file.color_table;
+
+            if(typeof(colorTable) == "undefined" || colorTable === "")
+                colorTable = 0;
+
+            colors = me.colorTables[colorTable];
+
+            if(typeof(colors) == "undefined")
+            {
+                me.getColorTable(colorTable);
+                return true;
+            }
+
+            if(colors == null)
+                return true;
+        }
+        else
+        {
+            files   = [view.blue_file, view.green_file, view.red_file];
+            offsets = [2, 1, 0];
+        }
+
+        var image = me.gc.createImageData(pixels.width, pixels.height);
+
+        var data = image.data;
+        var npix = pixels.width * pixels.height;
+
+        for(var i=0; i<files.length; ++i)
+        {
+            var table  = stretchTable(pixels.channels[i], files[i]);
+            var values = pixels.channels[i].values;
+
+            if(files.length == 1)
+            {
+                for(var j=0; j<npix; ++j)
                 {
-                    me.updateCallbacks[i]();
+                    var k = 3 * table[values[j]];
+
+                    data[4*j]   = colors[k];
+                    data[4*j+1] = colors[k+1];
+                    data[4*j+2] = colors[k+2];
+                    data[4*j+3] = 255;
+                }
+            }
+            else
+            {
+                var offset = offsets[i];
+
+                for(var j=0; j<npix; ++j)
+                {
+                    data[4*j+offset] = table[values[j]];
+                    data[4*j+3]      = 255;
                 }
             }
-            else if(xmlhttp.status != 200)
-                alert("Remote service error[1].");
         }
+
+        me.gc.setImageData(image);
+
+        return true;
+    }
+
+
+//  The colors in a color table, read from a 256 x 1 image of it
+//  the server makes for us.  The view is redrawn when it arrives
+//  or, if it can't be had, left to the server.
+
+    me.getColorTable = function(colorTable)
+    {
+        if(me.debug)
+            console.log("DEBUG> getColorTable(" + colorTable + ")");
+
+        me.colorTables[colorTable] = null;
+
+        var img = new Image();
+
+        img.onload = function()
+        {
+            var canvas = document.createElement("canvas");
+
+            canvas.width  = 256;
+            canvas.height = 1;
+
+            var context = canvas.getContext("2d");
+
+            context.drawImage(img, 0, 0);
+
+            var rgba   = context.getImageData(0, 0, 256, 1).data;
+            var colors = new Uint8Array(768);
+
+            for(var i=0; i<256; ++i)
+            {
+                colors[3*i]   = rgba[4*i];
+                colors[3*i+1] = rgba[4*i+1];
+                colors[3*i+2] = rgba[4*i+2];
+            }
+
+            me.colorTables[colorTable] = colors;
+
+            me.restretch();
+        }
+
+        img.onerror = function()
+        {
+            if(me.debug)
+                console.log("DEBUG> Color table " + colorTable + " not loaded; asking the server for the view.");
+
+            delete me.colorTables[colorTable];
+
+            me.submitUpdateRequest();
+        }
+
+        img.src = "colortable?ct=" + colorTable;
+    }
+
+
+//  Stretch lookup table for one channel: 16-bit quantized value to 
+//  0-255.  Blank pixels (65535) come out as zero.  The stretch modes
+//  are the same as in mViewer (and mvStretch on the Python side).
+//  The limits are worked out the same way as there too and filled 
+//  back in to the view for the stretch control.
+
+    function stretchTable(channel, file)
+    {
+        var table = new Uint8Array(65536);
+
+        var stretchMin  = file.stretch_min;
+        var stretchMax  = file.stretch_max;
+        var stretchMode = file.stretch_mode;
+
+        if(typeof(stretchMin)  == "undefined" || stretchMin  === "") stretchMin  = "-1s";
+        if(typeof(stretchMax)  == "undefined" || stretchMax  === "") stretchMax  = "max";
+        if(typeof(stretchMode) == "undefined" || stretchMode === "") stretchMode = "gaussian-log";
+
+        var median = valueAt(channel, 50.);
+        var sigma  = (valueAt(channel, 84.1345) - valueAt(channel, 15.8655)) / 2.;
+
+        if(sigma <= 0.)
+            sigma = Math.max((channel.data_max - channel.data_min) / 2., 1.e-30);
+
+        var vmin = resolve(channel, String(stretchMin), median, sigma);
+        var vmax = resolve(channel, String(stretchMax), median, sigma);
+
+        file.min         = vmin;
+        file.max         = vmax;
+        file.min_sigma   = (vmin - median) / sigma;
+        file.max_sigma   = (vmax - median) / sigma;
+        file.min_percent = 100. * interp(vmin, channel.edges, channel.cdf);
+        file.max_percent = 100. * interp(vmax, channel.edges, channel.cdf);
+
+        if(!(vmax > vmin))
+            return table;
+
+        var gaussian = (stretchMode == "gaussian" || stretchMode == "gaussian-log");
+
+        var lo = interp(vmin, channel.edges, channel.quant);
+        var hi = interp(vmax, channel.edges, channel.quant);
+
+        for(var q=0; q<65535; ++q)
+        {
+            var fraction = q / 65534.;
+            var value;
+
+            if(gaussian && hi > lo)
+                value = (fraction - lo) / (hi - lo);
+            else
+                value = (interp(fraction, channel.quant, channel.edges) - vmin) / (vmax - vmin);
+
+            value = Math.min(Math.max(value, 0.), 1.);
+
+            if(gaussian)
+            {
+                value = (interp(value, normalCDF, normalZ) + 3.) / 6.;
+
+                if(stretchMode == "gaussian-log")
+                    value = Math.log(1. + 999. * value) / Math.LN10 / 3.;
+            }
+
+            else if(stretchMode == "log")
+                value = Math.log(1. + 999. * value) / Math.LN10 / 3.;
+
+            else if(stretchMode == "loglog")
+                value = Math.log(1. + 999. * Math.log(1. + 999. * value) / Math.LN10 / 3.) / Math.LN10 / 3.;
+
+            table[q] = Math.floor(value * 255. + 0.5);
+        }
+
+        return table;
+    }
+
+
+//  A stretch limit ("min", "max", "99.5%", "-1s" or a data value) 
+//  as a data value
+
+    function resolve(channel, spec, median, sigma)
+    {
+        spec = spec.trim();
+
+        if(spec == "min")
+            return channel.data_min;
+
+        if(spec == "max")
+            return channel.data_max;
+
+        if(spec.charAt(spec.length-1) == "%")
+            return valueAt(channel, parseFloat(spec));
+
+        if(spec.charAt(spec.length-1) == "s")
+            return median + parseFloat(spec) * sigma;
+
+        return parseFloat(spec);
+    }
+
+
+    function valueAt(channel, percent)
+    {
+        var value = interp(Math.min(Math.max(percent, 0.), 100.) / 100., channel.cdf, channel.edges);
+
+        return Math.min(Math.max(value, channel.data_min), channel.data_max);
+    }
+
+
+//  Piecewise linear interpolation (as numpy.interp; xp increasing)
+
+    function interp(x, xp, fp)
+    {
+        var n = xp.length;
+
+        if(x <= xp[0])   return fp[0];
+        if(x >= xp[n-1]) return fp[n-1];
+
+        var lo = 0;
+        var hi = n - 1;
+
+        while(hi - lo > 1)
+        {
+            var mid = (lo + hi) >> 1;
+
+            if(xp[mid] <= x)
+                lo = mid;
+            else
+                hi = mid;
+        }
+
+        return fp[lo] + (x - xp[lo]) * (fp[hi] - fp[lo]) / (xp[hi] - xp[lo]);
+    }
+
+
+//  Normal distribution (-3 to 3 sigma) for histogram equalization
+
+    var normalZ   = new Float64Array(1201);
+    var normalCDF = new Float64Array(1201);
+
+    for(var i=0; i<1201; ++i)
+    {
+        var z = -3. + i * 0.005;
+        var x = Math.abs(z) / Math.SQRT2;
+        var t = 1. / (1. + 0.3275911 * x);
+
+        var erf = 1. - t * (0.254829592 + t * (-0.284496736 + t * (1.421413741 
+                     + t * (-1.453152027 + t * 1.061405429)))) * Math.exp(-x * x);
+
+        normalZ[i]   = z;
+        normalCDF[i] = 0.5 * (1. + (z < 0 ? -erf : erf));
     }
 
 
@@ -403,6 +942,50 @@ function mViewer(client, imgDivID)
     }
 
 
+//  Stretch and color table changes.  If we have the pixel values we
+//  can redraw the view ourselves and the server only needs to know 
+//  the new settings (for later views).  Unless they are separate 
+//  layers, overlays are drawn by the server into its image, though,
+//  so if there are any showing we still ask for a full update to get
+//  them back.
+
+    me.submitStretchRequest = function()
+    {
+        if(me.debug)
+           console.log("DEBUG> mViewer.submitStretchRequest()");
+
+        if(!me.restretch() || me.hasOverlays())
+        {
+            me.submitUpdateRequest();
+            return;
+        }
+
+        var cmd = "stretch '" + JSON.stringify(me.updateJSON) + "'";
+
+        if(me.debug)
+            console.log("DEBUG> cmd: " + cmd);
+
+        me.client.send(cmd);
+    }
+
+
+    me.hasOverlays = function()
+    {
+        var overlay = me.updateJSON.overlay;
+
+        if(typeof(overlay) == "undefined" || typeof(me.updateJSON.layer_keys) != "undefined")
+            return false;
+
+        for(var i=0; i<overlay.length; ++i)
+        {
+            if(overlay[i].visible)
+                return true;
+        }
+
+        return false;
+    }
+
+
 //  When the user draws a box on the screen, the most
 //  common reaction is to ask the server to zoom the 
 //  image based on that box.
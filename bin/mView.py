@@ -15,7 +15,7 @@ import os
 # Custom usage message
 
 def msg(name=None):                                                            
-    return '''mView.py -g GRAY.fits | -c BLUE.fits GREEN.fits RED.fits
+    return '''mView.py -g GRAY.fits | -c BLUE.fits GREEN.fits RED.fits | -m IMAGES.tbl TEMPLATE.hdr
          [-C CATALOG.tbl] [-I IMAGES.tbl] [-G COORD_SYS [EQUINOX]]
          (overlays can be repeated)
         '''
@@ -26,9 +26,17 @@ parser = argparse.ArgumentParser(description='mVIEWER: Interactive Astronomical
 
 parser.add_argument('-d', '--debug', help='Turn on debugging.', action='store_true')
 parser.add_argument('-s', '--server', help='Start in server (remote browser) mode.', action='store_true')
+parser.add_argument('-t', '--tiled',  help='Build the display from cached tiles.', action='store_true')
+parser.add_argument('-p', '--prefetch', help='Render the next pan/zoom views in the background.', action='store_true')
+parser.add_argument('-b', '--browser-stretch', help='Apply stretch/color table changes in the browser.', action='store_true')
+parser.add_argument('-l', '--layers', help='Draw overlays as separate layers.', action='store_true')
+parser.add_argument('-f', '--format', help='Send views as png, png8 (palette), jpeg or webp (needs PIL).', choices=['png', 'png8', 'jpeg', 'webp'], default='png')
+parser.add_argument('-q', '--quality', help='JPEG/WebP quality (1-100).', type=int, default=85)
+parser.add_argument('-w', '--websocket-images', help='Send views over the websocket rather than having the browser fetch them.', action='store_true')
 
 parser.add_argument('-g', '--gray',    nargs=1,   help='Grayscale/pseudocolor FITS file')
 parser.add_argument('-c', '--color',   nargs=3,   help='Blue, green, red full color FITS files')
+parser.add_argument('-m', '--mosaic',  nargs=2,   help='Image metadata table and header template to view as a mosaic')
 parser.add_argument('-C', '--catalog', nargs=1,   help='Source table with sky positions', action='append')
 parser.add_argument('-I', '--images',  nargs=1,   help='Image metadata table', action='append')
 parser.add_argument('-G', '--grid',    nargs='*', help='Coordinate system for overlay grid', action='append')
@@ -48,7 +56,7 @@ if args.filename:
     nargs = len(args.filename)
 
 
-if nargs == 0 and args.gray is None and args.color is None and args.json is None:
+if nargs == 0 and args.gray is None and args.color is None and args.mosaic is None and args.json is None:
     print '\nERROR: You must choose one of grayscale (one image) or full color \n'
     print '         (three images), have a JSON file with that information or \n'
     print '         give 1/3 positional file name arguments. See "mView.py --help"\n'
@@ -78,6 +86,44 @@ viewer.debug = args.debug
 viewer.serverMode = args.server
 
 
+# Set "tiled" mode.  The browser builds the display from fixed-size tiles which are
+# cached on both ends, so panning only has to render the part of the image newly in view.
+
+viewer.tiledMode = args.tiled
+
+
+# Prefetching.  After each view is displayed, the views the pan and zoom buttons would give 
+# are rendered in the background, so stepping around the image is mostly cache lookups.
+
+viewer.prefetch = args.prefetch
+
+
+# Browser-side stretching.  The server also sends the pixel values of each view, so that
+# dragging the stretch sliders or changing the color table is handled by the browser alone.
+
+viewer.clientStretch = args.browser_stretch
+
+
+# Overlay layers.  Each overlay is drawn on its own and laid over the image by the browser,
+# so switching overlays on and off or changing their colors doesn't redraw the image.
+# (Tiled mode always does this.)
+
+viewer.overlayLayers = args.layers
+
+
+# Image format.  mViewer makes PNGs; with PIL they can be sent in a smaller format instead
+# (JPEG or WebP for slow connections, or an 8-bit palette PNG for grayscale).
+
+viewer.imageFormat  = args.format
+viewer.imageQuality = args.quality
+
+
+# Websocket images.  Each view (image and JSON) is sent to the browser as a single binary
+# websocket message, saving the two HTTP requests the browser would otherwise make.
+
+viewer.pushImages = args.websocket_images
+
+
 # Set the image or images
 
 if nargs == 1:
@@ -100,6 +146,10 @@ if nargs == 0:
         viewer.set_green_file(args.color[1])
         viewer.set_red_file  (args.color[2])
 
+    elif args.mosaic:
+        viewer.set_color_table(1)
+        viewer.set_mosaic(args.mosaic[0], args.mosaic[1])
+
     elif args.json is None:
         print '\nERROR: No image specified on the command line or in a JSON file. See "mView.py --help"\n'
         os._exit(0)
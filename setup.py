@@ -13,6 +13,7 @@ setup(
     url = 'https://github.com/AndrewDGood/mViewer',
     
     packages = ['agMontage'],
-    install_requires = ['tornado'],
+    install_requires = ['tornado>=4.3'],
+    extras_require = { 'fast': ['numpy'], 'encode': ['pillow'] },
     package_data = { 'agMontage': ['web/*'] }
 )
@@ -0,0 +1,216 @@
+#---------------------------------------------------------------------------------
+#  Test support: small synthetic FITS and IPAC files, stand-in Montage programs
+#
+#  Run the tests (they need NumPy) from the top directory with
+#
+#     python -m unittest discover -s tests
+#---------------------------------------------------------------------------------
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+import numpy
+
+
+# A FITS header card (strings quoted, everything else as Python
+# writes it, right-justified)
+
+def card(keyword, value):
+
+    if isinstance(value, bool):
+        value = "T" if value else "F"
+
+    elif isinstance(value, str):
+        value = "'" + value.ljust(8) + "'"
+
+    else:
+        value = repr(value)
+
+    return (keyword.ljust(8) + "= " + value.rjust(20))[0:80].ljust(80)
+
+
+# A simple TAN projection centered on the image
+
+def wcs_cards(nx, ny, ra=180., dec=30., cdelt=0.001, crota2=0.):
+
+    return [card('CTYPE1', 'RA---TAN'),
+            card('CTYPE2', 'DEC--TAN'),
+            card('CRVAL1', ra),
+            card('CRVAL2', dec),
+            card('CRPIX1', (nx + 1) / 2.),
+            card('CRPIX2', (ny + 1) / 2.),
+            card('CDELT1', -cdelt),
+            card('CDELT2', cdelt),
+            card('CROTA2', crota2),
+            card('EQUINOX', 2000.)]
+
+
+# Write a 2-D array (first index y) as a FITS file, written out here
+# rather than with mvFITS so the reader isn't checked against itself
+
+def write_fits(fits_file, data, cards=None, bscale=None, bzero=None, blank=None):
+
+    bitpix = { numpy.dtype('uint8'):    8,
+               numpy.dtype('int16'):   16,
+               numpy.dtype('int32'):   32,
+               numpy.dtype('float32'): -32,
+               numpy.dtype('float64'): -64 }[data.dtype]
+
+    ny, nx = data.shape
+
+    header = [card('SIMPLE', True),
+              card('BITPIX', bitpix),
+              card('NAXIS',  2),
+              card('NAXIS1', nx),
+              card('NAXIS2', ny)]
+
+    if bscale is not None:
+        header.append(card('BSCALE', bscale))
+
+    if bzero is not None:
+        header.append(card('BZERO', bzero))
+
+    if blank is not None:
+        header.append(card('BLANK', blank))
+
+    if cards is None:
+        cards = wcs_cards(nx, ny)
+
+    header.extend(cards)
+
+    header.append("END".ljust(80))
+
+    text = "".join(header)
+
+    fp = open(fits_file, 'wb')
+
+    fp.write(text + " " * (-len(text) % 2880))
+
+    raw = data.astype(data.dtype.newbyteorder('>')).tostring()
+
+    fp.write(raw + "\0" * (-len(raw) % 2880))
+
+    fp.close()
+
+    return fits_file
+
+
+# Write an IPAC table (columns as a list of (name, type, values))
+
+def write_table(table_file, columns, width=16):
+
+    fp = open(table_file, 'w')
+
+    fp.write("\\fixlen = T\n")
+
+    fp.write("|" + "|".join([name.rjust(width) for name, type, values in columns]) + "|\n")
+    fp.write("|" + "|".join([type.rjust(width)  for name, type, values in columns]) + "|\n")
+
+    for i in range(len(columns[0][2])):
+
+        fields = []
+
+        for name, type, values in columns:
+
+            value = values[i]
+
+            if value is None:
+                fields.append("null".rjust(width))
+            elif isinstance(value, float):
+                fields.append(("%.8f" % value).rjust(width))
+            else:
+                fields.append(str(value).rjust(width))
+
+        fp.write(" " + " ".join(fields) + " \n")
+
+    fp.close()
+
+    return table_file
+
+
+# A stand-in for a Montage program: a Python script (run with this
+# interpreter) in bin_dir
+
+def stub_program(bin_dir, name, body):
+
+    program = os.path.join(bin_dir, name)
+
+    fp = open(program, 'w')
+
+    fp.write("#!" + sys.executable + "\n")
+    fp.write("import sys, os, time\n")
+    fp.write(body)
+
+    fp.close()
+
+    os.chmod(program, 0755)
+
+    return program
+
+
+# A stand-in mViewer: writes the -png file and reports the image
+# size (from the -gray or -red image's header)
+
+MVIEWER = """
+args = sys.argv[1:]
+
+fits_file = args[args.index('-gray' if '-gray' in args else '-red') + 1]
+
+header = open(fits_file, 'rb').read(2880)
+cards  = dict((header[i:i+8].strip(), header[i+10:i+80].split('/')[0].strip()) for i in range(0, 2880, 80))
+
+fp = open(args[args.index('-png') + 1], 'wb')
+fp.write('PNG ' + ' '.join(args))
+fp.close()
+
+print '[struct stat="OK", width=%s, height=%s, min=1, max=2, datamin=0, datamax=3, minsigma=-1, maxsigma=2, minpercent=1, maxpercent=99, bmin=1, bmax=2, bdatamin=0, bdatamax=3, bminsigma=-1, bmaxsigma=2, bminpercent=1, bmaxpercent=99, gmin=1, gmax=2, gdatamin=0, gdatamax=3, gminsigma=-1, gmaxsigma=2, gminpercent=1, gmaxpercent=99, rmin=1, rmax=2, rdatamin=0, rdatamax=3, rminsigma=-1, rmaxsigma=2, rminpercent=1, rmaxpercent=99, bunit="DN"]' % (cards['NAXIS1'], cards['NAXIS2'])
+"""
+
+
+# Test case with a scratch directory (removed afterwards)
+
+class TestCase(unittest.TestCase):
+
+    def setUp(self):
+
+        self.directory = tempfile.mkdtemp(prefix="mvtest_")
+
+        self.bin_dir = self.path("bin")
+
+        os.makedirs(self.bin_dir)
+
+
+    def tearDown(self):
+
+        shutil.rmtree(self.directory, True)
+
+
+    def path(self, name):
+
+        return os.path.join(self.directory, name)
+
+
+  # A viewer working in the scratch directory, with the stand-in
+  # mViewer, showing a grayscale image on a 200x150 canvas
+
+    def viewer(self, fits_file):
+
+        from agMontage.mViewer import mViewer
+
+        stub_program(self.bin_dir, "mViewer", MVIEWER)
+
+        viewer = mViewer(self.path("work"))
+
+        viewer.montageBin = self.bin_dir
+        viewer.usePyramid = False
+        viewer.to_browser = lambda message: None
+
+        viewer.set_gray_file(fits_file)
+
+        viewer.view.canvas_width  = 200
+        viewer.view.canvas_height = 150
+
+        return viewer
@@ -0,0 +1,148 @@
+#---------------------------------------------------------------------------------
+#  Sky-cell index of a catalog (mvSkyGrid, mvCatalogIndex)
+#---------------------------------------------------------------------------------
+
+import unittest
+
+import numpy
+
+import mvtest
+
+from agMontage.mViewer import mvCatalogIndex, mvSkyGrid, mvTable
+
+
+# Angular distance (degrees) by the haversine formula
+
+def distance(ra1, dec1, ra2, dec2):
+
+    ra1, dec1, ra2, dec2 = [numpy.radians(value) for value in [ra1, dec1, ra2, dec2]]
+
+    a = numpy.sin((dec2 - dec1) / 2.)**2 + numpy.cos(dec1) * numpy.cos(dec2) * numpy.sin((ra2 - ra1) / 2.)**2
+
+    return numpy.degrees(2. * numpy.arcsin(numpy.sqrt(numpy.clip(a, 0., 1.))))
+
+
+class CatalogTest(mvtest.TestCase):
+
+  # Sources all over the sky, crowded around a few places that
+  # are awkward for a grid (a pole, RA 0, a cube corner) and with
+  # some positions missing
+
+    def setUp(self):
+
+        mvtest.TestCase.setUp(self)
+
+        state = numpy.random.RandomState(14)
+
+        n = 4000
+
+        ra  = list(state.uniform(0., 360., n))
+        dec = list(numpy.degrees(numpy.arcsin(state.uniform(-1., 1., n))))
+
+        for center_ra, center_dec in [(0., 89.5), (0.05, 10.), (45., 35.26), (180., 30.)]:
+            for k in range(500):
+                ra.append((center_ra + state.normal(0., 0.5)) % 360.)
+                dec.append(numpy.clip(center_dec + state.normal(0., 0.5), -89.999, 89.999))
+
+        flux = list(state.uniform(1., 100., len(ra)))
+
+        ra[7]    = None
+        dec[11]  = None
+        flux[13] = None
+
+        self.ra   = numpy.array([numpy.nan if value is None else value for value in ra])
+        self.dec  = numpy.array([numpy.nan if value is None else value for value in dec])
+        self.flux = numpy.array([numpy.nan if value is None else value for value in flux])
+
+        self.table_file = mvtest.write_table(self.path("catalog.tbl"), [('ra',   'double', ra),
+                                                                          ('dec',  'double', dec),
+                                                                          ('flux', 'double', flux)])
+
+        self.index = mvCatalogIndex(mvTable(self.table_file, self.path("cache")))
+
+        self.index.want("flux")
+
+        self.index.build_in_background()
+
+        self.index.thread.join()
+
+        self.assertEqual(self.index.error, "")
+        self.assertTrue(self.index.ready())
+
+
+  # Every point is within its cell's radius of the cell's center
+
+    def test_grid(self):
+
+        grid = mvSkyGrid(nside=16)
+
+        valid = numpy.isfinite(self.ra) & numpy.isfinite(self.dec)
+
+        xyz   = grid.unit_vectors(self.ra[valid], self.dec[valid])
+        cells = grid.cells(xyz)
+
+        centers, radii = grid.geometry()
+
+        self.assertEqual(len(centers), 6 * 16 * 16)
+
+        angles = numpy.arccos(numpy.clip((xyz * centers[cells]).sum(axis=1), -1., 1.))
+
+        self.assertTrue((angles <= radii[cells] + 1e-12).all())
+
+
+  # Cones found from the index are the ones a scan of every row finds
+
+    def test_cone(self):
+
+        ra  = self.index.table.column('ra')
+        dec = self.index.table.column('dec')
+
+        self.assertTrue(numpy.allclose(ra,  self.ra,  equal_nan=True))
+        self.assertTrue(numpy.allclose(dec, self.dec, equal_nan=True))
+
+        cones = [(0., 89.5, 1.), (180., 89.9, 0.5), (359.9, 10., 0.3), (0.1, 10., 2.), (45., 35.26, 0.7),
+                 (180., 30., 0.01), (180., 30., 1.5), (90., -45., 20.), (10., 0., 90.), (0., 0., 180.)]
+
+        for center_ra, center_dec, radius in cones:
+
+            rows = self.index.cone(center_ra, center_dec, radius)
+
+            with numpy.errstate(invalid='ignore'):
+                expected = numpy.nonzero(distance(center_ra, center_dec, self.ra, self.dec) <= radius)[0]
+
+            self.assertTrue(numpy.array_equal(rows, expected), (center_ra, center_dec, radius))
+
+
+  # The rows in view are written out with their positions and
+  # the symbol size column
+
+    def test_write_subset(self):
+
+        rows = self.index.cone(180., 30., 1.)
+
+        rows = numpy.append(rows, 13)
+
+        self.index.write_subset(rows, self.path("subset.tbl"), "FLUX")
+
+        subset = mvTable(self.path("subset.tbl"), self.path("cache"))
+
+        self.assertEqual(subset.names, ['ra', 'dec', 'flux'])
+
+        for name, values in [('ra', self.ra), ('dec', self.dec), ('flux', self.flux)]:
+            self.assertTrue(numpy.allclose(subset.column(name), values[rows], rtol=1e-9, equal_nan=True))
+
+        self.assertTrue(numpy.isnan(subset.column('flux')[-1]))
+
+
+  # A table without positions can't be indexed
+
+    def test_no_positions(self):
+
+        table_file = mvtest.write_table(self.path("other.tbl"), [('x', 'double', [1., 2.]), ('y', 'double', [3., 4.])])
+
+        with self.assertRaises(Exception):
+            mvCatalogIndex(mvTable(table_file, self.path("cache")))
+
+
+if __name__ == "__main__":
+    unittest.main()
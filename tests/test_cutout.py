@@ -0,0 +1,201 @@
+#---------------------------------------------------------------------------------
+#  In-process cutouts (mvFITS.cutout, mViewer.make_cutout)
+#---------------------------------------------------------------------------------
+
+import os
+import unittest
+
+from distutils.spawn import find_executable
+
+import numpy
+
+import mvtest
+
+from agMontage.mViewer import mvFITS, mvWCS
+
+
+# A stand-in mSubimage: writes its arguments to the output file
+
+MSUBIMAGE = """
+open(sys.argv[3], 'w').write(' '.join(sys.argv[1:]))
+
+print '[struct stat="OK", content="normal"]'
+"""
+
+
+class CutoutTest(mvtest.TestCase):
+
+  # A 200x100 image with every pixel different
+
+    def setUp(self):
+
+        mvtest.TestCase.setUp(self)
+
+        self.data = numpy.arange(100 * 200, dtype='f4').reshape(100, 200)
+
+        self.fits_file = mvtest.write_fits(self.path("image.fits"), self.data)
+
+
+  # The cutout is the same block of the array, with the reference
+  # pixel moved to match
+
+    def test_cutout(self):
+
+        fits = mvFITS(self.fits_file)
+
+        data, cards = fits.cutout(11, 21, 61, 51)
+
+        self.assertTrue(numpy.array_equal(data, self.data[20:50, 10:60]))
+
+        header = dict((card[0:8].strip(), fits.parse_value(card[10:])) for card in cards)
+
+        self.assertEqual(header['NAXIS1'], 50)
+        self.assertEqual(header['NAXIS2'], 30)
+
+        self.assertEqual(header['CRPIX1'], 100.5 - 10)
+        self.assertEqual(header['CRPIX2'],  50.5 - 20)
+
+
+  # A box running off the far edges is clipped; one entirely
+  # off the image is an error
+
+    def test_clipped(self):
+
+        fits = mvFITS(self.fits_file)
+
+        data, cards = fits.cutout(181, 91, 260, 140)
+
+        self.assertTrue(numpy.array_equal(data, self.data[90:100, 180:200]))
+
+        with self.assertRaises(Exception):
+            fits.cutout(201, 1, 250, 50)
+
+
+  # Written out and read back, the cutout has the same data and
+  # puts each pixel at the same place on the sky
+
+    def test_write(self):
+
+        fits = mvFITS(self.fits_file)
+
+        data, cards = fits.cutout(11, 21, 61, 51)
+
+        fits.write(self.path("cutout.fits"), data, cards)
+
+        cutout = mvFITS(self.path("cutout.fits"))
+
+        self.assertEqual(os.path.getsize(self.path("cutout.fits")) % 2880, 0)
+
+        self.assertTrue(numpy.array_equal(cutout.data(), self.data[20:50, 10:60]))
+
+        wcs     = mvWCS(fits.wcs)
+        cut_wcs = mvWCS(cutout.wcs)
+
+        for x, y in [(1, 1), (50, 1), (17, 23), (50, 30)]:
+
+            ra,     dec     = wcs.pix2sky(x + 10, y + 20)
+            cut_ra, cut_dec = cut_wcs.pix2sky(x, y)
+
+            self.assertAlmostEqual(ra,  cut_ra,  places=9)
+            self.assertAlmostEqual(dec, cut_dec, places=9)
+
+
+  # Scaled integers with blanks: physical values, blanks as NaN
+
+    def test_physical(self):
+
+        raw = (numpy.arange(100 * 200) % 1000).astype('int16').reshape(100, 200)
+
+        raw[5, 7] = -32768
+
+        fits = mvFITS(mvtest.write_fits(self.path("scaled.fits"), raw, bscale=2., bzero=-100., blank=-32768))
+
+        data, cards = fits.cutout(1, 1, 21, 11)
+
+        values = fits.physical(data)
+
+        expected = raw[0:10, 0:20] * 2. - 100.
+
+        expected[5, 7] = numpy.nan
+
+        self.assertTrue(numpy.array_equal(numpy.isnan(values), numpy.isnan(expected)))
+        self.assertTrue(numpy.allclose(values[~numpy.isnan(values)], expected[~numpy.isnan(expected)]))
+
+
+  # Files we don't handle are refused (so the caller uses mSubimage)
+
+    def test_unsupported(self):
+
+        for name, cards in [("cube.fits",   [mvtest.card('SIMPLE', True), mvtest.card('BITPIX', -32), mvtest.card('NAXIS', 3),
+                                             mvtest.card('NAXIS1', 4), mvtest.card('NAXIS2', 4), mvtest.card('NAXIS3', 2)]),
+                            ("table.fits",  [mvtest.card('SIMPLE', True), mvtest.card('BITPIX', 8), mvtest.card('NAXIS', 0)]),
+                            ("odd.fits",    [mvtest.card('SIMPLE', False), mvtest.card('BITPIX', -32), mvtest.card('NAXIS', 2),
+                                             mvtest.card('NAXIS1', 4), mvtest.card('NAXIS2', 4)])]:
+
+            text = "".join(cards) + "END".ljust(80)
+
+            fp = open(self.path(name), 'wb')
+            fp.write(text + " " * (-len(text) % 2880) + "\0" * 2880)
+            fp.close()
+
+            with self.assertRaises(Exception):
+                mvFITS(self.path(name))
+
+
+  # The viewer cuts out its view box in-process, or (when it can't)
+  # runs mSubimage for the same region
+
+    def test_make_cutout(self):
+
+        viewer = self.viewer(self.fits_file)
+
+        viewer.view.xmin = 11
+        viewer.view.ymin = 21
+        viewer.view.xmax = 61
+        viewer.view.ymax = 51
+
+        self.assertEqual(viewer.make_cutout(self.fits_file, self.path("cutout.fits")), (50, 30))
+
+        self.assertTrue(numpy.array_equal(mvFITS(self.path("cutout.fits")).data(), self.data[20:50, 10:60]))
+
+        mvtest.stub_program(self.bin_dir, "mSubimage", MSUBIMAGE)
+
+        viewer.useMemmap = False
+
+        self.assertIsNone(viewer.make_cutout(self.fits_file, self.path("subimage.fits")))
+
+        self.assertEqual(open(self.path("subimage.fits")).read(),
+                         "-p " + self.fits_file + " " + self.path("subimage.fits") + " 11 21 50 30")
+
+
+  # The same region from the real mSubimage
+
+    @unittest.skipUnless(find_executable("mSubimage"), "mSubimage is not on the PATH")
+    def test_msubimage(self):
+
+        viewer = self.viewer(self.fits_file)
+
+        viewer.montageBin = ""
+
+        viewer.view.xmin = 11
+        viewer.view.ymin = 21
+        viewer.view.xmax = 61
+        viewer.view.ymax = 51
+
+        viewer.make_cutout(self.fits_file, self.path("cutout.fits"))
+
+        viewer.useMemmap = False
+
+        viewer.make_cutout(self.fits_file, self.path("subimage.fits"))
+
+        cutout   = mvFITS(self.path("cutout.fits"))
+        subimage = mvFITS(self.path("subimage.fits"))
+
+        self.assertTrue(numpy.array_equal(cutout.data(), subimage.data()))
+
+        for keyword in ['NAXIS1', 'NAXIS2', 'CRPIX1', 'CRPIX2']:
+            self.assertAlmostEqual(cutout.header[keyword], subimage.header[keyword])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,162 @@
+#---------------------------------------------------------------------------------
+#  Fused cutout and downsample (mvFITS.downsample)
+#---------------------------------------------------------------------------------
+
+import unittest
+import warnings
+
+import numpy
+
+import mvtest
+
+from agMontage.mViewer import mvFITS, mvWCS
+
+
+# The mean of the non-null pixels each output pixel covers, one
+# output pixel at a time (an output pixel narrower than a source
+# pixel gets the source pixel it starts in)
+
+def naive_average(data, nx, ny):
+
+    height, width = data.shape
+
+    xstart = [i * width  // nx for i in range(nx)] + [width]
+    ystart = [j * height // ny for j in range(ny)] + [height]
+
+    out = numpy.empty((ny, nx))
+
+    with warnings.catch_warnings():
+
+        warnings.simplefilter("ignore", RuntimeWarning)
+
+        for j in range(ny):
+            for i in range(nx):
+
+                block = data[ystart[j]:max(ystart[j+1], ystart[j]+1), xstart[i]:max(xstart[i+1], xstart[i]+1)]
+
+                out[j, i] = numpy.nanmean(block)
+
+    return out
+
+
+class DownsampleTest(mvtest.TestCase):
+
+    def setUp(self):
+
+        mvtest.TestCase.setUp(self)
+
+        self.data = numpy.random.RandomState(3).normal(100., 10., (300, 400)).astype('f4')
+
+        self.data[50:60, 70:90] = numpy.nan
+        self.data[5, 5]         = numpy.nan
+
+        self.fits_file = mvtest.write_fits(self.path("image.fits"), self.data)
+
+
+    def check_average(self, data, expected):
+
+        self.assertEqual(data.dtype, numpy.float32)
+        self.assertEqual(data.shape, expected.shape)
+
+        self.assertTrue(numpy.array_equal(numpy.isnan(data), numpy.isnan(expected)))
+        self.assertTrue(numpy.allclose(data[~numpy.isnan(data)], expected[~numpy.isnan(expected)], rtol=1e-5, atol=1e-5))
+
+
+  # Averaging by whole and fractional factors, and blowing up
+
+    def test_average(self):
+
+        fits = mvFITS(self.fits_file)
+
+        region = self.data[10:290, 20:370]
+
+        for nx, ny in [(35, 28), (100, 71), (7, 3), (350, 280), (500, 400)]:
+
+            data, cards = fits.downsample(21, 11, 371, 291, nx, ny)
+
+            self.check_average(data, naive_average(region, nx, ny))
+
+
+  # A region tall enough to be read in several bands
+
+    def test_bands(self):
+
+        big = numpy.random.RandomState(4).normal(0., 1., (2100, 4000)).astype('f4')
+
+        big[1000:1100, 0:200] = numpy.nan
+
+        fits = mvFITS(mvtest.write_fits(self.path("big.fits"), big))
+
+        data, cards = fits.downsample(1, 1, 4001, 2101, 30, 1000)
+
+        self.check_average(data, naive_average(big, 30, 1000))
+
+
+  # Sampling takes the source pixel at each output pixel's center
+
+    def test_sample(self):
+
+        fits = mvFITS(self.fits_file)
+
+        nx, ny = 70, 45
+
+        data, cards = fits.downsample(21, 11, 371, 291, nx, ny, method="sample")
+
+        for j in range(ny):
+            for i in range(nx):
+
+                expected = self.data[10 + (2 * j + 1) * 280 // (2 * ny), 20 + (2 * i + 1) * 350 // (2 * nx)]
+
+                if numpy.isnan(expected):
+                    self.assertTrue(numpy.isnan(data[j, i]))
+                else:
+                    self.assertEqual(data[j, i], expected)
+
+
+  # Streamed bands make up the same image, and write the same file
+
+    def test_stream(self):
+
+        fits = mvFITS(self.fits_file)
+
+        data,  cards        = fits.downsample(21, 11, 371, 291, 100, 71)
+        bands, stream_cards = fits.downsample(21, 11, 371, 291, 100, 71, stream=True)
+
+        self.assertEqual(cards, stream_cards)
+
+        fits.write(self.path("data.fits"), data, cards)
+
+        fits.write(self.path("stream.fits"), bands, cards)
+
+        self.assertEqual(open(self.path("data.fits"), 'rb').read(), open(self.path("stream.fits"), 'rb').read())
+
+
+  # The output header puts each output pixel center where the
+  # middle of the source pixels it covers is
+
+    def test_cards(self):
+
+        fits = mvFITS(self.fits_file)
+
+        data, cards = fits.downsample(21, 11, 371, 291, 35, 28)
+
+        fits.write(self.path("small.fits"), data, cards)
+
+        small = mvFITS(self.path("small.fits"))
+
+        self.assertEqual((small.naxis1, small.naxis2, small.bitpix), (35, 28, -32))
+
+        wcs       = mvWCS(fits.wcs)
+        small_wcs = mvWCS(small.wcs)
+
+        for i, j in [(1, 1), (35, 1), (12, 17), (35, 28)]:
+
+            ra,       dec       = wcs.pix2sky(20 + (i - 0.5) * 10 + 0.5, 10 + (j - 0.5) * 10 + 0.5)
+            small_ra, small_dec = small_wcs.pix2sky(i, j)
+
+            self.assertAlmostEqual(ra,  small_ra,  places=9)
+            self.assertAlmostEqual(dec, small_dec, places=9)
+
+
+if __name__ == "__main__":
+    unittest.main()
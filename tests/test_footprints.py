@@ -0,0 +1,206 @@
+#---------------------------------------------------------------------------------
+#  Sky-cell index of image footprints (mvFootprintIndex)
+#---------------------------------------------------------------------------------
+
+import unittest
+
+import numpy
+
+import mvtest
+
+from agMontage.mViewer import mvFootprintIndex, mvTable
+
+
+# Unit vector for RA, Dec (degrees) and the east and north
+# directions there
+
+def frame(ra, dec):
+
+    ra  = numpy.radians(ra)
+    dec = numpy.radians(dec)
+
+    point = numpy.array([numpy.cos(dec) * numpy.cos(ra), numpy.cos(dec) * numpy.sin(ra), numpy.sin(dec)])
+    east  = numpy.array([-numpy.sin(ra), numpy.cos(ra), 0.])
+    north = numpy.array([-numpy.sin(dec) * numpy.cos(ra), -numpy.sin(dec) * numpy.sin(ra), numpy.cos(dec)])
+
+    return point, east, north
+
+
+def position(xyz):
+
+    xyz = xyz / numpy.sqrt((xyz**2).sum())
+
+    return numpy.degrees(numpy.arctan2(xyz[1], xyz[0])) % 360., numpy.degrees(numpy.arcsin(xyz[2]))
+
+
+# Angle (degrees) for a dot product of unit vectors
+
+def angle(dot):
+
+    return numpy.degrees(numpy.arccos(numpy.clip(dot, -1., 1.)))
+
+
+class FootprintTest(mvtest.TestCase):
+
+  # Square images of various sizes and orientations all over the
+  # sky and crowded around the pole and RA 0, each given by its
+  # corners (as mImgtbl would list them), and one with a corner missing
+
+    def setUp(self):
+
+        mvtest.TestCase.setUp(self)
+
+        state = numpy.random.RandomState(16)
+
+        centers = list(zip(state.uniform(0., 360., 600), numpy.degrees(numpy.arcsin(state.uniform(-1., 1., 600)))))
+
+        for center_ra, center_dec in [(0., 89.), (0., -20.)]:
+            for k in range(200):
+                centers.append(((center_ra + state.normal(0., 1.)) % 360., numpy.clip(center_dec + state.normal(0., 1.), -89.9, 89.9)))
+
+        self.corners = []
+
+        for center_ra, center_dec in centers:
+
+            point, east, north = frame(center_ra, center_dec)
+
+            size  = numpy.radians(state.uniform(0.05, 1.))
+            theta = state.uniform(0., 2. * numpy.pi)
+
+            corners = []
+
+            for x, y in [(-1, -1), (1, -1), (1, 1), (-1, 1)]:
+
+                u = size * (x * numpy.cos(theta) - y * numpy.sin(theta))
+                v = size * (x * numpy.sin(theta) + y * numpy.cos(theta))
+
+                ra, dec = position(point + u * east + v * north)
+
+                corners.append((float("%.8f" % ra), float("%.8f" % dec)))
+
+            self.corners.append(corners)
+
+        columns = []
+
+        for k in range(4):
+
+            columns.append(('ra'  + str(k+1), 'double', [footprint[k][0] for footprint in self.corners]))
+            columns.append(('dec' + str(k+1), 'double', [footprint[k][1] for footprint in self.corners]))
+
+        columns[4][2][17] = None
+
+        self.missing = 17
+
+        self.vectors = numpy.array([[frame(*corner)[0] for corner in footprint] for footprint in self.corners])
+
+        columns.append(('fname', 'char', ["image" + str(row) + ".fits" for row in range(len(self.corners))]))
+
+        self.table_file = mvtest.write_table(self.path("images.tbl"), columns)
+
+        self.index = mvFootprintIndex(mvTable(self.table_file, self.path("cache")))
+
+        self.index.build_in_background()
+
+        self.index.thread.join()
+
+        self.assertEqual(self.index.error, "")
+        self.assertTrue(self.index.ready())
+
+
+  # Rows in the cone: exactly those whose circle (around the mean
+  # of the corners, out to the farthest one) reaches it, checking
+  # every row.  That has to take in every footprint with a corner
+  # in the cone.
+
+    def test_cone(self):
+
+        for center_ra, center_dec, radius in [(0., 89.5, 1.), (180., 89.9, 2.), (359.5, -20., 0.5), (0.5, -20.5, 3.),
+                                              (123., 45., 5.), (200., -60., 0.1), (10., 0., 60.), (0., 0., 180.)]:
+
+            center = frame(center_ra, center_dec)[0]
+
+            rows = self.index.cone(center_ra, center_dec, radius)
+
+            middle = self.vectors.sum(axis=1)
+            middle = middle / numpy.sqrt((middle**2).sum(axis=1))[:, None]
+
+            reach = angle((self.vectors * middle[:, None, :]).sum(axis=2)).max(axis=1)
+
+            inside = angle(numpy.dot(middle, center)) <= radius + reach + 1e-9
+            corner = angle(numpy.dot(self.vectors, center)).min(axis=1) <= radius
+
+            inside[self.missing] = False
+            corner[self.missing] = False
+
+            self.assertEqual(list(rows), list(numpy.nonzero(inside)[0]), (center_ra, center_dec, radius))
+
+            self.assertTrue(inside[corner].all())
+
+
+  # Rows covering a point: the point is inside the corners when
+  # they are projected onto the plane touching the sky there
+
+    def test_covering(self):
+
+        state = numpy.random.RandomState(17)
+
+        points = [position(self.vectors[row].sum(axis=0)) for row in [0, 100, 650, 900]]
+
+        points.extend(zip(state.uniform(0., 360., 100), numpy.degrees(numpy.arcsin(state.uniform(-1., 1., 100)))))
+        points.extend(zip(state.uniform(0., 360., 100), state.uniform(87., 90., 100)))
+
+        found = 0
+
+        for ra, dec in points:
+
+            point, east, north = frame(ra, dec)
+
+            depth = numpy.dot(self.vectors, point)
+
+            with numpy.errstate(invalid='ignore', divide='ignore'):
+                x = numpy.dot(self.vectors, east)  / depth
+                y = numpy.dot(self.vectors, north) / depth
+
+            sides = x * numpy.roll(y, -1, axis=1) - y * numpy.roll(x, -1, axis=1)
+
+            inside = (depth > 0.).all(axis=1) & ((sides >= 0.).all(axis=1) | (sides <= 0.).all(axis=1))
+
+            inside[self.missing] = False
+
+            rows = self.index.covering(ra, dec)
+
+            self.assertEqual(list(rows), list(numpy.nonzero(inside)[0]), (ra, dec))
+
+            found += len(rows)
+
+        self.assertGreater(found, 4)
+
+
+  # The rows in view are written out whole
+
+    def test_write_subset(self):
+
+        rows = self.index.cone(0., 89.5, 1.)
+
+        self.index.write_subset(rows, self.path("subset.tbl"))
+
+        subset = mvTable(self.path("subset.tbl"), self.path("cache"))
+
+        self.assertEqual(subset.names, self.index.table.names)
+
+        self.assertEqual([subset.field(line, 'fname') for line in subset.lines(range(len(rows)))],
+                         ["image" + str(row) + ".fits" for row in rows])
+
+
+  # A table without corners can't be indexed
+
+    def test_no_corners(self):
+
+        table_file = mvtest.write_table(self.path("other.tbl"), [('ra', 'double', [1., 2.]), ('dec', 'double', [3., 4.])])
+
+        with self.assertRaises(Exception):
+            mvFootprintIndex(mvTable(table_file, self.path("cache")))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,144 @@
+#---------------------------------------------------------------------------------
+#  Summed-area tables (mvIntegral)
+#---------------------------------------------------------------------------------
+
+import os
+import unittest
+
+import numpy
+
+import mvtest
+
+from agMontage.mViewer import mvFITS, mvIntegral, mvPyramid
+
+
+class IntegralTest(mvtest.TestCase):
+
+    def setUp(self):
+
+        mvtest.TestCase.setUp(self)
+
+        self.data = numpy.random.RandomState(8).normal(100., 10., (150, 200)).astype('f4')
+
+        self.data[40:45, 60:63] = numpy.nan
+        self.data[0, 0]         = numpy.nan
+
+        self.fits_file = mvtest.write_fits(self.path("image.fits"), self.data)
+
+        self.integral = self.built(self.fits_file)
+
+
+    def built(self, fits_file):
+
+        integral = mvIntegral(mvPyramid(fits_file, self.path("cache")))
+
+        self.assertFalse(integral.ready())
+
+        integral.build_in_background()
+
+        integral.thread.join()
+
+        self.assertEqual(integral.error, "")
+        self.assertTrue(integral.ready())
+
+        return integral
+
+
+  # Count, mean and RMS of the non-null values in a block
+
+    def brute_force(self, block):
+
+        values = block[numpy.isfinite(block)].astype('f8')
+
+        if values.size == 0:
+            return 0, 0., 0.
+
+        return values.size, values.mean(), values.std()
+
+
+    def check(self, stats, expected):
+
+        self.assertEqual(stats[0], expected[0])
+
+        self.assertAlmostEqual(stats[1], expected[1], places=6)
+        self.assertAlmostEqual(stats[2], expected[2], places=6)
+
+
+  # Boxes inside, over nulls, clipped by the edges, and of one pixel
+
+    def test_box_stats(self):
+
+        state = numpy.random.RandomState(9)
+
+        boxes = [(1, 1, 200, 150), (60, 40, 64, 46), (61, 41, 63, 45), (-10, -5, 20, 30), (190, 140, 250, 200), (7, 9, 7, 9)]
+
+        for k in range(50):
+
+            xmin, xmax = sorted(state.randint(1, 201, 2))
+            ymin, ymax = sorted(state.randint(1, 151, 2))
+
+            boxes.append((xmin, ymin, xmax, ymax))
+
+        for xmin, ymin, xmax, ymax in boxes:
+
+            block = self.data[max(ymin, 1)-1:ymax, max(xmin, 1)-1:xmax]
+
+            self.check(self.integral.box_stats(xmin, ymin, xmax, ymax), self.brute_force(block))
+
+
+  # Circles: the same pixels region_stats() would look at
+
+    def test_circle_stats(self):
+
+        y, x = numpy.mgrid[1:151, 1:201]
+
+        for ix, iy, r in [(100, 75, 10), (61, 42, 6), (62, 42, 1), (100, 75, 0), (3, 148, 12), (199, 1, 30), (100, 75, 500)]:
+
+            inside = (x - ix)**2 + (y - iy)**2 <= r * r
+
+            npixel, nnull, mean, rms = self.integral.circle_stats(ix, iy, r)
+
+            expected = self.brute_force(self.data[inside])
+
+            self.check((npixel, mean, rms), expected)
+
+            self.assertEqual(nnull, inside.sum() - expected[0])
+
+
+  # Pick statistics are the same from the tables as from the pixels
+
+    def test_region_stats(self):
+
+        fits = mvFITS(self.fits_file)
+
+        for x, y, r in [(100.2, 75.4, 10), (61., 42., 6), (2.6, 148.5, 12)]:
+
+            slow = fits.region_stats(x, y, r)
+            fast = fits.region_stats(x, y, r, integral=self.integral)
+
+            self.assertEqual((fast.npixel, fast.nnull), (slow.npixel, slow.nnull))
+
+            self.assertAlmostEqual(fast.aveflux, slow.aveflux, places=6)
+            self.assertAlmostEqual(fast.rmsflux, slow.rmsflux, places=6)
+
+
+  # An image tall enough to be built in more than one band (the
+  # running totals carry over from one band to the next)
+
+    def test_bands(self):
+
+        data = numpy.random.RandomState(10).normal(0., 1., (1100, 4200)).astype('f4')
+
+        integral = self.built(mvtest.write_fits(self.path("wide.fits"), data))
+
+        for xmin, ymin, xmax, ymax in [(1, 1, 4200, 1100), (100, 990, 3000, 1010), (4000, 1000, 4200, 1100)]:
+
+            block = data[ymin-1:ymax, xmin-1:xmax]
+
+            self.check(integral.box_stats(xmin, ymin, xmax, ymax), self.brute_force(block))
+
+        self.assertEqual(os.listdir(integral.directory), ["integral.f8"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,171 @@
+#---------------------------------------------------------------------------------
+#  Block minimum/maximum tree (mvMinMax)
+#---------------------------------------------------------------------------------
+
+import unittest
+
+import numpy
+
+import mvtest
+
+from agMontage.mViewer import mvFITS, mvMinMax, mvPyramid
+
+
+class MinMaxTest(mvtest.TestCase):
+
+  # 300x200 pixels is 10x7 blocks, the last row and column partial
+
+    def setUp(self):
+
+        mvtest.TestCase.setUp(self)
+
+        self.data = numpy.random.RandomState(11).normal(100., 10., (200, 300)).astype('f4')
+
+        self.data[64:96, 96:128] = numpy.nan
+        self.data[150:160, 5:9]  = numpy.nan
+
+        self.fits_file = mvtest.write_fits(self.path("image.fits"), self.data)
+
+        self.minmax = self.built(self.fits_file)
+
+
+    def built(self, fits_file):
+
+        minmax = mvMinMax(mvPyramid(fits_file, self.path("cache")))
+
+        self.assertFalse(minmax.ready())
+
+        minmax.build_in_background()
+
+        minmax.thread.join()
+
+        self.assertEqual(minmax.error, "")
+        self.assertTrue(minmax.ready())
+
+        return minmax
+
+
+  # Where the smallest and largest non-null values in the circle
+  # are, looking at every pixel
+
+    def brute_force(self, data, ix, iy, r):
+
+        ny, nx = data.shape
+
+        y, x = numpy.mgrid[1:ny+1, 1:nx+1]
+
+        valid = ((x - ix)**2 + (y - iy)**2 <= r * r) & numpy.isfinite(data)
+
+        if not valid.any():
+            return None
+
+        k = numpy.where(valid, data, numpy.inf).argmin()
+        l = numpy.where(valid, data, -numpy.inf).argmax()
+
+        return (x.flat[k], y.flat[k]), (x.flat[l], y.flat[l])
+
+
+  # The bottom level against the blocks, the top against the image
+
+    def test_tree(self):
+
+        levels = self.minmax.load()
+
+        mins, argmins, maxs, argmaxs = levels[0]
+
+        self.assertEqual(mins.shape, (7, 10))
+
+        for by in range(7):
+            for bx in range(10):
+
+                block = self.data[by*32:(by+1)*32, bx*32:(bx+1)*32]
+
+                if numpy.isnan(block).all():
+                    self.assertEqual(mins[by, bx],  numpy.inf)
+                    self.assertEqual(maxs[by, bx], -numpy.inf)
+                    continue
+
+                self.assertEqual(mins[by, bx], numpy.nanmin(block))
+                self.assertEqual(maxs[by, bx], numpy.nanmax(block))
+
+                self.assertEqual(self.data.flat[argmins[by, bx]], mins[by, bx])
+                self.assertEqual(self.data.flat[argmaxs[by, bx]], maxs[by, bx])
+
+        mins, argmins, maxs, argmaxs = levels[-1]
+
+        self.assertEqual(mins.shape, (1, 1))
+
+        self.assertEqual(argmins[0, 0], numpy.nanargmin(self.data))
+        self.assertEqual(argmaxs[0, 0], numpy.nanargmax(self.data))
+
+
+  # Circles large and small, on the edges and over nulls
+
+    def test_circle_extrema(self):
+
+        fits = mvFITS(self.fits_file)
+
+        circles = [(150, 100, 0), (150, 100, 5), (112, 80, 16), (112, 80, 30), (1, 1, 40), (300, 200, 100), (150, 100, 400)]
+
+        state = numpy.random.RandomState(12)
+
+        for k in range(100):
+            circles.append((state.randint(1, 301), state.randint(1, 201), state.randint(0, 120)))
+
+        for ix, iy, r in circles:
+            self.assertEqual(self.minmax.circle_extrema(fits, ix, iy, r), self.brute_force(self.data, ix, iy, r), (ix, iy, r))
+
+
+  # A circle of nothing but nulls has no extremes
+
+    def test_all_null(self):
+
+        self.assertIsNone(self.minmax.circle_extrema(mvFITS(self.fits_file), 112, 80, 10))
+
+
+  # Scaled data, with a negative scale (so the largest raw value
+  # is the smallest physical one).  Integers repeat, so it's the
+  # values at the positions that have to match.
+
+    def test_scaled(self):
+
+        raw = numpy.random.RandomState(13).randint(-30000, 30000, (200, 300)).astype('int16')
+
+        raw[20:30, 40:50] = -32768
+
+        fits_file = mvtest.write_fits(self.path("scaled.fits"), raw, bscale=-0.5, bzero=100., blank=-32768)
+
+        fits   = mvFITS(fits_file)
+        minmax = self.built(fits_file)
+
+        data = fits.physical(fits.data())
+
+        for ix, iy, r in [(45, 25, 8), (45, 25, 20), (150, 100, 60), (150, 100, 400)]:
+
+            extrema  = minmax.circle_extrema(fits, ix, iy, r)
+            expected = self.brute_force(data, ix, iy, r)
+
+            for (x, y), (ex, ey) in zip(extrema, expected):
+
+                self.assertLessEqual((x - ix)**2 + (y - iy)**2, r * r)
+
+                self.assertEqual(data[y-1, x-1], data[ey-1, ex-1])
+
+
+  # Pick statistics are the same from the tree as from the pixels
+
+    def test_region_stats(self):
+
+        fits = mvFITS(self.fits_file)
+
+        for x, y, r in [(150.2, 99.6, 40), (112., 80., 20), (2., 199., 12)]:
+
+            slow = fits.region_stats(x, y, r)
+            fast = fits.region_stats(x, y, r, minmax=self.minmax)
+
+            for name in ['fluxmin', 'xmin', 'ymin', 'fluxmax', 'xmax', 'ymax']:
+                self.assertEqual(getattr(fast, name), getattr(slow, name))
+
+
+if __name__ == "__main__":
+    unittest.main()
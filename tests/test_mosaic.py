@@ -0,0 +1,198 @@
+#---------------------------------------------------------------------------------
+#  Virtual mosaics (mvMosaic, mViewer.make_mosaic_shrunken)
+#---------------------------------------------------------------------------------
+
+import os
+import unittest
+
+import numpy
+
+import mvtest
+
+from agMontage.mViewer import mvFITS, mvMosaic, mvWCS
+
+
+class MosaicTest(mvtest.TestCase):
+
+  # A 300x210 image cut into six overlapping tiles (each with its
+  # own reference pixel), an image table listing them, and the
+  # image's header as the mosaic's template
+
+    def setUp(self):
+
+        mvtest.TestCase.setUp(self)
+
+        y, x = numpy.mgrid[0:210, 0:300]
+
+        self.data = (x + 1000. * y).astype('f4')
+
+        self.fits_file = mvtest.write_fits(self.path("image.fits"), self.data)
+
+        self.tiles = []
+
+        for ty in range(2):
+            for tx in range(3):
+
+                x0 = max(tx * 100 - 3, 0)
+                y0 = max(ty * 105 - 3, 0)
+                x1 = min(tx * 100 + 103, 300)
+                y1 = min(ty * 105 + 108, 210)
+
+                self.tiles.append((x0, y0, x1, y1))
+
+        os.makedirs(self.path("tiles"))
+
+        corners = [[] for k in range(8)]
+        names   = []
+
+        for x0, y0, x1, y1 in self.tiles:
+
+            name = "tiles/tile_" + str(x0) + "_" + str(y0) + ".fits"
+
+            cards = mvtest.wcs_cards(x1 - x0, y1 - y0)
+
+            cards[4] = mvtest.card('CRPIX1', 150.5 - x0)
+            cards[5] = mvtest.card('CRPIX2', 105.5 - y0)
+
+            mvtest.write_fits(self.path(name), self.data[y0:y1, x0:x1], cards)
+
+            wcs = mvWCS(mvFITS(self.path(name)).wcs)
+
+            for k, (px, py) in enumerate([(0.5, 0.5), (x1 - x0 + 0.5, 0.5), (x1 - x0 + 0.5, y1 - y0 + 0.5), (0.5, y1 - y0 + 0.5)]):
+
+                ra, dec = wcs.pix2sky(px, py)
+
+                corners[2*k].append(float(ra))
+                corners[2*k+1].append(float(dec))
+
+            names.append(name)
+
+        columns = []
+
+        for k in range(4):
+            columns.append(('ra'  + str(k+1), 'double', corners[2*k]))
+            columns.append(('dec' + str(k+1), 'double', corners[2*k+1]))
+
+        columns.append(('fname', 'char', names))
+
+        self.table_file = mvtest.write_table(self.path("images.tbl"), columns, width=32)
+
+        self.header_file = self.path("region.hdr")
+
+        fp = open(self.header_file, 'w')
+
+        for card in [mvtest.card('SIMPLE', True), mvtest.card('BITPIX', -64), mvtest.card('NAXIS', 2),
+                     mvtest.card('NAXIS1', 300), mvtest.card('NAXIS2', 210)] + mvtest.wcs_cards(300, 210):
+            fp.write(card.rstrip() + "\n")
+
+        fp.write("END\n")
+
+        fp.close()
+
+
+    def mosaic(self):
+
+        mosaic = mvMosaic(self.table_file, self.header_file, self.path("cache"))
+
+        mosaic.index.thread.join()
+
+        return mosaic
+
+
+  # The mosaic has the template's geometry, and no data of its own
+
+    def test_header(self):
+
+        mosaic = self.mosaic()
+
+        self.assertEqual((mosaic.naxis1, mosaic.naxis2, mosaic.bitpix), (300, 210, -32))
+
+        self.assertEqual(mosaic.wcs, mvFITS(self.fits_file).wcs)
+
+        self.assertTrue(mosaic.current())
+
+        with self.assertRaises(Exception):
+            mosaic.data()
+
+
+  # The images found for a region include every tile that overlaps
+  # it (checking them all), with names relative to the table
+
+    def test_frames(self):
+
+        mosaic = self.mosaic()
+
+        for x0, y0, x1, y1 in [(0, 0, 300, 210), (10, 10, 50, 50), (90, 90, 110, 120), (250, 150, 300, 210), (120, 20, 180, 60)]:
+
+            frames = mosaic.frames(x0, y0, x1, y1)
+
+            for tx0, ty0, tx1, ty1 in self.tiles:
+
+                if tx0 < x1 and x0 < tx1 and ty0 < y1 and y0 < ty1:
+                    self.assertIn(self.path("tiles/tile_" + str(tx0) + "_" + str(ty0) + ".fits"), frames)
+
+        self.assertEqual(len(mosaic.frames(0, 0, 300, 210)), 6)
+
+
+  # Each tile sampled at full resolution is the part of the image
+  # it came from (and nothing outside it)
+
+    def test_sample_frame(self):
+
+        mosaic = self.mosaic()
+
+        for x0, y0, x1, y1 in self.tiles:
+
+            fits = mvFITS(self.path("tiles/tile_" + str(x0) + "_" + str(y0) + ".fits"))
+
+            j0, j1, i0, i1, values = mosaic.sample_frame(fits, 0, 0, 300, 210, 300, 210)
+
+            canvas = numpy.full((210, 300), numpy.nan, dtype='f4')
+
+            canvas[j0:j1, i0:i1] = values
+
+            self.assertTrue(numpy.array_equal(canvas[y0:y1, x0:x1], self.data[y0:y1, x0:x1]))
+
+            canvas[y0:y1, x0:x1] = numpy.nan
+
+            self.assertTrue(numpy.isnan(canvas).all())
+
+        fits = mvFITS(self.path("tiles/tile_0_0.fits"))
+
+        self.assertIsNone(mosaic.sample_frame(fits, 150, 150, 300, 210, 50, 20))
+
+
+  # The mosaic shown on a canvas a third of its size is the image
+  # sampled at the same pixels (the tiles agree where they overlap)
+
+    def test_shrunken(self):
+
+        viewer = self.viewer(self.fits_file)
+
+        viewer.set_mosaic(self.table_file, self.header_file)
+
+        viewer.view.canvas_width  = 100
+        viewer.view.canvas_height = 70
+
+        viewer.view.xmin = 1
+        viewer.view.ymin = 1
+        viewer.view.xmax = 301
+        viewer.view.ymax = 211
+
+        for workers in [1, 4]:
+
+            viewer.mosaicWorkers = workers
+
+            self.assertEqual(viewer.make_mosaic_shrunken(self.path("mosaic.fits")), 3.)
+
+            mosaic = mvFITS(self.path("mosaic.fits"))
+
+            data, cards = mvFITS(self.fits_file).downsample(1, 1, 301, 211, 100, 70, method="sample")
+
+            self.assertTrue(numpy.array_equal(mosaic.data(), data))
+
+            self.assertEqual(viewer.view.mosaic_frames, 6)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,100 @@
+#---------------------------------------------------------------------------------
+#  Prefetching (mViewer.start_prefetch)
+#---------------------------------------------------------------------------------
+
+import Queue
+import unittest
+
+import numpy
+
+import mvtest
+
+
+class PrefetchTest(mvtest.TestCase):
+
+  # A viewer showing the whole image, whose prefetch just passes
+  # on the jobs it would have run (see prefetched())
+
+    def prefetching(self, scope):
+
+        y, x = numpy.mgrid[0:600, 0:800]
+
+        data = (x * 0.01 + y * 0.02 + numpy.random.RandomState(1).normal(0., 1., x.shape)).astype('f4')
+
+        viewer = self.viewer(mvtest.write_fits(self.path("image.fits"), data))
+
+        viewer.prefetch     = True
+        viewer.stretchScope = scope
+
+        self.prefetches = Queue.Queue()
+
+        viewer.run_prefetch = lambda jobs, files, workdir, encoding, cancel: self.prefetches.put(jobs)
+
+        viewer.from_browser("initialize 200 150")
+
+        return viewer
+
+
+  # The prefetch jobs started by the last display, by view box
+
+    def prefetched(self):
+
+        return dict((box, key) for key, box, command in self.prefetches.get(timeout=10.))
+
+
+  # Each prefetched view's key has to be the one the pan or zoom
+  # itself comes up with, or the prefetch is wasted
+
+    def check_keys(self, scope):
+
+        viewer = self.prefetching(scope)
+
+        self.prefetched()
+
+        viewer.from_browser("zoomIn")
+
+        jobs = self.prefetched()
+
+        for cmd in ['panLeft', 'panDown', 'zoomIn']:
+
+            box = viewer.zoom_pan_box(cmd, None)
+
+            self.assertIn(box, jobs)
+
+            viewer.from_browser(cmd)
+
+            self.assertTrue(viewer.renderCache.contains(jobs[box]), cmd)
+
+            jobs = self.prefetched()
+
+
+    def test_global_keys(self):
+
+        self.check_keys("global")
+
+
+    def test_local_keys(self):
+
+        self.check_keys("local")
+
+
+  # Working out the jobs leaves the stretches resolved for the
+  # view being shown alone
+
+    def test_no_side_effects(self):
+
+        viewer = self.prefetching("local")
+
+        self.prefetched()
+
+        resolved = viewer.resolvedStretches
+
+        viewer.start_prefetch()
+
+        self.prefetched()
+
+        self.assertIs(viewer.resolvedStretches, resolved)
+
+
+if __name__ == "__main__":
+    unittest.main()
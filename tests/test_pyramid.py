@@ -0,0 +1,181 @@
+#---------------------------------------------------------------------------------
+#  Multi-resolution copies of an image (mvPyramid)
+#---------------------------------------------------------------------------------
+
+import os
+import unittest
+import warnings
+
+import numpy
+
+import mvtest
+
+from agMontage.mViewer import mvFITS, mvPyramid, mvWCS
+
+
+# 2x2 block means of the non-null pixels (an odd last row or
+# column is dropped)
+
+def block_mean(data):
+
+    ny, nx = data.shape[0] // 2, data.shape[1] // 2
+
+    blocks = data[0:2*ny, 0:2*nx].reshape(ny, 2, nx, 2).transpose(0, 2, 1, 3).reshape(ny, nx, 4)
+
+    with warnings.catch_warnings():
+
+        warnings.simplefilter("ignore", RuntimeWarning)
+
+        return numpy.nanmean(blocks, axis=2)
+
+
+class PyramidTest(mvtest.TestCase):
+
+  # A 1000x700 image, which gets three levels at a minimum size
+  # of 100 (500x350, 250x175, 125x87)
+
+    def setUp(self):
+
+        mvtest.TestCase.setUp(self)
+
+        self.data = numpy.random.RandomState(5).normal(100., 10., (700, 1000)).astype('f4')
+
+        self.data[100:104, 200:204] = numpy.nan
+        self.data[301, 401]         = numpy.nan
+
+        self.fits_file = mvtest.write_fits(self.path("image.fits"), self.data)
+
+        self.pyramid = mvPyramid(self.fits_file, self.path("cache"), min_size=100)
+
+
+    def test_levels(self):
+
+        self.assertEqual(self.pyramid.nlevel, 3)
+
+        self.assertEqual(self.pyramid.levels(), [0])
+
+        self.pyramid.build()
+
+        self.assertEqual(self.pyramid.levels(), [0, 1, 2, 3])
+
+        self.assertEqual(sorted(os.listdir(self.pyramid.directory)), ["level1.fits", "level2.fits", "level3.fits"])
+
+
+  # Each level is the 2x2 block average of the one below it, and
+  # each pixel is at the same place on the sky as the block it
+  # came from
+
+    def test_build(self):
+
+        self.pyramid.build()
+
+        below = self.data
+        wcs   = mvWCS(mvFITS(self.fits_file).wcs)
+
+        for level in range(1, 4):
+
+            fits = mvFITS(self.pyramid.level_file(level))
+
+            data = fits.physical(fits.data())
+
+            expected = block_mean(below)
+
+            self.assertEqual(data.shape, expected.shape)
+
+            self.assertTrue(numpy.array_equal(numpy.isnan(data), numpy.isnan(expected)))
+            self.assertTrue(numpy.allclose(data[~numpy.isnan(data)], expected[~numpy.isnan(expected)], rtol=1e-5))
+
+            level_wcs = mvWCS(fits.wcs)
+
+            scale = 2**level
+
+            for i, j in [(1, 1), (40, 17), (fits.naxis1, fits.naxis2)]:
+
+                ra,       dec       = wcs.pix2sky((i - 0.5) * scale + 0.5, (j - 0.5) * scale + 0.5)
+                level_ra, level_dec = level_wcs.pix2sky(i, j)
+
+                self.assertAlmostEqual(ra,  level_ra,  places=9)
+                self.assertAlmostEqual(dec, level_dec, places=9)
+
+            below = data
+
+
+  # The coarsest level no coarser than the output pixels (out of
+  # the ones built so far)
+
+    def test_choose(self):
+
+        self.assertEqual(self.pyramid.choose(10.), 0)
+
+        self.pyramid.build()
+
+        for factor, level in [(0.5, 0), (1., 0), (1.9, 0), (2., 1), (3.5, 1), (4., 2), (7.9, 2), (8., 3), (100., 3)]:
+            self.assertEqual(self.pyramid.choose(factor), level)
+
+        os.remove(self.pyramid.level_file(2))
+
+        self.assertEqual(self.pyramid.choose(4.), 1)
+        self.assertEqual(self.pyramid.choose(8.), 3)
+
+
+  # A level box covers the region it came from
+
+    def test_level_box(self):
+
+        self.assertEqual(self.pyramid.level_box(0, 10, 21, 300, 301), (11, 22, 301, 302))
+        self.assertEqual(self.pyramid.level_box(2, 10, 21, 300, 301), (3, 6, 76, 77))
+
+        state = numpy.random.RandomState(6)
+
+        for k in range(100):
+
+            level = state.randint(1, 4)
+            scale = 2**level
+
+            x0, x1 = sorted(state.randint(0, 1000, 2))
+            y0, y1 = sorted(state.randint(0, 700,  2))
+
+            xmin, ymin, xmax, ymax = self.pyramid.level_box(level, x0, y0, x1 + 1, y1 + 1)
+
+            self.assertLessEqual((xmin - 1) * scale, x0)
+            self.assertLessEqual((ymin - 1) * scale, y0)
+
+            self.assertGreaterEqual((xmax - 1) * scale, x1 + 1)
+            self.assertGreaterEqual((ymax - 1) * scale, y1 + 1)
+
+            self.assertGreater(xmin * scale, x0)
+            self.assertGreater(ymin * scale, y0)
+
+
+  # An interrupted build carries on from where it stopped; a changed
+  # file needs a new pyramid
+
+    def test_rebuild(self):
+
+        self.pyramid.build()
+
+        level2 = open(self.pyramid.level_file(2), 'rb').read()
+
+        os.remove(self.pyramid.level_file(2))
+        os.remove(self.pyramid.level_file(3))
+
+        self.pyramid.build_in_background()
+
+        self.pyramid.thread.join()
+
+        self.assertEqual(self.pyramid.error, "")
+
+        self.assertEqual(open(self.pyramid.level_file(2), 'rb').read(), level2)
+        self.assertEqual(self.pyramid.levels(), [0, 1, 2, 3])
+
+        self.assertTrue(self.pyramid.current())
+
+        info = os.stat(self.fits_file)
+
+        os.utime(self.fits_file, (info.st_atime, info.st_mtime + 10))
+
+        self.assertFalse(self.pyramid.current())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,148 @@
+#---------------------------------------------------------------------------------
+#  In-process pick statistics (mvFITS.region_stats)
+#---------------------------------------------------------------------------------
+
+import unittest
+
+import numpy
+
+import mvtest
+
+from agMontage.mViewer import mvFITS, mvWCS
+
+
+class RegionStatsTest(mvtest.TestCase):
+
+    def setUp(self):
+
+        mvtest.TestCase.setUp(self)
+
+        self.data = numpy.random.RandomState(7).normal(100., 10., (150, 200)).astype('f4')
+
+        self.data[40:45, 60:63] = numpy.nan
+
+        self.fits_file = mvtest.write_fits(self.path("image.fits"), self.data)
+
+        self.fits = mvFITS(self.fits_file)
+
+
+  # Every pixel within r of the center, checked one by one
+
+    def check(self, x, y, r):
+
+        retval = self.fits.region_stats(x, y, r)
+
+        ix = int(numpy.floor(x + 0.5))
+        iy = int(numpy.floor(y + 0.5))
+
+        values = []
+        nnull  = 0
+
+        for py in range(1, 151):
+            for px in range(1, 201):
+
+                if (px - ix)**2 + (py - iy)**2 > r * r:
+                    continue
+
+                value = float(self.data[py-1, px-1])
+
+                if numpy.isnan(value):
+                    nnull += 1
+                else:
+                    values.append((value, px, py))
+
+        self.assertEqual(retval.stat,   "OK")
+        self.assertEqual(retval.npixel, len(values))
+        self.assertEqual(retval.nnull,  nnull)
+        self.assertEqual(retval.radpix, r)
+
+        flux = numpy.array([entry[0] for entry in values])
+
+        self.assertAlmostEqual(retval.aveflux, flux.mean(), places=6)
+        self.assertAlmostEqual(retval.rmsflux, flux.std(),  places=6)
+
+        self.assertEqual((retval.fluxmin, retval.xmin, retval.ymin), min(values))
+        self.assertEqual((retval.fluxmax, retval.xmax, retval.ymax), max(values))
+
+        self.assertEqual((retval.xref, retval.yref), (ix, iy))
+
+        ref = self.data[iy-1, ix-1]
+
+        if numpy.isnan(ref):
+            self.assertEqual(retval.fluxref, 0.)
+        else:
+            self.assertEqual(retval.fluxref, float(ref))
+
+            if flux.std() > 0.:
+                self.assertAlmostEqual(retval.sigmaref, (ref - flux.mean()) / flux.std(), places=5)
+            else:
+                self.assertEqual(retval.sigmaref, 0.)
+
+        ra, dec = mvWCS(self.fits.wcs).pix2sky(retval.xmax, retval.ymax)
+
+        self.assertAlmostEqual(retval.ramax,  ra,  places=9)
+        self.assertAlmostEqual(retval.decmax, dec, places=9)
+
+        return retval
+
+
+  # In the middle, over nulls and off the edges
+
+    def test_stats(self):
+
+        self.check(100.2, 75.4, 10)
+        self.check(61.,   42.,  6)
+        self.check(100.,  75.,  0)
+        self.check(2.6,   148.5, 12)
+        self.check(199.,  1.,   30)
+
+
+  # The center itself null
+
+    def test_null_center(self):
+
+        retval = self.check(61.4, 41.6, 4)
+
+        self.assertEqual(retval.fluxref,  0.)
+        self.assertEqual(retval.sigmaref, 0.)
+
+
+  # All nulls: no statistics, and min/max at the center
+
+    def test_all_null(self):
+
+        retval = self.fits.region_stats(62., 42., 1)
+
+        self.assertEqual((retval.npixel, retval.nnull), (0, 5))
+        self.assertEqual((retval.aveflux, retval.rmsflux), (0., 0.))
+
+        self.assertEqual((retval.xmin, retval.ymin, retval.xmax, retval.ymax), (62, 42, 62, 42))
+
+
+  # The image geometry, as mExamine reports it
+
+    def test_geometry(self):
+
+        retval = self.fits.region_stats(100., 75., 5)
+
+        self.assertEqual((retval.naxis1, retval.naxis2), (200, 150))
+
+        self.assertAlmostEqual(retval.crval1, 180.)
+        self.assertAlmostEqual(retval.crval2, 30.)
+
+        self.assertAlmostEqual(retval.rac,  180., places=6)
+        self.assertAlmostEqual(retval.decc,  30., places=6)
+
+        self.assertAlmostEqual(retval.rotequ, 0., places=6)
+
+        self.assertAlmostEqual(retval.radius, 0.005)
+
+
+    def test_off_image(self):
+
+        with self.assertRaises(Exception):
+            self.fits.region_stats(250., 75., 5)
+
+
+if __name__ == "__main__":
+    unittest.main()
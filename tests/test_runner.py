@@ -0,0 +1,165 @@
+#---------------------------------------------------------------------------------
+#  Running the Montage programs (mvMontageRunner), with stand-ins for them
+#---------------------------------------------------------------------------------
+
+import os
+import threading
+import time
+import unittest
+
+import mvtest
+
+from agMontage.mViewer import mvMontageRunner
+
+
+# A stand-in mExamine: reports the image size, or (when asked for the
+# size of "bad.fits") complains on stderr
+
+MEXAMINE = """
+if sys.argv[-1] == 'bad.fits':
+    sys.stderr.write('mExamine: cannot open bad.fits')
+    sys.exit(1)
+
+print '[struct stat="OK", naxis1=800, naxis2=600]'
+"""
+
+
+# A stand-in mViewer that notes when it starts and stops (in the log
+# file it is given) and sleeps in between
+
+MVIEWER = """
+log = sys.argv[1]
+
+open(log, 'a').write('start %f\\n' % time.time())
+time.sleep(float(sys.argv[2]))
+open(log, 'a').write('end %f\\n' % time.time())
+
+print '[struct stat="OK"]'
+"""
+
+
+class RunnerTest(mvtest.TestCase):
+
+    def setUp(self):
+
+        mvtest.TestCase.setUp(self)
+
+        mvtest.stub_program(self.bin_dir, "mExamine", MEXAMINE)
+        mvtest.stub_program(self.bin_dir, "mViewer",  MVIEWER)
+
+
+  # The return structure comes back parsed
+
+    def test_call(self):
+
+        runner = mvMontageRunner(bin_dir=self.bin_dir)
+
+        retval = runner.call("mExamine good.fits")
+
+        self.assertEqual(retval.stat, "OK")
+        self.assertEqual(int(retval.naxis1), 800)
+        self.assertEqual(int(retval.naxis2), 600)
+
+        self.assertEqual(runner.stats()["mExamine"]["count"], 1)
+
+
+  # Anything on stderr is an error (with the message passed on)
+
+    def test_stderr(self):
+
+        runner = mvMontageRunner(bin_dir=self.bin_dir)
+
+        stdout, stderr = runner.run("mExamine bad.fits")
+
+        self.assertEqual(stdout, "")
+        self.assertEqual(stderr, "mExamine: cannot open bad.fits")
+
+        with self.assertRaises(Exception) as context:
+            runner.call("mExamine bad.fits")
+
+        self.assertIn("cannot open bad.fits", str(context.exception))
+
+
+  # No more than "workers" programs run at once
+
+    def test_workers(self):
+
+        log = self.path("log")
+
+        runner = mvMontageRunner(workers=2, bin_dir=self.bin_dir)
+
+        threads = [threading.Thread(target=runner.call, args=("mViewer " + log + " 0.3",)) for i in range(6)]
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        events = []
+
+        for line in open(log).read().splitlines():
+            event, at = line.split()
+            events.append((float(at), event))
+
+        running = 0
+        most    = 0
+
+        for at, event in sorted(events):
+
+            if event == "start":
+                running += 1
+            else:
+                running -= 1
+
+            most = max(most, running)
+
+        self.assertEqual(len(events), 12)
+        self.assertEqual(most, 2)
+
+        self.assertEqual(runner.stats()["mViewer"]["count"], 6)
+
+
+  # A program that runs too long is killed, and the caller gets
+  # an exception (not a hang)
+
+    def test_timeout(self):
+
+        log = self.path("log")
+
+        runner = mvMontageRunner(timeout=0.5, bin_dir=self.bin_dir)
+
+        processes = []
+
+        start = time.time()
+
+        with self.assertRaises(Exception) as context:
+            runner.run("mViewer " + log + " 30", started=processes.append)
+
+        self.assertLess(time.time() - start, 10.)
+
+        self.assertIn("timed out", str(context.exception))
+
+        self.assertIsNotNone(processes[0].poll())
+        self.assertNotIn("end", open(log).read())
+
+
+  # Without bin_dir, the programs are looked for on the PATH
+
+    def test_path(self):
+
+        path = os.environ["PATH"]
+
+        os.environ["PATH"] = self.bin_dir + os.pathsep + path
+
+        try:
+            retval = mvMontageRunner().call("mExamine good.fits")
+
+        finally:
+            os.environ["PATH"] = path
+
+        self.assertEqual(retval.stat, "OK")
+
+
+if __name__ == "__main__":
+    unittest.main()
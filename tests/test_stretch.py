@@ -0,0 +1,74 @@
+#---------------------------------------------------------------------------------
+#  Stretch limits (mvStretch, mvSketch)
+#---------------------------------------------------------------------------------
+
+import unittest
+
+import numpy
+
+import mvtest
+
+from agMontage.mViewer import mvStretch
+
+
+class StretchTest(mvtest.TestCase):
+
+  # An image too big to sample every pixel of, with its extremes
+  # where the sample won't see them
+
+    def setUp(self):
+
+        mvtest.TestCase.setUp(self)
+
+        self.data = numpy.random.RandomState(2).normal(100., 10., (1500, 1600)).astype('f4')
+
+        self.data[1, 1]       = -500.
+        self.data[1001, 1303] = 2500.
+        self.data[7, 9]       = numpy.nan
+
+        self.fits_file = mvtest.write_fits(self.path("image.fits"), self.data)
+
+
+    def test_extremes(self):
+
+        stretch = mvStretch(self.fits_file)
+
+        self.assertEqual(stretch.resolve("min"), -500.)
+        self.assertEqual(stretch.resolve("max"), 2500.)
+
+        self.assertEqual(stretch.data_min, -500.)
+        self.assertEqual(stretch.data_max, 2500.)
+
+
+  # The distribution is still the sample's
+
+    def test_distribution(self):
+
+        stretch = mvStretch(self.fits_file)
+
+        valid = self.data[numpy.isfinite(self.data)]
+
+        self.assertAlmostEqual(stretch.resolve("50%"),  numpy.median(valid), delta=0.2)
+        self.assertAlmostEqual(stretch.resolve("-1s"),  90., delta=0.5)
+
+        self.assertAlmostEqual(stretch.sketch.percent_at(100.), 50., delta=0.5)
+
+
+  # Scaled integer data: the extremes are physical values
+
+    def test_scaled(self):
+
+        raw = numpy.arange(1500 * 1600, dtype='int32').reshape(1500, 1600) % 1000
+
+        raw[1, 1] = -32000
+
+        fits_file = mvtest.write_fits(self.path("scaled.fits"), raw, bscale=0.5, bzero=10.)
+
+        stretch = mvStretch(fits_file)
+
+        self.assertEqual(stretch.resolve("min"), -32000 * 0.5 + 10.)
+        self.assertEqual(stretch.resolve("max"), 999 * 0.5 + 10.)
+
+
+if __name__ == "__main__":
+    unittest.main()
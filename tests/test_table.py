@@ -0,0 +1,182 @@
+#---------------------------------------------------------------------------------
+#  Columnar binary copy of an IPAC table (mvTable)
+#---------------------------------------------------------------------------------
+
+import os
+import unittest
+
+import numpy
+
+import mvtest
+
+from agMontage.mViewer import mvTable
+
+
+class TableTest(mvtest.TestCase):
+
+  # A fixed-width table, with nulls in one stretch of it
+
+    def setUp(self):
+
+        mvtest.TestCase.setUp(self)
+
+        state = numpy.random.RandomState(15)
+
+        self.ra   = list(state.uniform(0., 360., 500))
+        self.dec  = list(state.uniform(-90., 90., 500))
+        self.mag  = list(state.uniform(5., 20., 500))
+        self.name = ["src" + str(k) for k in range(500)]
+
+        for k in [3, 250, 251, 499]:
+            self.mag[k] = None
+
+        self.table_file = mvtest.write_table(self.path("table.tbl"), [('RA',   'double', self.ra),
+                                                                        ('Dec',  'double', self.dec),
+                                                                        ('mag',  'double', self.mag),
+                                                                        ('name', 'char',   self.name)])
+
+
+  # What each field should parse to
+
+    def expected(self, values):
+
+        return numpy.array([numpy.nan if value is None else float("%.8f" % value) for value in values])
+
+
+    def check_columns(self, table):
+
+        self.assertEqual(table.names, ['ra', 'dec', 'mag', 'name'])
+        self.assertEqual(table.types, ['double', 'double', 'double', 'char'])
+
+        for name, values in [('ra', self.ra), ('DEC', self.dec), ('mag', self.mag)]:
+
+            column = table.column(name)
+
+            self.assertEqual(column.dtype, numpy.float64)
+
+            self.assertTrue(numpy.array_equal(numpy.isnan(column), numpy.isnan(self.expected(values))))
+            self.assertTrue(numpy.allclose(column, self.expected(values), rtol=0., atol=1e-12, equal_nan=True))
+
+
+  # Read in one go, and in blocks so small that lines are split
+  # between them (and some blocks have nulls and some don't)
+
+    def test_columns(self):
+
+        self.check_columns(mvTable(self.table_file, self.path("cache")))
+
+        for block_size in [97, 1000, 4096]:
+
+            table = mvTable(self.table_file, self.path("cache" + str(block_size)))
+
+            table.block_size = block_size
+
+            self.check_columns(table)
+
+
+  # Lines of different lengths (not fixed width), blank lines and
+  # a missing final newline
+
+    def test_ragged(self):
+
+        lines = ["\\fixlen = F",
+                 "\\comment = 'not really'",
+                 "|   x   |   y    |",
+                 "|double |double  |",
+                 "   1.5     2.5 ",
+                 " 3       4.25",
+                 "",
+                 "  -5e3   null  ",
+                 "   7    8 ",
+                 "   9.0   1e-2"]
+
+        fp = open(self.path("ragged.tbl"), 'w')
+        fp.write("\n".join(lines))
+        fp.close()
+
+        for block_size in [7, 4096]:
+
+            table = mvTable(self.path("ragged.tbl"), self.path("cache" + str(block_size)))
+
+            table.block_size = block_size
+
+            self.assertEqual(table.header, len("\n".join(lines[0:4])) + 1)
+
+            x = table.column('x')
+            y = table.column('y')
+
+            self.assertTrue(numpy.array_equal(x, [1.5, 3., -5000., 7., 9.]))
+            self.assertTrue(numpy.allclose(y, [2.5, 4.25, numpy.nan, 8., 0.01], equal_nan=True))
+
+            self.assertEqual(table.lines([1, 2, 4]), [" 3       4.25\n", "  -5e3   null  \n", "   9.0   1e-2"])
+
+
+  # The original lines of any rows, and fields from them
+
+    def test_lines(self):
+
+        table = mvTable(self.table_file, self.path("cache"))
+
+        text = open(self.table_file).read()
+
+        self.assertEqual(table.header_text(), text[0:table.header])
+
+        rows = [0, 3, 250, 499]
+
+        lines = table.lines(rows)
+
+        body = text[table.header:].splitlines(True)
+
+        self.assertEqual(lines, [body[row] for row in rows])
+
+        self.assertEqual([table.field(line, 'NAME') for line in lines], ['src0', 'src3', 'src250', 'src499'])
+        self.assertEqual([table.field(line, 'mag')  for line in lines][1:3], ['null', 'null'])
+
+
+  # The arrays are kept (and memory-mapped) between uses, and
+  # dropped when the table changes
+
+    def test_cache(self):
+
+        table = mvTable(self.table_file, self.path("cache"))
+
+        self.assertFalse(table.has('ra'))
+
+        table.build(['ra', 'dec'])
+
+        self.assertTrue(table.has('ra'))
+        self.assertFalse(table.has('mag'))
+
+        self.assertEqual(sorted(os.listdir(table.directory)), ['table_dec.npy', 'table_offsets.npy', 'table_ra.npy'])
+
+        again = mvTable(self.table_file, self.path("cache"))
+
+        self.assertEqual(again.directory, table.directory)
+        self.assertIsInstance(again.column('ra'), numpy.memmap)
+
+        info = os.stat(self.table_file)
+
+        os.utime(self.table_file, (info.st_atime, info.st_mtime + 10))
+
+        self.assertFalse(table.current())
+
+        self.assertNotEqual(mvTable(self.table_file, self.path("cache")).directory, table.directory)
+
+
+    def test_errors(self):
+
+        table = mvTable(self.table_file, self.path("cache"))
+
+        with self.assertRaises(Exception):
+            table.column('flux')
+
+        fp = open(self.path("empty.tbl"), 'w')
+        fp.write("\\fixlen = T\n")
+        fp.close()
+
+        with self.assertRaises(Exception):
+            mvTable(self.path("empty.tbl"), self.path("cache"))
+
+
+if __name__ == "__main__":
+    unittest.main()